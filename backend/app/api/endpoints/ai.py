@@ -6,6 +6,7 @@ from app.schemas.response import ApiResponse
 from app.services import prompt_service, agent_service, llm_config_service, history_service
 from fastapi.responses import StreamingResponse
 import json
+from contextlib import aclosing
 from fastapi import Body
 from pydantic import ValidationError, create_model
 from pydantic import Field as PydanticField
@@ -23,6 +24,8 @@ from app.schemas import entity as entity_schemas
 from app.services.workflow_triggers import trigger_on_generate_finish
 from app.services.context_service import assemble_context, ContextAssembleParams
 from app.services import llm_config_service as _llm_svc
+from app.services import stream_pipeline
+from app.services.stream_pipeline import TextRope
 from loguru import logger
 
 router = APIRouter()
@@ -359,7 +362,7 @@ def get_content_models(session: Session = Depends(get_session)):
 
 async def stream_wrapper(generator):
     async for item in generator:
-        yield f"data: {json.dumps({'content': item})}\n\n"
+        yield f"data: {json.dumps({'content': item}, ensure_ascii=False)}\n\n"
 
 @router.get("/config-options", summary="获取AI生成配置选项")
 async def get_ai_config_options(session: Session = Depends(get_session)):
@@ -492,18 +495,22 @@ async def generate_continuation(
         system_prompt = _inject_knowledge(session, str(p.template))
 
         if request.stream:
-            # 先做一次配额预检，避免流式过程中才抛错
-            ok, reason = _llm_svc.can_consume(session, request.llm_config_id, 0, 0, 1)
+            # 先做一次配额预检，避免流式过程中才抛错（故障转移组由各配置在尝试时自行预检）
+            ok, reason = (True, "") if request.llm_failover_group else _llm_svc.can_consume(session, request.llm_config_id, 0, 0, 1)
             if not ok:
                 raise HTTPException(status_code=400, detail=f"LLM 配额不足：{reason}")
             async def _stream_and_trigger():
-                content_acc = []
-                async for chunk in agent_service.generate_continuation_streaming(session, request, system_prompt):
-                    content_acc.append(chunk)
-                    yield chunk
+                # 模型增量按时间窗口/字符数合帧后再推给客户端；全文只在 rope 中累加一份
+                rope = TextRope()
+                frames = stream_pipeline.coalesce(
+                    agent_service.generate_continuation_streaming(session, request, system_prompt, rope=rope)
+                )
+                async with aclosing(frames):
+                    async for frame in frames:
+                        yield frame
                 
                 # 保存到历史记录
-                full_content = "".join(content_acc)
+                full_content = rope.text()
                 if full_content and request.project_id:
                     try:
                         history_service.save_history(
@@ -13,7 +13,7 @@ from app.db.models import Card, CardType, LLMConfig
 from loguru import logger
 
 from app.schemas.card import CardCopyOrMoveRequest
-from app.services.workflow_triggers import trigger_on_card_save
+from app.services.workflow_triggers import invalidate_trigger_index, trigger_on_card_save
 from fastapi import Response
 from app.services import history_service
 from app.services.card_package_service import CardPackageService
@@ -66,7 +66,10 @@ def _compose_schema_with_types(schema: dict, db: Session) -> dict:
 @router.post("/card-types", response_model=CardTypeRead)
 def create_card_type(card_type: CardTypeCreate, db: Session = Depends(get_session)):
     service = CardTypeService(db)
-    return service.create(card_type)
+    created = service.create(card_type)
+    # 触发器按类型名匹配，索引中缓存了 类型ID -> 名称
+    invalidate_trigger_index()
+    return created
 
 @router.get("/card-types", response_model=List[CardTypeRead])
 def get_all_card_types(db: Session = Depends(get_session)):
@@ -87,6 +90,7 @@ def update_card_type(card_type_id: int, card_type: CardTypeUpdate, db: Session =
     db_card_type = service.update(card_type_id, card_type)
     if db_card_type is None:
         raise HTTPException(status_code=404, detail="CardType not found")
+    invalidate_trigger_index()
     return db_card_type
 
 @router.delete("/card-types/{card_type_id}", status_code=204)
@@ -99,6 +103,7 @@ def delete_card_type(card_type_id: int, db: Session = Depends(get_session)):
         raise HTTPException(status_code=400, detail="系统内置卡片类型不可删除")
     if not service.delete(card_type_id):
         raise HTTPException(status_code=404, detail="CardType not found")
+    invalidate_trigger_index()
     return {"ok": True}
 
 # --- CardType Schema Endpoints ---
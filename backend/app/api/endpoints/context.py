@@ -3,13 +3,15 @@ from typing import Any
 from sqlmodel import Session
 
 from app.db.session import get_session
-from app.services.context_service import assemble_context, ContextAssembleParams
+from app.services.context_service import assemble_context_async, ContextAssembleParams
+from app.services import context_cache
 from app.schemas.context import AssembleContextRequest, AssembleContextResponse
+from app.schemas.response import ApiResponse
 
 router = APIRouter()
 
 @router.post("/assemble", response_model=AssembleContextResponse, summary="装配写作上下文（事实子图）")
-def assemble(req: AssembleContextRequest, session: Session = Depends(get_session)):
+async def assemble(req: AssembleContextRequest, session: Session = Depends(get_session)):
     params = ContextAssembleParams(
         project_id=req.project_id,
         volume_number=req.volume_number,
@@ -17,6 +19,14 @@ def assemble(req: AssembleContextRequest, session: Session = Depends(get_session
         chapter_id=req.chapter_id,
         participants=req.participants,
         current_draft_tail=req.current_draft_tail,
+        llm_config_id=req.llm_config_id,
+        token_budget=req.token_budget,
     )
-    ctx = assemble_context(session, params)
+    # 图谱、写作指南、向量检索并发查询，各自限时降级；耗时见 budget_stats.sources
+    ctx = await assemble_context_async(session, params)
     return AssembleContextResponse(**ctx.__dict__)
+
+
+@router.get("/cache/stats", response_model=ApiResponse, summary="写作上下文缓存统计（命中/未命中/失效、各项目数据版本）")
+def get_context_cache_stats():
+    return ApiResponse(data=context_cache.cache_stats())
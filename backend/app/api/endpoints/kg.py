@@ -1,5 +1,5 @@
-from fastapi import APIRouter, HTTPException
-from typing import Any, Dict
+from fastapi import APIRouter, HTTPException, Query
+from typing import Any, Dict, List, Optional
 
 from app.services.kg_provider import get_provider
 from app.schemas.response import ApiResponse
@@ -18,3 +18,29 @@ def get_project_graph(project_id: int, pov_character: str = None):
         return ApiResponse(data=graph)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"获取图谱失败: {str(e)}")
+
+
+@router.get("/project/{project_id}/subgraph/profile", response_model=ApiResponse[Dict[str, Any]], summary="以 PROFILE 执行子图查询，返回执行计划")
+def profile_project_subgraph(
+    project_id: int,
+    participants: List[str] = Query(default=[]),
+    radius: int = 2,
+    top_k: int = 50,
+    edge_types: Optional[List[str]] = Query(default=None),
+    max_chapter_id: Optional[int] = None,
+    pov_character: Optional[str] = None,
+):
+    try:
+        provider = get_provider()
+        plan = provider.profile_subgraph(
+            project_id,
+            participants=participants,
+            radius=radius,
+            edge_type_whitelist=edge_types,
+            top_k=top_k,
+            max_chapter_id=max_chapter_id,
+            pov_character=pov_character,
+        )
+        return ApiResponse(data=plan)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"子图查询分析失败: {str(e)}")
@@ -2,10 +2,16 @@
 from fastapi import APIRouter, Depends, HTTPException
 from sqlmodel import Session
 from app.db.session import get_session
-from app.schemas.llm_config import LLMConfigCreate, LLMConfigRead, LLMConfigUpdate, LLMConnectionTest
+from app.schemas.llm_config import (
+    LLMConfigCreate, LLMConfigRead, LLMConfigUpdate, LLMConnectionTest,
+    LLMFailoverGroupCreate, LLMFailoverGroupRead, LLMFailoverGroupUpdate,
+)
 from app.schemas.response import ApiResponse
-from app.services import llm_config_service
-from typing import List
+from app.services import llm_config_service, llm_failover, llm_response_cache, llm_retry, token_counter
+from app.services.llm_model_pool import chat_model_pool
+from app.services.llm_scheduler import llm_scheduler
+from app.services.llm_usage_ledger import usage_ledger
+from typing import List, Optional
 
 router = APIRouter()
 
@@ -19,7 +25,68 @@ def create_llm_config_endpoint(config_in: LLMConfigCreate, session: Session = De
 @router.get("/", response_model=ApiResponse[List[LLMConfigRead]])
 def get_llm_configs_endpoint(session: Session = Depends(get_session)):
     configs = llm_config_service.get_llm_configs(session=session)
-    return ApiResponse(data=configs)
+    return ApiResponse(data=[llm_config_service.with_pending_usage(c) for c in configs])
+
+@router.get("/scheduler/metrics", response_model=ApiResponse, summary="LLM 调度器指标（队列深度、等待时间、剩余额度）")
+def get_llm_scheduler_metrics():
+    return ApiResponse(data=llm_scheduler.metrics())
+
+@router.get("/usage-ledger/stats", response_model=ApiResponse, summary="LLM 用量账本（未回写增量、进行中预留、回写次数）")
+def get_usage_ledger_stats():
+    return ApiResponse(data=usage_ledger.stats())
+
+@router.get("/retry/metrics", response_model=ApiResponse, summary="结构化调用重试统计（按错误类别、退避等待时间）")
+def get_llm_retry_metrics():
+    return ApiResponse(data=llm_retry.retry_metrics())
+
+@router.get("/token-estimators", response_model=ApiResponse, summary="Token 估算器（各提供商家族的分词器与按实际用量的校准）与计数缓存统计")
+def get_token_estimators():
+    return ApiResponse(data=token_counter.token_stats())
+
+@router.get("/model-pool/stats", response_model=ApiResponse, summary="ChatModel 实例池统计")
+def get_llm_model_pool_stats():
+    return ApiResponse(data=chat_model_pool.stats())
+
+@router.get("/response-cache/stats", response_model=ApiResponse, summary="结构化调用响应缓存统计（命中/未命中/跳过/节省 token）")
+def get_llm_response_cache_stats():
+    return ApiResponse(data=llm_response_cache.stats.to_dict())
+
+@router.delete("/response-cache", response_model=ApiResponse, summary="清空响应缓存（可按配置）")
+def clear_llm_response_cache(config_id: Optional[int] = None, session: Session = Depends(get_session)):
+    removed = llm_response_cache.clear(session, config_id)
+    return ApiResponse(data={"removed": removed})
+
+@router.get("/failover-groups", response_model=ApiResponse[List[LLMFailoverGroupRead]], summary="LLM 故障转移组列表")
+def get_failover_groups(session: Session = Depends(get_session)):
+    return ApiResponse(data=llm_failover.get_groups(session))
+
+@router.get("/failover-groups/metrics", response_model=ApiResponse, summary="故障转移组统计（对冲、切换、首 token 延迟、各配置胜出次数）")
+def get_failover_metrics():
+    return ApiResponse(data=llm_failover.failover_metrics())
+
+@router.post("/failover-groups", response_model=ApiResponse[LLMFailoverGroupRead], summary="创建 LLM 故障转移组")
+def create_failover_group(group_in: LLMFailoverGroupCreate, session: Session = Depends(get_session)):
+    try:
+        group = llm_failover.create_group(session, group_in)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return ApiResponse(data=group)
+
+@router.put("/failover-groups/{group_id}", response_model=ApiResponse[LLMFailoverGroupRead], summary="更新 LLM 故障转移组")
+def update_failover_group(group_id: int, group_in: LLMFailoverGroupUpdate, session: Session = Depends(get_session)):
+    try:
+        group = llm_failover.update_group(session, group_id, group_in)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if not group:
+        raise HTTPException(status_code=404, detail="Failover group not found")
+    return ApiResponse(data=group)
+
+@router.delete("/failover-groups/{group_id}", response_model=ApiResponse, summary="删除 LLM 故障转移组")
+def delete_failover_group(group_id: int, session: Session = Depends(get_session)):
+    if not llm_failover.delete_group(session, group_id):
+        raise HTTPException(status_code=404, detail="Failover group not found")
+    return ApiResponse(message="Failover group deleted successfully")
 
 @router.put("/{config_id}", response_model=ApiResponse[LLMConfigRead])
 def update_llm_config_endpoint(config_id: int, config_in: LLMConfigUpdate, session: Session = Depends(get_session)):
@@ -33,6 +100,7 @@ def delete_llm_config_endpoint(config_id: int, session: Session = Depends(get_se
     success = llm_config_service.delete_llm_config(session=session, config_id=config_id)
     if not success:
         raise HTTPException(status_code=404, detail="LLM Config not found")
+    llm_scheduler.forget(config_id)
     return ApiResponse(message="LLM Config deleted successfully")
 
 @router.post("/test", response_model=ApiResponse, summary="测试 LLM 连接")
@@ -42,7 +110,12 @@ async def test_llm_connection_endpoint(connection_data: LLMConnectionTest, sessi
         provider = (connection_data.provider or "").lower()
 
         # 延迟导入以避免在未使用时增加启动开销
-        if provider == "openai_compatible":
+        if provider == "fake":
+            from app.services.llm_fake import create_fake_chat_model
+
+            model = create_fake_chat_model(connection_data.model_name, connection_data.api_base)
+
+        elif provider == "openai_compatible":
             from langchain_qwq import ChatQwen
             #原生的ChatOpenAI虽然能够支持OpenAI兼容的各种模型，但是似乎对推理模式支持不够好模式
             kwargs: dict = {
@@ -112,7 +185,7 @@ async def test_llm_connection_endpoint(connection_data: LLMConnectionTest, sessi
             model = ChatOpenAI(**kwargs)
 
         else:
-            raise HTTPException(status_code=400, detail=f"不支持的提供商类型: {connection_data.provider}。支持的类型: openai, openai_compatible, anthropic, zhipu_anthropic, google, deepseek, moonshot, qwen, minimax, zhipu, baichuan")
+            raise HTTPException(status_code=400, detail=f"不支持的提供商类型: {connection_data.provider}。支持的类型: openai, openai_compatible, anthropic, zhipu_anthropic, google, deepseek, moonshot, qwen, minimax, zhipu, baichuan, fake")
 
         # 发送一次最小请求以验证连通性
         await model.ainvoke("ping")
@@ -1,5 +1,6 @@
-from typing import List
-from fastapi import APIRouter, Depends, HTTPException
+from datetime import datetime
+from typing import List, Optional
+from fastapi import APIRouter, Depends, Header, HTTPException
 from fastapi.responses import StreamingResponse
 from sqlmodel import Session, select
 
@@ -17,6 +18,11 @@ from app.schemas.workflow import (
     WorkflowTriggerRead,
 )
 from app.services.workflow_engine import engine as wf_engine
+from app.services.workflow_events import event_bus
+from app.services.workflow_trace import run_trace, summarize_by_node_type
+from app.services.workflow_plan import canonicalize
+from app.services.workflow_queue import run_queue
+from app.services.workflow_triggers import invalidate_trigger_index, trigger_metrics
 from app.services.nodes import get_node_types
 
 
@@ -72,12 +78,18 @@ def list_triggers(session: Session = Depends(get_session)):
     items = session.exec(select(WorkflowTrigger)).all()
     return items
 
+@router.get("/workflow-triggers/metrics")
+def get_trigger_metrics():
+    """触发合并统计：按事件类型返回收到的事件数、合并数、实际执行数等"""
+    return trigger_metrics()
+
 @router.post("/workflow-triggers", response_model=WorkflowTriggerRead)
 def create_trigger(payload: WorkflowTriggerCreate, session: Session = Depends(get_session)):
     t = WorkflowTrigger(**payload.model_dump())
     session.add(t)
     session.commit()
     session.refresh(t)
+    invalidate_trigger_index()
     return t
 
 @router.put("/workflow-triggers/{trigger_id}", response_model=WorkflowTriggerRead)
@@ -90,6 +102,7 @@ def update_trigger(trigger_id: int, payload: WorkflowTriggerUpdate, session: Ses
     session.add(t)
     session.commit()
     session.refresh(t)
+    invalidate_trigger_index()
     return t
 
 @router.delete("/workflow-triggers/{trigger_id}")
@@ -99,6 +112,7 @@ def delete_trigger(trigger_id: int, session: Session = Depends(get_session)):
         raise HTTPException(status_code=404, detail="Trigger not found")
     session.delete(t)
     session.commit()
+    invalidate_trigger_index()
     return {"ok": True}
 
 
@@ -108,6 +122,7 @@ def create_workflow(payload: WorkflowCreate, session: Session = Depends(get_sess
     session.add(wf)
     session.commit()
     session.refresh(wf)
+    invalidate_trigger_index()
     return wf
 
 
@@ -124,11 +139,18 @@ def update_workflow(workflow_id: int, payload: WorkflowUpdate, session: Session
     wf = session.get(Workflow, workflow_id)
     if not wf:
         raise HTTPException(status_code=404, detail="Workflow not found")
-    for k, v in payload.model_dump(exclude_unset=True).items():
+    data = payload.model_dump(exclude_unset=True)
+    definition_changed = "definition_json" in data and data["definition_json"] != wf.definition_json
+    for k, v in data.items():
         setattr(wf, k, v)
+    # 定义变更时递增版本：执行计划缓存与运行检查点均以版本区分
+    if definition_changed and "version" not in data:
+        wf.version = (wf.version or 1) + 1
     session.add(wf)
     session.commit()
     session.refresh(wf)
+    wf_engine.invalidate_plan(workflow_id)
+    invalidate_trigger_index()
     return wf
 
 
@@ -139,6 +161,8 @@ def delete_workflow(workflow_id: int, session: Session = Depends(get_session)):
         raise HTTPException(status_code=404, detail="Workflow not found")
     session.delete(wf)
     session.commit()
+    wf_engine.invalidate_plan(workflow_id)
+    invalidate_trigger_index()
     return {"ok": True}
 
 
@@ -161,6 +185,39 @@ def get_run(run_id: int, session: Session = Depends(get_session)):
     return run
 
 
+@router.get("/workflows/runs/{run_id}/trace")
+def get_run_trace(run_id: int, session: Session = Depends(get_session)):
+    """运行轨迹：各节点耗时、排队等待、LLM 调用与 token、写入的 state 键"""
+    run = session.get(WorkflowRun, run_id)
+    if not run:
+        raise HTTPException(status_code=404, detail="Run not found")
+    return run_trace(session, run)
+
+
+@router.get("/workflow-traces/by-node-type")
+def get_trace_summary(
+    workflow_id: Optional[int] = None,
+    since: Optional[datetime] = None,
+    include_body: bool = True,
+    session: Session = Depends(get_session),
+):
+    """按节点类型聚合运行轨迹（按总耗时降序），可按工作流与起始时间过滤"""
+    return summarize_by_node_type(session, workflow_id=workflow_id, since=since, include_body=include_body)
+
+
+@router.post("/workflows/runs/{run_id}/retry", response_model=WorkflowRunRead)
+def retry_run(run_id: int, session: Session = Depends(get_session)):
+    """从检查点续跑失败/取消的运行：已完成的节点不再执行，从首个未完成节点开始"""
+    run = session.get(WorkflowRun, run_id)
+    if not run:
+        raise HTTPException(status_code=404, detail="Run not found")
+    if run.status not in ("failed", "cancelled"):
+        raise HTTPException(status_code=409, detail=f"Run is {run.status}, only failed or cancelled runs can be resumed")
+    wf_engine.resume_failed(session, run)
+    session.refresh(run)
+    return run
+
+
 @router.post("/workflows/{workflow_id}/validate")
 def validate_workflow(workflow_id: int, session: Session = Depends(get_session)):
     wf = session.get(Workflow, workflow_id)
@@ -169,11 +226,14 @@ def validate_workflow(workflow_id: int, session: Session = Depends(get_session))
     dsl = wf.definition_json or {}
     raw_nodes = list((dsl.get("nodes") or []))
 
+    # 0) 编译执行计划（与运行时共用缓存），下方的自动修复不影响计划
+    plan, plan_errors = wf_engine.compile_report(wf)
+
     # 从节点注册表自动获取允许的节点类型
     allowed_types = set(get_node_types())
 
     # 1) 规范化：补全/唯一化 id；将缺失 body 的 ForEach 折叠后一节点
-    canonical = wf_engine._canonicalize(raw_nodes)  # type: ignore[attr-defined]
+    canonical = canonicalize(raw_nodes)
 
     # 为主线节点与 body 节点补全稳定 id；同时检查重复 id
     used_ids = set()
@@ -246,19 +306,58 @@ def validate_workflow(workflow_id: int, session: Session = Depends(get_session))
         "warnings": warnings,
         "auto_fixes": auto_fixes,
         "fixed_dsl": fixed_dsl,
+        "plan": plan.describe(),
+        "plan_errors": plan_errors,
     }
 
 
 @router.post("/workflows/runs/{run_id}/cancel", response_model=CancelResponse)
-def cancel_run(run_id: int):
+async def cancel_run(run_id: int):
     ok = wf_engine.cancel(run_id)
+    if not ok and run_queue.cancel_queued(run_id):
+        # 排队中的运行没有执行任务，由这里结束其事件流
+        event_bus.publish(run_id, "event: run_cancelled\ndata: cancelled\n\n")
+        event_bus.close(run_id)
+        ok = True
     return CancelResponse(ok=ok, message="cancelled" if ok else "not running")
 
 
+_FINAL_EVENTS = {
+    "completed": "event: run_completed\ndata: success\n\n",
+    "failed": "event: run_failed\ndata: {error}\n\n",
+    "cancelled": "event: run_cancelled\ndata: cancelled\n\n",
+}
+
+
 @router.get("/workflows/runs/{run_id}/events")
-async def stream_events(run_id: int):
+async def stream_events(
+    run_id: int,
+    last_event_id: Optional[int] = None,
+    last_event_id_header: Optional[str] = Header(None, alias="Last-Event-ID"),
+    session: Session = Depends(get_session),
+):
+    """
+    运行事件流（SSE）：每条事件带 id，可多个标签页同时订阅
+    断线重连时浏览器自动携带 Last-Event-ID 头（也可用 ?last_event_id=），从其后继续回放
+    """
+    run = session.get(WorkflowRun, run_id)
+    if not run:
+        raise HTTPException(status_code=404, detail="Run not found")
+    if last_event_id is None and last_event_id_header and last_event_id_header.isdigit():
+        last_event_id = int(last_event_id_header)
+    final = _FINAL_EVENTS.get(run.status)
+    if final and not event_bus.has(run_id):
+        # 事件缓冲已过期回收：直接以运行的最终状态结束
+        error = (run.error_json or {}).get("error", "")
+        session.close()
+
+        async def final_publisher():
+            yield final.format(error=error)
+        return StreamingResponse(final_publisher(), media_type="text/event-stream")
+    session.close()
+
     async def event_publisher():
-        async for evt in wf_engine.subscribe_events(run_id):
+        async for evt in wf_engine.subscribe_events(run_id, last_event_id):
             yield evt
 
     return StreamingResponse(event_publisher(), media_type="text/event-stream")
@@ -1,6 +1,6 @@
 import os
 from pathlib import Path
-from typing import Optional
+from typing import Dict, Optional
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 class Settings(BaseSettings):
@@ -15,14 +15,69 @@ class Settings(BaseSettings):
     # AI Model Settings
     OPENAI_API_KEY: Optional[str] = None
     OPENAI_API_BASE: Optional[str] = "https://api.openai.com/v1"
+    # 复用的 ChatModel 实例上限（按配置与采样参数区分）
+    LLM_MODEL_POOL_SIZE: int = 32
+    # 结构化调用的响应缓存：默认只缓存 temperature<=0 的调用（调用方可强制开启），条目有效期与总大小上限
+    LLM_RESPONSE_CACHE_ENABLED: bool = True
+    LLM_RESPONSE_CACHE_TTL_SEC: int = 3 * 24 * 3600
+    LLM_RESPONSE_CACHE_MAX_BYTES: int = 32 * 1024 * 1024
+    # 结构化调用失败重试：指数退避基础间隔/上限（全抖动），服务端 Retry-After 的最长遵从时间
+    LLM_RETRY_BASE_DELAY_SEC: float = 1.0
+    LLM_RETRY_MAX_DELAY_SEC: float = 30.0
+    LLM_RETRY_MAX_RETRY_AFTER_SEC: float = 60.0
+    # 离线分词器目录：<family>.json（HuggingFace tokenizers 格式，family 为 openai/anthropic/google）
+    LLM_TOKENIZER_DIR: Optional[str] = None
+    # LLM 用量账本回写间隔：进程崩溃时最多丢失该时间内的用量统计
+    LLM_USAGE_FLUSH_INTERVAL_SEC: float = 2.0
+    # 流式续写合帧：首个增量后最多等待的毫秒数（0 表示只在客户端消费慢时合并）与单帧字符上限
+    STREAM_COALESCE_WINDOW_MS: float = 40.0
+    STREAM_COALESCE_MAX_CHARS: int = 1024
+    # 客户端消费慢时服务端最多缓冲的字符数，超过后暂停读取模型流
+    STREAM_BACKPRESSURE_HIGH_WATER_CHARS: int = 32768
+    # 写作上下文缓存：条目上限与兜底 TTL（项目数据变化时按版本立即失效，TTL 只针对外部直接修改图谱/向量库）
+    CONTEXT_CACHE_MAX_ENTRIES: int = 256
+    CONTEXT_CACHE_TTL_SEC: int = 1800
+    # 异步上下文装配中单个来源（图谱/写作指南/向量检索）的超时，超时后降级
+    CONTEXT_SOURCE_TIMEOUT_SEC: float = 3.0
+    # 上下文打包预算：目标模型上下文窗口 × 比例，并封顶；未指定 LLM 配置时使用默认预算
+    CONTEXT_BUDGET_RATIO: float = 0.1
+    CONTEXT_BUDGET_MAX_TOKENS: int = 8000
+    CONTEXT_DEFAULT_BUDGET_TOKENS: int = 3000
+    # 无法按模型名推断上下文窗口时的默认值；LLM_CONTEXT_WINDOWS 可按模型名前缀覆盖，如 {"my-model": 32768}
+    CONTEXT_DEFAULT_WINDOW_TOKENS: int = 32768
+    LLM_CONTEXT_WINDOWS: Dict[str, int] = {}
     
     # Neo4j Settings
     NEO4J_URI: str = "bolt://localhost:7687"
     NEO4J_USER: str = "neo4j"
     NEO4J_PASSWORD: str = "neo4j"
+    # 子图查询变长扩展的最大跳数（上下文装配的 radius 超过时截断）
+    KG_MAX_RADIUS: int = 3
     
     # Project Settings
     RESERVED_PROJECT_ID: int = 1
+
+    # Workflow Settings
+    # 标准格式工作流中可同时执行的就绪节点数（可被 run.params_json.max_concurrency 覆盖）
+    WORKFLOW_MAX_CONCURRENCY: int = 4
+    # 持久化运行队列：worker 数、空闲轮询间隔、相邻两次领取的最小间隔（削峰）
+    WORKFLOW_QUEUE_WORKERS: int = 2
+    WORKFLOW_QUEUE_POLL_INTERVAL_SEC: float = 2.0
+    WORKFLOW_QUEUE_DISPATCH_INTERVAL_MS: int = 200
+    # 运行租约：心跳间隔、租约时长（过期视为 worker 已失联，运行重新入队）、最大尝试次数
+    WORKFLOW_RUN_HEARTBEAT_SEC: float = 15.0
+    WORKFLOW_RUN_LEASE_SEC: float = 60.0
+    WORKFLOW_RUN_MAX_ATTEMPTS: int = 3
+    # 触发合并窗口：同一 (工作流, 卡片) 在窗口内的多次保存合并为一次排队运行，窗口随最后一次保存顺延，
+    # 但自首次保存起最多顺延 MAX_WAIT（持续自动保存时运行不会被无限推迟）；只对卡片保存事件生效
+    WORKFLOW_TRIGGER_COALESCE_MS: int = 1500
+    WORKFLOW_TRIGGER_COALESCE_MAX_WAIT_MS: int = 10000
+    # 运行事件缓冲：每个运行保留的最近事件条数、运行结束后缓冲区保留时长（供 Last-Event-ID 重连回放）
+    WORKFLOW_EVENT_BUFFER_SIZE: int = 1000
+    WORKFLOW_EVENT_TTL_SEC: float = 600.0
+    # 节点输出缓存（需在节点 params.cache 或 run.params_json.node_cache 中开启）：条目有效期与总大小上限
+    WORKFLOW_NODE_CACHE_TTL_SEC: int = 7 * 24 * 3600
+    WORKFLOW_NODE_CACHE_MAX_BYTES: int = 64 * 1024 * 1024
     
     model_config = SettingsConfigDict(
         env_file=".env",
@@ -43,7 +43,7 @@ class LLMConfig(SQLModel, table=True):
         default=0,
         sa_column=Column(sa.Integer, nullable=False, server_default='0')
     )
-    # RPM/TPM 仅占位，暂不实现
+    # 每分钟请求数/token 数上限，由 llm_scheduler 在进程内限流排队（-1 表示不限）
     rpm_limit: int = Field(
         default=-1,
         sa_column=Column(sa.Integer, nullable=False, server_default='-1')
@@ -54,6 +54,18 @@ class LLMConfig(SQLModel, table=True):
     )
 
 
+
+class LLMFailoverGroup(SQLModel, table=True):
+    """LLM 故障转移组：按顺序排列的一组 LLM 配置（首个为主配置），用于延迟敏感的流式生成"""
+    id: Optional[int] = Field(default=None, primary_key=True)
+    name: str = Field(unique=True, index=True)
+    description: Optional[str] = None
+    config_ids: List[int] = Field(default_factory=list, sa_column=Column(JSON))
+    # 主配置在该时间内未输出首个 token 时，并发请求下一个配置，先出 token 者胜出（为空不对冲）
+    hedge_delay_ms: Optional[int] = None
+    # 首 token 延迟 SLO：单个配置超时仍无输出则取消并切换到下一个配置（为空不限）
+    first_token_timeout_ms: Optional[int] = None
+
 class Prompt(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
     name: str = Field(unique=True, index=True)
@@ -195,6 +207,12 @@ class WorkflowTrigger(SQLModel, table=True):
     # 过滤规则（JSON）
     filter_json: Optional[dict] = Field(default=None, sa_column=Column(JSON))
     is_active: bool = Field(default=True)
+    # 同一卡片已有在途运行时再次触发的处理：supersede（保留在途运行，其后排队一次）| cancel（取消在途运行，
+    # 仅限在本进程执行的运行，其他进程 worker 上的运行按 supersede 处理）
+    inflight_policy: str = Field(
+        default="supersede",
+        sa_column=Column(sa.String, nullable=False, server_default='supersede')
+    )
 
 
 class WorkflowRun(SQLModel, table=True):
@@ -203,7 +221,7 @@ class WorkflowRun(SQLModel, table=True):
     workflow: Workflow = Relationship(back_populates="runs")
 
     definition_version: int = Field(default=1)
-    # queued | running | succeeded | failed | cancelled | partial
+    # queued | running | completed | failed | cancelled | partial
     status: str = Field(default="queued", index=True)
     scope_json: Optional[dict] = Field(default=None, sa_column=Column(JSON))
     params_json: Optional[dict] = Field(default=None, sa_column=Column(JSON))
@@ -211,8 +229,80 @@ class WorkflowRun(SQLModel, table=True):
     created_at: datetime = Field(default_factory=datetime.utcnow, nullable=False)
     started_at: Optional[datetime] = None
     finished_at: Optional[datetime] = None
+    # 最早可被领取的时间：触发合并窗口内的后续保存会把它向后推（尾沿合并）
+    available_at: Optional[datetime] = None
     summary_json: Optional[dict] = Field(default=None, sa_column=Column(JSON))
     error_json: Optional[dict] = Field(default=None, sa_column=Column(JSON))
+    # 节点级检查点：state 快照与已完成节点 ID，失败后从首个未完成节点续跑；运行完成后清空
+    checkpoint_json: Optional[dict] = Field(default=None, sa_column=Column(JSON))
+    # 持久化运行队列：领取该运行的 worker、租约到期时间与最近心跳；attempts 为已领取次数
+    lease_owner: Optional[str] = Field(default=None, index=True)
+    lease_expires_at: Optional[datetime] = None
+    heartbeat_at: Optional[datetime] = None
+    attempts: int = Field(
+        default=0,
+        sa_column=Column(sa.Integer, nullable=False, server_default='0')
+    )
+
+
+class WorkflowRunStep(SQLModel, table=True):
+    """运行轨迹：每个节点一行（循环体节点按节点 ID 聚合各次迭代），运行结束时批量写入"""
+    id: Optional[int] = Field(default=None, primary_key=True)
+    run_id: int = Field(foreign_key="workflowrun.id", index=True)
+    node_id: str
+    node_type: str = Field(index=True)
+    # 循环体节点所属的循环节点 ID；顶层节点为空
+    parent_id: Optional[str] = None
+    # completed | failed | cancelled
+    status: str = Field(default="completed")
+    started_at: datetime
+    finished_at: Optional[datetime] = None
+    # 就绪后等待并发槽位的时间；duration_ms 为各次执行耗时之和（循环节点包含其循环体）
+    queue_wait_ms: float = Field(default=0.0)
+    duration_ms: float = Field(default=0.0)
+    iterations: int = Field(default=1)
+    cache_hits: int = Field(default=0)
+    llm_calls: int = Field(default=0)
+    input_tokens: int = Field(default=0)
+    output_tokens: int = Field(default=0)
+    # LLM 调用失败后的重试次数与退避等待时间
+    llm_retries: int = Field(default=0)
+    llm_retry_wait_ms: float = Field(default=0.0)
+    # 合并进其他节点进行中的相同结构化请求的次数（用量计在发起请求的节点上）
+    shared_hits: int = Field(default=0, sa_column_kwargs={"server_default": "0"})
+    # 节点写入的 state 键（顶层键与 $.a.b 形式的路径）
+    state_keys: Optional[list] = Field(default=None, sa_column=Column(JSON))
+    error: Optional[str] = None
+
+
+class WorkflowNodeCache(SQLModel, table=True):
+    """工作流节点输出缓存：以节点类型 + 渲染后参数 + 输入内容哈希 + LLM 配置为键"""
+    id: Optional[int] = Field(default=None, primary_key=True)
+    cache_key: str = Field(index=True, unique=True)
+    node_type: str = Field(index=True)
+    # {"state": {path: value}, "result": 节点返回值}，值按检查点格式编码
+    output_json: Optional[dict] = Field(default=None, sa_column=Column(JSON))
+    size_bytes: int = Field(default=0)
+    hit_count: int = Field(default=0)
+    created_at: datetime = Field(default_factory=datetime.utcnow, nullable=False)
+    last_used_at: datetime = Field(default_factory=datetime.utcnow, nullable=False, index=True)
+
+
+class LLMResponseCache(SQLModel, table=True):
+    """结构化 LLM 调用的精确匹配响应缓存：以提示词 + 输出 schema + 模型 + 采样参数的哈希为键"""
+    id: Optional[int] = Field(default=None, primary_key=True)
+    cache_key: str = Field(index=True, unique=True)
+    llm_config_id: Optional[int] = Field(default=None, index=True)
+    model_name: Optional[str] = None
+    schema_name: Optional[str] = None
+    response_json: Optional[dict] = Field(default=None, sa_column=Column(JSON))
+    # 命中时免去的 token（写入时按估算记录）
+    input_tokens: int = Field(default=0)
+    output_tokens: int = Field(default=0)
+    size_bytes: int = Field(default=0)
+    hit_count: int = Field(default=0)
+    created_at: datetime = Field(default_factory=datetime.utcnow, nullable=False)
+    last_used_at: datetime = Field(default_factory=datetime.utcnow, nullable=False, index=True)
 
 
 class CardTemplate(SQLModel, table=True):
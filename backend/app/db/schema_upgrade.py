@@ -0,0 +1,52 @@
+"""启动时的增量表结构升级。
+
+create_all 只创建缺失的表，不会给已有表补列；已有的 aiauthor.db 升级代码后，
+模型新增的列（如 workflowrun 的租约/检查点列、workflowtrigger.inflight_policy）
+在这里用 ALTER TABLE ADD COLUMN 补齐，并补建这些列上的索引。
+只增不删、不改列类型，可重复执行。
+"""
+
+from typing import List
+
+from loguru import logger
+from sqlalchemy import Column, inspect as sa_inspect
+from sqlalchemy.engine import Engine
+from sqlalchemy.schema import CreateColumn
+from sqlmodel import SQLModel
+
+
+def _column_ddl(column: Column, engine: Engine) -> str:
+    if column.nullable or column.server_default is not None:
+        return str(CreateColumn(column).compile(dialect=engine.dialect))
+    # SQLite 不能追加没有默认值的 NOT NULL 列：放宽为可空，旧行取 NULL
+    logger.warning(f"[数据库升级] 列 {column.table.name}.{column.name} 无服务端默认值，按可空列追加")
+    col_type = column.type.compile(dialect=engine.dialect)
+    return f"{engine.dialect.identifier_preparer.quote(column.name)} {col_type}"
+
+
+def upgrade_schema(engine: Engine) -> List[str]:
+    """给已存在的表补齐模型中新增的列与索引，返回新增的 "表.列" 列表"""
+    added: List[str] = []
+    with engine.begin() as conn:
+        # 在执行 ALTER 的同一连接上读取表结构（PRAGMA table_info）：SQLite 连接缓存的表结构
+        # 可能早于其他连接的 DDL，先读取才会刷新，否则 ALTER 会按过期结构判断列是否重复
+        inspector = sa_inspect(conn)
+        existing_tables = set(inspector.get_table_names())
+        for table in SQLModel.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            present = {c["name"] for c in inspector.get_columns(table.name)}
+            missing = [c for c in table.columns if c.name not in present]
+            if not missing:
+                continue
+            quoted = engine.dialect.identifier_preparer.quote(table.name)
+            for column in missing:
+                conn.exec_driver_sql(f"ALTER TABLE {quoted} ADD COLUMN {_column_ddl(column, engine)}")
+                added.append(f"{table.name}.{column.name}")
+            names = {c.name for c in missing}
+            for index in table.indexes:
+                if any(c.name in names for c in index.columns):
+                    index.create(conn, checkfirst=True)
+    if added:
+        logger.info(f"[数据库升级] 已补齐列 {added}")
+    return added
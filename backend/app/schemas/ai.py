@@ -4,6 +4,8 @@ from typing import Optional, Dict, Any, List
 class ContinuationRequest(BaseModel):
     previous_content: str = Field(default="", description="已写的章节内容")
     llm_config_id: int
+    # 故障转移组名称：设置后流式续写按组内配置顺序故障转移/对冲，llm_config_id 仅用于记录
+    llm_failover_group: Optional[str] = Field(default=None, description="LLM 故障转移组名称（仅流式续写）")
     stream: bool = False
     # 可选上下文字段（向后兼容）
     project_id: Optional[int] = None
@@ -13,6 +13,8 @@ class AssembleContextRequest(BaseModel):
 	participants: Optional[List[str]] = Field(default=None, description="参与实体名称列表")
 	current_draft_tail: Optional[str] = Field(default=None, description="上下文模板（草稿尾部）")
 	recent_chapters_window: Optional[int] = Field(default=None, description="最近窗口N（保留，为将来扩展）")
+	llm_config_id: Optional[int] = Field(default=None, description="目标 LLM 配置ID：按其上下文窗口推算上下文 token 预算")
+	token_budget: Optional[int] = Field(default=None, description="显式指定上下文 token 预算（优先于按 LLM 配置推算）")
 
 
 class FactsStructured(BaseModel):
@@ -1,6 +1,6 @@
 
 from sqlmodel import SQLModel
-from typing import Optional
+from typing import List, Optional
 
 class LLMConfigBase(SQLModel):
     provider: str
@@ -37,6 +37,27 @@ class LLMConfigUpdate(SQLModel):
     used_tokens_output: Optional[int] = None
     used_calls: Optional[int] = None
 
+class LLMFailoverGroupBase(SQLModel):
+    name: str
+    description: Optional[str] = None
+    # 按优先级排列的 LLM 配置 ID，首个为主配置
+    config_ids: List[int]
+    hedge_delay_ms: Optional[int] = None
+    first_token_timeout_ms: Optional[int] = None
+
+class LLMFailoverGroupCreate(LLMFailoverGroupBase):
+    pass
+
+class LLMFailoverGroupRead(LLMFailoverGroupBase):
+    id: int
+
+class LLMFailoverGroupUpdate(SQLModel):
+    name: Optional[str] = None
+    description: Optional[str] = None
+    config_ids: Optional[List[int]] = None
+    hedge_delay_ms: Optional[int] = None
+    first_token_timeout_ms: Optional[int] = None
+
 class LLMConnectionTest(SQLModel):
     provider: str
     model_name: str
@@ -68,6 +68,7 @@ class WorkflowTriggerBase(BaseModel):
     card_type_name: Optional[str] = None
     filter_json: Optional[dict] = None
     is_active: Optional[bool] = True
+    inflight_policy: Optional[str] = "supersede"  # supersede | cancel
 
 
 class WorkflowTriggerCreate(WorkflowTriggerBase):
@@ -79,6 +80,7 @@ class WorkflowTriggerUpdate(BaseModel):
     card_type_name: Optional[str] = None
     filter_json: Optional[dict] = None
     is_active: Optional[bool] = None
+    inflight_policy: Optional[str] = None
 
 
 class WorkflowTriggerRead(WorkflowTriggerBase):
@@ -1,4 +1,4 @@
-from typing import Awaitable, Callable, Optional, Type, Any, Dict, AsyncGenerator, Union
+from typing import Awaitable, Callable, Optional, Type, Any, Dict, AsyncGenerator, Tuple, Union
 from pydantic import BaseModel
 from sqlmodel import Session
 from app.services import llm_config_service
@@ -7,45 +7,45 @@ from app.schemas.ai import ContinuationRequest, AssistantChatRequest
 from app.services import prompt_service
 from app.db.models import LLMConfig
 import asyncio
+import contextvars
+import hashlib
 import json
-import re
 import os
+from contextlib import aclosing
 from datetime import datetime
 
 from langchain_core.messages import HumanMessage, SystemMessage
 
-_TOKEN_REGEX = re.compile(
-    r"""
-    ([A-Za-z]+)               # 英文单词（连续字母算 1）
-    |([0-9])                 # 1个数字算 1
-    |([\u4E00-\u9FFF])       # 单个中文汉字算 1
-    |(\S)                     # 其它非空白符号/标点算 1
-    """,
-    re.VERBOSE,
-)
-
 def _estimate_tokens(text: str) -> int:
-    """按规则估算 token：
+    """按规则估算 token（实现见 app.services.token_counter，长文本按内容缓存）：
     - 1 个中文 = 1
     - 1 个英文单词 = 1
     - 1 个数字 = 1
     - 1 个符号 = 1
     空白不计。
     """
-    if not text:
-        return 0
-    try:
-        return sum(1 for _ in _TOKEN_REGEX.finditer(text))
-    except Exception:
-        # 退化：按非空白字符计数
-        return sum(1 for ch in (text or "") if not ch.isspace())
+    return token_counter.estimate_tokens(text)
 
 from app.services import llm_config_service as _llm_svc
+from app.services.workflow_trace import (
+    StepTrace,
+    attribute_llm_usage,
+    capture_llm_usage,
+    record_llm_retry,
+    record_llm_usage,
+    record_shared_llm_hit,
+)
+from app.services import llm_retry
+from app.services import llm_failover
+from app.services import token_counter
+from app.services.llm_scheduler import llm_scheduler
+from app.services.llm_usage_ledger import Reservation, usage_ledger
+from app.services import llm_response_cache as response_cache
+from app.services.stream_pipeline import TextRope
 
 def _calc_input_tokens(system_prompt: Optional[str], user_prompt: Optional[str]) -> int:
-    sys_part = system_prompt or ""
-    usr_part = user_prompt or ""
-    return _estimate_tokens(sys_part+usr_part) 
+    # 分别计数：重复使用的系统提示词命中计数缓存，不必与每次不同的用户提示词拼接后整体重算
+    return _estimate_tokens(system_prompt) + _estimate_tokens(user_prompt)
 
 
 def _precheck_quota(session: Session, llm_config_id: int, input_tokens: int, need_calls: int = 1) -> None:
@@ -53,12 +53,109 @@ def _precheck_quota(session: Session, llm_config_id: int, input_tokens: int, nee
     return ok,reason
 
 
-def _record_usage(session: Session, llm_config_id: int, input_tokens: int, output_tokens: int, calls: int = 1, aborted: bool = False) -> None:
+def _record_usage(session: Session, llm_config_id: int, input_tokens: int, output_tokens: int, calls: int = 1, aborted: bool = False,
+                  reservation: Optional[Reservation] = None) -> None:
+    # 在工作流节点内调用时计入运行轨迹
+    record_llm_usage(input_tokens, output_tokens, calls)
     try:
-        _llm_svc.accumulate_usage(session, llm_config_id, max(0, input_tokens), max(0, output_tokens), max(0, calls), aborted=aborted)
+        if reservation is not None:
+            # 预留与记账在账本内一次完成
+            reservation.commit(max(0, input_tokens), max(0, output_tokens), max(0, calls))
+        else:
+            _llm_svc.accumulate_usage(session, llm_config_id, max(0, input_tokens), max(0, output_tokens), max(0, calls), aborted=aborted)
     except Exception as stat_e:
         logger.warning(f"记录 LLM 统计失败: {stat_e}")
 
+class _Flight:
+    def __init__(self) -> None:
+        self.task: Optional["asyncio.Task[Any]"] = None
+        self.waiters = 0
+        # 共享请求自身的 LLM 用量，完成后只计入发起者的当前节点
+        self.usage = StepTrace(node_id="", node_type="llm.shared")
+        # 发起者在请求完成前退出时，用量改由首个拿到结果的等待者承担
+        self.orphaned = False
+        self.attributed = False
+
+
+class _SingleFlight:
+    """
+    合并并发的相同请求：同一指纹只有一个共享任务在执行，结果（或异常）分发给所有等待者。
+    等待者各自被取消时只退出自己的等待；最后一个等待者取消时才取消共享任务。
+
+    共享任务在发起者上下文的副本中运行，沿用其调度优先级与项目（llm_context），
+    但 LLM 用量先单独计量、不直接记到发起者的节点上；factory 需自备 Session。
+    配额只在共享任务内扣一次，调用与 token 用量在任务结束后只计入发起者的节点轨迹，
+    合并进来的等待者只记一次 shared_hits，轨迹汇总不会按等待者数量重复计费。
+    返回 (共享结果, 是否为发起者)；结果对象为所有等待者共用，非发起者需自行复制后再修改。
+    """
+
+    def __init__(self) -> None:
+        self._flights: Dict[str, _Flight] = {}
+        self.started = 0
+        self.joined = 0
+
+    async def do(self, key: str, factory: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        flight = self._flights.get(key)
+        owner = flight is None
+        if owner:
+            flight = _Flight()
+            flight.task = contextvars.copy_context().run(asyncio.ensure_future, self._run(flight, factory))
+            self._flights[key] = flight
+            flight.task.add_done_callback(lambda _t, _k=key, _f=flight: self._forget(_k, _f))
+            self.started += 1
+        else:
+            self.joined += 1
+            logger.info(f"[LangChain-Structured] 合并相同的进行中请求 key={key[:12]} waiters={flight.waiters + 1}")
+        flight.waiters += 1
+        try:
+            result = await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            # 共享任务仍在执行且已无其他等待者：取消它，避免继续消耗配额
+            if not flight.task.done() and flight.waiters == 1:
+                flight.task.cancel()
+            raise
+        finally:
+            flight.waiters -= 1
+            if not flight.task.done():
+                if owner:
+                    flight.orphaned = True
+            elif (owner or flight.orphaned) and not flight.attributed:
+                flight.attributed = True
+                attribute_llm_usage(flight.usage)
+            else:
+                record_shared_llm_hit()
+        return result, owner
+
+    @staticmethod
+    async def _run(flight: _Flight, factory: Callable[[], Awaitable[Any]]) -> Any:
+        # 复制来的上下文里仍是发起者的当前节点：替换为共享计量，调度上下文保持不变
+        with capture_llm_usage(flight.usage):
+            return await factory()
+
+    def _forget(self, key: str, flight: _Flight) -> None:
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+        # 无人等待时取回异常，避免 "Task exception was never retrieved"
+        if not flight.task.cancelled():
+            flight.task.exception()
+
+    def stats(self) -> Dict[str, int]:
+        return {"in_flight": len(self._flights), "started": self.started, "joined": self.joined}
+
+
+_inflight = _SingleFlight()
+
+
+def _request_fingerprint(llm_config_id: int, system_prompt: str, user_prompt: str, output_type: Type[BaseModel],
+                         temperature: Optional[float], max_tokens: Optional[int]) -> str:
+    raw = json.dumps(
+        [llm_config_id, system_prompt, user_prompt, f"{output_type.__module__}.{output_type.__qualname__}",
+         temperature, max_tokens],
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
 def _build_continuation_chat_model(
     session: Session,
     llm_config_id: int,
@@ -95,6 +192,7 @@ async def run_llm_agent(
     timeout: Optional[float] = None,
     track_stats: bool = True,
     style_guidelines: Optional[str] = None,
+    cache: Optional[bool] = None,
 ) -> BaseModel:
     """运行结构化输出的 LLM 调用
 
@@ -102,65 +200,185 @@ async def run_llm_agent(
       - 由 app.services.langchain_assistant.build_chat_model 构造底层模型
       - 通过 model.with_structured_output(output_type) 获取结构化输出
       - 仍然保留原有的配额预检、重试和统计逻辑
+      - 响应缓存：temperature<=0 时自动启用，cache=True/False 强制开关；命中时不消耗配额
     """
 
-    from app.services.langchain_assistant import build_chat_model
+    eff_temperature = 0.7 if temperature is None else temperature
+    eff_system_prompt = system_prompt or "你是一个专业的小说创作助手。"
+    if style_guidelines:
+        eff_system_prompt += f"\n\n【写作风格指引】\n{style_guidelines}"
+
+    cache_key = None
+    cfg = session.get(LLMConfig, llm_config_id) if response_cache.should_cache(eff_temperature, cache) else None
+    if cfg is not None:
+        cache_key = response_cache.build_cache_key(
+            cfg, eff_system_prompt, user_prompt, output_type, eff_temperature, max_tokens
+        )
+        # 命中不消耗配额，但已超限的配置同样不出结果
+        if track_stats:
+            ok, reason = _precheck_quota(session, llm_config_id, 0, need_calls=0)
+            if not ok:
+                raise ValueError(f"LLM 配额不足:{reason}")
+        cached = response_cache.lookup(session, cache_key, output_type, llm_config_id)
+        if cached is not None:
+            logger.info(f"[LLM缓存] 命中 llm_config_id={llm_config_id} schema={output_type.__name__}")
+            return cached
+        logger.info(f"[LLM缓存] 未命中 llm_config_id={llm_config_id} schema={output_type.__name__}")
+    else:
+        response_cache.stats.bump(llm_config_id, "bypassed")
+
+    # 相同请求并发时只向提供商发起一次，结果分发给所有等待者
+    fingerprint = _request_fingerprint(
+        llm_config_id, eff_system_prompt, user_prompt, output_type, eff_temperature, max_tokens
+    )
 
-    # 限额预检（按估算的输入 tokens + 1 次调用）
+    async def _shared_call() -> Tuple[BaseModel, int, int]:
+        # 共享任务用自己的 Session 且只读库，与首个等待者的事务及其生命周期无关
+        with Session(session.get_bind(), expire_on_commit=False) as flight_session:
+            return await _call_structured_llm(
+                flight_session,
+                llm_config_id,
+                user_prompt,
+                output_type,
+                system_prompt,
+                eff_system_prompt,
+                max_tokens=max_tokens,
+                max_retries=max_retries,
+                temperature=eff_temperature,
+                timeout=timeout,
+                track_stats=track_stats,
+            )
+
+    (response, in_tokens, out_tokens), owner = await _inflight.do(fingerprint, _shared_call)
+    if not owner:
+        # 调用方可能原地修改结果，合并进来的等待者拿到独立副本
+        return response.model_copy(deep=True) if isinstance(response, BaseModel) else response
+    # 缓存在后台写线程的独立会话中写入，不提交调用方的 Session，也不等待其未提交的写事务
+    if cache_key is not None and isinstance(response, BaseModel):
+        response_cache.store(session.get_bind(), cache_key, cfg, response, in_tokens, out_tokens)
+    return response
+
+
+async def _call_structured_llm(
+    session: Session,
+    llm_config_id: int,
+    user_prompt: str,
+    output_type: Type[BaseModel],
+    system_prompt: Optional[str],
+    eff_system_prompt: str,
+    *,
+    max_tokens: Optional[int],
+    max_retries: int,
+    temperature: float,
+    timeout: Optional[float],
+    track_stats: bool,
+) -> Tuple[BaseModel, int, int]:
+    """实际发起结构化调用：配额预留、调度、重试与用量统计；返回 (结果, 输入 tokens, 输出 tokens)"""
+    # 限额预检并预留（按估算的输入 tokens + 1 次调用），成功或中止时按实际用量记账，其余情况释放
+    reservation = None
     if track_stats:
-        ok, reason = _precheck_quota(
+        ok, reason, reservation = usage_ledger.reserve(
             session,
             llm_config_id,
-            _calc_input_tokens(system_prompt, user_prompt),
+            _calc_input_tokens(eff_system_prompt, user_prompt),
             need_calls=1,
         )
         if not ok:
             raise ValueError(f"LLM 配额不足:{reason}")
 
-    logger.info(f"[LangChain-Structured] system_prompt: {system_prompt}")
-    logger.info(f"[LangChain-Structured] user_prompt: {user_prompt}")
+    try:
+        return await _invoke_structured(
+            session,
+            llm_config_id,
+            user_prompt,
+            output_type,
+            system_prompt,
+            eff_system_prompt,
+            max_tokens=max_tokens,
+            max_retries=max_retries,
+            temperature=temperature,
+            timeout=timeout,
+            track_stats=track_stats,
+            reservation=reservation,
+        )
+    finally:
+        if reservation is not None:
+            reservation.release()
 
-    last_exception = None
-    for attempt in range(max_retries):
-        try:
-            # 构造底层 ChatModel
-            model = build_chat_model(
-                session=session,
-                llm_config_id=llm_config_id,
-                temperature=temperature or 0.7,
-                max_tokens=max_tokens,
-                timeout=timeout or 150,
-            )
 
-            # 结构化输出模型
-            structured_llm = model.with_structured_output(output_type)
+async def _invoke_structured(
+    session: Session,
+    llm_config_id: int,
+    user_prompt: str,
+    output_type: Type[BaseModel],
+    system_prompt: Optional[str],
+    eff_system_prompt: str,
+    *,
+    max_tokens: Optional[int],
+    max_retries: int,
+    temperature: float,
+    timeout: Optional[float],
+    track_stats: bool,
+    reservation: Optional[Reservation],
+) -> Tuple[BaseModel, int, int]:
+    from app.services.langchain_assistant import build_chat_model
+
+    logger.info(f"[LangChain-Structured] system_prompt: {system_prompt}")
+    logger.info(f"[LangChain-Structured] user_prompt: {user_prompt}")
 
-            messages = []
-            eff_system_prompt = system_prompt or "你是一个专业的小说创作助手。"
-            if style_guidelines:
-                eff_system_prompt += f"\n\n【写作风格指引】\n{style_guidelines}"
-            
-            messages.append(SystemMessage(content=eff_system_prompt))
-            messages.append(HumanMessage(content=user_prompt))
+    # 底层 ChatModel 从实例池获取，重试时复用同一实例（及其连接池）
+    model = build_chat_model(
+        session=session,
+        llm_config_id=llm_config_id,
+        temperature=temperature,
+        max_tokens=max_tokens,
+        timeout=timeout or 150,
+    )
 
-            response = await structured_llm.ainvoke(messages)
+    provider = session.get(LLMConfig, llm_config_id).provider
+    # 结构化输出模型；include_raw 以便取得提供商返回的实际用量（用于校准 token 估算）
+    structured_llm = model.with_structured_output(output_type, include_raw=True)
+    messages = [SystemMessage(content=eff_system_prompt), HumanMessage(content=user_prompt)]
+    # 按实际发送的系统提示词计数；调度、记账与估算校准共用这一次计数
+    in_tokens = _calc_input_tokens(eff_system_prompt, user_prompt)
+
+    policy = llm_retry.RetryPolicy(max_attempts=max(1, max_retries))
+    retry_stats = llm_retry.CallRetryStats()
+    last_exception: Optional[Exception] = None
+    while True:
+        retry_stats.attempts += 1
+        attempt = retry_stats.attempts
+        grant = None
+        try:
+            # 经全局调度器按 rpm/tpm 限额放行；每次重试都是一次独立请求
+            grant = await llm_scheduler.acquire(session, llm_config_id, in_tokens)
+            result = await structured_llm.ainvoke(messages)
+            response = result
+            if isinstance(result, dict) and "parsed" in result:
+                if result.get("parsing_error") is not None:
+                    raise llm_retry.InvalidOutputError(str(result["parsing_error"]))
+                response = result["parsed"]
+                actual_in = token_counter.usage_input_tokens(result.get("raw"))
+                if actual_in:
+                    token_counter.calibrate(provider, in_tokens, actual_in)
 
             if response is None:
-                raise ValueError("LLM 返回了空响应")
+                raise llm_retry.InvalidOutputError("LLM 返回了空响应")
 
             logger.info(f"[LangChain-Structured] response: {response}")
 
+            try:
+                out_text = (
+                    response
+                    if isinstance(response, str)
+                    else json.dumps(response, ensure_ascii=False)
+                )
+            except Exception:
+                out_text = str(response)
+            out_tokens = _estimate_tokens(out_text)
+            grant.settle(in_tokens + out_tokens)
+
             if track_stats:
-                in_tokens = _calc_input_tokens(system_prompt, user_prompt)
-                try:
-                    out_text = (
-                        response
-                        if isinstance(response, str)
-                        else json.dumps(response, ensure_ascii=False)
-                    )
-                except Exception:
-                    out_text = str(response)
-                out_tokens = _estimate_tokens(out_text)
                 _record_usage(
                     session,
                     llm_config_id,
@@ -168,14 +386,19 @@ async def run_llm_agent(
                     out_tokens,
                     calls=1,
                     aborted=False,
+                    reservation=reservation,
                 )
 
-            return response
+            llm_retry.record_call(retry_stats, failed=False)
+            if retry_stats.retries:
+                logger.info(
+                    f"[LangChain-Structured] 重试后成功 llm_config_id={llm_config_id} retry={retry_stats.to_dict()}"
+                )
+            return response, in_tokens, out_tokens
 
         except asyncio.CancelledError:
             logger.info("[LangChain-Structured] LLM 调用被取消（CancelledError），立即中止，不再重试。")
             if track_stats:
-                in_tokens = _calc_input_tokens(system_prompt, user_prompt)
                 _record_usage(
                     session,
                     llm_config_id,
@@ -183,19 +406,58 @@ async def run_llm_agent(
                     0,
                     calls=1,
                     aborted=True,
+                    reservation=reservation,
                 )
+            llm_retry.record_call(retry_stats, failed=True)
             raise
         except Exception as e:
+            if grant is not None:
+                # 退避等待前先退还额度，不占着 tpm 睡眠
+                grant.release()
             last_exception = e
+            kind = llm_retry.classify(e)
+            retry_stats.errors.append(kind)
+            if not policy.should_retry(kind, attempt):
+                break
+            delay = policy.delay(kind, attempt, llm_retry.retry_after(e))
+            retry_stats.delays.append(delay)
+            record_llm_retry(delay)
             logger.warning(
-                f"[LangChain-Structured] 调用失败，重试 {attempt + 1}/{max_retries}，llm_config_id={llm_config_id}: {e}"
+                f"[LangChain-Structured] 调用失败（{kind}），{delay:.2f}s 后重试 {attempt}/{policy.max_attempts}，"
+                f"llm_config_id={llm_config_id}: {e}"
             )
-
+            if kind == llm_retry.INVALID_OUTPUT:
+                # 把校验错误回填给模型，而不是原样重发同一提示词
+                messages = messages[:2] + [HumanMessage(content=_invalid_output_feedback(e))]
+                in_tokens = _calc_input_tokens(eff_system_prompt, user_prompt) + _estimate_tokens(messages[-1].content)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        finally:
+            # 成功路径已按实际用量结算；抛错/取消时退还本次预扣额度
+            if grant is not None:
+                grant.release()
+
+    llm_retry.record_call(retry_stats, failed=True)
     logger.error(
-        f"[LangChain-Structured] 调用在重试 {max_retries} 次后仍失败，llm_config_id={llm_config_id}. Last error: {last_exception}"
+        f"[LangChain-Structured] 调用失败，不再重试，llm_config_id={llm_config_id} "
+        f"retry={retry_stats.to_dict()}. Last error: {last_exception}"
     )
     raise ValueError(
-        f"调用LLM服务失败，已重试 {max_retries} 次: {str(last_exception)}"
+        f"调用LLM服务失败，已尝试 {retry_stats.attempts} 次: {str(last_exception)}"
+    )
+
+
+_FEEDBACK_ERROR_MAX_LEN = 1000
+
+
+def _invalid_output_feedback(error: Exception) -> str:
+    detail = str(error).strip()
+    if len(detail) > _FEEDBACK_ERROR_MAX_LEN:
+        detail = detail[:_FEEDBACK_ERROR_MAX_LEN] + "..."
+    return (
+        "上一次输出未通过结构化校验，错误如下：\n"
+        f"{detail}\n"
+        "请修正上述问题，严格按照要求的字段与类型重新输出完整结果。"
     )
 
 async def generate_assistant_chat_streaming(
@@ -244,8 +506,11 @@ async def generate_assistant_chat_streaming(
         raise
 
 
-async def generate_continuation_streaming(session: Session, request: ContinuationRequest, system_prompt: str, track_stats: bool = True, style_guidelines: Optional[str] = None) -> AsyncGenerator[str, None]:
-    """以流式方式生成续写内容。system_prompt 由外部显式传入。"""
+async def generate_continuation_streaming(session: Session, request: ContinuationRequest, system_prompt: str, track_stats: bool = True, style_guidelines: Optional[str] = None, rope: Optional[TextRope] = None) -> AsyncGenerator[str, None]:
+    """以流式方式生成续写内容。system_prompt 由外部显式传入。
+
+    传入 rope 时输出的全文累加在其中（用量估算与调用方保存历史共用同一份），调用方无需再自行拼接。
+    """
     # 注入风格指引
     eff_system_prompt = system_prompt
     if style_guidelines:
@@ -291,20 +556,104 @@ async def generate_continuation_streaming(session: Session, request: Continuatio
                 user_prompt_parts.append("【指令】请开始创作新章节。直接输出小说正文。")
     
     user_prompt = "\n\n".join(user_prompt_parts)
-    
-    # 限额预检
+
+    def _open(llm_config_id: int, attempt_rope: Optional[TextRope] = None) -> AsyncGenerator[str, None]:
+        return _stream_continuation(
+            session,
+            llm_config_id,
+            eff_system_prompt,
+            user_prompt,
+            temperature=request.temperature or 0.7,
+            max_tokens=request.max_tokens,
+            timeout=request.timeout or 64,
+            project_id=request.project_id,
+            track_stats=track_stats,
+            rope=attempt_rope,
+        )
+
+    if request.llm_failover_group:
+        group = llm_failover.get_group_by_name(session, request.llm_failover_group)
+        if group is None:
+            raise ValueError(f"LLM 故障转移组不存在: {request.llm_failover_group}")
+        # 对冲/故障转移的各尝试各自累加（落选尝试的输出不能混入），调用方的 rope 只收胜出流
+        stream = llm_failover.stream_with_failover(group, _open)
+        collect = rope
+    else:
+        stream = _open(request.llm_config_id, rope)
+        collect = None
+    async with aclosing(stream):
+        async for delta in stream:
+            if collect is not None:
+                collect.append(delta)
+            yield delta
+
+
+async def _stream_continuation(
+    session: Session,
+    llm_config_id: int,
+    eff_system_prompt: str,
+    user_prompt: str,
+    *,
+    temperature: float,
+    max_tokens: Optional[int],
+    timeout: float,
+    project_id: Optional[int],
+    track_stats: bool,
+    rope: Optional[TextRope] = None,
+) -> AsyncGenerator[str, None]:
+    """向单个 LLM 配置发起续写流：配额预留、调度放行、用量结算都记在该配置上"""
+    # 限额预检并预留
+    reservation = None
     if track_stats:
-        ok, reason = _precheck_quota(session, request.llm_config_id, _calc_input_tokens(eff_system_prompt, user_prompt), need_calls=1)
+        ok, reason, reservation = usage_ledger.reserve(
+            session, llm_config_id, _calc_input_tokens(eff_system_prompt, user_prompt), need_calls=1
+        )
         if not ok:
             raise ValueError(f"LLM 配额不足:{reason}")
 
+    try:
+        # 下游关闭时先关闭内层流（按中止记账并结算预留），再释放剩余预留
+        async with aclosing(_stream_continuation_once(
+            session,
+            llm_config_id,
+            eff_system_prompt,
+            user_prompt,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            timeout=timeout,
+            project_id=project_id,
+            track_stats=track_stats,
+            reservation=reservation,
+            rope=rope if rope is not None else TextRope(),
+        )) as stream:
+            async for delta in stream:
+                yield delta
+    finally:
+        if reservation is not None:
+            reservation.release()
+
+
+async def _stream_continuation_once(
+    session: Session,
+    llm_config_id: int,
+    eff_system_prompt: str,
+    user_prompt: str,
+    *,
+    temperature: float,
+    max_tokens: Optional[int],
+    timeout: float,
+    project_id: Optional[int],
+    track_stats: bool,
+    reservation: Optional[Reservation],
+    rope: TextRope,
+) -> AsyncGenerator[str, None]:
     # 使用 LangChain ChatModel 进行流式续写
     model = _build_continuation_chat_model(
         session=session,
-        llm_config_id=request.llm_config_id,
-        temperature=request.temperature or 0.7,
-        max_tokens=request.max_tokens,
-        timeout=request.timeout or 64,
+        llm_config_id=llm_config_id,
+        temperature=temperature,
+        max_tokens=max_tokens,
+        timeout=timeout,
     )
 
     messages = [
@@ -312,11 +661,16 @@ async def generate_continuation_streaming(session: Session, request: Continuatio
         HumanMessage(content=user_prompt),
     ]
 
-    accumulated: str = ""
+    in_tokens = _calc_input_tokens(eff_system_prompt, user_prompt)
+    grant = await llm_scheduler.acquire(
+        session, llm_config_id, in_tokens, priority="interactive", project_id=project_id
+    )
 
+    actual_in = 0
     try:
         logger.debug("正在以 LangChain ChatModel 流式生成续写内容")
         async for chunk in model.astream(messages):
+            actual_in = token_counter.usage_input_tokens(chunk) or actual_in
             content = getattr(chunk, "content", None)
             if not content:
                 continue
@@ -335,25 +689,30 @@ async def generate_continuation_streaming(session: Session, request: Continuatio
             if not delta:
                 continue
 
-            accumulated += delta
+            rope.append(delta)
             yield delta
 
-    except asyncio.CancelledError:
-        logger.info("流式 LLM 调用被取消（CancelledError），停止推送。")
+    except (asyncio.CancelledError, GeneratorExit):
+        # CancelledError：任务被取消；GeneratorExit：下游在 yield 处关闭了流（客户端断开）
+        logger.info("流式 LLM 调用被取消，停止推送。")
+        out_tokens = _estimate_tokens(rope.text())
+        grant.settle(in_tokens + out_tokens)
         if track_stats:
-            in_tokens = _calc_input_tokens(eff_system_prompt, user_prompt)
-            out_tokens = _estimate_tokens(accumulated)
-            _record_usage(session, request.llm_config_id, in_tokens, out_tokens, calls=1, aborted=True)
+            _record_usage(session, llm_config_id, in_tokens, out_tokens, calls=1, aborted=True, reservation=reservation)
         return
     except Exception as e:
         logger.error(f"流式 LLM 调用失败: {e}")
+        grant.settle(in_tokens + _estimate_tokens(rope.text()))
         raise
 
     # 正常结束后统计
+    out_tokens = _estimate_tokens(rope.text())
+    grant.settle(in_tokens + out_tokens)
+    if actual_in:
+        cfg = session.get(LLMConfig, llm_config_id)
+        token_counter.calibrate(cfg.provider if cfg else None, in_tokens, actual_in)
     try:
         if track_stats:
-            in_tokens = _calc_input_tokens(eff_system_prompt, user_prompt)
-            out_tokens = _estimate_tokens(accumulated)
-            _record_usage(session, request.llm_config_id, in_tokens, out_tokens, calls=1, aborted=False)
+            _record_usage(session, llm_config_id, in_tokens, out_tokens, calls=1, aborted=False, reservation=reservation)
     except Exception as stat_e:
-        logger.warning(f"记录 LLM 流式统计失败: {stat_e}")
\ No newline at end of file
+        logger.warning(f"记录 LLM 流式统计失败: {stat_e}")
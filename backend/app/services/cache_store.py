@@ -0,0 +1,143 @@
+"""持久化缓存表（LLM 响应缓存、工作流节点缓存）共用的读取、淘汰与计数。
+
+缓存表需有 id / cache_key / size_bytes / hit_count / created_at / last_used_at 列。
+查询只读不写：命中次数与最近使用时间先记在内存，下一次写入缓存（store → evict）时一并回写，
+查询方的 Session 不会因为一次缓存命中被提交。
+写入在后台写线程中用独立会话执行，从不提交或回滚调用方的 Session：调用方可能正持有未提交的
+写事务（SQLite 写锁），写入在写线程中排队等待其提交，不阻塞调用方，也不会带走调用方的半成品写入。
+"""
+
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from dataclasses import asdict, dataclass
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, Optional, Set, Tuple, Type
+
+import sqlalchemy as sa
+from loguru import logger
+from sqlalchemy.engine import Engine
+from sqlmodel import Session, SQLModel, select
+
+from app.core.config import settings
+
+
+# 所有缓存表共用一个写线程：缓存写入之间不争抢 SQLite 写锁
+_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="cache-writer")
+_pending: Set["Future[bool]"] = set()
+_pending_lock = threading.Lock()
+
+
+def _forget_write(future: "Future[bool]") -> None:
+    with _pending_lock:
+        _pending.discard(future)
+
+
+def wait_writes(timeout: Optional[float] = None) -> None:
+    """等待已提交的缓存写入完成（进程退出前、测试中使用）"""
+    with _pending_lock:
+        pending = list(_pending)
+    if pending:
+        wait(pending, timeout=timeout)
+
+
+@dataclass
+class CacheCounters:
+    """缓存命中/未命中/写入计数"""
+    hits: int = 0
+    misses: int = 0
+    stores: int = 0
+
+    def bump(self, name: str, amount: int = 1) -> None:
+        setattr(self, name, getattr(self, name) + amount)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return asdict(self)
+
+
+class CacheTable:
+    """按 TTL 过期、总大小超限时按最近使用时间淘汰的缓存表；TTL/上限按配置项名实时读取"""
+
+    def __init__(self, model: Type[SQLModel], ttl_setting: str, max_bytes_setting: str, log_prefix: str) -> None:
+        self.model = model
+        self._ttl_setting = ttl_setting
+        self._max_bytes_setting = max_bytes_setting
+        self._log_prefix = log_prefix
+        self._touches: Dict[str, Tuple[int, datetime]] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def ttl_sec(self) -> int:
+        return getattr(settings, self._ttl_setting)
+
+    @property
+    def max_bytes(self) -> int:
+        return getattr(settings, self._max_bytes_setting)
+
+    def find(self, session: Session, cache_key: str) -> Optional[Any]:
+        """未过期的条目；过期条目视为未命中（由 evict 统一删除）"""
+        entry = session.exec(select(self.model).where(self.model.cache_key == cache_key)).first()
+        if entry is None or entry.created_at < datetime.utcnow() - timedelta(seconds=self.ttl_sec):
+            return None
+        return entry
+
+    def touch(self, cache_key: str) -> None:
+        """记录一次命中，回写推迟到下一次 evict"""
+        with self._lock:
+            count, _ = self._touches.get(cache_key, (0, None))
+            self._touches[cache_key] = (count + 1, datetime.utcnow())
+
+    def write(self, bind: Engine, apply: Callable[[Session], None]) -> "Future[bool]":
+        """在写线程中用独立会话执行 apply 并淘汰（同一事务提交）；结果为是否写入成功，失败只告警"""
+        future = _writer.submit(self._write, bind, apply)
+        with _pending_lock:
+            _pending.add(future)
+        future.add_done_callback(_forget_write)
+        return future
+
+    def _write(self, bind: Engine, apply: Callable[[Session], None]) -> bool:
+        try:
+            with Session(bind) as own:
+                apply(own)
+                self.evict(own)
+            return True
+        except Exception as e:  # noqa: BLE001
+            logger.warning(f"{self._log_prefix} 写入失败 err={e}")
+            return False
+
+    def evict(self, session: Session) -> int:
+        """回写命中记录，删除过期条目；总大小超过上限时按最近使用时间从旧到新删除。
+        会提交 session，只应传入缓存自己的会话"""
+        model = self.model
+        with self._lock:
+            touches, self._touches = self._touches, {}
+        for cache_key, (count, used_at) in touches.items():
+            session.exec(  # type: ignore[call-overload]
+                sa.update(model).where(model.cache_key == cache_key)
+                .values(
+                    hit_count=sa.func.coalesce(model.hit_count, 0) + count,
+                    last_used_at=sa.case((model.last_used_at < used_at, used_at), else_=model.last_used_at),
+                )
+            )
+        expire_before = datetime.utcnow() - timedelta(seconds=self.ttl_sec)
+        removed = session.exec(  # type: ignore[call-overload]
+            sa.delete(model).where(model.created_at < expire_before)
+        ).rowcount or 0
+        total = session.exec(select(sa.func.coalesce(sa.func.sum(model.size_bytes), 0))).one()
+        overflow = int(total) - self.max_bytes
+        if overflow > 0:
+            rows = session.exec(
+                select(model.id, model.size_bytes).order_by(model.last_used_at)  # type: ignore[arg-type]
+            ).all()
+            victims = []
+            for entry_id, size in rows:
+                if overflow <= 0:
+                    break
+                victims.append(entry_id)
+                overflow -= size or 0
+            if victims:
+                session.exec(sa.delete(model).where(model.id.in_(victims)))  # type: ignore[call-overload,union-attr]
+                removed += len(victims)
+        session.commit()
+        if removed:
+            logger.info(f"{self._log_prefix} 淘汰条目 count={removed}")
+        return removed
@@ -0,0 +1,136 @@
+"""写作上下文缓存：assemble_context 的结果按项目数据版本失效。
+
+每个项目有一个进程内单调递增的数据版本，以下写入成功后递增：
+- 知识图谱写入（ingest_triples_with_attributes / ingest_aliases / delete_project_graph）
+- 卡片保存或删除（ORM 会话提交时检测到 Card 变更，覆盖所有写卡片的路径）
+- 向量库写入或删除（VectorService.add_texts / delete_project_data）
+版本递增时立即丢弃该项目的全部缓存条目；装配期间版本发生变化的结果不写入缓存，
+因此不会出现用旧数据装配、却挂在新版本下的条目。TTL 只作为外部直接修改 Neo4j/Chroma 时的兜底。
+"""
+
+import copy
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from itertools import chain
+from typing import Any, Dict, Hashable, Iterable, Optional, Tuple
+
+from loguru import logger
+from sqlalchemy import event
+from sqlalchemy.orm import Session as OrmSession
+
+from app.core.config import settings
+from app.db.models import Card
+
+
+_SESSION_KEY = "context_cache_projects"
+
+_lock = threading.Lock()
+_versions: Dict[int, int] = {}
+# key -> (写入时间, 装配结果)；key 的第一、二项为 project_id 与数据版本
+_entries: "OrderedDict[Tuple[Hashable, ...], Tuple[float, Any]]" = OrderedDict()
+_counters = {"hits": 0, "misses": 0, "stores": 0, "stale_skips": 0, "invalidations": 0}
+
+
+def project_version(project_id: int) -> int:
+    return _versions.get(project_id, 0)
+
+
+def bump(project_id: Optional[int], reason: str) -> None:
+    """项目数据已变化：版本递增并丢弃该项目的缓存条目"""
+    if not project_id:
+        return
+    with _lock:
+        _versions[project_id] = _versions.get(project_id, 0) + 1
+        stale = [key for key in _entries if key[0] == project_id]
+        for key in stale:
+            del _entries[key]
+        _counters["invalidations"] += 1
+    if stale:
+        logger.debug(f"[上下文缓存] project={project_id} 因{reason}失效 dropped={len(stale)}")
+
+
+def make_key(project_id: int, version: int, participants: Iterable[str], chapter_id: Optional[int],
+             pov_character: Optional[str], radius: int, top_k: int,
+             draft_query: Optional[str], token_budget: int = 0, tokenizer_family: str = "") -> Tuple[Hashable, ...]:
+    """缓存键：项目、版本、排序后的参与者、章节、视角、半径、TopK、向量检索查询的摘要，以及打包预算与分词器家族"""
+    query_digest = hashlib.sha1(draft_query.encode("utf-8")).hexdigest() if draft_query else None
+    return (
+        project_id,
+        version,
+        tuple(sorted(str(p) for p in participants)),
+        chapter_id,
+        pov_character or None,
+        radius,
+        top_k,
+        query_digest,
+        token_budget,
+        tokenizer_family,
+    )
+
+
+def lookup(key: Tuple[Hashable, ...]) -> Optional[Any]:
+    """命中时返回深拷贝，调用方修改结果不会污染缓存"""
+    now = time.monotonic()
+    with _lock:
+        item = _entries.get(key)
+        if item is not None and now - item[0] > settings.CONTEXT_CACHE_TTL_SEC:
+            del _entries[key]
+            item = None
+        if item is None:
+            _counters["misses"] += 1
+            return None
+        _entries.move_to_end(key)
+        _counters["hits"] += 1
+    return copy.deepcopy(item[1])
+
+
+def store(key: Tuple[Hashable, ...], value: Any) -> None:
+    """写入缓存；装配期间项目版本已变化（数据被修改）时丢弃"""
+    project_id, version = key[0], key[1]
+    with _lock:
+        if _versions.get(project_id, 0) != version:
+            _counters["stale_skips"] += 1
+            return
+        _entries[key] = (time.monotonic(), copy.deepcopy(value))
+        _entries.move_to_end(key)
+        _counters["stores"] += 1
+        while len(_entries) > settings.CONTEXT_CACHE_MAX_ENTRIES:
+            _entries.popitem(last=False)
+
+
+def clear() -> int:
+    with _lock:
+        removed = len(_entries)
+        _entries.clear()
+    return removed
+
+
+def cache_stats() -> Dict[str, Any]:
+    with _lock:
+        return {**_counters, "entries": len(_entries), "versions": dict(_versions)}
+
+
+# ---------------- 卡片变更 → 版本递增 ----------------
+@event.listens_for(OrmSession, "after_flush")
+def _collect_card_projects(session: OrmSession, flush_context: Any) -> None:
+    touched = {
+        obj.project_id
+        for obj in chain(session.new, session.dirty, session.deleted)
+        if isinstance(obj, Card) and obj.project_id
+    }
+    if touched:
+        session.info.setdefault(_SESSION_KEY, set()).update(touched)
+
+
+@event.listens_for(OrmSession, "after_commit")
+def _bump_card_projects(session: OrmSession) -> None:
+    # 提交后再递增：提交前并发装配读到的仍是旧数据，先递增会让其结果挂在新版本下
+    for project_id in session.info.pop(_SESSION_KEY, ()):
+        bump(project_id, "卡片变更")
+
+
+@event.listens_for(OrmSession, "after_rollback")
+def _discard_card_projects(session: OrmSession) -> None:
+    session.info.pop(_SESSION_KEY, None)
@@ -0,0 +1,207 @@
+"""上下文打包：按相关性给候选片段打分，在 token 预算内装入得分最高的片段。
+
+候选来源与打分（0~1，越高越优先）：
+- 关系摘要：两端是否均为参与者、距参与者的跳数、生效章节（valid_from）距当前章节的远近、是否带称呼/对话/事件等证据
+- 事实摘要：文本中出现的参与者数量
+- 向量片段：检索距离换算的相似度，辅以参与者出现情况
+- 写作指南：按段落拆分，越靠前的段落得分越高（整体高于一般事实，预算紧张时最后被丢弃）
+预算来自目标 LLM 配置的上下文窗口（按模型名推断，可由 LLM_CONTEXT_WINDOWS 覆盖）乘以
+CONTEXT_BUDGET_RATIO，并以 CONTEXT_BUDGET_MAX_TOKENS 封顶；调用方也可显式指定。
+token 数使用 token_counter 中该提供商家族的估算器（含校准）计算。
+"""
+
+import re
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from sqlmodel import Session
+
+from app.core.config import settings
+from app.db.models import LLMConfig
+from app.services import token_counter
+
+
+# 关系得分权重：参与者覆盖 / 章节新近度 / 证据
+_RELATION_WEIGHTS = (0.5, 0.3, 0.2)
+# 向量片段得分权重：相似度 / 参与者覆盖
+_VECTOR_WEIGHTS = (0.7, 0.3)
+# 章节差达到该值时新近度衰减为一半
+_RECENCY_HALF_LIFE = 10
+# 写作指南段落基础分
+_GUIDE_BASE = 0.6
+
+# 模型名前缀 → 上下文窗口（token）；按前缀长度从长到短匹配
+_CONTEXT_WINDOWS: Dict[str, int] = {
+    "gpt-3.5": 16_385,
+    "gpt-4o": 128_000,
+    "gpt-4.1": 1_000_000,
+    "gpt-4-turbo": 128_000,
+    "gpt-4": 8_192,
+    "gpt-5": 400_000,
+    "o1": 200_000,
+    "o3": 200_000,
+    "o4": 200_000,
+    "claude": 200_000,
+    "gemini": 1_000_000,
+    "deepseek": 64_000,
+    "qwen": 32_768,
+    "glm-4": 128_000,
+    "moonshot": 8_192,
+    "kimi": 128_000,
+    "abab": 245_760,
+    "minimax": 245_760,
+    "baichuan": 32_768,
+}
+_WINDOW_SUFFIX_RE = re.compile(r"(\d+)k\b", re.IGNORECASE)
+
+KIND_RELATION = "relation"
+KIND_FACT = "fact"
+KIND_VECTOR = "vector"
+KIND_GUIDE = "guide"
+
+
+@dataclass
+class Candidate:
+    kind: str
+    text: str
+    score: float
+    # 原始条目（关系 dict / 检索结果等），打包后用于还原结构化输出
+    ref: Any = None
+    tokens: int = 0
+
+
+@dataclass
+class PackResult:
+    budget: int
+    used: int = 0
+    kept: List[Candidate] = field(default_factory=list)
+    dropped: List[Candidate] = field(default_factory=list)
+
+    def kept_of(self, kind: str) -> List[Candidate]:
+        return [c for c in self.kept if c.kind == kind]
+
+    def stats(self, tokenizer: str) -> Dict[str, Any]:
+        kept_by_kind: Dict[str, int] = {}
+        for c in self.kept:
+            kept_by_kind[c.kind] = kept_by_kind.get(c.kind, 0) + 1
+        return {
+            "budget_tokens": self.budget,
+            "used_tokens": self.used,
+            "tokenizer": tokenizer,
+            "kept": kept_by_kind,
+            "dropped_count": len(self.dropped),
+            "dropped": [
+                {"kind": c.kind, "score": round(c.score, 3), "tokens": c.tokens, "preview": c.text[:40]}
+                for c in self.dropped
+            ],
+        }
+
+
+# ---------------- 预算 ----------------
+def context_window(model_name: Optional[str]) -> int:
+    """按模型名推断上下文窗口：LLM_CONTEXT_WINDOWS 配置 > 名称中的 32k/128k 等后缀 > 内置前缀表"""
+    name = (model_name or "").lower()
+    window = _match_prefix(settings.LLM_CONTEXT_WINDOWS or {}, name)
+    if window is None:
+        m = _WINDOW_SUFFIX_RE.search(name)
+        window = int(m.group(1)) * 1024 if m else _match_prefix(_CONTEXT_WINDOWS, name)
+    return window or settings.CONTEXT_DEFAULT_WINDOW_TOKENS
+
+
+def _match_prefix(table: Dict[str, int], name: str) -> Optional[int]:
+    for prefix in sorted(table, key=len, reverse=True):
+        if name.startswith(prefix.lower()):
+            return int(table[prefix])
+    return None
+
+
+def resolve_budget(session: Session, llm_config_id: Optional[int],
+                   explicit: Optional[int] = None) -> Tuple[int, Optional[str]]:
+    """返回 (预算 token 数, 提供商)；显式预算优先，其次按目标 LLM 配置的上下文窗口推算"""
+    cfg = session.get(LLMConfig, llm_config_id) if llm_config_id else None
+    provider = cfg.provider if cfg else None
+    if explicit is not None and explicit > 0:
+        return int(explicit), provider
+    if cfg is None:
+        return settings.CONTEXT_DEFAULT_BUDGET_TOKENS, None
+    budget = int(context_window(cfg.model_name) * settings.CONTEXT_BUDGET_RATIO)
+    return max(1, min(budget, settings.CONTEXT_BUDGET_MAX_TOKENS)), provider
+
+
+# ---------------- 打分 ----------------
+def _overlap(text: str, participants: List[str]) -> float:
+    """文本中出现的参与者比例（出现两个即满分）；无参与者时取中性值"""
+    if not participants:
+        return 0.5
+    hits = sum(1 for p in participants if p and p in text)
+    return min(1.0, hits / min(2, len(participants)))
+
+
+def _recency(valid_from: Any, chapter_id: Optional[int]) -> float:
+    if valid_from is None or chapter_id is None:
+        return 0.5
+    try:
+        gap = max(0, int(chapter_id) - int(valid_from))
+    except (TypeError, ValueError):
+        return 0.5
+    return 1 / (1 + gap / _RECENCY_HALF_LIFE)
+
+
+def score_relation(item: Dict[str, Any], participants: List[str], chapter_id: Optional[int]) -> float:
+    pset = set(participants)
+    overlap = ((str(item.get("a")) in pset) + (str(item.get("b")) in pset)) / 2 if pset else 0.5
+    evidence = 1.0 if (item.get("recent_dialogues") or item.get("recent_event_summaries")
+                       or item.get("a_to_b_addressing") or item.get("b_to_a_addressing")) else 0.0
+    w_overlap, w_recency, w_evidence = _RELATION_WEIGHTS
+    score = w_overlap * overlap + w_recency * _recency(item.get("valid_from"), chapter_id) + w_evidence * evidence
+    # 多跳扩展得到的关系：每多一跳得分减半
+    try:
+        hops = max(1, int(item.get("hops") or 1))
+    except (TypeError, ValueError):
+        hops = 1
+    return score / (2 ** (hops - 1))
+
+
+def score_fact(text: str, participants: List[str]) -> float:
+    return 0.6 * _overlap(text, participants) + 0.4 * 0.5
+
+
+def score_vector(result: Dict[str, Any], participants: List[str]) -> float:
+    try:
+        distance = max(0.0, float(result.get("distance") or 0.0))
+    except (TypeError, ValueError):
+        distance = 1.0
+    w_sim, w_overlap = _VECTOR_WEIGHTS
+    return w_sim * (1 / (1 + distance)) + w_overlap * _overlap(str(result.get("text") or ""), participants)
+
+
+def guide_sections(guide: str) -> List[str]:
+    return [part.strip() for part in re.split(r"\n\s*\n", guide) if part.strip()]
+
+
+def score_guide_section(index: int, total: int) -> float:
+    return _GUIDE_BASE + (1 - _GUIDE_BASE) * (1 - index / max(1, total))
+
+
+# ---------------- 打包 ----------------
+def pack(candidates: Iterable[Candidate], budget: int, provider: Optional[str] = None,
+         headers: Optional[Dict[str, str]] = None) -> PackResult:
+    """按得分从高到低贪心装入；放不下的跳过并继续尝试更小的候选。
+
+    headers 为各类候选渲染时的标题（如“关键事实：”），该类首个候选入选时一并计入预算。
+    同分时保持原有顺序。
+    """
+    result = PackResult(budget=budget)
+    header_cost = {kind: token_counter.count_tokens(text, provider) for kind, text in (headers or {}).items()}
+    opened: set = set()
+    ranked = sorted(enumerate(candidates), key=lambda pair: (-pair[1].score, pair[0]))
+    for _, cand in ranked:
+        cand.tokens = token_counter.count_tokens(cand.text, provider)
+        cost = cand.tokens + (header_cost.get(cand.kind, 0) if cand.kind not in opened else 0)
+        if result.used + cost <= budget:
+            result.used += cost
+            result.kept.append(cand)
+            opened.add(cand.kind)
+        else:
+            result.dropped.append(cand)
+    return result
@@ -1,8 +1,11 @@
 from __future__ import annotations
 
+import asyncio
 import os
+import time
 from dataclasses import dataclass
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from loguru import logger
 from sqlmodel import Session, select
 
 from app.db.models import Card, CardType
@@ -10,6 +13,8 @@ from app.services.memory_service import MemoryService
 from app.schemas.context import FactsStructured
 from app.schemas.relation_extract import CN_TO_EN_KIND
 from app.services.kg_provider import get_provider
+from app.services import context_cache, context_packer, token_counter
+from app.core.config import settings
 
 
 
@@ -25,6 +30,10 @@ class ContextAssembleParams:
     radius: Optional[int] = None
     top_k: Optional[int] = None
     pov_character: Optional[str] = None
+    # 目标 LLM 配置：按其上下文窗口推算 token 预算并选择对应的 token 估算器
+    llm_config_id: Optional[int] = None
+    # 显式 token 预算（优先于按 LLM 配置推算）
+    token_budget: Optional[int] = None
 
 
 @dataclass
@@ -43,154 +52,36 @@ class AssembledContext:
         return "\n\n".join(parts)
 
 
-def _truncate(text: str, limit: int) -> str:
-    if len(text) <= limit:
-        return text
-    return text[: max(0, limit - 200)] + "\n...[已截断]"
-
-
 def _compose_facts_subgraph_stub() -> str:
     return "关键事实：暂无（尚未收集）。"
 
 
 
-def assemble_context(session: Session, params: ContextAssembleParams) -> AssembledContext:
-    facts_quota = 5000
-
-    eff_participants: List[str] = list(params.participants or [])
-    participant_set = set(eff_participants)
-
-    # 启发式动态调整：参与者越多，TopK 越大，半径越小
-    p_count = len(eff_participants)
-    default_radius = 2
-    if p_count > 5:
-        default_radius = 1
-    elif p_count == 0:
-        default_radius = 0
-        
-    eff_radius = params.radius if params.radius is not None else default_radius
-    
-    # TopK 启发式：每个参与者预留 15 个事实，最小 20，最大 150
-    default_top_k = max(20, min(150, p_count * 15))
-    eff_top_k = params.top_k if params.top_k is not None else default_top_k
-
-    facts_text = _compose_facts_subgraph_stub()
-    facts_structured: Optional[Dict[str, Any]] = None
-    try:
-        provider = get_provider()
-        # 放宽：边类型允许任意（排除 HAS_ALIAS），以兼容旧图/新图
-        edge_whitelist = None
-        sub_struct = provider.query_subgraph(
-            project_id=params.project_id or -1,
-            participants=eff_participants,
-            radius=eff_radius,
-            edge_type_whitelist=edge_whitelist,
-            top_k=eff_top_k,
-            max_chapter_id=params.chapter_id,
-            pov_character=params.pov_character,
-        )
-        raw_relation_items = [it for it in (sub_struct.get("relation_summaries") or []) if isinstance(it, dict)]
-        filtered_relation_items = [
-            it for it in raw_relation_items
-            if (str(it.get("a")) in participant_set and str(it.get("b")) in participant_set)
-        ]
-        if filtered_relation_items:
-            lines: List[str] = ["关键事实："]
-            for it in filtered_relation_items:
-                a = str(it.get("a")); b = str(it.get("b")); kind_cn = str(it.get("kind") or "其他")
-                pred_en = CN_TO_EN_KIND.get(kind_cn, kind_cn)
-                lines.append(f"- {a} {pred_en} {b}")
-            facts_text = "\n".join(lines)
-        else:
-            raw = sub_struct
-            txt = "\n".join([f"- {f}" for f in (raw.get("fact_summaries") or [])])
-            if txt:
-                facts_text = "关键事实：\n" + txt
-        try:
-            from app.schemas.context import FactsStructured as _FactsStructured
-            fs_model = _FactsStructured(
-                fact_summaries=list(sub_struct.get("fact_summaries") or []),
-                relation_summaries=[
-                    {
-                        "a": it.get("a"),
-                        "b": it.get("b"),
-                        "kind": it.get("kind"),
-                        "description": it.get("description"),
-                        "a_to_b_addressing": it.get("a_to_b_addressing"),
-                        "b_to_a_addressing": it.get("b_to_a_addressing"),
-                        "recent_dialogues": it.get("recent_dialogues") or [],
-                        "recent_event_summaries": it.get("recent_event_summaries") or [],
-                        "stance": it.get("stance"),
-                    }
-                    for it in filtered_relation_items
-                ],
-            )
-            facts_structured = fs_model.model_dump()
-        except Exception:
-            facts_structured = {
-                "fact_summaries": sub_struct.get("fact_summaries") or [],
-                "relation_summaries": filtered_relation_items,
-from __future__ import annotations
-
-import os
-from dataclasses import dataclass
-from typing import Any, Dict, List, Optional, Tuple
-from sqlmodel import Session, select
-
-from app.db.models import Card, CardType
-from app.services.memory_service import MemoryService
-from app.schemas.context import FactsStructured
-from app.schemas.relation_extract import CN_TO_EN_KIND
-from app.services.kg_provider import get_provider
-
-
-
 @dataclass
-class ContextAssembleParams:
-    project_id: Optional[int] = None
-    volume_number: Optional[int] = None
-    chapter_number: Optional[int] = None
-    participants: Optional[List[str]] = None
-    current_draft_tail: Optional[str] = None
-    recent_chapters_window: Optional[int] = None
-    chapter_id: Optional[int] = None
-    radius: Optional[int] = None
-    top_k: Optional[int] = None
-    pov_character: Optional[str] = None
+class _Plan:
+    """装配前解析出的有效参数与缓存键"""
+    participants: List[str]
+    radius: int
+    top_k: int
+    draft_query: Optional[str]
+    budget: int
+    provider: Optional[str]
+    cache_key: Optional[Tuple[Any, ...]]
 
 
 @dataclass
-class AssembledContext:
-    facts_subgraph: str
-    budget_stats: Dict[str, Any]
-    facts_structured: Optional[Dict[str, Any]] = None
-    writing_guide: Optional[str] = None
-
-    def to_system_prompt_block(self) -> str:
-        parts: List[str] = []
-        if self.facts_subgraph:
-            parts.append(f"[事实子图]\n{self.facts_subgraph}")
-        if self.writing_guide:
-            parts.append(f"[写作指南]\n{self.writing_guide}")
-        return "\n\n".join(parts)
+class _FactsResult:
+    """图谱查询结果：有参与者间关系时用关系，否则退回事实摘要"""
+    relations: List[Dict[str, Any]]
+    fact_summaries: List[str]
 
 
-def _truncate(text: str, limit: int) -> str:
-    if len(text) <= limit:
-        return text
-    return text[: max(0, limit - 200)] + "\n...[已截断]"
+_FACTS_HEADER = "关键事实："
+_VECTOR_HEADER = "相关原文片段："
 
 
-def _compose_facts_subgraph_stub() -> str:
-    return "关键事实：暂无（尚未收集）。"
-
-
-
-def assemble_context(session: Session, params: ContextAssembleParams) -> AssembledContext:
-    facts_quota = 5000
-
+def _plan(session: Session, params: ContextAssembleParams) -> _Plan:
     eff_participants: List[str] = list(params.participants or [])
-    participant_set = set(eff_participants)
 
     # 启发式动态调整：参与者越多，TopK 越大，半径越小
     p_count = len(eff_participants)
@@ -206,98 +97,284 @@ def assemble_context(session: Session, params: ContextAssembleParams) -> Assembl
     default_top_k = max(20, min(150, p_count * 15))
     eff_top_k = params.top_k if params.top_k is not None else default_top_k
 
-    facts_text = _compose_facts_subgraph_stub()
-    facts_structured: Optional[Dict[str, Any]] = None
+    draft_query = params.current_draft_tail[-200:] if params.current_draft_tail else None
+    budget, provider = context_packer.resolve_budget(session, params.llm_config_id, params.token_budget)
+    cache_key = None
+    if params.project_id:
+        cache_key = context_cache.make_key(
+            params.project_id,
+            context_cache.project_version(params.project_id),
+            eff_participants,
+            params.chapter_id,
+            params.pov_character,
+            eff_radius,
+            eff_top_k,
+            draft_query,
+            budget,
+            token_counter.provider_family(provider),
+        )
+    return _Plan(eff_participants, eff_radius, eff_top_k, draft_query, budget, provider, cache_key)
+
+
+def _fetch_facts(params: ContextAssembleParams, plan: _Plan) -> _FactsResult:
+    """知识图谱子图 → 参与者间关系与事实摘要；图谱不可用时抛出异常"""
+    participant_set = set(plan.participants)
+    provider = get_provider()
+    # 放宽：边类型允许任意（排除 HAS_ALIAS），以兼容旧图/新图
+    edge_whitelist = None
+    sub_struct = provider.query_subgraph(
+        project_id=params.project_id or -1,
+        participants=plan.participants,
+        radius=plan.radius,
+        edge_type_whitelist=edge_whitelist,
+        top_k=plan.top_k,
+        max_chapter_id=params.chapter_id,
+        pov_character=params.pov_character,
+    )
+    raw_relation_items = [it for it in (sub_struct.get("relation_summaries") or []) if isinstance(it, dict)]
+    # radius > 0 时图谱已按跳数做有界扩展，多跳关系保留并由打包按跳数降权；否则只保留参与者之间的关系
+    filtered_relation_items = raw_relation_items if plan.radius > 0 else [
+        it for it in raw_relation_items
+        if (str(it.get("a")) in participant_set and str(it.get("b")) in participant_set)
+    ]
+    return _FactsResult(
+        relations=filtered_relation_items,
+        fact_summaries=[str(f) for f in (sub_struct.get("fact_summaries") or [])],
+    )
+
+
+def _fetch_writing_guide(session: Session, project_id: Optional[int]) -> Optional[str]:
+    """提取写作指南（如果存在）"""
+    if not project_id:
+        return None
+    guide_card = session.exec(
+        select(Card).where(Card.project_id == project_id, Card.title == "写作指南")
+    ).first()
+    if guide_card:
+        return str(guide_card.content) if guide_card.content else None
+    return None
+
+
+def _fetch_writing_guide_isolated(bind: Any, project_id: Optional[int]) -> Optional[str]:
+    # 在工作线程中执行：使用独立会话，调用方的会话不跨线程共享
+    with Session(bind) as own_session:
+        return _fetch_writing_guide(own_session, project_id)
+
+
+def _fetch_vector_results(project_id: Optional[int], draft_query: Optional[str]) -> List[Dict[str, Any]]:
+    """向量检索增强：以当前草稿尾部为查询召回相关原文片段（含距离，供打分）"""
+    if not project_id or not draft_query:
+        return []
+    from app.services.vector_service import VectorService
+    vec_svc = VectorService()
+    return vec_svc.search(project_id, draft_query, top_k=3) or []
+
+
+def _relation_line(item: Dict[str, Any]) -> str:
+    a = str(item.get("a")); b = str(item.get("b")); kind_cn = str(item.get("kind") or "其他")
+    pred_en = CN_TO_EN_KIND.get(kind_cn, kind_cn)
+    return f"- {a} {pred_en} {b}"
+
+
+def _structured(relations: List[Dict[str, Any]], fact_summaries: List[str]) -> Dict[str, Any]:
     try:
-        provider = get_provider()
-        # 放宽：边类型允许任意（排除 HAS_ALIAS），以兼容旧图/新图
-        edge_whitelist = None
-        sub_struct = provider.query_subgraph(
-            project_id=params.project_id or -1,
-            participants=eff_participants,
-            radius=eff_radius,
-            edge_type_whitelist=edge_whitelist,
-            top_k=eff_top_k,
-            max_chapter_id=params.chapter_id,
-            pov_character=params.pov_character,
+        fs_model = FactsStructured(
+            fact_summaries=fact_summaries,
+            relation_summaries=[
+                {
+                    "a": it.get("a"),
+                    "b": it.get("b"),
+                    "kind": it.get("kind"),
+                    "description": it.get("description"),
+                    "a_to_b_addressing": it.get("a_to_b_addressing"),
+                    "b_to_a_addressing": it.get("b_to_a_addressing"),
+                    "recent_dialogues": it.get("recent_dialogues") or [],
+                    "recent_event_summaries": it.get("recent_event_summaries") or [],
+                    "stance": it.get("stance"),
+                }
+                for it in relations
+            ],
         )
-        raw_relation_items = [it for it in (sub_struct.get("relation_summaries") or []) if isinstance(it, dict)]
-        filtered_relation_items = [
-            it for it in raw_relation_items
-            if (str(it.get("a")) in participant_set and str(it.get("b")) in participant_set)
-        ]
-        if filtered_relation_items:
-            lines: List[str] = ["关键事实："]
-            for it in filtered_relation_items:
-                a = str(it.get("a")); b = str(it.get("b")); kind_cn = str(it.get("kind") or "其他")
-                pred_en = CN_TO_EN_KIND.get(kind_cn, kind_cn)
-                lines.append(f"- {a} {pred_en} {b}")
-            facts_text = "\n".join(lines)
-        else:
-            raw = sub_struct
-            txt = "\n".join([f"- {f}" for f in (raw.get("fact_summaries") or [])])
-            if txt:
-                facts_text = "关键事实：\n" + txt
-        try:
-            from app.schemas.context import FactsStructured as _FactsStructured
-            fs_model = _FactsStructured(
-                fact_summaries=list(sub_struct.get("fact_summaries") or []),
-                relation_summaries=[
-                    {
-                        "a": it.get("a"),
-                        "b": it.get("b"),
-                        "kind": it.get("kind"),
-                        "description": it.get("description"),
-                        "a_to_b_addressing": it.get("a_to_b_addressing"),
-                        "b_to_a_addressing": it.get("b_to_a_addressing"),
-                        "recent_dialogues": it.get("recent_dialogues") or [],
-                        "recent_event_summaries": it.get("recent_event_summaries") or [],
-                        "stance": it.get("stance"),
-                    }
-                    for it in filtered_relation_items
-                ],
-            )
-            facts_structured = fs_model.model_dump()
-        except Exception:
-            facts_structured = {
-                "fact_summaries": sub_struct.get("fact_summaries") or [],
-                "relation_summaries": filtered_relation_items,
-            }
+        return fs_model.model_dump()
     except Exception:
-        pass
-
-    facts = _truncate(facts_text, facts_quota)
+        return {
+            "fact_summaries": fact_summaries,
+            "relation_summaries": relations,
+        }
+
+
+def _candidates(params: ContextAssembleParams, plan: _Plan, facts: Optional[_FactsResult],
+                writing_guide: Optional[str], vector_results: List[Dict[str, Any]]) -> List[context_packer.Candidate]:
+    Candidate = context_packer.Candidate
+    cands: List[Candidate] = []
+    if facts is not None:
+        if facts.relations:
+            for it in facts.relations:
+                cands.append(Candidate(
+                    context_packer.KIND_RELATION, _relation_line(it),
+                    context_packer.score_relation(it, plan.participants, params.chapter_id), ref=it,
+                ))
+        else:
+            for fact in facts.fact_summaries:
+                cands.append(Candidate(
+                    context_packer.KIND_FACT, f"- {fact}",
+                    context_packer.score_fact(fact, plan.participants), ref=fact,
+                ))
+    for r in vector_results:
+        cands.append(Candidate(
+            context_packer.KIND_VECTOR, f"- {r.get('text')}",
+            context_packer.score_vector(r, plan.participants), ref=r,
+        ))
+    if writing_guide:
+        sections = context_packer.guide_sections(writing_guide)
+        for i, section in enumerate(sections):
+            cands.append(Candidate(
+                context_packer.KIND_GUIDE, section,
+                context_packer.score_guide_section(i, len(sections)), ref=i,
+            ))
+    return cands
+
+
+def _finish(params: ContextAssembleParams, plan: _Plan, facts: Optional[_FactsResult], writing_guide: Optional[str],
+            vector_results: List[Dict[str, Any]], sources: Dict[str, Dict[str, Any]], started: float) -> AssembledContext:
+    # 按相关性在 token 预算内挑选关系/事实、向量片段与写作指南段落，替代按字符截断
+    packed = context_packer.pack(
+        _candidates(params, plan, facts, writing_guide, vector_results),
+        plan.budget,
+        plan.provider,
+        headers={
+            context_packer.KIND_RELATION: _FACTS_HEADER,
+            context_packer.KIND_FACT: _FACTS_HEADER,
+            context_packer.KIND_VECTOR: _VECTOR_HEADER,
+        },
+    )
+    fact_lines = [c.text for c in packed.kept if c.kind in (context_packer.KIND_RELATION, context_packer.KIND_FACT)]
+    facts_text = "\n".join([_FACTS_HEADER, *fact_lines]) if fact_lines else _compose_facts_subgraph_stub()
+    vector_lines = [c.text for c in packed.kept_of(context_packer.KIND_VECTOR)]
+    final_facts = facts_text
+    if vector_lines:
+        final_facts = f"{facts_text}\n\n" + "\n".join([_VECTOR_HEADER, *vector_lines])
+
+    # 写作指南保持原段落顺序
+    guide_kept = sorted(packed.kept_of(context_packer.KIND_GUIDE), key=lambda c: c.ref)
+    packed_guide = "\n\n".join(c.text for c in guide_kept) if guide_kept else None
+
+    facts_structured = None
+    if facts is not None:
+        # 结构化事实同样只含入选条目（前端会把它拼进提示词）
+        facts_structured = _structured(
+            [c.ref for c in packed.kept_of(context_packer.KIND_RELATION)],
+            [c.ref for c in packed.kept_of(context_packer.KIND_FACT)],
+        )
 
-    # 提取写作指南（如果存在）
-    writing_guide: Optional[str] = None
-    if params.project_id:
-        guide_card = session.exec(
-            select(Card).where(Card.project_id == params.project_id, Card.title == "写作指南")
-        ).first()
-        if guide_card:
-            writing_guide = str(guide_card.content) if guide_card.content else None
-
-    # ---------------- 向量检索增强 ----------------
-    vector_context = ""
-    if params.project_id and params.current_draft_tail:
-        try:
-            from app.services.vector_service import VectorService
-            vec_svc = VectorService()
-            # 使用当前草稿尾部作为查询
-            query = params.current_draft_tail[-200:] 
-            vec_results = vec_svc.search(params.project_id, query, top_k=3)
-            if vec_results:
-                vector_context = "相关原文片段：\n" + "\n".join([f"- {r['text']}" for r in vec_results])
-        except Exception as e:
-            pass
-            
-    final_facts = facts
-    if vector_context:
-        final_facts = f"{facts}\n\n{vector_context}"
-
-    return AssembledContext(
+    assembled = AssembledContext(
         facts_subgraph=final_facts,
-        budget_stats={},
+        budget_stats={
+            "cache": "miss",
+            "total_ms": round((time.perf_counter() - started) * 1000, 1),
+            "sources": sources,
+            **packed.stats(token_counter.get_estimator(plan.provider).name),
+        },
         facts_structured=facts_structured,
-        writing_guide=writing_guide,
-    )
\ No newline at end of file
+        writing_guide=packed_guide,
+    )
+    # 任一来源失败或超时得到的是降级结果（占位事实/缺少片段），不缓存，以便恢复后立即生效
+    if plan.cache_key is not None and all(src["status"] in ("ok", "skipped") for src in sources.values()):
+        context_cache.store(plan.cache_key, assembled)
+    return assembled
+
+
+def _from_cache(plan: _Plan, started: float) -> Optional[AssembledContext]:
+    if plan.cache_key is None:
+        return None
+    cached = context_cache.lookup(plan.cache_key)
+    if cached is None:
+        return None
+    # 保留装配时各来源的耗时与打包结果（预算、入选/丢弃明细），只更新命中标记与本次耗时
+    cached.budget_stats = {
+        **(cached.budget_stats or {}),
+        "cache": "hit",
+        "total_ms": round((time.perf_counter() - started) * 1000, 1),
+    }
+    return cached
+
+
+def _run_source(name: str, sources: Dict[str, Dict[str, Any]], fn: Callable[..., Any], *args: Any) -> Any:
+    """同步执行单个来源并记录耗时；失败时记为 error 并返回 None"""
+    start = time.perf_counter()
+    try:
+        result = fn(*args)
+        sources[name] = {"status": "ok", "ms": round((time.perf_counter() - start) * 1000, 1)}
+        return result
+    except Exception as e:  # noqa: BLE001
+        sources[name] = {"status": "error", "ms": round((time.perf_counter() - start) * 1000, 1), "error": str(e)[:200]}
+        return None
+
+
+def assemble_context(session: Session, params: ContextAssembleParams) -> AssembledContext:
+    """同步装配（工作流节点等同步调用方使用）：三个来源依次查询"""
+    started = time.perf_counter()
+    plan = _plan(session, params)
+    # 命中缓存时跳过图谱查询、写作指南查询与向量检索；项目数据变化时缓存随版本失效
+    cached = _from_cache(plan, started)
+    if cached is not None:
+        return cached
+
+    sources: Dict[str, Dict[str, Any]] = {}
+    facts = _run_source("graph", sources, _fetch_facts, params, plan)
+    writing_guide = _run_source("writing_guide", sources, _fetch_writing_guide, session, params.project_id)
+    vector_results: List[Dict[str, Any]] = []
+    if params.project_id and plan.draft_query:
+        vector_results = _run_source("vector", sources, _fetch_vector_results, params.project_id, plan.draft_query) or []
+    else:
+        sources["vector"] = {"status": "skipped", "ms": 0.0}
+    return _finish(params, plan, facts, writing_guide, vector_results, sources, started)
+
+
+async def _run_source_async(name: str, sources: Dict[str, Dict[str, Any]], timeout: float,
+                            fn: Callable[..., Any], *args: Any) -> Any:
+    """在工作线程中执行单个来源，超时或失败时降级为 None（超时的线程在后台自行结束）"""
+    start = time.perf_counter()
+    try:
+        result = await asyncio.wait_for(asyncio.to_thread(fn, *args), timeout)
+        sources[name] = {"status": "ok", "ms": round((time.perf_counter() - start) * 1000, 1)}
+        return result
+    except asyncio.TimeoutError:
+        sources[name] = {"status": "timeout", "ms": round((time.perf_counter() - start) * 1000, 1)}
+        logger.warning(f"[上下文装配] 来源 {name} 超时 timeout={timeout}s，降级处理")
+    except Exception as e:  # noqa: BLE001
+        sources[name] = {"status": "error", "ms": round((time.perf_counter() - start) * 1000, 1), "error": str(e)[:200]}
+        logger.warning(f"[上下文装配] 来源 {name} 失败，降级处理: {e}")
+    return None
+
+
+async def assemble_context_async(
+    session: Session,
+    params: ContextAssembleParams,
+    source_timeout: Optional[float] = None,
+) -> AssembledContext:
+    """异步装配：图谱、写作指南、向量检索三个来源在工作线程中并发查询，不阻塞事件循环。
+
+    每个来源单独限时（默认 CONTEXT_SOURCE_TIMEOUT_SEC），超时或失败时降级：
+    图谱 → 占位事实，写作指南 → 无，向量检索 → 无相关片段。各来源耗时与状态写入 budget_stats。
+    """
+    started = time.perf_counter()
+    plan = _plan(session, params)
+    cached = _from_cache(plan, started)
+    if cached is not None:
+        return cached
+
+    timeout = source_timeout if source_timeout is not None else settings.CONTEXT_SOURCE_TIMEOUT_SEC
+    sources: Dict[str, Dict[str, Any]] = {}
+    jobs = [
+        _run_source_async("graph", sources, timeout, _fetch_facts, params, plan),
+        _run_source_async("writing_guide", sources, timeout, _fetch_writing_guide_isolated,
+                          session.get_bind(), params.project_id),
+    ]
+    if params.project_id and plan.draft_query:
+        jobs.append(_run_source_async("vector", sources, timeout, _fetch_vector_results,
+                                      params.project_id, plan.draft_query))
+    else:
+        sources["vector"] = {"status": "skipped", "ms": 0.0}
+    facts, writing_guide, *rest = await asyncio.gather(*jobs)
+    return _finish(params, plan, facts, writing_guide, (rest[0] if rest else None) or [], sources, started)
@@ -105,6 +105,8 @@ class DynamicInfoService:
             output_type=UpdateDynamicInfo,
             system_prompt=system_prompt,
             timeout=timeout,
+            # 抽取任务对同一正文与提示词的结果应当稳定，强制启用响应缓存
+            cache=True,
         )
 
         if not isinstance(res, UpdateDynamicInfo):
@@ -2,9 +2,12 @@ from __future__ import annotations
 
 import os
 import json
+import threading
 from typing import Any, Dict, List, Optional, Tuple, Protocol
+from loguru import logger
 from app.schemas.relation_extract import EN_TO_CN_KIND
 from app.core.config import settings
+from app.services import context_cache
 
 
 class KnowledgeGraphUnavailableError(RuntimeError):
@@ -24,10 +27,43 @@ class KnowledgeGraphProvider(Protocol):
 		max_chapter_id: Optional[int] = None,
 		pov_character: Optional[str] = None,
 	) -> Dict[str, Any]: ...
+	def profile_subgraph(
+		self,
+		project_id: int,
+		participants: Optional[List[str]] = None,
+		radius: int = 2,
+		edge_type_whitelist: Optional[List[str]] = None,
+		top_k: int = 50,
+		max_chapter_id: Optional[int] = None,
+		pov_character: Optional[str] = None,
+	) -> Dict[str, Any]: ...
 	def delete_project_graph(self, project_id: int) -> None: ...
 	def get_full_graph(self, project_id: int) -> Dict[str, Any]: ...
 
 
+# 子图查询依赖的索引（每个进程只尝试创建一次）
+_INDEX_STATEMENTS = (
+	"CREATE INDEX entity_group_name IF NOT EXISTS FOR (n:Entity) ON (n.group_id, n.name)",
+)
+_indexes_lock = threading.Lock()
+_indexes_ready = False
+
+
+def _sum_db_hits(plan: Dict[str, Any]) -> int:
+	return int(plan.get("dbHits") or 0) + sum(_sum_db_hits(c) for c in plan.get("children") or [])
+
+
+def _compact_plan(plan: Dict[str, Any]) -> Dict[str, Any]:
+	args = plan.get("args") or {}
+	return {
+		"operator": plan.get("operatorType"),
+		"details": args.get("Details") or args.get("ExpandExpression") or args.get("LegacyExpression"),
+		"rows": plan.get("rows"),
+		"db_hits": plan.get("dbHits"),
+		"children": [_compact_plan(c) for c in plan.get("children") or []],
+	}
+
+
 class Neo4jKGProvider:
 	def __init__(self) -> None:
 		from neo4j import GraphDatabase  # type: ignore
@@ -35,6 +71,25 @@ class Neo4jKGProvider:
 			settings.NEO4J_URI, 
 			auth=(settings.NEO4J_USER, settings.NEO4J_PASSWORD)
 		)
+		self._ensure_indexes()
+
+	def _ensure_indexes(self) -> None:
+		"""(group_id, name) 复合索引：子图查询的起点定位与写入时的 MERGE 都依赖它"""
+		global _indexes_ready
+		if _indexes_ready:
+			return
+		with _indexes_lock:
+			if _indexes_ready:
+				return
+			try:
+				with self._driver.session() as sess:
+					for stmt in _INDEX_STATEMENTS:
+						sess.run(stmt).consume()
+				logger.info("[知识图谱] 已确保索引 Entity(group_id, name)")
+			except Exception as e:
+				# 只读账号或图谱暂不可用：不阻塞查询，本进程内不再重复尝试
+				logger.warning(f"[知识图谱] 创建索引失败，查询将退化为标签扫描: {e}")
+			_indexes_ready = True
 
 	def close(self) -> None:
 		try:
@@ -98,6 +153,68 @@ class Neo4jKGProvider:
 				if "Security.Forbidden" in error_msg or "access denied" in error_msg.lower():
 					raise RuntimeError(f"知识图谱写入失败: 权限不足 (Neo4j Access Denied)。请检查数据库用户权限或是否处于只读模式。详情: {error_msg}")
 				raise RuntimeError(f"知识图谱写入失败: {error_msg}")
+		context_cache.bump(project_id, "知识图谱写入")
+
+	@staticmethod
+	def _subgraph_query(
+		group: str,
+		parts: List[str],
+		radius: int,
+		edge_type_whitelist: Optional[List[str]],
+		top_k: int,
+		max_chapter_id: Optional[int],
+		pov_character: Optional[str],
+	) -> Tuple[str, Dict[str, Any]]:
+		"""构造子图查询：从参与者出发做有界变长扩展，白名单、时间切片与 POV 过滤都在库内对路径上每条边生效。
+
+		radius <= 0 时只取参与者之间的边；否则取距任一参与者不超过 radius 跳的边。
+		结果按跳数升序、两端为参与者的边优先、生效章节（valid_from）越新越靠前排序，取前 top_k。
+		"""
+		conds: List[str] = []
+		if edge_type_whitelist:
+			conds.append("(r.kind_en IN $whitelist OR r.kind IN $whitelist)")
+		if max_chapter_id is not None:
+			conds.append("(r.valid_from IS NULL OR r.valid_from <= $max_chapter_id) AND (r.valid_until IS NULL OR r.valid_until >= $max_chapter_id)")
+		if pov_character:
+			conds.append("(r.observed_by IS NULL OR r.observed_by = $pov_character)")
+		rel_filter = " AND ".join(conds)
+		params: Dict[str, Any] = {
+			"group": group,
+			"parts": parts,
+			"limit": max(1, int(top_k)),
+			"whitelist": list(edge_type_whitelist or []),
+			"max_chapter_id": max_chapter_id,
+			"pov_character": pov_character,
+		}
+		# 先排序截断再投影：RETURN 中的 a/b 别名会遮蔽节点变量
+		ranking = (
+			"WITH a, r, b, hops, "
+			"CASE WHEN a.name IN $parts THEN 1 ELSE 0 END + CASE WHEN b.name IN $parts THEN 1 ELSE 0 END AS anchored "
+			"ORDER BY hops ASC, anchored DESC, coalesce(r.valid_from, -1) DESC "
+			"LIMIT $limit "
+			"RETURN a.name AS a, 'RELATES_TO' AS t, b.name AS b, r {.*} AS props, hops"
+		)
+		if radius <= 0:
+			cypher = (
+				"MATCH (a:Entity {group_id:$group})-[r:RELATES_TO]->(b:Entity {group_id:$group}) "
+				"WHERE a.name IN $parts AND b.name IN $parts "
+				+ (f"AND {rel_filter} " if rel_filter else "")
+				+ "WITH a, r, b, 1 AS hops "
+				+ ranking
+			)
+			return cypher, params
+		# 变长上界不能参数化，radius 已限制为整数并封顶
+		hop_limit = min(int(radius), settings.KG_MAX_RADIUS)
+		cypher = (
+			"MATCH (p:Entity {group_id:$group}) WHERE p.name IN $parts "
+			f"MATCH path = (p)-[:RELATES_TO*1..{hop_limit}]-(:Entity {{group_id:$group}}) "
+			+ (f"WHERE all(r IN relationships(path) WHERE {rel_filter}) " if rel_filter else "")
+			+ "WITH last(relationships(path)) AS r, length(path) AS hops "
+			"WITH r, min(hops) AS hops "
+			"WITH startNode(r) AS a, r, endNode(r) AS b, hops "
+			+ ranking
+		)
+		return cypher, params
 
 	def query_subgraph(
 		self,
@@ -114,28 +231,18 @@ class Neo4jKGProvider:
 		if not parts:
 			return {"nodes": [], "edges": [], "alias_table": {}, "fact_summaries": [], "relation_summaries": []}
 
-		# 仅查询 RELATES_TO，支持时间切片和 POV 过滤
-		where_clause = "a.name IN $parts AND b.name IN $parts"
-		if max_chapter_id is not None:
-			where_clause += " AND (r.valid_from IS NULL OR r.valid_from <= $max_chapter_id) AND (r.valid_until IS NULL OR r.valid_until >= $max_chapter_id)"
-		
-		if pov_character:
-			where_clause += " AND (r.observed_by IS NULL OR r.observed_by = $pov_character)"
-
-		rel_cypher = (
-			f"MATCH (a:Entity {{group_id:$group}})-[r:RELATES_TO]->(b:Entity {{group_id:$group}}) "
-			f"WHERE {where_clause} "
-			"RETURN a.name AS a, 'RELATES_TO' AS t, b.name AS b, r {.*} as props "
-			"LIMIT $limit"
+		rel_cypher, query_params = self._subgraph_query(
+			group, parts, radius, edge_type_whitelist, top_k, max_chapter_id, pov_character
 		)
 
 		fact_summaries: List[str] = []
 		rel_items: Dict[Tuple[str, str, str], Dict[str, Any]] = {}
 		edges: List[Dict[str, Any]] = []
 		with self._driver.session() as sess:
-			results = sess.run(rel_cypher, group=group, parts=parts, limit=max(1, int(top_k)), max_chapter_id=max_chapter_id, pov_character=pov_character)
+			results = sess.run(rel_cypher, **query_params)
 			for rec in results:
 				a = rec["a"]; b = rec["b"]; t = rec["t"]; props = rec["props"] or {}
+				hops = rec["hops"]
 				# 中文关系类型优先来自属性
 				kind_cn = props.get("kind") or props.get("kind_cn") or None
 				if not kind_cn and props.get("kind_en"):
@@ -145,7 +252,9 @@ class Neo4jKGProvider:
 				fact = props.get("fact") or f"{a} relates_to {b}"
 				key = (a, b, str(kind_cn))
 				if key not in rel_items:
-					rel_items[key] = { "a": a, "b": b, "kind": kind_cn }
+					rel_items[key] = { "a": a, "b": b, "kind": kind_cn, "hops": hops }
+				# 生效章节：上下文打包按其新近度打分
+				if props.get("valid_from") is not None: rel_items[key]["valid_from"] = props.get("valid_from")
 				# 附带属性
 				try:
 					ev = json.loads(props.get("recent_event_summaries_json") or "[]")
@@ -162,7 +271,7 @@ class Neo4jKGProvider:
 				if len(fact_summaries) < top_k:
 					fact_summaries.append(fact)
 				if len(edges) < top_k:
-					edges.append({"source": a, "target": b, "type": "relates_to", "fact": fact, "kind": kind_cn})
+					edges.append({"source": a, "target": b, "type": "relates_to", "fact": fact, "kind": kind_cn, "hops": hops})
 
 		relation_summaries = list(rel_items.values())
 		return {
@@ -173,6 +282,36 @@ class Neo4jKGProvider:
 			"relation_summaries": relation_summaries,
 		}
 
+	def profile_subgraph(
+		self,
+		project_id: int,
+		participants: Optional[List[str]] = None,
+		radius: int = 2,
+		edge_type_whitelist: Optional[List[str]] = None,
+		top_k: int = 50,
+		max_chapter_id: Optional[int] = None,
+		pov_character: Optional[str] = None,
+	) -> Dict[str, Any]:
+		"""以 PROFILE 执行与 query_subgraph 相同的查询，返回执行计划（各算子行数与 dbHits）"""
+		group = self._group(project_id)
+		parts = [p for p in (participants or []) if isinstance(p, str) and p.strip()]
+		cypher, query_params = self._subgraph_query(
+			group, parts, radius, edge_type_whitelist, top_k, max_chapter_id, pov_character
+		)
+		with self._driver.session() as sess:
+			result = sess.run("PROFILE " + cypher, **query_params)
+			rows = len(list(result))
+			summary = result.consume()
+		plan = summary.profile or {}
+		return {
+			"cypher": cypher,
+			"rows": rows,
+			"db_hits": _sum_db_hits(plan),
+			"available_after_ms": summary.result_available_after,
+			"consumed_after_ms": summary.result_consumed_after,
+			"plan": _compact_plan(plan),
+		}
+
 	def delete_project_graph(self, project_id: int) -> None:
 		"""删除某个项目(group_id)下的所有节点和关系。"""
 		group = self._group(project_id)
@@ -180,6 +319,7 @@ class Neo4jKGProvider:
 			# 先删关系再删节点
 			sess.run("MATCH (n:Entity {group_id:$group})-[r]-() DELETE r", group=group)
 			sess.run("MATCH (n:Entity {group_id:$group}) DELETE n", group=group)
+		context_cache.bump(project_id, "知识图谱删除")
 
 	def get_full_graph(self, project_id: int) -> Dict[str, Any]:
 		"""获取某个项目下的完整图谱数据（节点与关系）。"""
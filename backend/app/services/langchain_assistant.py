@@ -36,6 +36,10 @@ from app.services.agent_service import (
     _record_usage,
     _precheck_quota,
 )
+from app.services import token_counter
+from app.services.llm_fake import create_fake_chat_model
+from app.services.llm_model_pool import chat_model_pool
+from app.services.llm_scheduler import llm_scheduler
 from app.services.assistant_tools.ai_tools import (
     AssistantDeps,
     ASSISTANT_TOOLS,
@@ -383,6 +387,40 @@ def build_chat_model(
     max_tokens: Optional[int] = None,
     timeout: Optional[float] = None,
     thinking_enabled: Optional[bool] = None,
+):
+    """
+    从LLMConfig获取一个LangChain ChatModel。
+
+    相同配置与采样参数的实例从 chat_model_pool 复用，不再每次调用都新建客户端。
+    """
+
+    cfg = _get_llm_config(session, llm_config_id)
+    params = (
+        None if temperature is None else float(temperature),
+        None if max_tokens is None else int(max_tokens),
+        None if timeout is None else float(timeout),
+        bool(thinking_enabled),
+    )
+    return chat_model_pool.get(
+        cfg,
+        params,
+        lambda: _create_chat_model(
+            cfg,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            timeout=timeout,
+            thinking_enabled=thinking_enabled,
+        ),
+    )
+
+
+def _create_chat_model(
+    cfg: LLMConfig,
+    *,
+    temperature: Optional[float] = None,
+    max_tokens: Optional[int] = None,
+    timeout: Optional[float] = None,
+    thinking_enabled: Optional[bool] = None,
 ):
     """
     从LLMConfig创建一个LangChain ChatModel。
@@ -390,7 +428,6 @@ def build_chat_model(
     只使用一个小而稳定的初始化参数子集来避免版本特定问题。
     """
 
-    cfg = _get_llm_config(session, llm_config_id)
     provider = (cfg.provider or "").lower()
 
     # Shared kwargs for most providers
@@ -412,6 +449,16 @@ def build_chat_model(
         f"temperature={temperature}, max_tokens={max_tokens}, timeout={timeout}"
     )
 
+    # 本地假提供商：压测与离线基准用，行为参数见 app.services.llm_fake
+    if provider == "fake":
+        return create_fake_chat_model(cfg.model_name, cfg.api_base or cfg.base_url, max_tokens)
+
+    # OpenAI 兼容类提供商共享同一配置的 httpx 连接池
+    if provider in ("openai_compatible", "openai"):
+        http_client, http_async_client = chat_model_pool.http_clients(cfg)
+        common_kwargs["http_client"] = http_client
+        common_kwargs["http_async_client"] = http_async_client
+
     # OpenAI 兼容（优先使用 ChatQwen，以更好支持推理模型；原生ChatOpenAI虽然支持各种OpenAI兼容模型，但是似乎对推理支持不好）
     if provider == "openai_compatible":
         model_kwargs: dict = {
@@ -540,58 +587,77 @@ async def stream_chat_with_react(
             has_visible_text = False
             stream_state: dict[str, str] = {"buffer": ""}
 
-            async for chunk in model.astream(messages):
-                if not isinstance(chunk, AIMessageChunk):
-                    continue
-                delta_text, delta_reasonings = _extract_chunk_parts(chunk)
+            # 每一轮都是一次独立的模型请求，分别经全局调度器放行
+            step_in_tokens = sum(_estimate_tokens(str(getattr(m, "content", "") or "")) for m in messages)
+            grant = await llm_scheduler.acquire(
+                session, request.llm_config_id, step_in_tokens, priority="interactive", project_id=request.project_id
+            )
 
-                if delta_text:
-                    step_text += delta_text
+            try:
+                async for chunk in model.astream(messages):
+                    if not isinstance(chunk, AIMessageChunk):
+                        continue
+                    delta_text, delta_reasonings = _extract_chunk_parts(chunk)
 
-                # 处理 reasoning 内容（来自 content_blocks，与标准模式一致）
-                for seg in delta_reasonings or []:
-                    if seg:
-                        reasoning_accumulated += seg
+                    if delta_text:
+                        step_text += delta_text
+
+                    # 处理 reasoning 内容（来自 content_blocks，与标准模式一致）
+                    for seg in delta_reasonings or []:
+                        if seg:
+                            reasoning_accumulated += seg
+                            yield {
+                                "type": "reasoning",
+                                "data": {"text": seg, "delta": True},
+                            }
+
+                    # 清理协议标签后发送文本
+                    cleaned_delta = _process_react_stream_text(
+                        stream_state,
+                        delta_text or "",
+                    )
+
+                    if cleaned_delta:
+                        has_visible_text = True
+                        accumulated_text += cleaned_delta
                         yield {
-                            "type": "reasoning",
-                            "data": {"text": seg, "delta": True},
+                            "type": "token",
+                            "data": {"text": cleaned_delta, "delta": True},
                         }
 
-                # 清理协议标签后发送文本
-                cleaned_delta = _process_react_stream_text(
-                    stream_state,
-                    delta_text or "",
-                )
+                    if full_chunk is None:
+                        full_chunk = chunk
+                    else:
+                        full_chunk = full_chunk + chunk
 
-                if cleaned_delta:
+                tail_text = _flush_react_stream_state(stream_state)
+                if tail_text:
                     has_visible_text = True
-                    accumulated_text += cleaned_delta
+                    accumulated_text += tail_text
                     yield {
                         "type": "token",
-                        "data": {"text": cleaned_delta, "delta": True},
+                        "data": {"text": tail_text, "delta": True},
                     }
-
-                if full_chunk is None:
-                    full_chunk = chunk
-                else:
-                    full_chunk = full_chunk + chunk
-
-            tail_text = _flush_react_stream_state(stream_state)
-            if tail_text:
-                has_visible_text = True
-                accumulated_text += tail_text
-                yield {
-                    "type": "token",
-                    "data": {"text": tail_text, "delta": True},
-                }
+            except BaseException:
+                # 本轮请求抛错、被取消或下游关闭了流：按已生成部分结算，多余的预扣额度退还
+                grant.settle(step_in_tokens + _estimate_tokens(step_text))
+                raise
 
             response = _chunk_to_message(full_chunk, step_text)
             messages.append(response)
 
+            step_usage = step_in_tokens + _estimate_tokens(step_text)
             if full_chunk:
                 in_tokens, out_tokens = _extract_usage_from_chunk(full_chunk)
+                if in_tokens:
+                    token_counter.calibrate(
+                        _get_llm_config(session, request.llm_config_id).provider, step_in_tokens, in_tokens
+                    )
                 usage_in_total += in_tokens
                 usage_out_total += out_tokens
+                if in_tokens and out_tokens:
+                    step_usage = in_tokens + out_tokens
+            grant.settle(step_usage)
 
             # 直接从本轮累计的文本中解析 Action 协议。
             # 早期实现曾经要求 has_visible_text 才允许解析，为的是避免模型在纯思考阶段输出 <Action>。
@@ -761,6 +827,14 @@ async def stream_chat_with_tools(
 
     accumulated_text = ""
     reasoning_accumulated = ""
+    # 智能体内部的多轮模型调用无法逐次拦截，按一次请求申请额度，结束时按总用量结算
+    grant = await llm_scheduler.acquire(
+        session,
+        request.llm_config_id,
+        _calc_input_tokens(system_prompt, final_user_prompt),
+        priority="interactive",
+        project_id=request.project_id,
+    )
     # 若底层提供商支持，优先从 LangChain 返回的 usage 元数据中读取 token 消耗
     usage_input_tokens: Optional[int] = None
     usage_output_tokens: Optional[int] = None
@@ -938,6 +1012,7 @@ async def stream_chat_with_tools(
         else:
             in_tokens = _calc_input_tokens(system_prompt, final_user_prompt)
             out_tokens = _estimate_tokens(accumulated_text + reasoning_accumulated)
+        grant.settle(in_tokens + out_tokens)
         _record_usage(
             session,
             request.llm_config_id,
@@ -954,8 +1029,14 @@ async def stream_chat_with_tools(
                 "data": {"text": reasoning_accumulated},
             }
         return
-    except Exception as e:
-        logger.error(f"[LangChain+Agent] chat failed: {e}")
+    except (Exception, GeneratorExit) as e:
+        # 抛错或下游关闭了流：按已生成部分结算，多余的预扣额度退还
+        if not isinstance(e, GeneratorExit):
+            logger.error(f"[LangChain+Agent] chat failed: {e}")
+        grant.settle(
+            _calc_input_tokens(system_prompt, final_user_prompt)
+            + _estimate_tokens(accumulated_text + reasoning_accumulated)
+        )
         raise
 
     # 在正常结束时，如果存在 reasoning 内容，先推送一次供前端折叠展示
@@ -971,6 +1052,7 @@ async def stream_chat_with_tools(
     else:
         in_tokens = _calc_input_tokens(system_prompt, final_user_prompt)
         out_tokens = _estimate_tokens(accumulated_text + reasoning_accumulated)
+    grant.settle(in_tokens + out_tokens)
     _record_usage(
         session,
         request.llm_config_id,
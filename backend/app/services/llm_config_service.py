@@ -1,7 +1,9 @@
 
 from sqlmodel import Session, select
 from app.db.models import LLMConfig
-from app.schemas.llm_config import LLMConfigCreate, LLMConfigUpdate
+from app.schemas.llm_config import LLMConfigCreate, LLMConfigRead, LLMConfigUpdate
+from app.services.llm_model_pool import chat_model_pool
+from app.services.llm_usage_ledger import usage_ledger
 
 def create_llm_config(session: Session, config_in: LLMConfigCreate) -> LLMConfig:
     # 现在直接使用 config_in 创建模型，它会包含 api_key
@@ -13,8 +15,18 @@ def create_llm_config(session: Session, config_in: LLMConfigCreate) -> LLMConfig
     return db_config
 
 def get_llm_configs(session: Session) -> list[LLMConfig]:
+    # 节点/工具选取配置也走这里：不回写账本（同步写库）。行上的用量可能落后于账本，
+    # 需要展示用量时用 with_pending_usage 叠加内存中的最新值
     return session.exec(select(LLMConfig)).all()
 
+def with_pending_usage(cfg: LLMConfig) -> LLMConfigRead:
+    """配置的展示副本：用量取账本内存中的最新值（已落库 + 未落库增量），不写库"""
+    data = LLMConfigRead.model_validate(cfg)
+    usage = usage_ledger.current_usage(cfg.id)
+    if usage is not None:
+        data.used_tokens_input, data.used_tokens_output, data.used_calls = usage
+    return data
+
 def get_llm_config(session: Session, config_id: int) -> LLMConfig | None:
     return session.get(LLMConfig, config_id)
 
@@ -23,6 +35,10 @@ def update_llm_config(session: Session, config_id: int, config_in: LLMConfigUpda
     if not db_config:
         return None
     
+    # 直接修改用量时先回写增量，更新后账本按新的限额/用量重新读取
+    usage_ledger.flush()
+    session.refresh(db_config)
+
     # 直接更新数据，不再排除 api_key
     update_data = config_in.model_dump(exclude_unset=True)
     for key, value in update_data.items():
@@ -31,6 +47,8 @@ def update_llm_config(session: Session, config_id: int, config_in: LLMConfigUpda
     session.add(db_config)
     session.commit()
     session.refresh(db_config)
+    chat_model_pool.invalidate(config_id)
+    usage_ledger.reload(session, config_id)
     return db_config
 
 def delete_llm_config(session: Session, config_id: int) -> bool:
@@ -40,44 +58,34 @@ def delete_llm_config(session: Session, config_id: int) -> bool:
     
     session.delete(db_config)
     session.commit()
+    chat_model_pool.invalidate(config_id)
+    usage_ledger.forget(config_id)
     return True 
 
 
 def can_consume(session: Session, config_id: int, need_input_tokens: int, need_output_tokens: int = 0, need_calls: int = 1) -> tuple[bool, str]:
-    cfg = session.get(LLMConfig, config_id)
-    if not cfg:
-        return False, "LLM 配置不存在"
-    # token 限额（-1 不限）
-    total_need = max(0, need_input_tokens) + max(0, need_output_tokens)
-    if cfg.token_limit is not None and cfg.token_limit >= 0:
-        if (cfg.used_tokens_input + cfg.used_tokens_output + total_need) > cfg.token_limit:
-            return False, "已超出 Token 上限"
-    # 调用次数
-    if cfg.call_limit is not None and cfg.call_limit >= 0:
-        if (cfg.used_calls + need_calls) > cfg.call_limit:
-            return False, "已超出调用次数上限"
-    return True, "OK"
+    # 由内存账本判断（已落库用量 + 未落库增量 + 进行中调用的预留），不再读写数据库
+    return usage_ledger.check(
+        session, config_id, max(0, need_input_tokens) + max(0, need_output_tokens), need_calls
+    )
 
 
 def accumulate_usage(session: Session, config_id: int, add_input_tokens: int, add_output_tokens: int, add_calls: int, aborted: bool = False) -> None:
-    cfg = session.get(LLMConfig, config_id)
-    if not cfg:
-        return
-    # 任务无论正常或中止，调用计数加一（也可按需区分）
-    cfg.used_calls = (cfg.used_calls or 0) + max(0, add_calls)
-    cfg.used_tokens_input = (cfg.used_tokens_input or 0) + max(0, add_input_tokens)
-    cfg.used_tokens_output = (cfg.used_tokens_output or 0) + max(0, add_output_tokens)
-    session.add(cfg)
-    session.commit()
+    # 任务无论正常或中止，调用计数加一（也可按需区分）；由账本定期批量回写
+    usage_ledger.record(session, config_id, add_input_tokens, add_output_tokens, add_calls)
 
 
 def reset_usage(session: Session, config_id: int) -> bool:
     cfg = session.get(LLMConfig, config_id)
     if not cfg:
         return False
+    # 先回写已记账的增量，避免清零后再被加回
+    usage_ledger.flush()
+    session.refresh(cfg)
     cfg.used_tokens_input = 0
     cfg.used_tokens_output = 0
     cfg.used_calls = 0
     session.add(cfg)
     session.commit()
-    return True
\ No newline at end of file
+    usage_ledger.reload(session, config_id)
+    return True
@@ -8,6 +8,7 @@ from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain_qwq import ChatQwen
 
 from app.db.models import LLMConfig
+from app.services.llm_fake import create_fake_chat_model
 from app.services import llm_config_service
 
 def _get_llm_config(session: Session, llm_config_id: int) -> Optional[LLMConfig]:
@@ -48,6 +49,9 @@ def build_chat_model(
 
     logger.info(f"[LLMFactory] 构建模型: provider={provider}, model={model_name}, timeout={timeout}")
 
+    if provider == "fake":
+        return create_fake_chat_model(model_name, api_base, max_tokens)
+
     if provider == "openai":
         return ChatOpenAI(api_key=api_key, base_url=api_base, **kwargs)
 
@@ -0,0 +1,261 @@
+"""LLM 故障转移组：延迟敏感的流式生成在多个 LLM 配置间故障转移与对冲。
+
+一个组是按优先级排列的 LLM 配置（首个为主配置），流式调用时：
+- 先请求主配置；主配置出错，或超过 first_token_timeout_ms 仍未输出首个 token（首 token SLO），
+  取消它并切换到下一个配置
+- 设置了 hedge_delay_ms 时，主配置在该时间内无首个 token 就并发请求下一个配置（对冲），
+  先输出 token 的一方胜出，另一方立即取消
+- 首个 token 之后不再切换：已推送给客户端的内容无法撤回
+
+每个尝试是一条独立的流（由调用方提供），各自按所属配置预检配额、向调度器申请额度并记录用量；
+被取消的一方按已消耗的 token 记为中止调用，因此用量始终记在实际发出请求的配置上。
+"""
+
+import asyncio
+from contextlib import aclosing
+from dataclasses import dataclass, field
+from time import monotonic
+from typing import AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+from loguru import logger
+from sqlmodel import Session, select
+
+from app.db.models import LLMConfig, LLMFailoverGroup
+from app.schemas.llm_config import LLMFailoverGroupCreate, LLMFailoverGroupUpdate
+
+
+# ---------------- 组管理 ----------------
+def _validate(session: Session, config_ids: List[int], hedge_delay_ms: Optional[int],
+              first_token_timeout_ms: Optional[int]) -> None:
+    if not config_ids:
+        raise ValueError("故障转移组至少需要一个 LLM 配置")
+    if len(set(config_ids)) != len(config_ids):
+        raise ValueError("故障转移组中的 LLM 配置不能重复")
+    missing = [cid for cid in config_ids if session.get(LLMConfig, cid) is None]
+    if missing:
+        raise ValueError(f"LLM 配置不存在: {missing}")
+    for name, value in (("hedge_delay_ms", hedge_delay_ms), ("first_token_timeout_ms", first_token_timeout_ms)):
+        if value is not None and value <= 0:
+            raise ValueError(f"{name} 必须为正数")
+
+
+def get_groups(session: Session) -> List[LLMFailoverGroup]:
+    return session.exec(select(LLMFailoverGroup)).all()
+
+
+def get_group_by_name(session: Session, name: str) -> Optional[LLMFailoverGroup]:
+    return session.exec(select(LLMFailoverGroup).where(LLMFailoverGroup.name == name)).first()
+
+
+def create_group(session: Session, group_in: LLMFailoverGroupCreate) -> LLMFailoverGroup:
+    _validate(session, group_in.config_ids, group_in.hedge_delay_ms, group_in.first_token_timeout_ms)
+    if get_group_by_name(session, group_in.name):
+        raise ValueError(f"故障转移组已存在: {group_in.name}")
+    group = LLMFailoverGroup.model_validate(group_in)
+    session.add(group)
+    session.commit()
+    session.refresh(group)
+    return group
+
+
+def update_group(session: Session, group_id: int, group_in: LLMFailoverGroupUpdate) -> Optional[LLMFailoverGroup]:
+    group = session.get(LLMFailoverGroup, group_id)
+    if not group:
+        return None
+    data = group_in.model_dump(exclude_unset=True)
+    merged = {**group.model_dump(), **data}
+    _validate(session, merged["config_ids"], merged["hedge_delay_ms"], merged["first_token_timeout_ms"])
+    if "name" in data and data["name"] != group.name and get_group_by_name(session, data["name"]):
+        raise ValueError(f"故障转移组已存在: {data['name']}")
+    for key, value in data.items():
+        setattr(group, key, value)
+    session.add(group)
+    session.commit()
+    session.refresh(group)
+    return group
+
+
+def delete_group(session: Session, group_id: int) -> bool:
+    group = session.get(LLMFailoverGroup, group_id)
+    if not group:
+        return False
+    session.delete(group)
+    session.commit()
+    stats.pop(group.name, None)
+    return True
+
+
+# ---------------- 统计 ----------------
+@dataclass
+class _GroupStats:
+    requests: int = 0
+    failed: int = 0
+    hedges: int = 0
+    hedge_wins: int = 0
+    failovers: int = 0
+    slo_breaches: int = 0
+    errors: int = 0
+    wins: Dict[int, int] = field(default_factory=dict)
+    first_token_ms_total: float = 0.0
+    first_token_ms_max: float = 0.0
+
+    def to_dict(self) -> dict:
+        won = sum(self.wins.values())
+        return {
+            "requests": self.requests,
+            "failed": self.failed,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "failovers": self.failovers,
+            "slo_breaches": self.slo_breaches,
+            "errors": self.errors,
+            "wins_by_config": dict(self.wins),
+            "first_token_ms_avg": round(self.first_token_ms_total / won, 2) if won else 0.0,
+            "first_token_ms_max": round(self.first_token_ms_max, 2),
+        }
+
+
+stats: Dict[str, _GroupStats] = {}
+
+
+def failover_metrics() -> Dict[str, dict]:
+    return {name: s.to_dict() for name, s in stats.items()}
+
+
+# ---------------- 流式故障转移 ----------------
+@dataclass
+class _Attempt:
+    config_id: int
+    role: str  # primary | failover | hedge
+    stream: AsyncIterator[str]
+    started: float = field(default_factory=monotonic)
+
+
+async def _first_delta(stream: AsyncIterator[str]) -> Tuple[bool, str]:
+    try:
+        return True, await stream.__anext__()
+    except StopAsyncIteration:
+        return False, ""
+
+
+async def _discard(tasks: Dict["asyncio.Task", _Attempt]) -> None:
+    """取消尝试并等待其完成（流内部据此记录中止用量）"""
+    for task in tasks:
+        task.cancel()
+    if tasks:
+        await asyncio.gather(*tasks, return_exceptions=True)
+    for attempt in tasks.values():
+        await _close_stream(attempt.stream)
+    tasks.clear()
+
+
+async def _close_stream(stream: AsyncIterator[str]) -> None:
+    aclose = getattr(stream, "aclose", None)
+    if aclose is not None:
+        try:
+            await aclose()
+        except Exception:  # noqa: BLE001
+            pass
+
+
+async def stream_with_failover(
+    group: LLMFailoverGroup,
+    open_stream: Callable[[int], AsyncIterator[str]],
+) -> AsyncIterator[str]:
+    """按组配置依次/并发打开 open_stream(config_id)，输出首个出 token 的流"""
+    candidates = list(group.config_ids or [])
+    if not candidates:
+        raise ValueError(f"故障转移组 {group.name} 未配置 LLM")
+    hedge = group.hedge_delay_ms / 1000 if group.hedge_delay_ms else None
+    slo = group.first_token_timeout_ms / 1000 if group.first_token_timeout_ms else None
+    gs = stats.setdefault(group.name, _GroupStats())
+    gs.requests += 1
+
+    pending: Dict[asyncio.Task, _Attempt] = {}
+    errors: List[str] = []
+    next_index = 0
+    hedged = False
+    request_start = monotonic()
+
+    def launch(role: str) -> None:
+        nonlocal next_index
+        config_id = candidates[next_index]
+        next_index += 1
+        attempt = _Attempt(config_id=config_id, role=role, stream=open_stream(config_id))
+        pending[asyncio.ensure_future(_first_delta(attempt.stream))] = attempt
+        if role != "primary":
+            logger.info(f"[LLM故障转移] group={group.name} 启动{role} config_id={config_id}")
+
+    winner: Optional[_Attempt] = None
+    first = ""
+    try:
+        launch("primary")
+        while winner is None:
+            if not pending:
+                if next_index >= len(candidates):
+                    gs.failed += 1
+                    raise ValueError(f"故障转移组 {group.name} 中的所有 LLM 配置均失败: {'; '.join(errors)}")
+                gs.failovers += 1
+                launch("failover")
+
+            now = monotonic()
+            deadlines = [a.started + slo for a in pending.values()] if slo else []
+            if hedge is not None and not hedged and next_index < len(candidates):
+                deadlines.append(request_start + hedge)
+            timeout = max(0.0, min(deadlines) - now) if deadlines else None
+            done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+            for task in done:
+                attempt = pending.pop(task)
+                try:
+                    _, first = task.result()
+                except Exception as e:  # noqa: BLE001
+                    gs.errors += 1
+                    errors.append(f"config_id={attempt.config_id}: {e}")
+                    logger.warning(f"[LLM故障转移] group={group.name} config_id={attempt.config_id} 出错: {e}")
+                    continue
+                if winner is None:
+                    winner = attempt
+                else:
+                    # 同一轮内多个尝试同时出 token，保留先选中的，其余取消
+                    pending[task] = attempt
+            if winner is not None:
+                break
+
+            now = monotonic()
+            if slo:
+                breached = {t: a for t, a in pending.items() if now - a.started >= slo}
+                for t, a in breached.items():
+                    pending.pop(t)
+                    gs.slo_breaches += 1
+                    errors.append(f"config_id={a.config_id}: 首 token 超过 {group.first_token_timeout_ms}ms")
+                    logger.warning(f"[LLM故障转移] group={group.name} config_id={a.config_id} 首 token 超时，取消")
+                await _discard(breached)
+            if hedge is not None and not hedged and next_index < len(candidates) and now - request_start >= hedge:
+                hedged = True
+                gs.hedges += 1
+                launch("hedge")
+
+        await _discard(pending)
+        first_ms = (monotonic() - winner.started) * 1000
+        gs.wins[winner.config_id] = gs.wins.get(winner.config_id, 0) + 1
+        gs.first_token_ms_total += first_ms
+        gs.first_token_ms_max = max(gs.first_token_ms_max, first_ms)
+        if winner.role == "hedge":
+            gs.hedge_wins += 1
+        if winner.role != "primary":
+            logger.info(f"[LLM故障转移] group={group.name} 由 config_id={winner.config_id}（{winner.role}）完成，首 token {first_ms:.0f}ms")
+    except BaseException:
+        # 出错或被取消（如客户端断开）时取消所有仍在进行的尝试，等待其结束并关闭各自的流；
+        # 已选出的胜出流尚未交给下游，一并关闭
+        await _discard(pending)
+        if winner is not None:
+            await _close_stream(winner.stream)
+        raise
+
+    # 下游关闭时立即关闭胜出流，使其按中止记账
+    async with aclosing(winner.stream) as stream:
+        if first:
+            yield first
+        async for delta in stream:
+            yield delta
@@ -0,0 +1,289 @@
+"""本地假 LLM 提供商（provider = "fake"），用于压测与离线基准，不消耗真实 token。
+
+行为参数写在 LLMConfig.api_base 的查询串中（可带或不带 "fake://?" 前缀），例如：
+    fake://?tps=40&latency_ms=300&jitter_ms=100&error_rate=0.05&error=rate_limit&tokens=200&seed=7
+- latency_ms / jitter_ms：首个 token 前的延迟及其随机抖动
+- tps：流式输出速率（token/秒），0 表示不限速
+- tokens：文本回复的 token 数（受 max_tokens 限制）
+- error_rate / error：每次调用注入错误的概率与类型
+  （rate_limit | network | timeout | auth | invalid_output，逗号分隔时随机选择）
+- retry_after：注入限流错误时附带的 Retry-After 秒数
+- seed：随机种子；相同种子、相同提示词得到相同输出，错误注入按调用序号确定
+
+结构化输出按 output_type 的 JSON Schema 生成合法数据（枚举、数值范围、长度限制等），
+with_structured_output 与 astream 都可用；bind_tools 接受但忽略工具，始终返回文本。
+"""
+
+import asyncio
+import hashlib
+import itertools
+import json
+import random
+from dataclasses import dataclass
+from types import SimpleNamespace
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Type
+from urllib.parse import parse_qsl
+
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.runnables import RunnableLambda
+from pydantic import BaseModel, PrivateAttr
+
+from app.services.llm_retry import InvalidOutputError
+
+
+_WORDS = (
+    "夜色", "长街", "灯火", "他", "她", "缓缓", "抬起头", "看向", "远处", "的", "山门", "风", "吹过",
+    "剑鞘", "轻声", "说道", "。", "，", "仿佛", "一切", "都", "还", "未曾", "开始", "少年", "握紧",
+    "手中", "旧信", "心里", "忽然", "明白", "了", "命运", "在", "此刻", "悄然", "转向",
+)
+_MAX_DEPTH = 6
+
+
+@dataclass
+class FakeBehavior:
+    latency_ms: float = 0.0
+    jitter_ms: float = 0.0
+    tps: float = 0.0
+    tokens: int = 120
+    error_rate: float = 0.0
+    error: str = "network"
+    retry_after: Optional[float] = None
+    seed: int = 0
+
+    @classmethod
+    def parse(cls, spec: Optional[str]) -> "FakeBehavior":
+        query = (spec or "").split("?", 1)[-1]
+        values: Dict[str, Any] = {}
+        for key, raw in parse_qsl(query):
+            field_type = cls.__dataclass_fields__.get(key)
+            if field_type is None:
+                continue
+            default = getattr(cls, key, None)
+            try:
+                values[key] = raw if isinstance(default, str) else (int(raw) if isinstance(default, int) else float(raw))
+            except ValueError:
+                raise ValueError(f"fake 提供商参数无效: {key}={raw}")
+        return cls(**values)
+
+
+class FakeProviderError(Exception):
+    """注入的提供商错误；带 status_code/response.headers，与真实 SDK 异常一样可被 llm_retry 分类"""
+
+    def __init__(self, message: str, status_code: int, headers: Optional[Dict[str, str]] = None) -> None:
+        super().__init__(message)
+        self.status_code = status_code
+        self.response = SimpleNamespace(status_code=status_code, headers=headers or {})
+
+
+def _seeded(*parts: Any) -> random.Random:
+    digest = hashlib.sha256("\x1f".join(str(p) for p in parts).encode("utf-8")).hexdigest()
+    return random.Random(int(digest[:16], 16))
+
+
+def _prompt_of(messages: Any) -> str:
+    if isinstance(messages, str):
+        return messages
+    if isinstance(messages, list):
+        return "\n".join(str(getattr(m, "content", m)) for m in messages)
+    return str(messages)
+
+
+# ---------------- 按 JSON Schema 生成数据 ----------------
+def _text(rng: random.Random, min_len: int = 0, max_len: Optional[int] = None) -> str:
+    target = max(min_len, min(max_len or 24, rng.randint(4, 24)))
+    out = ""
+    while len(out) < target:
+        out += rng.choice(_WORDS)
+    return out[:max_len] if max_len is not None else out
+
+
+def _number(schema: dict, rng: random.Random, integer: bool) -> Any:
+    low = schema.get("minimum", schema.get("exclusiveMinimum", 0))
+    high = schema.get("maximum", schema.get("exclusiveMaximum", max(low, 0) + 100))
+    if "exclusiveMinimum" in schema:
+        low = low + (1 if integer else 1e-6)
+    if "exclusiveMaximum" in schema:
+        high = high - (1 if integer else 1e-6)
+    if high < low:
+        high = low
+    return rng.randint(int(low), int(high)) if integer else round(rng.uniform(low, high), 3)
+
+
+def sample_schema(schema: dict, defs: Dict[str, dict], rng: random.Random, depth: int = 0) -> Any:
+    if "$ref" in schema:
+        return sample_schema(defs.get(schema["$ref"].rsplit("/", 1)[-1], {}), defs, rng, depth)
+    if "const" in schema:
+        return schema["const"]
+    if "enum" in schema:
+        return rng.choice(schema["enum"])
+    for key in ("anyOf", "oneOf"):
+        if key in schema:
+            options = [s for s in schema[key] if s.get("type") != "null"] or schema[key]
+            return sample_schema(options[0] if depth >= _MAX_DEPTH else rng.choice(options), defs, rng, depth)
+    if "allOf" in schema:
+        return sample_schema(schema["allOf"][0], defs, rng, depth)
+
+    kind = schema.get("type")
+    if isinstance(kind, list):
+        kind = next((k for k in kind if k != "null"), "null")
+    if kind == "object" or (kind is None and "properties" in schema):
+        required = set(schema.get("required", []))
+        out = {}
+        for name, prop in (schema.get("properties") or {}).items():
+            if name in required or depth < _MAX_DEPTH:
+                out[name] = sample_schema(prop, defs, rng, depth + 1)
+        return out
+    if kind == "array":
+        low = schema.get("minItems", 0)
+        high = schema.get("maxItems", max(low, 3))
+        count = low if depth >= _MAX_DEPTH else rng.randint(min(max(low, 1), high), high)
+        items = schema.get("items") or {}
+        return [sample_schema(items, defs, rng, depth + 1) for _ in range(count)]
+    if kind == "string":
+        return _text(rng, schema.get("minLength", 0), schema.get("maxLength"))
+    if kind == "integer":
+        return _number(schema, rng, integer=True)
+    if kind == "number":
+        return _number(schema, rng, integer=False)
+    if kind == "boolean":
+        return rng.random() < 0.5
+    if kind == "null":
+        return None
+    return _text(rng)
+
+
+def sample_model(output_type: Type[BaseModel], rng: random.Random) -> BaseModel:
+    schema = output_type.model_json_schema()
+    data = sample_schema(schema, schema.get("$defs", {}), rng)
+    try:
+        return output_type.model_validate(data)
+    except Exception as e:  # noqa: BLE001
+        # 自定义校验器等 schema 无法表达的约束：与真实模型一样表现为结构化输出失败
+        raise InvalidOutputError(f"fake 提供商生成的 {output_type.__name__} 未通过校验: {e}")
+
+
+# ---------------- ChatModel ----------------
+class FakeChatModel(BaseChatModel):
+    """按 FakeBehavior 模拟延迟、输出速率与错误的 ChatModel"""
+
+    model_name: str = "fake"
+    behavior: FakeBehavior = FakeBehavior()
+    max_tokens: Optional[int] = None
+
+    _calls: Any = PrivateAttr(default_factory=itertools.count)
+
+    model_config = {"arbitrary_types_allowed": True}
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake"
+
+    def _reply_tokens(self, prompt: str) -> List[str]:
+        count = self.behavior.tokens if self.max_tokens is None else min(self.behavior.tokens, self.max_tokens)
+        rng = _seeded(self.behavior.seed, self.model_name, prompt)
+        return [rng.choice(_WORDS) for _ in range(max(0, count))]
+
+    def _first_token_delay(self) -> float:
+        b = self.behavior
+        jitter = random.uniform(0, b.jitter_ms) if b.jitter_ms > 0 else 0.0
+        return (b.latency_ms + jitter) / 1000
+
+    def _maybe_fail(self, structured: bool) -> None:
+        b = self.behavior
+        call_index = next(self._calls)
+        rng = _seeded(b.seed, "error", call_index)
+        if b.error_rate <= 0 or rng.random() >= b.error_rate:
+            return
+        kinds = [k.strip() for k in b.error.split(",") if k.strip()] or ["network"]
+        kind = rng.choice(kinds)
+        if kind == "rate_limit":
+            headers = {"retry-after": str(b.retry_after)} if b.retry_after is not None else {}
+            raise FakeProviderError("fake: rate limit exceeded", 429, headers)
+        if kind == "timeout":
+            raise TimeoutError("fake: request timed out")
+        if kind == "auth":
+            raise FakeProviderError("fake: invalid api key", 401)
+        if kind == "invalid_output" and structured:
+            raise InvalidOutputError("fake: injected invalid structured output")
+        raise FakeProviderError("fake: upstream unavailable", 503)
+
+    @staticmethod
+    def _usage(prompt: str, tokens: int) -> Dict[str, int]:
+        input_tokens = len(prompt)
+        return {"input_tokens": input_tokens, "output_tokens": tokens, "total_tokens": input_tokens + tokens}
+
+    # ---- 同步接口（压测主要走异步，同步仅保证可用）----
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        self._maybe_fail(structured=False)
+        prompt = _prompt_of(messages)
+        tokens = self._reply_tokens(prompt)
+        message = AIMessage(content="".join(tokens), usage_metadata=self._usage(prompt, len(tokens)))
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        self._maybe_fail(structured=False)
+        for token in self._reply_tokens(_prompt_of(messages)):
+            yield ChatGenerationChunk(message=AIMessageChunk(content=token))
+
+    # ---- 异步接口 ----
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                         run_manager: Optional[AsyncCallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        await asyncio.sleep(self._first_token_delay())
+        self._maybe_fail(structured=False)
+        prompt = _prompt_of(messages)
+        tokens = self._reply_tokens(prompt)
+        if self.behavior.tps > 0:
+            await asyncio.sleep(len(tokens) / self.behavior.tps)
+        message = AIMessage(content="".join(tokens), usage_metadata=self._usage(prompt, len(tokens)))
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    async def _astream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                       run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+                       **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        await asyncio.sleep(self._first_token_delay())
+        self._maybe_fail(structured=False)
+        interval = 1 / self.behavior.tps if self.behavior.tps > 0 else 0.0
+        for i, token in enumerate(self._reply_tokens(_prompt_of(messages))):
+            if i and interval:
+                await asyncio.sleep(interval)
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=token))
+            if run_manager:
+                await run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
+
+    def bind_tools(self, tools: Any, **kwargs: Any) -> "FakeChatModel":
+        return self
+
+    def with_structured_output(self, schema: Any, *, include_raw: bool = False, **kwargs: Any) -> RunnableLambda:
+        if not (isinstance(schema, type) and issubclass(schema, BaseModel)):
+            raise ValueError("fake 提供商仅支持 pydantic 模型作为结构化输出类型")
+
+        def _build(messages: Any) -> BaseModel:
+            self._maybe_fail(structured=True)
+            prompt = _prompt_of(messages)
+            return sample_model(schema, _seeded(self.behavior.seed, self.model_name, schema.__name__, prompt))
+
+        def _wrap(parsed: BaseModel) -> Any:
+            if not include_raw:
+                return parsed
+            raw = AIMessage(content=json.dumps(parsed.model_dump(mode="json"), ensure_ascii=False))
+            return {"raw": raw, "parsed": parsed, "parsing_error": None}
+
+        async def _abuild(messages: Any) -> Any:
+            await asyncio.sleep(self._first_token_delay())
+            parsed = _build(messages)
+            if self.behavior.tps > 0:
+                size = len(json.dumps(parsed.model_dump(mode="json"), ensure_ascii=False))
+                await asyncio.sleep(size / self.behavior.tps)
+            return _wrap(parsed)
+
+        return RunnableLambda(lambda messages: _wrap(_build(messages)), afunc=_abuild)
+
+
+def create_fake_chat_model(model_name: str, api_base: Optional[str], max_tokens: Optional[int] = None) -> FakeChatModel:
+    return FakeChatModel(model_name=model_name or "fake", behavior=FakeBehavior.parse(api_base), max_tokens=max_tokens)
@@ -0,0 +1,236 @@
+"""ChatModel 实例池。
+
+按 (llm_config_id, 配置指纹, temperature, max_tokens, timeout, thinking) 复用已构造的 ChatModel，
+避免每次调用都新建客户端与连接池（每次都要重新 TLS 握手）。同一配置的不同采样参数共享
+底层 httpx 客户端（OpenAI 兼容类提供商支持注入）。
+
+配置指纹取自影响连接的字段（provider/model/api_key/地址），配置被修改或删除时由
+llm_config_service 主动失效；即便有遗漏（如直接改库），指纹变化也会让旧实例不再命中。
+失效的 httpx 客户端不立即关闭：经计数传输层跟踪进行中的请求（直到响应流关闭），
+最后一个请求结束后再关闭连接池；进程退出时 aclose_all 关闭全部客户端。
+"""
+
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import httpx
+from loguru import logger
+
+from app.core.config import settings
+from app.db.models import LLMConfig
+
+
+def config_fingerprint(cfg: LLMConfig) -> str:
+    raw = "\x1f".join(str(v or "") for v in (cfg.provider, cfg.model_name, cfg.api_key, cfg.api_base, cfg.base_url))
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()[:16]
+
+
+class _SharedClients:
+    """同一配置共享的同步/异步 httpx 客户端，统计进行中的请求；退役后在空闲时关闭"""
+
+    def __init__(self) -> None:
+        self.inflight = 0
+        self.retired = False
+        self.closed = False
+        self._lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self.sync = httpx.Client(transport=_CountingTransport(httpx.HTTPTransport(), self))
+        self.async_ = httpx.AsyncClient(transport=_CountingAsyncTransport(httpx.AsyncHTTPTransport(), self))
+
+    def enter(self, loop: Optional[asyncio.AbstractEventLoop] = None) -> None:
+        with self._lock:
+            self.inflight += 1
+            if loop is not None:
+                self._loop = loop
+
+    def leave(self) -> None:
+        with self._lock:
+            self.inflight -= 1
+            idle = self.retired and self.inflight == 0
+        if idle:
+            self._close()
+
+    def retire(self) -> None:
+        with self._lock:
+            self.retired = True
+            idle = self.inflight == 0
+        if idle:
+            self._close()
+
+    def _close(self) -> None:
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+        self.sync.close()
+        # AsyncClient 的连接属于发起请求的事件循环，回到该循环上关闭
+        loop = self._loop
+        if loop is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(lambda: loop.create_task(self.async_.aclose()))
+            return
+        # 从未发起过异步请求：没有连接，在当前循环或临时循环上关闭即可
+        try:
+            asyncio.get_running_loop().create_task(self.async_.aclose())
+        except RuntimeError:
+            asyncio.run(self.async_.aclose())
+
+    async def aclose(self) -> None:
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+        self.sync.close()
+        await self.async_.aclose()
+
+
+class _CountingStream(httpx.SyncByteStream):
+    def __init__(self, stream: httpx.SyncByteStream, owner: _SharedClients) -> None:
+        self._stream = stream
+        self._owner = owner
+        self._done = False
+
+    def __iter__(self):
+        yield from self._stream
+
+    def close(self) -> None:
+        try:
+            self._stream.close()
+        finally:
+            if not self._done:
+                self._done = True
+                self._owner.leave()
+
+
+class _CountingAsyncStream(httpx.AsyncByteStream):
+    def __init__(self, stream: httpx.AsyncByteStream, owner: _SharedClients) -> None:
+        self._stream = stream
+        self._owner = owner
+        self._done = False
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self) -> None:
+        try:
+            await self._stream.aclose()
+        finally:
+            if not self._done:
+                self._done = True
+                self._owner.leave()
+
+
+class _CountingTransport(httpx.BaseTransport):
+    """请求开始时计数，响应流关闭时减计数"""
+
+    def __init__(self, transport: httpx.BaseTransport, owner: _SharedClients) -> None:
+        self._transport = transport
+        self._owner = owner
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        self._owner.enter()
+        try:
+            response = self._transport.handle_request(request)
+        except BaseException:
+            self._owner.leave()
+            raise
+        response.stream = _CountingStream(response.stream, self._owner)
+        return response
+
+    def close(self) -> None:
+        self._transport.close()
+
+
+class _CountingAsyncTransport(httpx.AsyncBaseTransport):
+    def __init__(self, transport: httpx.AsyncBaseTransport, owner: _SharedClients) -> None:
+        self._transport = transport
+        self._owner = owner
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        self._owner.enter(asyncio.get_running_loop())
+        try:
+            response = await self._transport.handle_async_request(request)
+        except BaseException:
+            self._owner.leave()
+            raise
+        response.stream = _CountingAsyncStream(response.stream, self._owner)
+        return response
+
+    async def aclose(self) -> None:
+        await self._transport.aclose()
+
+
+class ChatModelPool:
+    """有界 LRU：条目为已构造的 ChatModel；httpx 客户端按 (配置, 指纹) 共享"""
+
+    def __init__(self, max_size: Optional[int] = None) -> None:
+        self._max_size = max_size or settings.LLM_MODEL_POOL_SIZE
+        self._models: "OrderedDict[Tuple, Any]" = OrderedDict()
+        self._http_clients: Dict[Tuple[int, str], _SharedClients] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def http_clients(self, cfg: LLMConfig) -> Tuple[httpx.Client, httpx.AsyncClient]:
+        """同一配置共享的同步/异步 httpx 客户端（超时由模型按请求传入）"""
+        key = (int(cfg.id), config_fingerprint(cfg))
+        with self._lock:
+            clients = self._http_clients.get(key)
+            if clients is None:
+                clients = self._http_clients[key] = _SharedClients()
+            return clients.sync, clients.async_
+
+    def get(self, cfg: LLMConfig, params: Tuple, factory: Callable[[], Any]) -> Any:
+        key = (int(cfg.id), config_fingerprint(cfg)) + params
+        with self._lock:
+            model = self._models.get(key)
+            if model is not None:
+                self._models.move_to_end(key)
+                self.hits += 1
+                return model
+        # 构造放在锁外；并发未命中时可能各自构造一次，以后写入者为准
+        model = factory()
+        with self._lock:
+            self.misses += 1
+            self._models[key] = model
+            self._models.move_to_end(key)
+            while len(self._models) > self._max_size:
+                self._models.popitem(last=False)
+        return model
+
+    def invalidate(self, config_id: int) -> None:
+        """丢弃某配置的全部实例与共享客户端；进行中的请求不受影响，客户端在其结束后关闭"""
+        with self._lock:
+            dropped = [k for k in self._models if k[0] == config_id]
+            for k in dropped:
+                del self._models[k]
+            retired = [self._http_clients.pop(k) for k in [k for k in self._http_clients if k[0] == config_id]]
+        for clients in retired:
+            clients.retire()
+        if dropped:
+            logger.info(f"[LLM] 已失效 ChatModel 实例 config_id={config_id} count={len(dropped)}")
+
+    async def aclose_all(self) -> None:
+        """进程退出时关闭全部共享客户端（不等待进行中的请求）"""
+        with self._lock:
+            self._models.clear()
+            clients = list(self._http_clients.values())
+            self._http_clients.clear()
+        for c in clients:
+            await c.aclose()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "size": len(self._models),
+                "max_size": self._max_size,
+                "http_clients": len(self._http_clients),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+chat_model_pool = ChatModelPool()
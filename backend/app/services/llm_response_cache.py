@@ -0,0 +1,154 @@
+"""结构化 LLM 调用（run_llm_agent）的持久化响应缓存。
+
+缓存键 = 有效 system prompt + user prompt + 输出 schema + 模型（provider/model/地址）+ temperature/max_tokens 的哈希，
+条目存于 SQLite（llmresponsecache 表），按 TTL 过期、总大小超限时按最近使用时间淘汰。
+temperature>0 的调用默认不读写缓存（输出本应有随机性），调用方传 cache=True 可强制启用。
+命中前仍做配额检查（已超限的配置不再出结果），但不经过全局调度与用量统计：缓存命中不消耗配额。
+查询只读，写入在缓存自己的会话中进行，不提交也不回滚调用方的 Session；命中记录随下一次写入回写（见 cache_store）。
+"""
+
+import hashlib
+import json
+from dataclasses import dataclass, field
+from datetime import datetime
+from functools import lru_cache
+from typing import Any, Dict, Optional, Type
+
+import sqlalchemy as sa
+from loguru import logger
+from pydantic import BaseModel
+from sqlalchemy.engine import Engine
+from sqlmodel import Session, select
+
+from app.core.config import settings
+from app.db.models import LLMConfig, LLMResponseCache
+from app.services.cache_store import CacheCounters, CacheTable
+
+
+_table = CacheTable(LLMResponseCache, "LLM_RESPONSE_CACHE_TTL_SEC", "LLM_RESPONSE_CACHE_MAX_BYTES", "[LLM缓存]")
+
+
+@dataclass
+class _Counters(CacheCounters):
+    bypassed: int = 0
+    saved_input_tokens: int = 0
+    saved_output_tokens: int = 0
+
+
+@dataclass
+class ResponseCacheStats:
+    """进程内累计统计：总计与按 LLM 配置拆分"""
+    total: _Counters = field(default_factory=_Counters)
+    by_config: Dict[int, _Counters] = field(default_factory=dict)
+
+    def bump(self, config_id: int, name: str, amount: int = 1) -> None:
+        for counters in (self.total, self.by_config.setdefault(config_id, _Counters())):
+            counters.bump(name, amount)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            **self.total.to_dict(),
+            "by_config": {cid: c.to_dict() for cid, c in self.by_config.items()},
+        }
+
+
+stats = ResponseCacheStats()
+
+
+@lru_cache(maxsize=256)
+def _schema_digest(output_type: Type[BaseModel]) -> str:
+    schema = json.dumps(output_type.model_json_schema(), ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(schema.encode("utf-8")).hexdigest()
+
+
+def should_cache(temperature: Optional[float], force: Optional[bool]) -> bool:
+    """force 为 None 时按 temperature 判断（<=0 才缓存）；True/False 强制开关"""
+    if not settings.LLM_RESPONSE_CACHE_ENABLED:
+        return False
+    if force is not None:
+        return bool(force)
+    return temperature is not None and float(temperature) <= 0
+
+
+def build_cache_key(cfg: LLMConfig, system_prompt: str, user_prompt: str, output_type: Type[BaseModel],
+                    temperature: Optional[float], max_tokens: Optional[int]) -> str:
+    raw = json.dumps({
+        "provider": cfg.provider,
+        "model": cfg.model_name,
+        "api_base": cfg.api_base or cfg.base_url,
+        "schema": _schema_digest(output_type),
+        "system": system_prompt,
+        "user": user_prompt,
+        "temperature": temperature,
+        "max_tokens": max_tokens,
+    }, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def lookup(session: Session, cache_key: str, output_type: Type[BaseModel], config_id: int) -> Optional[BaseModel]:
+    """读取缓存并还原为 output_type；过期或无法还原时视为未命中"""
+    entry = _table.find(session, cache_key)
+    if entry is None:
+        stats.bump(config_id, "misses")
+        return None
+    try:
+        response = output_type.model_validate(entry.response_json)
+    except Exception as e:  # noqa: BLE001
+        logger.warning(f"[LLM缓存] 缓存条目无法还原，视为未命中 schema={output_type.__name__} err={e}")
+        stats.bump(config_id, "misses")
+        return None
+    _table.touch(cache_key)
+    stats.bump(config_id, "hits")
+    stats.bump(config_id, "saved_input_tokens", entry.input_tokens or 0)
+    stats.bump(config_id, "saved_output_tokens", entry.output_tokens or 0)
+    return response
+
+
+def store(bind: Engine, cache_key: str, cfg: LLMConfig, response: BaseModel,
+          input_tokens: int, output_tokens: int) -> None:
+    """在后台写线程中写入（或覆盖）缓存条目并按大小/时间淘汰；不使用调用方的 Session，写入失败只告警"""
+    try:
+        payload = response.model_dump(mode="json")
+        size = len(json.dumps(payload, ensure_ascii=False).encode("utf-8"))
+    except Exception as e:  # noqa: BLE001
+        logger.warning(f"[LLM缓存] 响应无法序列化，不缓存 err={e}")
+        return
+    if size > settings.LLM_RESPONSE_CACHE_MAX_BYTES:
+        logger.info(f"[LLM缓存] 响应过大不缓存 size={size}")
+        return
+    config_id, model_name = int(cfg.id), cfg.model_name
+    schema_name = type(response).__name__
+
+    def _upsert(own: Session) -> None:
+        now = datetime.utcnow()
+        entry = own.exec(select(LLMResponseCache).where(LLMResponseCache.cache_key == cache_key)).first()
+        if entry is None:
+            entry = LLMResponseCache(cache_key=cache_key)
+        entry.llm_config_id = config_id
+        entry.model_name = model_name
+        entry.schema_name = schema_name
+        entry.response_json = payload
+        entry.input_tokens = max(0, input_tokens)
+        entry.output_tokens = max(0, output_tokens)
+        entry.size_bytes = size
+        entry.created_at = now
+        entry.last_used_at = now
+        own.add(entry)
+
+    future = _table.write(bind, _upsert)
+    future.add_done_callback(lambda f: f.result() and stats.bump(config_id, "stores"))
+
+
+def evict(bind: Engine) -> int:
+    """删除过期条目；总大小超过上限时按最近使用时间从旧到新删除（独立会话）"""
+    with Session(bind) as own:
+        return _table.evict(own)
+
+
+def clear(session: Session, config_id: Optional[int] = None) -> int:
+    stmt = sa.delete(LLMResponseCache)
+    if config_id is not None:
+        stmt = stmt.where(LLMResponseCache.llm_config_id == config_id)
+    removed = session.exec(stmt).rowcount or 0  # type: ignore[call-overload]
+    session.commit()
+    return removed
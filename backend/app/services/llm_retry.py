@@ -0,0 +1,187 @@
+"""LLM 调用的重试策略：错误分类 + 指数退避（全抖动）+ Retry-After。
+
+错误类别：
+- rate_limit：429 / 限流，优先按服务端 Retry-After 等待
+- network：连接失败、5xx 等瞬时故障
+- timeout：请求超时
+- invalid_output：结构化输出解析/校验失败，重试时把校验错误回填给模型
+- auth：401/403、密钥无效，不重试
+- other：其余异常，按普通退避重试
+
+按提供商 SDK 的异常属性（status_code / response.headers）鸭子类型识别，不直接依赖各 SDK 的异常类。
+"""
+
+import asyncio
+import random
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Dict, List, Optional
+
+import httpx
+from pydantic import ValidationError
+
+from app.core.config import settings
+
+
+RATE_LIMIT = "rate_limit"
+NETWORK = "network"
+TIMEOUT = "timeout"
+INVALID_OUTPUT = "invalid_output"
+AUTH = "auth"
+OTHER = "other"
+
+ERROR_KINDS = (RATE_LIMIT, NETWORK, TIMEOUT, INVALID_OUTPUT, AUTH, OTHER)
+_NON_RETRYABLE = {AUTH}
+
+_RATE_LIMIT_HINTS = ("rate limit", "rate_limit", "too many requests", "429", "限流", "频率")
+_AUTH_HINTS = ("invalid api key", "incorrect api key", "unauthorized", "authentication", "permission denied", "401", "403")
+_TIMEOUT_HINTS = ("timed out", "timeout")
+_NETWORK_HINTS = ("connection", "connect error", "server disconnected", "502", "503", "504", "overloaded")
+
+
+class InvalidOutputError(ValueError):
+    """LLM 返回内容不符合结构化输出要求（空响应、类型不符等）"""
+
+
+def _status_code(exc: BaseException) -> Optional[int]:
+    code = getattr(exc, "status_code", None)
+    if code is None:
+        response = getattr(exc, "response", None)
+        code = getattr(response, "status_code", None)
+    try:
+        return int(code) if code is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def classify(exc: BaseException) -> str:
+    if isinstance(exc, (InvalidOutputError, ValidationError)) or type(exc).__name__ == "OutputParserException":
+        return INVALID_OUTPUT
+    if isinstance(exc, (asyncio.TimeoutError, httpx.TimeoutException)) or "Timeout" in type(exc).__name__:
+        return TIMEOUT
+    code = _status_code(exc)
+    if code == 429:
+        return RATE_LIMIT
+    if code in (401, 403):
+        return AUTH
+    if code is not None and (code >= 500 or code == 408):
+        return NETWORK
+    if isinstance(exc, (httpx.TransportError, ConnectionError)) or "Connection" in type(exc).__name__:
+        return NETWORK
+    text = str(exc).lower()
+    if any(h in text for h in _RATE_LIMIT_HINTS):
+        return RATE_LIMIT
+    if any(h in text for h in _AUTH_HINTS):
+        return AUTH
+    if any(h in text for h in _TIMEOUT_HINTS):
+        return TIMEOUT
+    if any(h in text for h in _NETWORK_HINTS):
+        return NETWORK
+    return OTHER
+
+
+def retry_after(exc: BaseException) -> Optional[float]:
+    """从响应头读取服务端建议的等待秒数（retry-after-ms / retry-after，支持秒数与 HTTP 日期）"""
+    headers = getattr(getattr(exc, "response", None), "headers", None)
+    if not headers:
+        return None
+    try:
+        ms = headers.get("retry-after-ms")
+        if ms is not None:
+            return max(0.0, float(ms) / 1000)
+        value = headers.get("retry-after")
+        if value is None:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            when = parsedate_to_datetime(value)
+            return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+    except Exception:  # noqa: BLE001
+        return None
+
+
+@dataclass
+class RetryPolicy:
+    max_attempts: int = 3
+    base_delay: float = field(default_factory=lambda: settings.LLM_RETRY_BASE_DELAY_SEC)
+    max_delay: float = field(default_factory=lambda: settings.LLM_RETRY_MAX_DELAY_SEC)
+    max_retry_after: float = field(default_factory=lambda: settings.LLM_RETRY_MAX_RETRY_AFTER_SEC)
+
+    def should_retry(self, kind: str, attempt: int) -> bool:
+        """attempt 为已失败的次数（从 1 开始）"""
+        return kind not in _NON_RETRYABLE and attempt < self.max_attempts
+
+    def delay(self, kind: str, attempt: int, server_hint: Optional[float] = None) -> float:
+        """全抖动指数退避；限流时至少等待 Retry-After。结构化输出错误换提示词重试，无需等待"""
+        if kind == INVALID_OUTPUT:
+            return 0.0
+        backoff = random.uniform(0, min(self.max_delay, self.base_delay * (2 ** (attempt - 1))))
+        if kind == RATE_LIMIT:
+            # 限流时退避下限取基础间隔，避免抖动出接近 0 的等待
+            backoff = max(backoff, self.base_delay)
+            if server_hint is not None:
+                backoff = max(backoff, min(server_hint, self.max_retry_after))
+        return backoff
+
+
+@dataclass
+class CallRetryStats:
+    """单次调用的重试记录"""
+    attempts: int = 0
+    errors: List[str] = field(default_factory=list)
+    delays: List[float] = field(default_factory=list)
+
+    @property
+    def retries(self) -> int:
+        return max(0, self.attempts - 1)
+
+    @property
+    def total_delay(self) -> float:
+        return sum(self.delays)
+
+    def to_dict(self) -> Dict[str, object]:
+        return {
+            "attempts": self.attempts,
+            "retries": self.retries,
+            "errors": list(self.errors),
+            "delays": [round(d, 3) for d in self.delays],
+        }
+
+
+@dataclass
+class _RetryTotals:
+    calls: int = 0
+    retried_calls: int = 0
+    retries: int = 0
+    failures: int = 0
+    delay_sec: float = 0.0
+    errors: Dict[str, int] = field(default_factory=lambda: dict.fromkeys(ERROR_KINDS, 0))
+
+
+_totals = _RetryTotals()
+
+
+def record_call(stats: CallRetryStats, failed: bool) -> None:
+    """汇总单次调用的重试记录到进程级指标"""
+    _totals.calls += 1
+    _totals.retries += stats.retries
+    _totals.delay_sec += stats.total_delay
+    if stats.retries:
+        _totals.retried_calls += 1
+    if failed:
+        _totals.failures += 1
+    for kind in stats.errors:
+        _totals.errors[kind] = _totals.errors.get(kind, 0) + 1
+
+
+def retry_metrics() -> Dict[str, object]:
+    return {
+        "calls": _totals.calls,
+        "retried_calls": _totals.retried_calls,
+        "retries": _totals.retries,
+        "failures": _totals.failures,
+        "delay_sec": round(_totals.delay_sec, 3),
+        "errors": dict(_totals.errors),
+    }
@@ -0,0 +1,323 @@
+"""进程级 LLM 调用调度器。
+
+所有 LLM 请求（结构化调用、续写流、灵感助手流）在发出前都向调度器申请额度：
+- 每个 LLMConfig 一组令牌桶：rpm_limit（每分钟请求数）与 tpm_limit（每分钟 token 数），-1/0 表示不限
+- 额度不足时排队；出队顺序先按优先级（交互式流 > 普通调用 > 后台工作流），同一优先级内按项目轮转，
+  避免某个项目的批量任务占满整个配置的额度
+- 申请时按估算的输入 token 预扣 tpm，调用结束后按实际 token 结算（多退少补）
+
+优先级与项目默认从 ContextVar 读取：工作流引擎在执行运行时以 llm_context("background", project_id) 包裹，
+节点内的 LLM 调用自动归为后台请求。
+"""
+
+import asyncio
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from time import monotonic
+from typing import Deque, Dict, Iterator, Optional
+
+from loguru import logger
+from sqlmodel import Session
+
+from app.db.models import LLMConfig
+
+
+PRIORITIES = ("interactive", "standard", "background")
+_PRIORITY_RANK = {name: rank for rank, name in enumerate(PRIORITIES)}
+
+_ctx_priority: ContextVar[Optional[str]] = ContextVar("llm_priority", default=None)
+_ctx_project: ContextVar[Optional[int]] = ContextVar("llm_project", default=None)
+
+
+@contextmanager
+def llm_context(priority: Optional[str] = None, project_id: Optional[int] = None) -> Iterator[None]:
+    """为其中发起的 LLM 调用设置默认优先级与所属项目"""
+    tokens = []
+    if priority is not None:
+        tokens.append((_ctx_priority, _ctx_priority.set(priority)))
+    if project_id is not None:
+        tokens.append((_ctx_project, _ctx_project.set(project_id)))
+    try:
+        yield
+    finally:
+        for var, token in reversed(tokens):
+            var.reset(token)
+
+
+class _TokenBucket:
+    """容量为每分钟额度、按秒匀速回填的令牌桶；结算超支后余额可为负，回填前阻塞后续请求"""
+
+    def __init__(self, per_minute: int) -> None:
+        self.capacity = float(per_minute)
+        self.tokens = float(per_minute)
+        self._updated = monotonic()
+
+    def set_limit(self, per_minute: int) -> None:
+        if per_minute != self.capacity:
+            self._refill()
+            self.capacity = float(per_minute)
+            self.tokens = min(self.tokens, self.capacity)
+
+    @property
+    def rate(self) -> float:
+        return self.capacity / 60.0
+
+    def _refill(self) -> None:
+        now = monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait_time(self, cost: float) -> float:
+        """还需等待多少秒才能扣除 cost（超过容量的请求按容量计，避免永远等不到）"""
+        self._refill()
+        need = min(cost, self.capacity) - self.tokens
+        return 0.0 if need <= 0 else need / self.rate
+
+    def take(self, cost: float) -> None:
+        self._refill()
+        self.tokens -= cost
+
+    def give(self, amount: float) -> None:
+        """退还已扣除的额度（不超过容量）"""
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+
+@dataclass
+class _Waiter:
+    cost: int
+    priority: str
+    project_id: Optional[int]
+    future: "asyncio.Future[None]"
+    enqueued_at: float = field(default_factory=monotonic)
+
+
+@dataclass
+class _ConfigStats:
+    granted: int = 0
+    waited: int = 0
+    wait_ms_total: float = 0.0
+    wait_ms_max: float = 0.0
+    reserved_tokens: int = 0
+    settled_tokens: int = 0
+    # 已放行但调用方在拿到额度前被取消、退还的次数
+    refunded: int = 0
+
+
+class _ConfigLimiter:
+    def __init__(self, config_id: int) -> None:
+        self.config_id = config_id
+        self.rpm: Optional[_TokenBucket] = None
+        self.tpm: Optional[_TokenBucket] = None
+        # priority -> project -> 等待队列；同一优先级内按项目轮转出队
+        self.queues: Dict[str, "OrderedDict[Optional[int], Deque[_Waiter]]"] = {p: OrderedDict() for p in PRIORITIES}
+        self.stats = _ConfigStats()
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    def set_limits(self, rpm_limit: int, tpm_limit: int) -> None:
+        self.rpm = self._bucket(self.rpm, rpm_limit)
+        self.tpm = self._bucket(self.tpm, tpm_limit)
+
+    @staticmethod
+    def _bucket(bucket: Optional[_TokenBucket], limit: int) -> Optional[_TokenBucket]:
+        if not limit or limit < 0:
+            return None
+        if bucket is None:
+            return _TokenBucket(limit)
+        bucket.set_limit(limit)
+        return bucket
+
+    def depth(self) -> int:
+        return sum(len(q) for queues in self.queues.values() for q in queues.values())
+
+    def _wait_time(self, cost: int) -> float:
+        return max(
+            self.rpm.wait_time(1) if self.rpm else 0.0,
+            self.tpm.wait_time(cost) if self.tpm else 0.0,
+        )
+
+    def _grant(self, cost: int, enqueued_at: float) -> None:
+        if self.rpm:
+            self.rpm.take(1)
+        if self.tpm:
+            self.tpm.take(cost)
+        waited_ms = (monotonic() - enqueued_at) * 1000
+        self.stats.granted += 1
+        self.stats.reserved_tokens += cost
+        if waited_ms >= 1:
+            self.stats.waited += 1
+            self.stats.wait_ms_total += waited_ms
+            self.stats.wait_ms_max = max(self.stats.wait_ms_max, waited_ms)
+
+    def try_acquire(self, cost: int) -> bool:
+        """无人排队且额度充足时直接放行"""
+        if self.depth() == 0 and self._wait_time(cost) <= 0:
+            self._grant(cost, monotonic())
+            return True
+        return False
+
+    def enqueue(self, waiter: _Waiter) -> None:
+        self.queues[waiter.priority].setdefault(waiter.project_id, deque()).append(waiter)
+        self.pump()
+
+    def remove(self, waiter: _Waiter) -> None:
+        queues = self.queues[waiter.priority]
+        q = queues.get(waiter.project_id)
+        if q is not None and waiter in q:
+            q.remove(waiter)
+            if not q:
+                del queues[waiter.project_id]
+        self.pump()
+
+    def _head(self) -> Optional[_Waiter]:
+        for priority in PRIORITIES:
+            queues = self.queues[priority]
+            while queues:
+                project_id, q = next(iter(queues.items()))
+                while q and q[0].future.done():
+                    q.popleft()
+                if q:
+                    return q[0]
+                del queues[project_id]
+        return None
+
+    def _pop(self, waiter: _Waiter) -> None:
+        queues = self.queues[waiter.priority]
+        q = queues[waiter.project_id]
+        q.popleft()
+        # 轮转：出队后把该项目移到队尾
+        if q:
+            queues.move_to_end(waiter.project_id)
+        else:
+            del queues[waiter.project_id]
+
+    def pump(self) -> None:
+        """按优先级/项目轮转放行队首请求；队首额度不足时定时重试（不让后面的小请求插队，避免饿死大请求）"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        while True:
+            head = self._head()
+            if head is None:
+                return
+            delay = self._wait_time(head.cost)
+            if delay > 0:
+                self._timer = asyncio.get_running_loop().call_later(delay, self.pump)
+                return
+            self._pop(head)
+            self._grant(head.cost, head.enqueued_at)
+            head.future.set_result(None)
+
+    def refund(self, cost: int) -> None:
+        """放行后调用未发出：退还请求次数与预扣的 tpm，并让排队中的请求继续出队"""
+        if self.rpm:
+            self.rpm.give(1)
+        if self.tpm:
+            self.tpm.give(cost)
+        self.stats.refunded += 1
+        self.pump()
+
+    def settle(self, reserved: int, actual: int) -> None:
+        self.stats.settled_tokens += max(0, actual)
+        if self.tpm and actual != reserved:
+            self.tpm.take(actual - reserved)
+
+    def snapshot(self) -> dict:
+        s = self.stats
+        return {
+            "rpm_limit": int(self.rpm.capacity) if self.rpm else -1,
+            "tpm_limit": int(self.tpm.capacity) if self.tpm else -1,
+            "requests_available": round(self.rpm.tokens, 2) if self.rpm else None,
+            "tokens_available": round(self.tpm.tokens, 2) if self.tpm else None,
+            "queue_depth": self.depth(),
+            "queue_by_priority": {
+                p: sum(len(q) for q in self.queues[p].values()) for p in PRIORITIES
+            },
+            "queued_projects": sorted(
+                {pid for queues in self.queues.values() for pid, q in queues.items() if q and pid is not None}
+            ),
+            "granted": s.granted,
+            "waited": s.waited,
+            "wait_ms_avg": round(s.wait_ms_total / s.waited, 2) if s.waited else 0.0,
+            "wait_ms_max": round(s.wait_ms_max, 2),
+            "reserved_tokens": s.reserved_tokens,
+            "settled_tokens": s.settled_tokens,
+            "refunded": s.refunded,
+        }
+
+
+class LLMGrant:
+    """一次放行的额度；调用结束后以实际 token 数结算"""
+
+    def __init__(self, limiter: _ConfigLimiter, reserved: int) -> None:
+        self._limiter = limiter
+        self._reserved = reserved
+        self._settled = False
+
+    def settle(self, actual_tokens: int) -> None:
+        if self._settled:
+            return
+        self._settled = True
+        self._limiter.settle(self._reserved, max(0, int(actual_tokens)))
+
+    def release(self) -> None:
+        """调用未能按实际用量结算（抛错/取消）时退还预扣的 tpm；已结算则不做任何事"""
+        self.settle(0)
+
+
+class LLMScheduler:
+    def __init__(self) -> None:
+        self._limiters: Dict[int, _ConfigLimiter] = {}
+
+    def _limiter(self, session: Session, config_id: int) -> _ConfigLimiter:
+        limiter = self._limiters.get(config_id)
+        if limiter is None:
+            limiter = self._limiters[config_id] = _ConfigLimiter(config_id)
+        # 每次申请时读取最新限额，配置修改即时生效
+        cfg = session.get(LLMConfig, config_id)
+        if cfg is not None:
+            limiter.set_limits(cfg.rpm_limit, cfg.tpm_limit)
+        return limiter
+
+    async def acquire(self, session: Session, config_id: int, est_tokens: int = 0,
+                      priority: Optional[str] = None, project_id: Optional[int] = None) -> LLMGrant:
+        """申请一次调用额度；priority/project_id 为空时取 llm_context 中的值"""
+        priority = priority or _ctx_priority.get() or "standard"
+        if priority not in _PRIORITY_RANK:
+            priority = "standard"
+        if project_id is None:
+            project_id = _ctx_project.get()
+        cost = max(0, int(est_tokens))
+        limiter = self._limiter(session, config_id)
+        if limiter.try_acquire(cost):
+            return LLMGrant(limiter, cost)
+
+        waiter = _Waiter(cost=cost, priority=priority, project_id=project_id,
+                         future=asyncio.get_running_loop().create_future())
+        limiter.enqueue(waiter)
+        if not waiter.future.done():
+            logger.info(f"[LLM调度] 额度不足，排队 config_id={config_id} priority={priority} project_id={project_id} depth={limiter.depth()}")
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.cancelled():
+                limiter.remove(waiter)
+            elif waiter.future.done():
+                # 已被放行、但在恢复执行前被取消：额度已扣除且不会再有 LLMGrant 结算，直接退还
+                limiter.refund(cost)
+            raise
+        return LLMGrant(limiter, cost)
+
+    def forget(self, config_id: int) -> None:
+        """配置删除后丢弃其限流状态；仍有请求排队时保留，待其出队"""
+        limiter = self._limiters.get(config_id)
+        if limiter is not None and limiter.depth() == 0:
+            del self._limiters[config_id]
+
+    def metrics(self) -> Dict[int, dict]:
+        return {config_id: limiter.snapshot() for config_id, limiter in self._limiters.items()}
+
+
+llm_scheduler = LLMScheduler()
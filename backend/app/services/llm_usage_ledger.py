@@ -0,0 +1,277 @@
+"""LLM 用量账本：内存记账 + 定期批量回写（write-behind）。
+
+每次 LLM 调用不再读取 LLMConfig 行、修改计数后单独提交（并行工作流下 SQLite 写锁串行化，
+容易出现 database is locked），而是：
+- 配额检查由内存中的账户完成：已落库用量 + 未落库增量 + 进行中调用的预留
+- reserve() 原子地检查并预留（输入 token + 调用次数），调用结束后 commit() 按实际用量记账并释放预留，
+  失败时 release() 只释放预留；检查与预留在同一把锁内完成，并发调用不会同时越过上限
+- 后台任务每隔 LLM_USAGE_FLUSH_INTERVAL_SEC 把各配置的增量合并为一条
+  UPDATE llmconfig SET used_x = used_x + ? 写回（同一事务），成功后才从增量中扣除
+进程崩溃最多丢失最近一次回写之后的增量；正常停止时会做最后一次回写。
+"""
+
+import asyncio
+import threading
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+
+import sqlalchemy as sa
+from loguru import logger
+from sqlmodel import Session
+
+from app.core.config import settings
+from app.db.models import LLMConfig
+
+
+@dataclass
+class _Account:
+    token_limit: int
+    call_limit: int
+    # 已落库用量
+    base_input: int
+    base_output: int
+    base_calls: int
+    # 未落库增量
+    pending_input: int = 0
+    pending_output: int = 0
+    pending_calls: int = 0
+    # 进行中调用的预留
+    reserved_tokens: int = 0
+    reserved_calls: int = 0
+
+    @property
+    def used_tokens(self) -> int:
+        return self.base_input + self.base_output + self.pending_input + self.pending_output
+
+    @property
+    def used_calls(self) -> int:
+        return self.base_calls + self.pending_calls
+
+    def check(self, need_tokens: int, need_calls: int) -> Tuple[bool, str]:
+        if self.token_limit is not None and self.token_limit >= 0:
+            if self.used_tokens + self.reserved_tokens + need_tokens > self.token_limit:
+                return False, "已超出 Token 上限"
+        if self.call_limit is not None and self.call_limit >= 0:
+            if self.used_calls + self.reserved_calls + need_calls > self.call_limit:
+                return False, "已超出调用次数上限"
+        return True, "OK"
+
+    def snapshot(self) -> dict:
+        return {
+            "token_limit": self.token_limit,
+            "call_limit": self.call_limit,
+            "used_tokens_input": self.base_input + self.pending_input,
+            "used_tokens_output": self.base_output + self.pending_output,
+            "used_calls": self.used_calls,
+            "pending_input": self.pending_input,
+            "pending_output": self.pending_output,
+            "pending_calls": self.pending_calls,
+            "reserved_tokens": self.reserved_tokens,
+            "reserved_calls": self.reserved_calls,
+        }
+
+
+class Reservation:
+    """一次调用的配额预留；commit/release 只生效一次"""
+
+    def __init__(self, ledger: "UsageLedger", config_id: int, tokens: int, calls: int) -> None:
+        self._ledger = ledger
+        self.config_id = config_id
+        self.tokens = tokens
+        self.calls = calls
+        self._done = False
+
+    def commit(self, input_tokens: int, output_tokens: int, calls: int = 1) -> None:
+        """按实际用量记账并释放预留"""
+        if self._done:
+            return
+        self._done = True
+        self._ledger._settle(self, input_tokens, output_tokens, calls)
+
+    def release(self) -> None:
+        """调用未发出或失败：只释放预留"""
+        if self._done:
+            return
+        self._done = True
+        self._ledger._settle(self, 0, 0, 0)
+
+
+class UsageLedger:
+    def __init__(self) -> None:
+        self._accounts: Dict[int, _Account] = {}
+        self._lock = threading.RLock()
+        self._flush_lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self.flushes = 0
+        self.flush_errors = 0
+
+    # ---------------- 账户 ----------------
+    def _account(self, session: Session, config_id: int) -> Optional[_Account]:
+        account = self._accounts.get(config_id)
+        if account is not None:
+            return account
+        cfg = session.get(LLMConfig, config_id)
+        if cfg is None:
+            return None
+        with self._lock:
+            account = self._accounts.get(config_id)
+            if account is None:
+                account = self._accounts[config_id] = _Account(
+                    token_limit=cfg.token_limit,
+                    call_limit=cfg.call_limit,
+                    base_input=cfg.used_tokens_input or 0,
+                    base_output=cfg.used_tokens_output or 0,
+                    base_calls=cfg.used_calls or 0,
+                )
+            return account
+
+    def check(self, session: Session, config_id: int, need_tokens: int, need_calls: int = 1) -> Tuple[bool, str]:
+        account = self._account(session, config_id)
+        if account is None:
+            return False, "LLM 配置不存在"
+        with self._lock:
+            return account.check(max(0, need_tokens), max(0, need_calls))
+
+    def reserve(self, session: Session, config_id: int, need_tokens: int,
+                need_calls: int = 1) -> Tuple[bool, str, Optional[Reservation]]:
+        """原子地检查配额并预留；不足时不预留"""
+        account = self._account(session, config_id)
+        if account is None:
+            return False, "LLM 配置不存在", None
+        tokens, calls = max(0, need_tokens), max(0, need_calls)
+        with self._lock:
+            ok, reason = account.check(tokens, calls)
+            if not ok:
+                return False, reason, None
+            account.reserved_tokens += tokens
+            account.reserved_calls += calls
+        return True, "OK", Reservation(self, config_id, tokens, calls)
+
+    def record(self, session: Session, config_id: int, input_tokens: int, output_tokens: int, calls: int = 1) -> None:
+        """记账（不经预留的调用）"""
+        account = self._account(session, config_id)
+        if account is None:
+            return
+        with self._lock:
+            account.pending_input += max(0, input_tokens)
+            account.pending_output += max(0, output_tokens)
+            account.pending_calls += max(0, calls)
+
+    def _settle(self, reservation: Reservation, input_tokens: int, output_tokens: int, calls: int) -> None:
+        with self._lock:
+            account = self._accounts.get(reservation.config_id)
+            if account is None:
+                return
+            account.reserved_tokens = max(0, account.reserved_tokens - reservation.tokens)
+            account.reserved_calls = max(0, account.reserved_calls - reservation.calls)
+            account.pending_input += max(0, input_tokens)
+            account.pending_output += max(0, output_tokens)
+            account.pending_calls += max(0, calls)
+
+    def reload(self, session: Session, config_id: int) -> None:
+        """限额或用量在数据库中被直接修改后（应先 flush）重新读取；未落库增量与进行中的预留保留"""
+        cfg = session.get(LLMConfig, config_id)
+        with self._lock:
+            account = self._accounts.get(config_id)
+            if account is None:
+                return
+            if cfg is None:
+                del self._accounts[config_id]
+                return
+            account.token_limit, account.call_limit = cfg.token_limit, cfg.call_limit
+            account.base_input = cfg.used_tokens_input or 0
+            account.base_output = cfg.used_tokens_output or 0
+            account.base_calls = cfg.used_calls or 0
+
+    def current_usage(self, config_id: int) -> Optional[Tuple[int, int, int]]:
+        """内存中的最新用量 (输入 tokens, 输出 tokens, 调用次数)，含未落库增量；账户未加载时为 None"""
+        with self._lock:
+            account = self._accounts.get(config_id)
+            if account is None:
+                return None
+            return (
+                account.base_input + account.pending_input,
+                account.base_output + account.pending_output,
+                account.used_calls,
+            )
+
+    def forget(self, config_id: int) -> None:
+        with self._lock:
+            self._accounts.pop(config_id, None)
+
+    # ---------------- 回写 ----------------
+    def flush(self) -> int:
+        """把所有未落库增量合并写回数据库；返回写回的配置数。失败时增量保留到下次"""
+        with self._flush_lock:
+            with self._lock:
+                deltas = {
+                    cid: (a.pending_input, a.pending_output, a.pending_calls)
+                    for cid, a in self._accounts.items()
+                    if a.pending_input or a.pending_output or a.pending_calls
+                }
+            if not deltas:
+                return 0
+            from app.db.session import engine
+
+            stmt = (
+                sa.update(LLMConfig)
+                .where(LLMConfig.id == sa.bindparam("cid"))
+                .values(
+                    used_tokens_input=LLMConfig.used_tokens_input + sa.bindparam("d_in"),
+                    used_tokens_output=LLMConfig.used_tokens_output + sa.bindparam("d_out"),
+                    used_calls=LLMConfig.used_calls + sa.bindparam("d_calls"),
+                )
+            )
+            try:
+                with engine.begin() as conn:
+                    conn.execute(stmt, [
+                        {"cid": cid, "d_in": d_in, "d_out": d_out, "d_calls": d_calls}
+                        for cid, (d_in, d_out, d_calls) in deltas.items()
+                    ])
+            except Exception as e:  # noqa: BLE001
+                self.flush_errors += 1
+                logger.warning(f"[LLM用量] 回写失败，增量保留到下次 configs={len(deltas)} err={e}")
+                return 0
+            with self._lock:
+                for cid, (d_in, d_out, d_calls) in deltas.items():
+                    account = self._accounts.get(cid)
+                    if account is None:
+                        continue
+                    account.pending_input -= d_in
+                    account.pending_output -= d_out
+                    account.pending_calls -= d_calls
+                    account.base_input += d_in
+                    account.base_output += d_out
+                    account.base_calls += d_calls
+            self.flushes += 1
+            return len(deltas)
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(settings.LLM_USAGE_FLUSH_INTERVAL_SEC)
+            # 在线程中执行：其他协程持有未提交的 SQLite 写事务时，等待写锁不会阻塞事件循环
+            await asyncio.to_thread(self.flush)
+
+    async def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_loop())
+            logger.info(f"[LLM用量] 已启动定期回写 interval={settings.LLM_USAGE_FLUSH_INTERVAL_SEC}s")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        written = await asyncio.to_thread(self.flush)
+        logger.info(f"[LLM用量] 已停止，最后一次回写 configs={written}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "flushes": self.flushes,
+                "flush_errors": self.flush_errors,
+                "accounts": {cid: a.snapshot() for cid, a in self._accounts.items()},
+            }
+
+
+usage_ledger = UsageLedger()
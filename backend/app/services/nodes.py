@@ -11,6 +11,9 @@ from pydantic import BaseModel
 from app.db.models import Card, CardType
 from loguru import logger
 from app.services import agent_service, context_service, memory_service, llm_config_service, prompt_service
+from app.services.workflow_checkpoint import rebind_rows
+from app.services.workflow_expr import TPL_PATTERN, compile_expr, compile_path, compile_template
+from app.services.workflow_trace import record_state_write
 
 
 # ==================== 节点注册机制 ====================
@@ -40,11 +43,39 @@ def get_registered_nodes() -> Dict[str, Callable]:
     return _NODE_REGISTRY.copy()
 
 
+def get_node_fn(node_type: str) -> Optional[Callable]:
+    """按类型获取节点函数（不复制注册表），未注册返回 None"""
+    return _NODE_REGISTRY.get(node_type)
+
+
 def get_node_types() -> List[str]:
     """获取所有已注册的节点类型名称"""
     return list(_NODE_REGISTRY.keys())
 
 
+# 可参与输出缓存的节点：inputs(state, params) 返回参与缓存键的输入内容（渲染后的 params 之外），
+# outputs(params) 返回节点写入 state 的路径，命中缓存时按这些路径回放。
+# 命中时节点不会被调用，其副作用也不会重放，因此只登记除写 state 外没有副作用的节点；
+# 写卡片/图谱的节点（如 Outline.Generate、KG.UpdateFromContent）不登记，卡片或图谱被删除后重跑必须重新写入，
+# 其中的结构化 LLM 调用由 llm_response_cache 按提示词缓存。
+_CACHEABLE_NODES: Dict[str, Dict[str, Callable]] = {}
+
+
+def register_cacheable(node_type: str,
+                       inputs: Optional[Callable[[dict, dict], Any]] = None,
+                       outputs: Optional[Callable[[dict], List[str]]] = None) -> None:
+    """声明节点可缓存（工作流中仍需通过 params.cache 或运行参数 node_cache 显式开启）"""
+    _CACHEABLE_NODES[node_type] = {
+        "inputs": inputs or (lambda state, params: None),
+        "outputs": outputs or (lambda params: []),
+    }
+
+
+def get_cache_spec(node_type: str) -> Optional[Dict[str, Callable]]:
+    """获取节点的缓存声明，未声明返回 None"""
+    return _CACHEABLE_NODES.get(node_type)
+
+
 # ======================================================
 
 
@@ -159,29 +190,15 @@ def _get_card_by_id(session: Session, card_id: int) -> Optional[Card]:
 
 
 def _get_by_path(obj: Any, path: str) -> Any:
-    print(f"DEBUG: _get_by_path path={path}")
-    # 极简路径解析：支持 $.content.a.b.c 与 $.a.b
+    # 路径解析：支持 $.content.a.b.c、$.a.b 与列表下标 $.a.list[0].name（编译结果按路径缓存）
     if not path or not isinstance(path, str):
         return None
     if not path.startswith("$."):
         return None
-    parts = path[2:].split(".")
     # 处理根 '$'：若 obj 为 {"$": base} 则先取出 base
     if isinstance(obj, dict) and "$" in obj:
-        cur: Any = obj.get("$")
-    else:
-        cur = obj
-    for p in parts:
-        if cur is None:
-            return None
-        if isinstance(cur, dict):
-            cur = cur.get(p)
-        else:
-            try:
-                cur = getattr(cur, p)
-            except Exception:
-                return None
-    return cur
+        obj = obj.get("$")
+    return compile_path(path)(obj)
 
 
 def _set_by_path(obj: Dict[str, Any], path: str, value: Any) -> bool:
@@ -209,35 +226,16 @@ def _set_by_path(obj: Dict[str, Any], path: str, value: Any) -> bool:
     
     # 设置最后一层的值
     cur[parts[-1]] = value
+    record_state_write(obj, path)
     return True
 
 
-_TPL_PATTERN = re.compile(r"\{([^{}]+)\}")
+_TPL_PATTERN = TPL_PATTERN
 
 
 def _resolve_expr(expr: str, state: dict) -> Any:
-    expr = expr.strip()
-    # index（循环序号，从 1 开始）
-    if expr == "index":
-        return (state.get("item") or {}).get("index")
-    # item.xxx
-    if expr.startswith("item."):
-        item = state.get("item") or {}
-        return _get_by_path({"item": item}, "$." + expr)
-    # current.xxx / current.card.xxx
-    if expr.startswith("current."):
-        cur = state.get("current") or {}
-        return _get_by_path({"current": cur}, "$." + expr)
-    # scope.xxx
-    if expr.startswith("scope."):
-        scope = state.get("scope") or {}
-        return _get_by_path({"scope": scope}, "$." + expr)
-    # $.content.xxx 针对当前 card
-    if expr.startswith("$."):
-        card = (state.get("current") or {}).get("card") or state.get("card")
-        base = {"content": getattr(card, "content", {})} if card else {}
-        return _get_by_path({"$": base}, expr)
-    return None
+    # index（循环序号，从 1 开始）/ item.xxx / current.xxx / scope.xxx / $.content.xxx（针对当前 card）
+    return compile_expr(expr)(state)
 
 
 def _to_name(x: Any) -> str:
@@ -290,19 +288,8 @@ def _render_value(val: Any, state: dict) -> Any:
     if isinstance(val, list):
         return [_render_value(v, state) for v in val]
     if isinstance(val, str):
-        # 单一表达式直接返回原类型
-        m = _TPL_PATTERN.fullmatch(val.strip())
-        if m:
-            resolved = _resolve_expr(m.group(1), state)
-            return resolved
-        # 内嵌模板，最终还是字符串
-        def repl(match: re.Match) -> str:
-            expr = match.group(1)
-            res = _resolve_expr(expr, state)
-            if isinstance(res, (dict, list)):
-                return str(res)
-            return "" if res is None else str(res)
-        return _TPL_PATTERN.sub(repl, val)
+        # 单一表达式直接返回原类型；内嵌模板最终还是字符串
+        return compile_template(val)(state)
     return val
 
 
@@ -595,6 +582,152 @@ def node_card_upsert_child_by_title(session: Session, state: dict, params: dict)
     return {"card": result}
 
 
+_MISSING = object()
+
+
+class _IterationState(dict):
+    """并发循环单次迭代的 state：记录迭代读取过、且读取时仍为迭代开始时取值（含不存在）的顶层键"""
+
+    __slots__ = ("_initial", "reads")
+
+    def __init__(self, initial: Dict[str, Any]) -> None:
+        super().__init__(initial)
+        self._initial = initial
+        self.reads: set = set()
+
+    def _note(self, key: Any) -> None:
+        if dict.get(self, key, _MISSING) is self._initial.get(key, _MISSING):
+            self.reads.add(key)
+
+    def __contains__(self, key: Any) -> bool:
+        self._note(key)
+        return super().__contains__(key)
+
+    def __getitem__(self, key: Any) -> Any:
+        self._note(key)
+        return super().__getitem__(key)
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        self._note(key)
+        return super().get(key, default)
+
+    def setdefault(self, key: Any, default: Any = None) -> Any:
+        self._note(key)
+        return super().setdefault(key, default)
+
+
+def _iteration_writes(initial: Dict[str, Any], final: Dict[str, Any]) -> tuple[Dict[str, Any], List[str]]:
+    """迭代写入的顶层键（新增/替换）与删除的键"""
+    written = {k: v for k, v in final.items() if initial.get(k, _MISSING) is not v}
+    removed = [k for k in initial if k not in final]
+    return written, removed
+
+
+async def _call_body(run_body, *args) -> None:
+    if asyncio.iscoroutinefunction(run_body):
+        await run_body(*args)
+    else:
+        run_body(*args)
+
+
+async def _run_loop_iterations(session: Optional[Session], state: dict, items: List[dict], run_body,
+                               params: dict, label: str) -> None:
+    """按迭代执行循环体。
+
+    - 默认（concurrency<=1）：逐个写入共享 state['item'] 后串行执行 body
+    - concurrency>1：先单独执行第一次迭代并记录 body 读写的顶层键。body 读取了自己会写的键
+      （如 state['items'] = state['items'] + [x] 这类累加）时，迭代之间有先后依赖，其余迭代退回串行；
+      否则其余迭代各自在 state 的浅拷贝与独立 session 上并发执行（最多 concurrency 个），
+      迭代完成时提交自己的写入，全部完成后按迭代序号把写入的顶层键合并回 state，与串行执行结果一致
+    - 并发迭代中对共享可变对象的原地修改（如向 touched_card_ids 添加元素）按完成先后生效，不做合并
+    - 任一迭代失败或循环被取消时，取消其余迭代（回滚其未提交的写入）并向上抛出
+    """
+    try:
+        concurrency = int(params.get("concurrency") or 1)
+    except (TypeError, ValueError):
+        concurrency = 1
+
+    if concurrency <= 1 or len(items) <= 1:
+        for item in items:
+            state["item"] = item
+            logger.info(f"[节点] {label} index={item.get('index')}")
+            await _call_body(run_body)
+        return
+
+    # 第一次迭代单独执行，探测 body 是否读取自己写入的键
+    probe = _IterationState(state)
+    probe["item"] = items[0]
+    logger.info(f"[节点] {label} index={items[0].get('index')} (探测)")
+    await _call_body(run_body, probe, None)
+    written, removed = _iteration_writes(state, probe)
+    dependent = (probe.reads & (set(written) | set(removed))) - {"item"}
+    for key, value in written.items():
+        state[key] = value
+    for key in removed:
+        state.pop(key, None)
+    rest = items[1:]
+    if dependent:
+        logger.warning(f"[节点] {label} 循环体读取了自身写入的键 {sorted(dependent)}，迭代间存在依赖，改为串行执行")
+        for item in rest:
+            state["item"] = item
+            logger.info(f"[节点] {label} index={item.get('index')}")
+            await _call_body(run_body)
+        return
+
+    base = dict(state)
+    bind = session.get_bind() if session is not None else None
+    results: List[Optional[tuple]] = [None] * len(rest)
+    pending = iter(enumerate(rest))
+
+    async def _run_one(pos: int, item: dict) -> None:
+        iter_session = Session(bind, expire_on_commit=False) if bind is not None else None
+        try:
+            initial = {k: rebind_rows(v, iter_session) for k, v in base.items()} if iter_session else dict(base)
+            overlay = _IterationState(initial)
+            overlay["item"] = item
+            logger.info(f"[节点] {label} index={item.get('index')} (并发)")
+            await _call_body(run_body, overlay, iter_session)
+            if iter_session is not None:
+                iter_session.commit()
+        except BaseException:
+            if iter_session is not None:
+                iter_session.rollback()
+            raise
+        finally:
+            if iter_session is not None:
+                iter_session.close()
+        iter_written, iter_removed = _iteration_writes(initial, overlay)
+        if session is not None:
+            iter_written = {k: rebind_rows(v, session) for k, v in iter_written.items()}
+        results[pos] = (iter_written, iter_removed, overlay.reads)
+
+    async def _worker() -> None:
+        for pos, item in pending:
+            await _run_one(pos, item)
+
+    workers = [asyncio.create_task(_worker()) for _ in range(min(concurrency, len(rest)))]
+    try:
+        await asyncio.gather(*workers)
+    except BaseException:
+        for w in workers:
+            w.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        raise
+
+    earlier_writes: set = set(written)
+    conflicts: set = set()
+    for iter_written, iter_removed, reads in results:
+        # 串行执行时，本次迭代读到的应是前面迭代写入的值
+        conflicts |= (reads & earlier_writes) - {"item"}
+        earlier_writes |= set(iter_written) | set(iter_removed)
+        for key, value in iter_written.items():
+            state[key] = value
+        for key in iter_removed:
+            state.pop(key, None)
+    if conflicts:
+        logger.warning(f"[节点] {label} 并发迭代读取了其他迭代写入的键 {sorted(conflicts)}，结果可能与串行执行不同")
+
+
 @register_node("List.ForEach")
 async def node_list_foreach(session: Session, state: dict, params: dict, run_body):
     """
@@ -602,6 +735,7 @@ async def node_list_foreach(session: Session, state: dict, params: dict, run_bod
     params:
       - listPath: string 例如 "$.content.character_cards"
       - list: 任意（兼容：字符串路径 or 直接数组）
+      - concurrency: int 可选，>1 时并发执行迭代（每次迭代独立的 item/state/session，迭代间有依赖时自动串行），默认 1 串行
     """
     list_path = params.get("listPath")
     seq: Any = None
@@ -628,13 +762,8 @@ async def node_list_foreach(session: Session, state: dict, params: dict, run_bod
         logger.warning(f"[节点] List.ForEach 取值非列表 path={list_path}")
         return
     logger.info(f"[节点] List.ForEach 解析完成，长度={len(seq)}")
-    for idx, it in enumerate(seq, start=1):
-        state["item"] = {"index": idx, **(it if isinstance(it, dict) else {"value": it})}
-        logger.info(f"[节点] List.ForEach index={idx}")
-        if asyncio.iscoroutinefunction(run_body):
-            await run_body()
-        else:
-            run_body()
+    items = [{"index": idx, **(it if isinstance(it, dict) else {"value": it})} for idx, it in enumerate(seq, start=1)]
+    await _run_loop_iterations(session, state, items, run_body, params, "List.ForEach")
 
 
 @register_node("List.ForEachRange")
@@ -644,6 +773,7 @@ async def node_list_foreach_range(session: Session, state: dict, params: dict, r
     params:
       - countPath: string 例如 "$.content.stage_count"
       - start: int 默认 1
+      - concurrency: int 可选，>1 时并发执行迭代，默认 1 串行
     """
     count_path = params.get("countPath")
     if not isinstance(count_path, str):
@@ -662,13 +792,9 @@ async def node_list_foreach_range(session: Session, state: dict, params: dict, r
         return
     
     start = int(params.get("start", 1) or 1)
-    for i in range(start, start + n):
-        state["item"] = {"index": i}
-        logger.info(f"[节点] List.ForEachRange index={i} (共{n}次)")
-        if asyncio.iscoroutinefunction(run_body):
-            await run_body()
-        else:
-            run_body()
+    logger.info(f"[节点] List.ForEachRange 共{n}次")
+    items = [{"index": i} for i in range(start, start + n)]
+    await _run_loop_iterations(session, state, items, run_body, params, "List.ForEachRange")
 
 
 @register_node("Card.ClearFields")
@@ -942,6 +1068,13 @@ async def node_llm_generate(session: Session, state: dict, params: dict) -> dict
     return {"content": content, "raw_result": result}
 
 
+# 提示词与风格均在 params 中渲染，渲染结果已进入缓存键
+register_cacheable(
+    "LLM.Generate",
+    outputs=lambda params: [params.get("targetPath", "$.last_ai_response")],
+)
+
+
 @register_node("Context.Assemble")
 def node_context_assemble(session: Session, state: dict, params: dict) -> dict:
     """
@@ -952,6 +1085,8 @@ def node_context_assemble(session: Session, state: dict, params: dict) -> dict:
       - radius: 查询半径 (可选)
       - top_k: 最大返回事实数 (可选)
       - pov_character: 主观视角角色 (可选)
+      - llm_config_id: 目标 LLM 配置 (可选，按其上下文窗口推算 token 预算)
+      - token_budget: 上下文 token 预算 (可选，优先于按 LLM 配置推算)
     """
     from app.services import context_service
     from app.services.context_service import ContextAssembleParams
@@ -962,6 +1097,8 @@ def node_context_assemble(session: Session, state: dict, params: dict) -> dict:
     radius = _render_value(params.get("radius"), state)
     top_k = _render_value(params.get("top_k"), state)
     pov_character = _render_value(params.get("pov_character"), state)
+    llm_config_id = _render_value(params.get("llm_config_id"), state)
+    token_budget = _render_value(params.get("token_budget"), state)
     
     assemble_params = ContextAssembleParams(
         project_id=project_id,
@@ -970,6 +1107,8 @@ def node_context_assemble(session: Session, state: dict, params: dict) -> dict:
         radius=radius,
         top_k=top_k,
         pov_character=pov_character,
+        llm_config_id=int(llm_config_id) if llm_config_id else None,
+        token_budget=int(token_budget) if token_budget else None,
     )
     
     from dataclasses import asdict
@@ -78,6 +78,8 @@ class RelationService:
             output_type=RelationExtraction,
             system_prompt=system_prompt,
             timeout=timeout,
+            # 抽取任务对同一正文与提示词的结果应当稳定，强制启用响应缓存
+            cache=True,
         )
         if not isinstance(res, RelationExtraction):
             raise ValueError("LLM 关系抽取失败：输出格式不符合 RelationExtraction")
@@ -0,0 +1,163 @@
+"""流式输出管道：位于模型流与 SSE 客户端之间。
+
+- TextRope：只追加的分片累加器，追加 O(1)，首次取全文时一次 join 并缓存；
+  续写的用量估算与历史保存共用同一份累加结果，不再 `accumulated += delta` 反复拷贝整串
+- coalesce：按时间窗口与字符数把逐 token 的增量合并成帧，SSE 不再每个 token 一帧、一次 json.dumps
+- 背压：客户端消费慢时增量在缓冲区内继续合并（帧自动变大）；缓冲超过高水位后暂停读取模型流，
+  直到客户端取走一帧，避免慢客户端让服务端无限堆积
+"""
+
+import asyncio
+from dataclasses import dataclass
+from typing import AsyncIterator, List, Optional
+
+from loguru import logger
+
+from app.core.config import settings
+
+
+class TextRope:
+    """只追加的文本累加器"""
+
+    __slots__ = ("_parts", "_length", "_joined")
+
+    def __init__(self) -> None:
+        self._parts: List[str] = []
+        self._length = 0
+        self._joined: Optional[str] = None
+
+    def append(self, text: str) -> None:
+        if not text:
+            return
+        self._parts.append(text)
+        self._length += len(text)
+        self._joined = None
+
+    def text(self) -> str:
+        if self._joined is None:
+            joined = "".join(self._parts)
+            # 合并为单个分片，后续追加后再次 join 时不必重新拼接已有部分的列表
+            self._parts = [joined] if joined else []
+            self._joined = joined
+        return self._joined
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __bool__(self) -> bool:
+        return self._length > 0
+
+
+@dataclass
+class PipelineStats:
+    deltas: int = 0
+    frames: int = 0
+    chars: int = 0
+    # 因缓冲超过高水位而暂停读取模型流的次数与累计时长
+    paused: int = 0
+    paused_sec: float = 0.0
+    max_buffered: int = 0
+
+
+async def coalesce(
+    source: AsyncIterator[str],
+    *,
+    window_ms: Optional[float] = None,
+    max_chars: Optional[int] = None,
+    high_water: Optional[int] = None,
+    stats: Optional[PipelineStats] = None,
+) -> AsyncIterator[str]:
+    """把增量流合并成帧。
+
+    首个增量到达后最多等待 window_ms 再出帧，缓冲达到 max_chars 时立即出帧；
+    window_ms 为 0 时不主动等待，只在客户端消费慢时合并。
+    下游关闭（客户端断开）时取消读取任务，取消会传递给模型流，由其按中止记账。
+    """
+    window = (settings.STREAM_COALESCE_WINDOW_MS if window_ms is None else window_ms) / 1000
+    max_chars = max_chars or settings.STREAM_COALESCE_MAX_CHARS
+    high_water = max(high_water or settings.STREAM_BACKPRESSURE_HIGH_WATER_CHARS, max_chars)
+    st = stats if stats is not None else PipelineStats()
+    loop = asyncio.get_running_loop()
+
+    buffer: List[str] = []
+    buffered = 0
+    arrived = asyncio.Event()
+    drained = asyncio.Event()
+    done = False
+    error: Optional[BaseException] = None
+
+    async def pump() -> None:
+        nonlocal buffered, done, error
+        try:
+            async for delta in source:
+                if not delta:
+                    continue
+                buffer.append(delta)
+                buffered += len(delta)
+                st.deltas += 1
+                if buffered > st.max_buffered:
+                    st.max_buffered = buffered
+                # 只在缓冲由空变为非空或达到单帧上限时唤醒消费端，窗口内的后续增量不逐个唤醒
+                if buffered == len(delta) or buffered >= max_chars:
+                    arrived.set()
+                if buffered >= high_water:
+                    st.paused += 1
+                    paused_at = loop.time()
+                    drained.clear()
+                    await drained.wait()
+                    st.paused_sec += loop.time() - paused_at
+        except asyncio.CancelledError:
+            # 在背压等待中被取消时模型流停在 yield 处，需显式关闭使其按中止记账
+            aclose = getattr(source, "aclose", None)
+            if aclose is not None:
+                await aclose()
+            raise
+        except Exception as e:  # noqa: BLE001
+            error = e
+        finally:
+            done = True
+            arrived.set()
+
+    async def _wait(timeout: Optional[float]) -> None:
+        arrived.clear()
+        # 用定时回调代替 wait_for，每帧只多一个计时器而不是一个任务
+        timer = loop.call_later(timeout, arrived.set) if timeout is not None else None
+        try:
+            await arrived.wait()
+        finally:
+            if timer is not None:
+                timer.cancel()
+
+    task = asyncio.create_task(pump())
+    try:
+        while True:
+            while not buffer and not done:
+                await _wait(None)
+            if buffer and window > 0 and not done:
+                deadline = loop.time() + window
+                while not done and buffered < max_chars:
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        break
+                    await _wait(remaining)
+            if buffer:
+                frame = buffer[0] if len(buffer) == 1 else "".join(buffer)
+                buffer.clear()
+                buffered = 0
+                drained.set()
+                st.frames += 1
+                st.chars += len(frame)
+                yield frame
+                continue
+            if done:
+                break
+        if error is not None:
+            raise error
+    finally:
+        if not task.done():
+            task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        logger.debug(
+            f"[流式管道] deltas={st.deltas} frames={st.frames} chars={st.chars} "
+            f"max_buffered={st.max_buffered} paused={st.paused} paused_sec={st.paused_sec:.3f}"
+        )
@@ -0,0 +1,262 @@
+"""Token 计数：快速启发式估算、按内容缓存、可插拔的离线分词器与按实际用量校准。
+
+启发式规则与旧版正则一致：连续英文字母算 1，其余每个非空白字符（汉字、数字、符号）各算 1。
+实现上不再逐个匹配：只用一次正则去掉英文单词并计数，剩余非空白字符数由 split/join 在 C 层算出；
+没有英文字母的文本（纯中文正文）不产生任何中间字符串拷贝。
+
+较长文本（系统提示词、章节正文、知识库）按内容哈希缓存计数，同一请求内多次计算不再重复扫描。
+
+按提供商家族（openai / anthropic / google / heuristic）选择估算器：
+- LLM_TOKENIZER_DIR 下存在 <family>.json（HuggingFace tokenizers 格式）时用该分词器
+- openai 家族在设置了 TIKTOKEN_CACHE_DIR（已离线缓存编码文件）时使用 tiktoken
+- 其余回退到启发式；也可通过 register_tokenizer 注册自定义分词器
+每个估算器带一份校准：提供商返回实际输入 token 时记录 实际/估算 比值（指数滑动平均）与误差。
+"""
+
+import os
+import re
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Dict, Optional, Tuple
+
+from loguru import logger
+
+from app.core.config import settings
+
+
+_WORD_RE = re.compile(r"[A-Za-z]+")
+# 短文本直接计算比查缓存更快
+_MEMO_MIN_LEN = 512
+_MEMO_MAX_ENTRIES = 512
+# 校准比值的滑动平均权重
+_EMA_ALPHA = 0.1
+
+_PROVIDER_FAMILY = {
+    "openai": "openai",
+    "openai_compatible": "openai",
+    "deepseek": "openai",
+    "moonshot": "openai",
+    "qwen": "openai",
+    "minimax": "openai",
+    "zhipu": "openai",
+    "baichuan": "openai",
+    "anthropic": "anthropic",
+    "zhipu_anthropic": "anthropic",
+    "google": "google",
+}
+HEURISTIC = "heuristic"
+
+
+def heuristic_count(text: str) -> int:
+    """单遍启发式计数（不经缓存）"""
+    if not text:
+        return 0
+    # 去掉英文单词（每个记 1），剩余每个非空白字符记 1；
+    # 中文正文没有匹配时 subn 直接返回原字符串，只剩一次 split/join
+    stripped, words = _WORD_RE.subn("", text)
+    return len("".join(stripped.split())) + words
+
+
+class _Memo:
+    """按 (长度, 内容哈希) 缓存计数结果的 LRU；不持有原文"""
+
+    def __init__(self, max_entries: int = _MEMO_MAX_ENTRIES) -> None:
+        self._max = max_entries
+        self._data: "OrderedDict[Tuple[str, int, int], int]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_count(self, name: str, text: str, counter: Callable[[str], int]) -> int:
+        if len(text) < _MEMO_MIN_LEN:
+            return counter(text)
+        key = (name, len(text), hash(text))
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return value
+        value = counter(text)
+        with self._lock:
+            self.misses += 1
+            self._data[key] = value
+            while len(self._data) > self._max:
+                self._data.popitem(last=False)
+        return value
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"size": len(self._data), "hits": self.hits, "misses": self.misses}
+
+
+_memo = _Memo()
+
+
+def estimate_tokens(text: Optional[str]) -> int:
+    """启发式估算（带缓存）：配额、调度与用量统计统一使用此口径"""
+    if not text:
+        return 0
+    return _memo.get_or_count(HEURISTIC, text, heuristic_count)
+
+
+# ---------------- 估算器与校准 ----------------
+@dataclass
+class Calibration:
+    samples: int = 0
+    # 实际 / 估算 的滑动平均；样本不足时为 1
+    ratio: float = 1.0
+    # 校准前估算的平均相对误差（滑动平均）
+    error: float = 0.0
+    estimated_total: int = 0
+    actual_total: int = 0
+
+    def update(self, estimated: int, actual: int) -> None:
+        if estimated <= 0 or actual <= 0:
+            return
+        observed = actual / estimated
+        predicted = estimated * self.ratio
+        rel_error = abs(predicted - actual) / actual
+        if self.samples == 0:
+            self.ratio, self.error = observed, rel_error
+        else:
+            self.ratio += _EMA_ALPHA * (observed - self.ratio)
+            self.error += _EMA_ALPHA * (rel_error - self.error)
+        self.samples += 1
+        self.estimated_total += estimated
+        self.actual_total += actual
+
+    def to_dict(self) -> Dict[str, float]:
+        return {
+            "samples": self.samples,
+            "ratio": round(self.ratio, 4),
+            "error": round(self.error, 4),
+            "estimated_total": self.estimated_total,
+            "actual_total": self.actual_total,
+        }
+
+
+@dataclass
+class TokenEstimator:
+    family: str
+    name: str
+    counter: Callable[[str], int]
+    calibration: Calibration = field(default_factory=Calibration)
+
+    def count(self, text: Optional[str]) -> int:
+        if not text:
+            return 0
+        return _memo.get_or_count(self.name, text, self.counter)
+
+
+_registered: Dict[str, Tuple[str, Callable[[str], int]]] = {}
+_estimators: Dict[str, TokenEstimator] = {}
+_estimators_lock = threading.Lock()
+
+
+def register_tokenizer(family: str, name: str, counter: Callable[[str], int]) -> None:
+    """为提供商家族注册分词器（优先于内置加载逻辑）；已有校准数据随之重置"""
+    with _estimators_lock:
+        _registered[family] = (name, counter)
+        _estimators.pop(family, None)
+
+
+def provider_family(provider: Optional[str]) -> str:
+    return _PROVIDER_FAMILY.get((provider or "").lower(), HEURISTIC)
+
+
+def _load_hf_tokenizer(family: str) -> Optional[Tuple[str, Callable[[str], int]]]:
+    if not settings.LLM_TOKENIZER_DIR:
+        return None
+    path = Path(settings.LLM_TOKENIZER_DIR) / f"{family}.json"
+    if not path.is_file():
+        return None
+    try:
+        from tokenizers import Tokenizer
+    except ImportError:
+        logger.warning(f"[Token] 存在分词器文件但未安装 tokenizers，回退启发式 path={path}")
+        return None
+    tokenizer = Tokenizer.from_file(str(path))
+    return f"hf:{path.name}", lambda text: len(tokenizer.encode(text, add_special_tokens=False).ids)
+
+
+def _load_tiktoken() -> Optional[Tuple[str, Callable[[str], int]]]:
+    # 只在编码文件已离线缓存时使用，避免首次计数时联网下载
+    if not os.environ.get("TIKTOKEN_CACHE_DIR"):
+        return None
+    try:
+        import tiktoken
+        encoding = tiktoken.get_encoding("o200k_base")
+    except Exception as e:  # noqa: BLE001
+        logger.warning(f"[Token] tiktoken 不可用，回退启发式: {e}")
+        return None
+    return "tiktoken:o200k_base", lambda text: len(encoding.encode(text, disallowed_special=()))
+
+
+def _build_estimator(family: str) -> TokenEstimator:
+    loaded = _registered.get(family)
+    if loaded is None and family != HEURISTIC:
+        try:
+            loaded = _load_hf_tokenizer(family) or (_load_tiktoken() if family == "openai" else None)
+        except Exception as e:  # noqa: BLE001
+            logger.warning(f"[Token] 加载 {family} 分词器失败，回退启发式: {e}")
+            loaded = None
+    name, counter = loaded or (HEURISTIC, heuristic_count)
+    # 不同家族回退到同一启发式时各自校准，但共享计数缓存
+    return TokenEstimator(family=family, name=name, counter=counter)
+
+
+def get_estimator(provider: Optional[str] = None) -> TokenEstimator:
+    family = provider_family(provider)
+    estimator = _estimators.get(family)
+    if estimator is None:
+        with _estimators_lock:
+            estimator = _estimators.get(family)
+            if estimator is None:
+                estimator = _estimators[family] = _build_estimator(family)
+    return estimator
+
+
+def count_tokens(text: Optional[str], provider: Optional[str] = None, calibrated: bool = True) -> int:
+    """按提供商家族的估算器计数；calibrated 时乘以按实际用量校准的比值"""
+    estimator = get_estimator(provider)
+    raw = estimator.count(text)
+    if not calibrated or estimator.calibration.samples == 0:
+        return raw
+    return int(round(raw * estimator.calibration.ratio))
+
+
+def calibrate(provider: Optional[str], estimated_tokens: int, actual_tokens: int, tokenizer: str = HEURISTIC) -> None:
+    """用提供商返回的实际输入 token 数校准该家族的估算器。
+
+    estimated_tokens 为调用方发请求前已算好的输入估算（默认 estimate_tokens 的启发式口径），
+    不再重新拼接、计数输入文本；口径与该家族估算器不同（已加载真实分词器）时不更新校准。
+    """
+    if not actual_tokens or actual_tokens <= 0:
+        return
+    estimator = get_estimator(provider)
+    if estimator.name != tokenizer:
+        return
+    estimator.calibration.update(int(estimated_tokens), int(actual_tokens))
+
+
+def usage_input_tokens(message: object) -> int:
+    """从 LangChain 消息的 usage_metadata 中取实际输入 token 数（没有时为 0）"""
+    usage = getattr(message, "usage_metadata", None)
+    if isinstance(usage, dict):
+        try:
+            return int(usage.get("input_tokens") or 0)
+        except (TypeError, ValueError):
+            return 0
+    return 0
+
+
+def token_stats() -> Dict[str, object]:
+    return {
+        "memo": _memo.stats(),
+        "estimators": {
+            family: {"tokenizer": e.name, **e.calibration.to_dict()} for family, e in _estimators.items()
+        },
+    }
@@ -5,6 +5,8 @@ from chromadb.config import Settings
 from typing import List, Dict, Any, Optional
 from loguru import logger
 
+from app.services import context_cache
+
 # 默认存储路径
 VECTOR_DB_PATH = os.path.join(os.getcwd(), "data", "vector_store")
 
@@ -49,6 +51,7 @@ class VectorService:
                 metadatas=metadatas,
                 ids=ids
             )
+            context_cache.bump(project_id, "向量库写入")
             return True
         except Exception as e:
             logger.error(f"Vector add failed: {e}")
@@ -90,5 +93,6 @@ class VectorService:
         try:
             collection_name = f"project_{project_id}"
             self._client.delete_collection(collection_name)
+            context_cache.bump(project_id, "向量库删除")
         except Exception as e:
             logger.warning(f"Failed to delete collection for project {project_id}: {e}")
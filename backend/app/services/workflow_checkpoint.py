@@ -0,0 +1,131 @@
+"""工作流运行检查点：state 的紧凑序列化与恢复。
+
+state 中存在非 JSON 值：touched_card_ids 为 set，card/current.card/last_child 为 ORM 对象，
+部分节点会写入 pydantic 模型。序列化时：
+- set/tuple → {"__set__": [...]} / 列表
+- SQLModel 表对象 → {"__row__": 类名, "id": 主键}，恢复时按主键重新加载（只存引用，保持紧凑）
+- pydantic 模型 → model_dump() 的结果（恢复为普通 dict）
+- datetime → ISO 字符串
+- 其余无法表示的值 → 丢弃并记录告警
+"""
+
+from datetime import date, datetime
+from typing import Any, Dict, Iterable, List, Optional
+
+from loguru import logger
+from pydantic import BaseModel
+from sqlalchemy import inspect as sa_inspect
+from sqlalchemy.exc import InvalidRequestError
+from sqlmodel import Session, SQLModel
+
+from app.db import models as db_models
+
+
+_DROP = object()
+
+
+def _is_row(value: Any) -> bool:
+    return isinstance(value, SQLModel) and getattr(type(value), "__table__", None) is not None
+
+
+def _encode(value: Any, path: str) -> Any:
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    if isinstance(value, dict):
+        out: Dict[str, Any] = {}
+        for k, v in value.items():
+            enc = _encode(v, f"{path}.{k}")
+            if enc is not _DROP:
+                out[str(k)] = enc
+        return out
+    if isinstance(value, (list, tuple)):
+        return [e for e in (_encode(v, f"{path}[{i}]") for i, v in enumerate(value)) if e is not _DROP]
+    if isinstance(value, (set, frozenset)):
+        items = [e for e in (_encode(v, path) for v in value) if e is not _DROP]
+        try:
+            items.sort()
+        except TypeError:
+            pass
+        return {"__set__": items}
+    if _is_row(value):
+        return {"__row__": type(value).__name__, "id": getattr(value, "id", None)}
+    if isinstance(value, BaseModel):
+        return _encode(value.model_dump(), path)
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    logger.warning(f"[工作流检查点] 丢弃无法序列化的值 path={path} type={type(value).__name__}")
+    return _DROP
+
+
+def _decode(value: Any, session: Session) -> Any:
+    if isinstance(value, list):
+        return [_decode(v, session) for v in value]
+    if not isinstance(value, dict):
+        return value
+    if "__set__" in value and len(value) == 1:
+        return set(_decode(v, session) for v in value["__set__"])
+    if "__row__" in value and set(value.keys()) == {"__row__", "id"}:
+        model = getattr(db_models, str(value["__row__"]), None)
+        if model is None or value["id"] is None:
+            return None
+        return session.get(model, value["id"])
+    return {k: _decode(v, session) for k, v in value.items()}
+
+
+def encode_value(value: Any) -> Any:
+    """按检查点格式编码任意值（无法表示时返回 None）"""
+    encoded = _encode(value, "$")
+    return None if encoded is _DROP else encoded
+
+
+def decode_value(value: Any, session: Session) -> Any:
+    """encode_value 的逆过程"""
+    return _decode(value, session)
+
+
+def rebind_rows(value: Any, session: Session) -> Any:
+    """把 state 值中的 ORM 对象换成 session 中对应的实例（尽量不查库），供并发节点各用独立 session。
+
+    只复制包含 ORM 对象的 dict/list 容器，其余值（包括 touched_card_ids 等集合）原样返回、保持共享；
+    尚未持久化的对象无法跨 session 引用，同样原样返回。
+    """
+    if _is_row(value):
+        insp = sa_inspect(value)
+        if insp.key is None or insp.session is session:
+            return value
+        try:
+            return session.merge(value, load=False)
+        except InvalidRequestError:
+            # 带未提交修改的对象不能免加载合并，退回按主键加载后合并
+            return session.merge(value)
+    if isinstance(value, dict):
+        out: Optional[Dict[Any, Any]] = None
+        for k, v in value.items():
+            nv = rebind_rows(v, session)
+            if nv is not v:
+                if out is None:
+                    out = dict(value)
+                out[k] = nv
+        return value if out is None else out
+    if isinstance(value, list):
+        items = [rebind_rows(v, session) for v in value]
+        return value if all(a is b for a, b in zip(items, value)) else items
+    return value
+
+
+def dump_checkpoint(state: Dict[str, Any], executed: Iterable[str], definition_version: Optional[int]) -> Dict[str, Any]:
+    """生成检查点：state 快照 + 已完成节点 ID（有序，便于比对）"""
+    encoded = _encode(state, "$")
+    return {
+        "definition_version": definition_version,
+        "executed": sorted(str(n) for n in executed),
+        "state": encoded if isinstance(encoded, dict) else {},
+    }
+
+
+def load_checkpoint(session: Session, checkpoint: Dict[str, Any]) -> tuple[Dict[str, Any], List[str]]:
+    """从检查点恢复 (state, executed)；卡片等 ORM 引用在当前 session 中重新加载"""
+    state = _decode(checkpoint.get("state") or {}, session)
+    if not isinstance(state.get("touched_card_ids"), set):
+        state["touched_card_ids"] = set(state.get("touched_card_ids") or [])
+    return state, list(checkpoint.get("executed") or [])
@@ -1,61 +1,102 @@
 import asyncio
-from typing import AsyncIterator, Dict, Optional, Any, List, Callable
+from contextlib import nullcontext
+from time import monotonic
+from typing import AsyncIterator, Dict, Optional, Any, List, Callable, Iterable
 from datetime import datetime
 from sqlmodel import Session, select
 
+from app.core.config import settings
 from app.db.models import Workflow, WorkflowRun
 from app.services import nodes as builtin_nodes
+from app.services import workflow_node_cache as node_cache
+from app.services.workflow_plan import CompiledNode, ExecutionPlan, PlanCache
+from app.services.workflow_checkpoint import dump_checkpoint, load_checkpoint, rebind_rows
+from app.services.workflow_events import event_bus
+from app.services.workflow_trace import RunTrace, record_cache_hit
+from app.services.llm_scheduler import llm_context
 from loguru import logger
 
 
+_MISSING = object()
+
+
+class _StateMerger:
+    """并发节点的 state 合并器。
+
+    每个节点在 fork 出的浅拷贝上执行，完成后仅把发生变化（新增/替换/删除）的顶层键写回共享 state。
+    两个互不可见的并发节点写同一个键时，以声明顺序靠后的节点为准，与完成先后无关；
+    原地修改的可变对象（如 touched_card_ids 集合）本身即为共享对象，无需合并。
+    attach/detach 在 fork/merge 时转换值（节点使用独立 session 时，用于把 ORM 对象换到对应 session），
+    是否变化以转换后的快照为准，转换本身不算写入。
+    """
+
+    def __init__(self, state: Dict[str, Any]) -> None:
+        self._state = state
+        self._seq = 0
+        # key -> (合并序号, 写入节点的声明顺序)
+        self._writers: Dict[str, tuple] = {}
+        # node_id -> (fork 时的合并序号, 声明顺序, 基线快照, 节点本地 state)
+        self._forks: Dict[str, tuple] = {}
+
+    def fork(self, node_id: str, rank: int, attach: Optional[Callable[[Any], Any]] = None) -> Dict[str, Any]:
+        if attach is None:
+            base = dict(self._state)
+        else:
+            base = {k: attach(v) for k, v in self._state.items()}
+        local = dict(base)
+        self._forks[node_id] = (self._seq, rank, base, local)
+        return local
+
+    def merge(self, node_id: str, detach: Optional[Callable[[Any], Any]] = None) -> None:
+        launch_seq, rank, base, local = self._forks.pop(node_id)
+        self._seq += 1
+        changed = [k for k, v in local.items() if base.get(k, _MISSING) is not v]
+        removed = [k for k in base if k not in local]
+        for key in changed + removed:
+            writer = self._writers.get(key)
+            # 该键在本节点启动后被另一个并发节点写过，且对方声明顺序更靠后：保留对方的值
+            if writer and writer[0] > launch_seq and writer[1] > rank:
+                continue
+            if key in local:
+                self._state[key] = local[key] if detach is None else detach(local[key])
+            else:
+                self._state.pop(key, None)
+            self._writers[key] = (self._seq, rank)
+
+
 class LocalAsyncEngine:
     """
     极简本地执行器（MVP）
-    - 线性执行 nodes；支持 List.ForEach/List.ForEachRange（body 必须存在）
-    - 事件：step_started/step_succeeded/step_failed/run_completed
+    - 旧格式线性执行 nodes；标准格式（nodes+edges）按拓扑顺序并发执行就绪节点
+    - 支持 List.ForEach/List.ForEachRange（body 必须存在）
+    - 事件：step_started/step_succeeded/step_failed/run_completed，按运行缓冲并编号，支持多订阅者与断线回放
     - 规范化：执行前对 DSL 做兼容重写（ForEach 无 body → 将紧随节点折叠为 body）
+    - 执行计划：DSL 按 (workflow.id, version) 编译为不可变计划并跨运行复用
     - 调试支持：支持暂停、恢复、单步执行
+    - 检查点：每个节点完成后持久化 state 快照，失败运行可从首个未完成节点续跑
+    - 节点输出缓存：可缓存节点在输入未变时直接回放上次输出（需显式开启）
+    - 运行轨迹：记录每个节点的耗时、排队等待、LLM 调用与 token、写入的 state 键（workflowrunstep）
     """
 
     def __init__(self) -> None:
         self._run_tasks: Dict[int, asyncio.Task] = {}
-        self._event_queues: Dict[int, "asyncio.Queue[str]"] = {}
         self._paused_runs: Dict[int, asyncio.Event] = {}
         self._debug_runs: set[int] = set()
+        self._dispatcher: Optional[Callable[[int], None]] = None
+        self._cache_stats: Dict[int, node_cache.NodeCacheStats] = {}
+        self._traces: Dict[int, RunTrace] = {}
+        self._plans = PlanCache()
 
     # ---------------- background & events ----------------
     async def _publish(self, run_id: int, event: str) -> None:
-        # 兜底：若队列不存在则先创建，避免前端晚订阅时丢事件
-        queue = self._event_queues.get(run_id)
-        if queue is None:
-            logger.info(f"[工作流] _publish 发现队列不存在，已兜底创建 run_id={run_id}")
-            queue = asyncio.Queue()
-            self._event_queues[run_id] = queue
-        await queue.put(event)
+        event_bus.publish(run_id, event)
 
     async def _close_queue(self, run_id: int) -> None:
-        queue = self._event_queues.get(run_id)
-        if queue is not None:
-            await queue.put("__CLOSE__")
-
-    def _ensure_queue(self, run_id: int) -> asyncio.Queue:
-        q = self._event_queues.get(run_id)
-        if q is None:
-            q = asyncio.Queue()
-            self._event_queues[run_id] = q
-            logger.info(f"[工作流] 已创建事件队列 run_id={run_id}")
-        return q
-
-    def subscribe_events(self, run_id: int) -> AsyncIterator[str]:
-        queue = self._ensure_queue(run_id)
-
-        async def _gen() -> AsyncIterator[str]:
-            while True:
-                item = await queue.get()
-                if item == "__CLOSE__":
-                    break
-                yield item
-        return _gen()
+        event_bus.close(run_id)
+
+    def subscribe_events(self, run_id: int, last_event_id: Optional[int] = None) -> AsyncIterator[str]:
+        """订阅运行事件（可多个订阅者并存）；last_event_id 用于断线重连后从该序号之后回放"""
+        return event_bus.subscribe(run_id, last_event_id)
 
     def _background_run(self, coro_factory: Callable[[], Any], run_id: int) -> Optional[asyncio.Task]:
         try:
@@ -67,7 +108,8 @@ class LocalAsyncEngine:
             return None
 
     # ---------------- create run ----------------
-    def create_run(self, session: Session, workflow: Workflow, scope_json: Optional[dict], params_json: Optional[dict], idempotency_key: Optional[str]) -> WorkflowRun:
+    def create_run(self, session: Session, workflow: Workflow, scope_json: Optional[dict], params_json: Optional[dict], idempotency_key: Optional[str],
+                   available_at: Optional[datetime] = None) -> WorkflowRun:
         run = WorkflowRun(
             workflow_id=workflow.id,
             definition_version=workflow.version,
@@ -75,13 +117,14 @@ class LocalAsyncEngine:
             scope_json=scope_json,
             params_json=params_json,
             idempotency_key=idempotency_key,
+            available_at=available_at,
         )
         session.add(run)
         session.commit()
         session.refresh(run)
-        # 提前创建事件队列，确保即便前端稍后订阅也不会丢第一批事件
-        self._ensure_queue(run.id)
-        logger.info(f"[工作流] Run 已创建并初始化事件队列 run_id={run.id} workflow_id={workflow.id}")
+        # 提前创建事件缓冲，确保即便前端稍后订阅也不会丢第一批事件
+        event_bus.open(run.id)
+        logger.info(f"[工作流] Run 已创建并初始化事件缓冲 run_id={run.id} workflow_id={workflow.id}")
         return run
 
     # ---------------- debug control ----------------
@@ -125,221 +168,284 @@ class LocalAsyncEngine:
                 if run_id in self._debug_runs:
                     event.clear()  # 调试模式下，单步后继续暂停
 
-    # ---------------- nodes ----------------
-    def _resolve_node_fn(self, type_name: str):
-        """从节点注册表中获取节点函数"""
-        registry = builtin_nodes.get_registered_nodes()
-        fn = registry.get(type_name)
-        if not fn:
-            raise ValueError(f"未知节点类型: {type_name}，已注册的节点: {list(registry.keys())}")
-        return fn
+    # ---------------- plan ----------------
+    def get_plan(self, workflow: Workflow) -> ExecutionPlan:
+        """获取工作流的执行计划（按 workflow.id + version 缓存）"""
+        return self._plans.get(workflow)[0]
 
-    # ---------------- canonicalize ----------------
-    @staticmethod
-    def _canonicalize(nodes: List[dict]) -> List[dict]:
-        """将 DSL 规范化：
-        - ForEach/ForEachRange 若无 body，则将后一个节点折叠为其 body，并跳过单独执行。
-        """
-        out: List[dict] = []
-        i = 0
-        while i < len(nodes):
-            n = nodes[i]
-            ntype = n.get("type")
-            if ntype in ("List.ForEach", "List.ForEachRange") and not n.get("body") and i + 1 < len(nodes):
-                compat = dict(n)
-                compat["body"] = [nodes[i + 1]]
-                out.append(compat)
-                logger.warning("[工作流] 兼容重写：ForEach/Range 缺少 body，已将后一节点折叠为 body")
-                i += 2
-                continue
-            out.append(n)
-            i += 1
-        return out
+    def compile_report(self, workflow: Workflow) -> tuple[ExecutionPlan, List[str]]:
+        """获取执行计划及编译错误（供校验接口使用）"""
+        return self._plans.get(workflow)
+
+    def invalidate_plan(self, workflow_id: int) -> None:
+        """工作流定义变更/删除时丢弃已编译的计划"""
+        self._plans.invalidate(workflow_id)
 
     # ---------------- execute ----------------
     async def _execute_dsl(self, session: Session, workflow: Workflow, run: WorkflowRun) -> None:
-        dsl: Dict[str, Any] = workflow.definition_json or {}
-        raw_nodes: List[dict] = list(dsl.get("nodes") or [])
-        
-        # 检查是否是标准格式（包含edges）
-        is_standard_format = "edges" in dsl and isinstance(dsl["edges"], list)
-        
-        if is_standard_format:
+        plan = self.get_plan(workflow)
+        if plan.kind == "graph":
             # 标准格式：基于edges执行
-            await self._execute_standard_format(session, workflow, run, dsl)
+            await self._execute_standard_format(session, workflow, run, plan)
         else:
-            # 旧格式：保持原有逻辑
-            await self._execute_legacy_format(session, workflow, run, raw_nodes)
+            # 旧格式：线性执行
+            await self._execute_legacy_format(session, workflow, run, plan)
 
-    async def _execute_standard_format(self, session: Session, workflow: Workflow, run: WorkflowRun, dsl: dict) -> None:
+    async def _execute_standard_format(self, session: Session, workflow: Workflow, run: WorkflowRun, plan: ExecutionPlan) -> None:
         """执行标准格式的工作流（基于nodes+edges）"""
-        nodes: List[dict] = list(dsl.get("nodes") or [])
-        edges: List[dict] = list(dsl.get("edges") or [])
-        state: Dict[str, Any] = {"scope": run.scope_json or {}, "touched_card_ids": set()}
-        
-        logger.info(f"[工作流] 开始执行 run_id={run.id} workflow_id={workflow.id} nodes={len(nodes)} edges={len(edges)}")
+        state, completed = self._restore_checkpoint(session, run, plan.version)
         
-        # 构建执行图
-        graph = self._build_execution_graph(nodes, edges)
+        logger.info(f"[工作流] 开始执行 run_id={run.id} workflow_id={workflow.id} version={plan.version} nodes={len(plan.nodes)}")
         
-        # 执行工作流
-        await self._execute_graph(graph, session, state, run.id)
+        # 执行工作流（并发上限可由 run.params_json.max_concurrency 指定）
+        max_concurrency = (run.params_json or {}).get("max_concurrency")
+        await self._execute_graph(
+            plan, session, state, run.id,
+            max_concurrency=max_concurrency,
+            completed=completed,
+            on_checkpoint=lambda executed: self._write_checkpoint(session, run, state, executed),
+        )
         
         # 保存结果
         await self._save_execution_result(session, run, state)
     
-    def _build_execution_graph(self, nodes: List[dict], edges: List[dict]) -> dict:
-        """构建执行图：节点映射、依赖关系、后继关系"""
-        node_map = {n["id"]: n for n in nodes}
-        dependencies = {}  # node_id -> [predecessor_ids]
-        successors = {}    # node_id -> {"body": [...], "next": [...]}
-        
-        # 构建依赖和后继关系
-        for edge in edges:
-            source, target = edge["source"], edge["target"]
-            handle = edge.get("sourceHandle", "r")
-            
-            # 记录依赖
-            dependencies.setdefault(target, []).append(source)
-            
-            # 记录后继（区分body和next）
-            succ_type = "body" if handle == "b" else "next"
-            successors.setdefault(source, {"body": [], "next": []})[succ_type].append(target)
-        
-        # 找到起始节点
-        start_nodes = [n["id"] for n in nodes if n["id"] not in dependencies]
-        if not start_nodes and nodes:
-            logger.warning("[工作流] 无起始节点，使用第一个节点")
-            start_nodes = [nodes[0]["id"]]
-        
-        return {
-            "node_map": node_map,
-            "dependencies": dependencies,
-            "successors": successors,
-            "start_nodes": start_nodes
-        }
-    
-    async def _execute_graph(self, graph: dict, session: Session, state: dict, run_id: int) -> None:
-        """执行工作流图"""
-        node_map = graph["node_map"]
-        dependencies = graph["dependencies"]
-        successors = graph["successors"]
-        executed = set()
-        
-        async def execute_node(node_id: str) -> None:
-            if node_id in executed or node_id not in node_map:
-                return
-            
-            # 检查暂停状态
-            await self._check_pause(run_id)
-            
-            node = node_map[node_id]
-            ntype = node.get("type")
-            params = node.get("params") or {}
-            
-            logger.info(f"[工作流] 执行节点 id={node_id} type={ntype}")
-            await self._publish(run_id, f"event: step_started\ndata: {ntype}\n\n")
-            
-            try:
-                # 执行节点
-                await self._execute_single_node(node, session, state, run_id, successors.get(node_id, {}), node_map)
-                
-                # 标记为已执行
-                executed.add(node_id)
-                
-                # 如果是循环节点，标记body节点也已执行
-                if ntype in ("List.ForEach", "List.ForEachRange"):
-                    executed.update(successors.get(node_id, {}).get("body", []))
-                
-                logger.info(f"[工作流] 节点成功 id={node_id} type={ntype}")
-                await self._publish(run_id, f"event: step_succeeded\ndata: {ntype}\n\n")
-                
-                # 执行后续节点
-                await self._execute_successors(node_id, successors, dependencies, executed, execute_node)
-                
-            except Exception as e:
-                logger.exception(f"[工作流] 节点失败 id={node_id} type={ntype} err={e}")
-                await self._publish(run_id, f"event: step_failed\ndata: {ntype}: {e}\n\n")
-                raise
-        
-        # 执行所有起始节点
-        for start_id in graph["start_nodes"]:
-            await execute_node(start_id)
-
-    async def _execute_successors(self, node_id: str, successors: dict, dependencies: dict, executed: set, execute_node: Callable) -> None:
-        """执行后继节点"""
-        next_nodes = successors.get(node_id, {}).get("next", [])
-        for next_id in next_nodes:
-            # 检查所有依赖是否已完成
-            deps = dependencies.get(next_id, [])
-            if all(d in executed for d in deps):
-                await execute_node(next_id)
-
-    async def _execute_single_node(self, node: dict, session: Session, state: dict, run_id: int, 
-                                   node_successors: dict, node_map: dict) -> None:
-        """执行单个节点"""
-        ntype = node.get("type")
-        params = node.get("params") or {}
-        
-        # 循环节点特殊处理
-        if ntype in ("List.ForEach", "List.ForEachRange"):
-            body_node_ids = node_successors.get("body", [])
-            body_nodes = [node_map[bid] for bid in body_node_ids if bid in node_map]
-            
-            async def body_executor(s, st, p):
-                # 循环体执行逻辑
-                # 注意：循环体内部也需要支持异步
-                await self._execute_body_nodes(body_nodes, s, st, run_id)
-
-            fn = self._resolve_node_fn(ntype)
-            # 传入 body_executor 供循环节点调用
-            await fn(session, state, params, body_executor=body_executor)
+    async def _execute_graph(self, plan: ExecutionPlan, session: Session, state: dict, run_id: int,
+                             max_concurrency: Optional[int] = None,
+                             completed: Optional[Iterable[str]] = None,
+                             on_checkpoint: Optional[Callable[[set], None]] = None) -> None:
+        """执行工作流图（拓扑调度）
+        - 依赖全部完成的节点即为就绪节点，就绪节点并发执行，同时运行数受 max_concurrency 限制
+        - 每个节点在 state 的浅拷贝上执行，完成后按节点声明顺序确定性地合并写入
+        - 允许并发时每个节点使用独立 session：合并时提交该节点的写入，未合并（失败/被取消）的节点回滚，
+          检查点与运行状态的提交只涉及运行自身的 session，不会提交或丢弃其他节点未完成的写入
+        - 暂停/单步在启动节点前检查，单步一次只放行一个节点
+        - 任一节点失败时取消其余运行中的节点并抛出
+        - completed 为检查点中已完成的节点，续跑时跳过；每个节点合并后调用 on_checkpoint(executed)
+        """
+        node_map = plan.nodes
+        order = plan.order
+        dependencies = plan.dependencies
+        successors = plan.successors
+        body_ids = plan.body_ids
+        limit = max(1, int(max_concurrency or settings.WORKFLOW_MAX_CONCURRENCY))
+
+        executed: set = {nid for nid in (completed or []) if nid in node_map}
+        if executed:
+            # 续跑：依赖均已完成的未完成节点即为起点
+            start_nodes = [
+                nid for nid in plan.sequence
+                if nid not in executed and nid not in body_ids
+                and all(d in executed for d in dependencies.get(nid, ()))
+            ]
+            logger.info(f"[工作流] 从检查点续跑 run_id={run_id} 已完成={len(executed)} 起点={start_nodes}")
         else:
-            # 普通节点
-            fn = self._resolve_node_fn(ntype)
-            if asyncio.iscoroutinefunction(fn):
-                await fn(session, state, params)
+            start_nodes = list(plan.start_nodes)
+        scheduled: set = set(start_nodes) | executed
+        ready: List[str] = sorted((nid for nid in start_nodes if nid in node_map), key=order.get)
+        # 节点就绪时刻，用于统计等待并发槽位的时间
+        ready_at: Dict[str, float] = dict.fromkeys(ready, monotonic())
+        running: Dict[asyncio.Task, str] = {}
+        merger = _StateMerger(state)
+        # 节点独立 session：node_id -> session（合并后提交并关闭，失败/取消时回滚）
+        isolate = session is not None and limit > 1
+        node_sessions: Dict[str, Session] = {}
+        detach = (lambda value: rebind_rows(value, session)) if isolate else None
+
+        def _collect_ready(completed_ids: List[str]) -> None:
+            for cid in completed_ids:
+                for next_id in successors.get(cid, ()):
+                    if next_id in scheduled or next_id in body_ids or next_id not in node_map:
+                        continue
+                    if all(d in executed for d in dependencies.get(next_id, ())):
+                        scheduled.add(next_id)
+                        ready.append(next_id)
+                        ready_at[next_id] = monotonic()
+            ready.sort(key=order.get)
+
+        try:
+            while ready or running:
+                while ready and len(running) < limit:
+                    node_id = ready.pop(0)
+                    # 检查暂停状态
+                    await self._check_pause(run_id)
+                    node_session = session
+                    attach = None
+                    if isolate:
+                        node_session = node_sessions[node_id] = Session(session.get_bind(), expire_on_commit=False)
+                        attach = lambda value, ns=node_session: rebind_rows(value, ns)  # noqa: E731
+                    local_state = merger.fork(node_id, order[node_id], attach)
+                    wait_ms = (monotonic() - ready_at.pop(node_id, monotonic())) * 1000
+                    task = asyncio.create_task(
+                        self._execute_graph_node(node_map[node_id], node_session, local_state, run_id, wait_ms)
+                    )
+                    running[task] = node_id
+
+                done, _ = await asyncio.wait(list(running.keys()), return_when=asyncio.FIRST_COMPLETED)
+                # 同一批完成的节点按声明顺序合并，保证结果与完成先后无关
+                for task in sorted(done, key=lambda t: order[running[t]]):
+                    node_id = running.pop(task)
+                    task.result()
+                    node_session = node_sessions.pop(node_id, None)
+                    if node_session is not None:
+                        # 合并点：只提交该节点自己的写入
+                        try:
+                            node_session.commit()
+                            merger.merge(node_id, detach)
+                        finally:
+                            node_session.close()
+                    else:
+                        merger.merge(node_id)
+                    executed.add(node_id)
+                    completed = [node_id]
+                    # 如果是循环节点，标记body节点也已执行
+                    node = node_map[node_id]
+                    if node.is_loop:
+                        body = [b.id for b in node.body]
+                        executed.update(body)
+                        completed.extend(body)
+                    if on_checkpoint is not None:
+                        on_checkpoint(executed)
+                    _collect_ready(completed)
+        except BaseException:
+            for task in running:
+                task.cancel()
+            if running:
+                await asyncio.gather(*running.keys(), return_exceptions=True)
+            # 未合并节点的写入全部丢弃，续跑时这些节点会重新执行
+            for node_session in node_sessions.values():
+                try:
+                    node_session.rollback()
+                finally:
+                    node_session.close()
+            raise
+
+        pending = [nid for nid in plan.sequence if nid not in executed and nid not in body_ids]
+        if pending:
+            logger.warning(f"[工作流] 以下节点依赖未满足，未被执行 run_id={run_id} nodes={pending}")
+
+    async def _execute_graph_node(self, node: CompiledNode, session: Session, state: dict, run_id: int,
+                                  queue_wait_ms: float = 0.0) -> None:
+        """执行图中的单个节点并发布步骤事件"""
+        node_id = node.id
+        ntype = node.type
+        logger.info(f"[工作流] 执行节点 id={node_id} type={ntype}")
+        await self._publish(run_id, f"event: step_started\ndata: {ntype}\n\n")
+        try:
+            await self._execute_single_node(node, session, state, run_id, queue_wait_ms)
+        except asyncio.CancelledError:
+            logger.info(f"[工作流] 节点已取消 id={node_id} type={ntype}")
+            raise
+        except Exception as e:
+            logger.exception(f"[工作流] 节点失败 id={node_id} type={ntype} err={e}")
+            await self._publish(run_id, f"event: step_failed\ndata: {ntype}: {e}\n\n")
+            raise
+        logger.info(f"[工作流] 节点成功 id={node_id} type={ntype}")
+        await self._publish(run_id, f"event: step_succeeded\ndata: {ntype}\n\n")
+
+    async def _execute_single_node(self, node: CompiledNode, session: Session, state: dict, run_id: int,
+                                   queue_wait_ms: float = 0.0) -> None:
+        """执行单个节点"""
+        with self._trace_step(run_id, node, state, queue_wait_ms=queue_wait_ms):
+            # 循环节点特殊处理
+            if node.is_loop:
+                async def body_executor(iter_state: Optional[dict] = None, iter_session: Optional[Session] = None):
+                    # 循环体执行逻辑：默认在循环节点的 state/session 上执行；并发模式下由循环节点传入每次迭代独立的 state 与 session
+                    body_state = state if iter_state is None else iter_state
+                    body_session = session if iter_session is None else iter_session
+                    await self._execute_body_nodes(node.body, body_session, body_state, run_id, parent_id=node.id)
+
+                # 传入 body_executor 供循环节点调用
+                await node.fn(session, state, node.params, run_body=body_executor)
             else:
-                fn(session, state, params)
+                # 普通节点
+                await self._call_node(session, state, node, run_id)
+
+    def _trace_step(self, run_id: int, node: CompiledNode, state: dict, parent_id: Optional[str] = None,
+                    queue_wait_ms: float = 0.0):
+        trace = self._traces.get(run_id)
+        if trace is None:
+            return nullcontext()
+        return trace.step(node.id, node.type, state, parent_id=parent_id, queue_wait_ms=queue_wait_ms)
+
+    async def _call_node(self, session: Session, state: dict, node: CompiledNode, run_id: int) -> Any:
+        """调用普通节点；节点可缓存且本次运行开启缓存时，先查缓存，命中则把输出回放到 state"""
+        ntype, params = node.type, node.params
+        stats = self._cache_stats.get(run_id)
+        spec = builtin_nodes.get_cache_spec(ntype)
+        if spec is None or stats is None or not (stats.enabled or params.get("cache") is True):
+            return await self._invoke_node(node, session, state)
+
+        key = None
+        try:
+            rendered = node.render(state) if node.render else builtin_nodes._render_value(params, state)
+            key = node_cache.build_cache_key(session, ntype, rendered, spec["inputs"](state, params))
+            cached = None if stats.bypass else node_cache.lookup(session, key)
+        except Exception as e:  # noqa: BLE001
+            logger.warning(f"[工作流] 节点缓存查询失败，直接执行 type={ntype} err={e}")
+            cached = None
+        if cached is not None:
+            for path, value in cached["state"].items():
+                builtin_nodes._set_by_path(state, path, value)
+            stats.hits += 1
+            record_cache_hit()
+            logger.info(f"[工作流] 节点缓存命中 run_id={run_id} type={ntype}")
+            return cached["result"]
+
+        stats.misses += 1
+        result = await self._invoke_node(node, session, state)
+        if key is not None:
+            try:
+                # 输出路径与 _set_by_path 一致，相对 state 解析
+                outputs = {path: builtin_nodes._get_by_path(state, path) for path in spec["outputs"](params)}
+                node_cache.store(session, key, ntype, outputs, result)
+                stats.stores += 1
+            except Exception as e:  # noqa: BLE001
+                logger.warning(f"[工作流] 节点缓存写入失败 type={ntype} err={e}")
+        return result
 
-    async def _execute_body_nodes(self, body_nodes: List[dict], session, state, run_id: int):
+    @staticmethod
+    async def _invoke_node(node: CompiledNode, session: Session, state: dict) -> Any:
+        if node.is_async:
+            return await node.fn(session, state, node.params)
+        return node.fn(session, state, node.params)
+
+    async def _execute_body_nodes(self, body_nodes: Iterable[CompiledNode], session, state, run_id: int,
+                                  parent_id: Optional[str] = None):
         """执行body节点"""
         for bn in body_nodes:
             # 循环体内节点也检查暂停
             await self._check_pause(run_id)
             
-            ntype = bn.get("type")
-            params = bn.get("params") or {}
-            logger.info(f"[工作流] body节点 type={ntype}")
+            logger.info(f"[工作流] body节点 type={bn.type}")
             try:
-                fn = self._resolve_node_fn(ntype)
-                if asyncio.iscoroutinefunction(fn):
-                    await fn(session, state, params)
-                else:
-                    fn(session, state, params)
+                with self._trace_step(run_id, bn, state, parent_id=parent_id):
+                    await self._call_node(session, state, bn, run_id)
             except Exception as e:  # noqa: BLE001
-                logger.exception(f"[工作流] body节点失败 type={ntype} err={e}")
+                logger.exception(f"[工作流] body节点失败 type={bn.type} err={e}")
                 raise
 
-    async def _execute_legacy_format(self, session: Session, workflow: Workflow, run: WorkflowRun, raw_nodes: List[dict]) -> None:
+    async def _execute_legacy_format(self, session: Session, workflow: Workflow, run: WorkflowRun, plan: ExecutionPlan) -> None:
         """执行旧格式的工作流（线性执行）"""
-        nodes = self._canonicalize(raw_nodes)
-        state: Dict[str, Any] = {"scope": run.scope_json or {}, "touched_card_ids": set()}
+        state, completed = self._restore_checkpoint(session, run, plan.version)
+        executed: set = set(completed)
         
-        logger.info(f"[工作流] 开始执行(旧格式) run_id={run.id} workflow_id={workflow.id} nodes={len(nodes)}")
+        logger.info(f"[工作流] 开始执行(旧格式) run_id={run.id} workflow_id={workflow.id} nodes={len(plan.sequence)}")
         
-        for node in nodes:
+        for node_id in plan.sequence:
+            if node_id in executed:
+                continue
             # 检查暂停
             await self._check_pause(run_id=run.id)
             
-            ntype = node.get("type")
-            params = node.get("params") or {}
+            node = plan.nodes[node_id]
+            ntype = node.type
             
             await self._publish(run.id, f"event: step_started\ndata: {ntype}\n\n")
             try:
-                # 旧格式不支持 graph 结构的 successors，传入空
-                await self._execute_single_node(node, session, state, run.id, {}, {})
+                await self._execute_single_node(node, session, state, run.id)
                 await self._publish(run.id, f"event: step_succeeded\ndata: {ntype}\n\n")
+                executed.add(node_id)
+                self._write_checkpoint(session, run, state, executed)
             except Exception as e:
                 logger.exception(f"[工作流] 节点失败 run_id={run.id} type={ntype} err={e}")
                 await self._publish(run.id, f"event: step_failed\ndata: {ntype}: {e}\n\n")
@@ -351,39 +457,168 @@ class LocalAsyncEngine:
         """保存执行结果"""
         run.status = "completed"
         run.finished_at = datetime.now()
-        run.result_json = {"touched_card_ids": list(state.get("touched_card_ids", []))}
+        run.summary_json = {
+            **(run.summary_json or {}),
+            "touched_card_ids": list(state.get("touched_card_ids", [])),
+            **self._cache_summary(run.id),
+        }
+        run.checkpoint_json = None
         session.add(run)
+        self._persist_trace(session, run.id)
         session.commit()
         
-        # 清理调试状态
-        self._debug_runs.discard(run.id)
-        if run.id in self._paused_runs:
-            del self._paused_runs[run.id]
-            
+        self._clear_debug(run.id)
         await self._publish(run.id, "event: run_completed\ndata: success\n\n")
         await self._close_queue(run.id)
         logger.info(f"[工作流] Run 已完成 run_id={run.id}")
 
+    # ---------------- checkpoint ----------------
+    def _restore_checkpoint(self, session: Session, run: WorkflowRun,
+                            version: int) -> tuple[Dict[str, Any], List[str]]:
+        """读取运行检查点，返回 (state, 已完成节点)；无检查点或检查点写入后工作流定义已变更时从头执行
+
+        version 为本次执行所用计划的工作流版本；运行随之记为该版本，此后的检查点也按该版本写入。
+        """
+        fresh: Dict[str, Any] = {"scope": run.scope_json or {}, "touched_card_ids": set()}
+        checkpoint = run.checkpoint_json
+        run.definition_version = version
+        session.add(run)
+        if not checkpoint:
+            return fresh, []
+        if checkpoint.get("definition_version") != version:
+            logger.warning(
+                f"[工作流] 检查点与工作流版本不一致，从头执行 run_id={run.id} "
+                f"checkpoint={checkpoint.get('definition_version')} current={version}"
+            )
+            run.checkpoint_json = None
+            return fresh, []
+        try:
+            return load_checkpoint(session, checkpoint)
+        except Exception as e:  # noqa: BLE001
+            logger.warning(f"[工作流] 检查点恢复失败，从头执行 run_id={run.id} err={e}")
+            return fresh, []
+
+    def _write_checkpoint(self, session: Session, run: WorkflowRun, state: dict, executed: Iterable[str]) -> None:
+        """节点完成后持久化 state 快照与已完成节点；写入失败只告警，不影响运行"""
+        try:
+            run.checkpoint_json = dump_checkpoint(state, executed, run.definition_version)
+            session.add(run)
+            session.commit()
+        except Exception as e:  # noqa: BLE001
+            logger.warning(f"[工作流] 检查点写入失败 run_id={run.id} err={e}")
+
+    def resume_failed(self, session: Session, run: WorkflowRun) -> int:
+        """将失败/取消的运行重新提交，从检查点中首个未完成的节点继续执行"""
+        run.status = "queued"
+        run.error_json = None
+        run.finished_at = None
+        run.lease_owner = None
+        run.lease_expires_at = None
+        # 重新计数尝试次数，避免续跑被中断回收时因历史次数直接判失败
+        run.attempts = 0
+        session.add(run)
+        session.commit()
+        completed = len((run.checkpoint_json or {}).get("executed") or [])
+        logger.info(f"[工作流] 续跑运行 run_id={run.id} 已完成节点={completed}")
+        return self.run(session, run)
+
+    def _persist_trace(self, session: Session, run_id: int) -> None:
+        """把运行轨迹加入当前事务，随运行最终状态一并提交"""
+        trace = self._traces.pop(run_id, None)
+        if trace is None:
+            return
+        try:
+            session.add_all(trace.to_rows())
+        except Exception as e:  # noqa: BLE001
+            logger.warning(f"[工作流] 运行轨迹写入失败 run_id={run_id} err={e}")
+
+    def _cache_summary(self, run_id: int) -> Dict[str, Any]:
+        stats = self._cache_stats.get(run_id)
+        return {"node_cache": stats.to_dict()} if stats else {}
+
+    def _clear_debug(self, run_id: int) -> None:
+        """清理调试状态"""
+        self._debug_runs.discard(run_id)
+        if run_id in self._paused_runs:
+            del self._paused_runs[run_id]
+
+    async def mark_cancelled(self, session: Session, run: WorkflowRun) -> None:
+        """将运行标记为已取消并关闭事件流"""
+        run.status = "cancelled"
+        run.finished_at = datetime.now()
+        session.add(run)
+        session.commit()
+        self._clear_debug(run.id)
+        await self._publish(run.id, "event: run_cancelled\ndata: cancelled\n\n")
+        await self._close_queue(run.id)
+        logger.info(f"[工作流] Run 已取消 run_id={run.id}")
+
     # ---------------- public entry ----------------
+    def set_dispatcher(self, dispatcher: Optional[Callable[[int], None]]) -> None:
+        """注册运行调度器（持久化队列）。设置后 run() 只负责通知队列，由 worker 池领取执行。"""
+        self._dispatcher = dispatcher
+
+    def register_task(self, run_id: int, task: asyncio.Task) -> None:
+        """登记正在执行的运行任务，供 cancel() 使用"""
+        self._run_tasks[run_id] = task
+
+    async def execute(self, session: Session, workflow: Workflow, run: WorkflowRun) -> None:
+        """执行一次运行：失败时落库为 failed；被取消时原样抛出 CancelledError，由调用方决定最终状态"""
+        run_params = run.params_json or {}
+        # 节点缓存：node_cache 为整次运行开启（也可在节点 params.cache 单独开启），cache_bypass 跳过读取但仍刷新缓存
+        self._cache_stats[run.id] = node_cache.NodeCacheStats(
+            enabled=bool(run_params.get("node_cache")),
+            bypass=bool(run_params.get("cache_bypass")),
+        )
+        self._traces[run.id] = RunTrace(run.id)
+        try:
+            # 重新获取 session 避免跨线程问题（如果是在新线程运行）
+            # 但在 FastAPI/asyncio 环境下通常直接用传入的
+            # 节点内的 LLM 调用按后台优先级、以运行所属项目参与全局调度
+            with llm_context("background", (run.scope_json or {}).get("project_id")):
+                await self._execute_dsl(session, workflow, run)
+        except asyncio.CancelledError:
+            # 丢弃被中断节点的未提交写入，保留已执行节点的轨迹
+            try:
+                session.rollback()
+                self._persist_trace(session, run.id)
+                session.commit()
+            except Exception as e:  # noqa: BLE001
+                logger.warning(f"[工作流] 取消时保存运行轨迹失败 run_id={run.id} err={e}")
+            raise
+        except Exception as e:
+            logger.exception(f"[工作流] 运行异常 run_id={run.id} err={e}")
+            # 失败节点未提交的写入不随失败状态一并提交，续跑时该节点会重新执行
+            try:
+                session.rollback()
+            except Exception as rollback_err:  # noqa: BLE001
+                logger.warning(f"[工作流] 失败时回滚未提交写入失败 run_id={run.id} err={rollback_err}")
+            run.status = "failed"
+            run.error_json = {"error": str(e)}
+            run.summary_json = {**(run.summary_json or {}), **self._cache_summary(run.id)}
+            run.finished_at = datetime.now()
+            session.add(run)
+            self._persist_trace(session, run.id)
+            session.commit()
+            self._clear_debug(run.id)
+            await self._publish(run.id, f"event: run_failed\ndata: {e}\n\n")
+            await self._close_queue(run.id)
+        finally:
+            self._run_tasks.pop(run.id, None)
+            self._cache_stats.pop(run.id, None)
+            self._traces.pop(run.id, None)
+
     def run_workflow_background(self, session: Session, workflow: Workflow, run: WorkflowRun) -> int:
-        """后台异步运行工作流"""
+        """后台异步运行工作流（未启用持久化队列时的回退路径）"""
         async def _task():
+            run.status = "running"
+            run.started_at = datetime.now()
+            session.add(run)
+            session.commit()
             try:
-                # 重新获取 session 避免跨线程问题（如果是在新线程运行）
-                # 但在 FastAPI/asyncio 环境下通常直接用传入的
-                await self._execute_dsl(session, workflow, run)
-            except Exception as e:
-                logger.exception(f"[工作流] 运行异常 run_id={run.id} err={e}")
-                run.status = "failed"
-                run.error_json = {"error": str(e)}
-                run.finished_at = datetime.now()
-                session.add(run)
-                session.commit()
-                await self._publish(run.id, f"event: run_failed\ndata: {e}\n\n")
-                await self._close_queue(run.id)
-            finally:
-                if run.id in self._run_tasks:
-                    del self._run_tasks[run.id]
+                await self.execute(session, workflow, run)
+            except asyncio.CancelledError:
+                await self.mark_cancelled(session, run)
 
         task = self._background_run(_task, run.id)
         if task:
@@ -391,7 +626,10 @@ class LocalAsyncEngine:
         return run.id
 
     def run(self, session: Session, run: WorkflowRun) -> int:
-        """兼容旧代码：运行工作流"""
+        """提交运行：启用持久化队列时入队，否则直接在后台执行"""
+        if self._dispatcher is not None:
+            self._dispatcher(int(run.id))
+            return run.id
         workflow = session.get(Workflow, run.workflow_id)
         if not workflow:
             raise ValueError(f"Workflow not found: {run.workflow_id}")
@@ -0,0 +1,142 @@
+"""工作流运行事件总线。
+
+每个运行一个有界环形缓冲区，事件按运行内自增的序号（SSE id）编号：
+- 多个订阅者各自从缓冲区读取，互不抢占事件（多个浏览器标签页可同时订阅同一运行）
+- 订阅时可携带 Last-Event-ID，从该序号之后继续回放；已被环形缓冲挤出的事件以注释行提示
+- 运行结束后缓冲区保留 WORKFLOW_EVENT_TTL_SEC 供晚到/重连的订阅者回放，过期后回收
+
+发布与订阅都在事件循环线程内进行，不需要加锁；open() 可能在同步接口的线程中调用，只做字典插入。
+"""
+
+import asyncio
+from collections import deque
+from dataclasses import dataclass, field
+from time import monotonic
+from typing import AsyncIterator, Deque, Dict, Optional, Tuple
+
+from loguru import logger
+
+from app.core.config import settings
+
+
+# 未结束但长时间无事件、无订阅者的缓冲区（如进程外取消的排队运行）也会被回收
+_IDLE_EVICT_SEC = 3600.0
+
+
+@dataclass
+class _RunStream:
+    events: Deque[Tuple[int, str]]
+    last_seq: int = 0
+    closed_at: Optional[float] = None
+    touched_at: float = field(default_factory=monotonic)
+    subscribers: int = 0
+    # 每次发布后替换为新的 Event，等待中的订阅者全部被唤醒
+    changed: asyncio.Event = field(default_factory=asyncio.Event)
+
+    def notify(self) -> None:
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+
+def _format(seq: int, event: str) -> str:
+    """为 "event: x\\ndata: y\\n\\n" 形式的事件补上 SSE id 行"""
+    return f"id: {seq}\n{event}"
+
+
+class RunEventBus:
+    """按运行划分的可回放事件缓冲区"""
+
+    def __init__(self, buffer_size: Optional[int] = None, ttl_sec: Optional[float] = None) -> None:
+        self._streams: Dict[int, _RunStream] = {}
+        self._buffer_size = buffer_size or settings.WORKFLOW_EVENT_BUFFER_SIZE
+        self._ttl_sec = settings.WORKFLOW_EVENT_TTL_SEC if ttl_sec is None else ttl_sec
+
+    def _stream(self, run_id: int) -> _RunStream:
+        stream = self._streams.get(run_id)
+        if stream is None:
+            self._evict_expired()
+            stream = _RunStream(events=deque(maxlen=self._buffer_size))
+            self._streams[run_id] = stream
+        return stream
+
+    def open(self, run_id: int) -> None:
+        """提前创建缓冲区，确保即便前端稍后订阅也能回放第一批事件"""
+        self._stream(run_id)
+
+    def has(self, run_id: int) -> bool:
+        return run_id in self._streams
+
+    def publish(self, run_id: int, event: str) -> int:
+        """追加一条事件并唤醒订阅者，返回其序号；已关闭的运行（续跑）会重新打开"""
+        stream = self._stream(run_id)
+        stream.last_seq += 1
+        stream.events.append((stream.last_seq, event))
+        stream.closed_at = None
+        stream.touched_at = monotonic()
+        stream.notify()
+        return stream.last_seq
+
+    def close(self, run_id: int) -> None:
+        """标记运行事件流结束；订阅者读完缓冲区后退出，缓冲区在 TTL 后回收"""
+        stream = self._streams.get(run_id)
+        if stream is None:
+            return
+        stream.closed_at = stream.touched_at = monotonic()
+        stream.notify()
+
+    def _evict_expired(self) -> None:
+        now = monotonic()
+        expired = [
+            run_id for run_id, s in self._streams.items()
+            if s.subscribers == 0 and (
+                (s.closed_at is not None and now - s.closed_at >= self._ttl_sec)
+                or now - s.touched_at >= _IDLE_EVICT_SEC
+            )
+        ]
+        for run_id in expired:
+            del self._streams[run_id]
+        if expired:
+            logger.debug(f"[工作流事件] 已回收事件缓冲 {len(expired)} 个，剩余 {len(self._streams)}")
+
+    async def subscribe(self, run_id: int, last_event_id: Optional[int] = None) -> AsyncIterator[str]:
+        """
+        订阅运行事件：先回放 last_event_id 之后的缓冲事件，再实时推送，运行结束后退出
+        last_event_id 为空时从缓冲区起点回放
+        """
+        stream = self._stream(run_id)
+        stream.subscribers += 1
+        cursor = last_event_id or 0
+        if cursor > stream.last_seq:
+            # 序号超出当前缓冲（进程重启后序号重新计数），从头回放
+            cursor = 0
+        try:
+            while True:
+                waiter = stream.changed
+                if stream.events:
+                    first_seq = stream.events[0][0]
+                    if cursor + 1 < first_seq:
+                        yield f": {first_seq - cursor - 1} events dropped\n\n"
+                        cursor = first_seq - 1
+                    pending = [(seq, evt) for seq, evt in stream.events if seq > cursor]
+                    for seq, evt in pending:
+                        cursor = seq
+                        yield _format(seq, evt)
+                    if pending:
+                        continue
+                if stream.closed_at is not None and cursor >= stream.last_seq:
+                    return
+                await waiter.wait()
+        finally:
+            stream.subscribers -= 1
+            stream.touched_at = monotonic()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "streams": len(self._streams),
+            "open": sum(1 for s in self._streams.values() if s.closed_at is None),
+            "subscribers": sum(s.subscribers for s in self._streams.values()),
+            "buffered_events": sum(len(s.events) for s in self._streams.values()),
+        }
+
+
+event_bus = RunEventBus()
@@ -0,0 +1,154 @@
+"""工作流参数表达式的预编译层。
+
+模板字符串（如 "{item.name}"、"第{index}章：{item.title}"）与路径（如 "$.content.a.b"、
+"item.chars[0].name"）只在首次出现时切分，编译为访问闭包并按原字符串缓存；
+此后每次求值只做字典/属性/下标访问，不再重复正则匹配与 split。
+
+路径语法：以 "." 分隔的字段，字段后可跟任意个 [n] 下标（支持负数）；
+对列表使用纯数字字段（items.0）与 items[0] 等价。
+"""
+
+import re
+from functools import lru_cache
+from typing import Any, Callable, List, Optional, Tuple
+
+
+TPL_PATTERN = re.compile(r"\{([^{}]+)\}")
+_SEGMENT = re.compile(r"^([^\[\]]*)((?:\[-?\d+\])*)$")
+_INDEX = re.compile(r"\[(-?\d+)\]")
+
+_CACHE_SIZE = 4096
+
+# (是否下标, 字段名或下标)
+Step = Tuple[bool, Any]
+
+
+def _parse_steps(parts: List[str]) -> Tuple[Step, ...]:
+    steps: List[Step] = []
+    for part in parts:
+        m = _SEGMENT.match(part)
+        if not m:
+            steps.append((False, part))
+            continue
+        name, indexes = m.group(1), m.group(2)
+        if name or not indexes:
+            steps.append((False, name))
+        for idx in _INDEX.findall(indexes):
+            steps.append((True, int(idx)))
+    return tuple(steps)
+
+
+def _walk(cur: Any, steps: Tuple[Step, ...]) -> Any:
+    for is_index, key in steps:
+        if cur is None:
+            return None
+        if is_index:
+            if isinstance(cur, (list, tuple)):
+                try:
+                    cur = cur[key]
+                except IndexError:
+                    return None
+            elif isinstance(cur, dict):
+                cur = cur.get(key, cur.get(str(key)))
+            else:
+                return None
+        elif isinstance(cur, dict):
+            cur = cur.get(key)
+        elif isinstance(cur, (list, tuple)) and key.lstrip("-").isdigit():
+            try:
+                cur = cur[int(key)]
+            except IndexError:
+                return None
+        else:
+            try:
+                cur = getattr(cur, key)
+            except Exception:
+                return None
+    return cur
+
+
+@lru_cache(maxsize=_CACHE_SIZE)
+def compile_path(path: str) -> Callable[[Any], Any]:
+    """编译 "$.a.b[0]" 形式的路径为 accessor(root)；非法路径返回恒为 None 的访问器"""
+    if not isinstance(path, str) or not path.startswith("$."):
+        return lambda root: None
+    steps = _parse_steps(path[2:].split("."))
+    return lambda root: _walk(root, steps)
+
+
+def _card_content_base(state: dict) -> dict:
+    card = (state.get("current") or {}).get("card") or state.get("card")
+    return {"content": getattr(card, "content", {})} if card else {}
+
+
+@lru_cache(maxsize=_CACHE_SIZE)
+def compile_expr(expr: str) -> Callable[[dict], Any]:
+    """
+    编译单个表达式为 accessor(state)：
+    - index：循环序号（item.index）
+    - item.xxx / current.xxx / scope.xxx：从 state 对应根对象取值
+    - $.content.xxx：针对当前卡片（current.card 优先，其次 card）
+    - 其余：None
+    """
+    expr = expr.strip()
+    if expr == "index":
+        return lambda state: (state.get("item") or {}).get("index")
+    for root in ("item", "current", "scope"):
+        if expr.startswith(root + "."):
+            steps = _parse_steps(expr[len(root) + 1:].split("."))
+            return lambda state, _root=root: _walk(state.get(_root) or {}, steps)
+    if expr.startswith("$."):
+        steps = _parse_steps(expr[2:].split("."))
+        return lambda state: _walk(_card_content_base(state), steps)
+    return lambda state: None
+
+
+def _stringify(value: Any) -> str:
+    if value is None:
+        return ""
+    return str(value)
+
+
+@lru_cache(maxsize=_CACHE_SIZE)
+def compile_template(text: str) -> Callable[[dict], Any]:
+    """
+    编译模板字符串为 render(state)：
+    - 整体为单一表达式（"{item.list}"）时返回表达式的原始值（保留类型）
+    - 内嵌模板拼接为字符串，None 渲染为空串
+    - 不含模板时原样返回
+    """
+    whole = TPL_PATTERN.fullmatch(text.strip())
+    if whole:
+        return compile_expr(whole.group(1))
+    pieces: List[Any] = []
+    pos = 0
+    for m in TPL_PATTERN.finditer(text):
+        if m.start() > pos:
+            pieces.append(text[pos:m.start()])
+        pieces.append(compile_expr(m.group(1)))
+        pos = m.end()
+    if not pieces:
+        return lambda state: text
+    if pos < len(text):
+        pieces.append(text[pos:])
+    parts = tuple(pieces)
+
+    def render(state: dict) -> str:
+        return "".join(p if isinstance(p, str) else _stringify(p(state)) for p in parts)
+    return render
+
+
+def compile_value(val: Any, to_name_list: Optional[Callable[[Any], Any]] = None) -> Callable[[dict], Any]:
+    """将任意参数结构（dict/list/str）编译为 render(state)；{"$toNameList": expr} 交由 to_name_list 转换"""
+    if isinstance(val, dict):
+        if to_name_list is not None and isinstance(val.get("$toNameList"), str):
+            expr = compile_expr(val["$toNameList"])
+            return lambda state: to_name_list(expr(state))
+        items = tuple((k, compile_value(v, to_name_list)) for k, v in val.items())
+        return lambda state: {k: r(state) for k, r in items}
+    if isinstance(val, list):
+        renders = tuple(compile_value(v, to_name_list) for v in val)
+        return lambda state: [r(state) for r in renders]
+    if isinstance(val, str):
+        return compile_template(val)
+    return lambda state: val
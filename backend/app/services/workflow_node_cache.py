@@ -0,0 +1,104 @@
+import hashlib
+import json
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+from loguru import logger
+from sqlalchemy.engine import Engine
+from sqlmodel import Session, select
+
+from app.core.config import settings
+from app.db.models import LLMConfig, WorkflowNodeCache
+from app.services.cache_store import CacheCounters, CacheTable
+from app.services.workflow_checkpoint import decode_value, encode_value
+
+
+# 不参与缓存键的控制参数
+_CONTROL_PARAMS = ("cache",)
+
+_table = CacheTable(WorkflowNodeCache, "WORKFLOW_NODE_CACHE_TTL_SEC", "WORKFLOW_NODE_CACHE_MAX_BYTES", "[节点缓存]")
+
+
+@dataclass
+class NodeCacheStats(CacheCounters):
+    """单次运行的缓存统计，写入 run.summary_json.node_cache"""
+    enabled: bool = False
+    bypass: bool = False
+
+
+def _digest(obj: Any) -> str:
+    raw = json.dumps(obj, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def _llm_fingerprint(session: Session, params: dict) -> Optional[dict]:
+    """节点实际使用的 LLM 配置：显式 llm_config_id，否则与节点一致取第一个配置"""
+    config_id = params.get("llm_config_id")
+    config = session.get(LLMConfig, config_id) if config_id else session.exec(
+        select(LLMConfig).order_by(LLMConfig.id)  # type: ignore[arg-type]
+    ).first()
+    if not config:
+        return None
+    return {
+        "id": config.id,
+        "provider": config.provider,
+        "model_name": config.model_name,
+        "api_base": config.api_base,
+        "base_url": config.base_url,
+    }
+
+
+def build_cache_key(session: Session, node_type: str, rendered_params: dict, input_content: Any) -> str:
+    """缓存键 = 节点类型 + 渲染后参数 + 输入内容哈希 + LLM 配置"""
+    params = {k: v for k, v in (rendered_params or {}).items() if k not in _CONTROL_PARAMS}
+    return _digest({
+        "node_type": node_type,
+        "params": encode_value(params),
+        "input": _digest(encode_value(input_content)),
+        "llm": _llm_fingerprint(session, rendered_params or {}),
+    })
+
+
+def lookup(session: Session, cache_key: str) -> Optional[dict]:
+    """读取缓存条目，过期条目视为未命中；只读，不提交节点的 Session"""
+    entry = _table.find(session, cache_key)
+    if not entry:
+        return None
+    _table.touch(cache_key)
+    output = entry.output_json or {}
+    return {
+        "state": {path: decode_value(v, session) for path, v in (output.get("state") or {}).items()},
+        "result": decode_value(output.get("result"), session),
+    }
+
+
+def store(session: Session, cache_key: str, node_type: str, state_outputs: Dict[str, Any], result: Any) -> None:
+    """在后台写线程中写入（或覆盖）缓存条目并按大小/时间淘汰；不提交也不回滚节点的 Session"""
+    output = {
+        "state": {path: encode_value(v) for path, v in state_outputs.items()},
+        "result": encode_value(result),
+    }
+    size = len(json.dumps(output, ensure_ascii=False, default=str).encode("utf-8"))
+    if size > settings.WORKFLOW_NODE_CACHE_MAX_BYTES:
+        logger.info(f"[节点缓存] 输出过大不缓存 type={node_type} size={size}")
+        return
+
+    def _upsert(own: Session) -> None:
+        now = datetime.utcnow()
+        entry = own.exec(select(WorkflowNodeCache).where(WorkflowNodeCache.cache_key == cache_key)).first()
+        if entry is None:
+            entry = WorkflowNodeCache(cache_key=cache_key, node_type=node_type)
+        entry.output_json = output
+        entry.size_bytes = size
+        entry.created_at = now
+        entry.last_used_at = now
+        own.add(entry)
+
+    _table.write(session.get_bind(), _upsert)
+
+
+def evict(bind: Engine) -> int:
+    """删除过期条目；总大小超过上限时按最近使用时间从旧到新删除（独立会话）"""
+    with Session(bind) as own:
+        return _table.evict(own)
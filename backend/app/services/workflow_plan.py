@@ -0,0 +1,254 @@
+import asyncio
+import copy
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import Any, Callable, Dict, FrozenSet, List, Mapping, Optional, Tuple
+
+from loguru import logger
+
+from app.db.models import Workflow
+from app.services import nodes as builtin_nodes
+from app.services.workflow_expr import TPL_PATTERN, compile_value
+
+
+LOOP_TYPES = ("List.ForEach", "List.ForEachRange")
+
+
+def canonicalize(nodes: List[dict]) -> List[dict]:
+    """将 DSL 规范化：
+    - ForEach/ForEachRange 若无 body，则将后一个节点折叠为其 body，并跳过单独执行。
+    """
+    out: List[dict] = []
+    i = 0
+    while i < len(nodes):
+        n = nodes[i]
+        ntype = n.get("type")
+        if ntype in LOOP_TYPES and not n.get("body") and i + 1 < len(nodes):
+            compat = dict(n)
+            compat["body"] = [nodes[i + 1]]
+            out.append(compat)
+            logger.warning("[工作流] 兼容重写：ForEach/Range 缺少 body，已将后一节点折叠为 body")
+            i += 2
+            continue
+        out.append(n)
+        i += 1
+    return out
+
+
+@dataclass(frozen=True)
+class CompiledNode:
+    """编译后的节点：节点函数已解析，参数中的模板表达式已提取"""
+    id: str
+    type: str
+    params: Dict[str, Any]
+    fn: Callable
+    is_async: bool
+    body: Tuple["CompiledNode", ...] = ()
+    # 参数中引用的模板表达式（{item.xxx} 等）；为空且无 $toNameList 时参数无需渲染
+    templates: Tuple[str, ...] = ()
+    static_params: bool = True
+    # 预编译的参数渲染函数 render(state) -> 渲染后的 params
+    render: Optional[Callable[[dict], Dict[str, Any]]] = None
+
+    @property
+    def is_loop(self) -> bool:
+        return self.type in LOOP_TYPES
+
+
+@dataclass(frozen=True)
+class ExecutionPlan:
+    """
+    工作流执行计划（不可变），按 (workflow.id, workflow.version) 缓存复用
+    - graph：标准格式（nodes+edges），按依赖拓扑调度
+    - linear：旧格式，规范化后顺序执行
+    """
+    workflow_id: Optional[int]
+    version: int
+    kind: str
+    nodes: Mapping[str, CompiledNode]
+    # 声明顺序（linear 即执行顺序）
+    sequence: Tuple[str, ...]
+    order: Mapping[str, int]
+    dependencies: Mapping[str, Tuple[str, ...]]
+    # 仅 next 后继；循环体见 CompiledNode.body
+    successors: Mapping[str, Tuple[str, ...]]
+    body_ids: FrozenSet[str]
+    start_nodes: Tuple[str, ...]
+
+    def describe(self) -> dict:
+        """供 /validate 返回的计划摘要"""
+        def _node(n: CompiledNode) -> dict:
+            out: Dict[str, Any] = {"id": n.id, "type": n.type, "templates": list(n.templates)}
+            if n.body:
+                out["body"] = [_node(b) for b in n.body]
+            return out
+
+        return {
+            "workflow_id": self.workflow_id,
+            "version": self.version,
+            "kind": self.kind,
+            "sequence": list(self.sequence),
+            "start_nodes": list(self.start_nodes),
+            "dependencies": {k: list(v) for k, v in self.dependencies.items()},
+            "successors": {k: list(v) for k, v in self.successors.items()},
+            "body_ids": sorted(self.body_ids),
+            "nodes": [_node(self.nodes[nid]) for nid in self.sequence],
+        }
+
+
+def _scan_templates(val: Any, found: List[str]) -> bool:
+    """收集参数中的模板表达式；返回参数是否为静态（无需渲染）"""
+    static = True
+    if isinstance(val, dict):
+        if "$toNameList" in val:
+            static = False
+        for v in val.values():
+            static = _scan_templates(v, found) and static
+    elif isinstance(val, list):
+        for v in val:
+            static = _scan_templates(v, found) and static
+    elif isinstance(val, str):
+        for m in TPL_PATTERN.finditer(val):
+            found.append(m.group(1).strip())
+            static = False
+    return static
+
+
+def _compile_node(node: dict, node_id: str, body: Tuple[CompiledNode, ...], errors: List[str]) -> CompiledNode:
+    ntype = node.get("type")
+    fn = builtin_nodes.get_node_fn(ntype)
+    if fn is None:
+        errors.append(f"未知节点类型: {ntype} (id={node_id})")
+        fn = _unknown_node(ntype)
+    params = node.get("params") or {}
+    templates: List[str] = []
+    static = _scan_templates(params, templates)
+    return CompiledNode(
+        id=node_id,
+        type=ntype,
+        params=params,
+        fn=fn,
+        is_async=asyncio.iscoroutinefunction(fn),
+        body=body,
+        templates=tuple(dict.fromkeys(templates)),
+        static_params=static,
+        render=(lambda state, _p=params: _p) if static else compile_value(params, builtin_nodes._to_name_list),
+    )
+
+
+def _unknown_node(ntype: Any) -> Callable:
+    def _raise(session, state, params, **kwargs):
+        raise ValueError(f"未知节点类型: {ntype}，已注册的节点: {builtin_nodes.get_node_types()}")
+    return _raise
+
+
+def _compile_inline_body(node: dict, node_id: str, errors: List[str]) -> Tuple[CompiledNode, ...]:
+    return tuple(
+        _compile_node(bn, str(bn.get("id") or f"{node_id}.b{k}"), (), errors)
+        for k, bn in enumerate(node.get("body") or [])
+    )
+
+
+def _compile_graph(workflow_id: Optional[int], version: int, nodes: List[dict], edges: List[dict],
+                   errors: List[str]) -> ExecutionPlan:
+    order = {n["id"]: i for i, n in enumerate(nodes)}
+    dependencies: Dict[str, List[str]] = {}
+    successors: Dict[str, List[str]] = {}
+    bodies: Dict[str, List[str]] = {}
+    for edge in edges:
+        source, target = edge["source"], edge["target"]
+        dependencies.setdefault(target, []).append(source)
+        if edge.get("sourceHandle", "r") == "b":
+            bodies.setdefault(source, []).append(target)
+        else:
+            successors.setdefault(source, []).append(target)
+    body_ids = frozenset(bid for ids in bodies.values() for bid in ids)
+
+    raw = {n["id"]: n for n in nodes}
+    compiled: Dict[str, CompiledNode] = {}
+    for n in nodes:
+        nid = n["id"]
+        body: Tuple[CompiledNode, ...] = ()
+        if n.get("type") in LOOP_TYPES:
+            body_edges = [bid for bid in bodies.get(nid, []) if bid in raw]
+            if body_edges:
+                body = tuple(_compile_node(raw[bid], bid, (), errors) for bid in body_edges)
+            else:
+                # 旧写法：body 内联在节点定义中
+                body = _compile_inline_body(n, nid, errors)
+        compiled[nid] = _compile_node(n, nid, body, errors)
+
+    start_nodes = [n["id"] for n in nodes if n["id"] not in dependencies]
+    if not start_nodes and nodes:
+        logger.warning("[工作流] 无起始节点，使用第一个节点")
+        start_nodes = [nodes[0]["id"]]
+
+    return ExecutionPlan(
+        workflow_id=workflow_id,
+        version=version,
+        kind="graph",
+        nodes=MappingProxyType(compiled),
+        sequence=tuple(n["id"] for n in nodes),
+        order=MappingProxyType(order),
+        dependencies=MappingProxyType({k: tuple(v) for k, v in dependencies.items()}),
+        successors=MappingProxyType({k: tuple(v) for k, v in successors.items()}),
+        body_ids=body_ids,
+        start_nodes=tuple(start_nodes),
+    )
+
+
+def _compile_linear(workflow_id: Optional[int], version: int, raw_nodes: List[dict],
+                    errors: List[str]) -> ExecutionPlan:
+    compiled: Dict[str, CompiledNode] = {}
+    sequence: List[str] = []
+    for index, n in enumerate(canonicalize(raw_nodes)):
+        # 旧格式节点可能没有 id，以序号标识（与检查点中的节点标识一致）
+        nid = str(n.get("id") or f"#{index}")
+        body = _compile_inline_body(n, nid, errors) if n.get("type") in LOOP_TYPES else ()
+        compiled[nid] = _compile_node(n, nid, body, errors)
+        sequence.append(nid)
+    return ExecutionPlan(
+        workflow_id=workflow_id,
+        version=version,
+        kind="linear",
+        nodes=MappingProxyType(compiled),
+        sequence=tuple(sequence),
+        order=MappingProxyType({nid: i for i, nid in enumerate(sequence)}),
+        dependencies=MappingProxyType({}),
+        successors=MappingProxyType({}),
+        body_ids=frozenset(),
+        start_nodes=tuple(sequence[:1]),
+    )
+
+
+def compile_plan(workflow: Workflow) -> Tuple[ExecutionPlan, List[str]]:
+    """编译工作流定义，返回 (计划, 编译错误)；未知节点类型在执行到该节点时才报错，与旧行为一致"""
+    dsl: Dict[str, Any] = copy.deepcopy(workflow.definition_json or {})
+    nodes: List[dict] = list(dsl.get("nodes") or [])
+    errors: List[str] = []
+    version = int(workflow.version or 1)
+    if "edges" in dsl and isinstance(dsl["edges"], list):
+        plan = _compile_graph(workflow.id, version, nodes, list(dsl["edges"]), errors)
+    else:
+        plan = _compile_linear(workflow.id, version, nodes, errors)
+    return plan, errors
+
+
+class PlanCache:
+    """按 (workflow.id, workflow.version) 缓存执行计划；每个工作流只保留最新版本"""
+
+    def __init__(self) -> None:
+        self._plans: Dict[int, Tuple[ExecutionPlan, List[str]]] = {}
+
+    def get(self, workflow: Workflow) -> Tuple[ExecutionPlan, List[str]]:
+        cached = self._plans.get(workflow.id) if workflow.id is not None else None
+        if cached and cached[0].version == int(workflow.version or 1):
+            return cached
+        compiled = compile_plan(workflow)
+        if workflow.id is not None:
+            self._plans[workflow.id] = compiled
+            logger.info(f"[工作流] 已编译执行计划 workflow_id={workflow.id} version={compiled[0].version} nodes={len(compiled[0].nodes)}")
+        return compiled
+
+    def invalidate(self, workflow_id: int) -> None:
+        self._plans.pop(workflow_id, None)
@@ -0,0 +1,257 @@
+import asyncio
+import os
+import socket
+import uuid
+from datetime import datetime, timedelta
+from time import monotonic
+from typing import List, Optional
+
+import sqlalchemy as sa
+from loguru import logger
+from sqlalchemy.orm import aliased
+from sqlmodel import Session, select
+
+from app.core.config import settings
+from app.db.models import Workflow, WorkflowRun
+from app.db.session import engine as db_engine
+from app.services.workflow_engine import LocalAsyncEngine, engine as wf_engine
+
+
+class WorkflowRunQueue:
+    """
+    基于 workflowrun 表的持久化运行队列
+    - 入队：create_run 写入 status=queued 的记录即为入队，run() 仅唤醒 worker
+    - 领取：worker 以条件 UPDATE（status=queued）抢占，写入 lease_owner/lease_expires_at
+    - 心跳：执行期间定期续租；租约过期（进程崩溃/重启）的运行会被重新入队
+    - 削峰：worker 数量与相邻两次领取的最小间隔共同限制突发触发的执行速率
+    - 合并：available_at 未到的运行暂不领取；同一幂等键（工作流+卡片）仍有运行中的记录时不领取，避免重叠执行
+    """
+
+    def __init__(self, wf: LocalAsyncEngine) -> None:
+        self._engine = wf
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._workers: List[asyncio.Task] = []
+        self._wakeup = asyncio.Event()
+        self._dispatch_lock = asyncio.Lock()
+        self._last_dispatch = 0.0
+        self._stopping = False
+
+    # ---------------- lifecycle ----------------
+    async def start(self, workers: Optional[int] = None) -> None:
+        """回收中断的运行并启动 worker 池"""
+        if self._workers:
+            return
+        self._stopping = False
+        self._wakeup = asyncio.Event()
+        self._dispatch_lock = asyncio.Lock()
+        recovered = self.recover(on_boot=True)
+        count = max(1, int(workers or settings.WORKFLOW_QUEUE_WORKERS))
+        for i in range(count):
+            self._workers.append(asyncio.create_task(self._worker_loop(i)))
+        self._engine.set_dispatcher(self.notify)
+        self._wakeup.set()
+        logger.info(f"[工作流队列] 已启动 worker={count} owner={self.worker_id} 回收运行={recovered}")
+
+    async def stop(self) -> None:
+        """停止 worker 池；执行中的运行被中断后重新入队，下次启动时继续"""
+        self._stopping = True
+        self._engine.set_dispatcher(None)
+        for w in self._workers:
+            w.cancel()
+        if self._workers:
+            await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        logger.info("[工作流队列] 已停止")
+
+    def notify(self, run_id: Optional[int] = None) -> None:
+        """有新运行入队时唤醒空闲 worker"""
+        self._wakeup.set()
+
+    # ---------------- recovery ----------------
+    def recover(self, on_boot: bool = False) -> int:
+        """将租约过期的 running 运行重新入队（超过最大尝试次数则标记失败）。
+
+        启动时额外回收没有租约信息的 running 运行（旧版本遗留或进程在领取后立即崩溃）。
+        """
+        now = datetime.now()
+        cond = WorkflowRun.lease_expires_at < now  # type: ignore[operator]
+        if on_boot:
+            cond = sa.or_(cond, WorkflowRun.lease_expires_at.is_(None))  # type: ignore[union-attr]
+        with Session(db_engine) as session:
+            stale = session.exec(
+                select(WorkflowRun).where(WorkflowRun.status == "running", cond)
+            ).all()
+            for run in stale:
+                if (run.attempts or 0) >= settings.WORKFLOW_RUN_MAX_ATTEMPTS:
+                    run.status = "failed"
+                    run.finished_at = now
+                    run.error_json = {"error": "System restarted while running", "attempts": run.attempts}
+                else:
+                    run.status = "queued"
+                    logger.warning(f"[工作流队列] 运行中断，重新入队 run_id={run.id} attempts={run.attempts}")
+                run.lease_owner = None
+                run.lease_expires_at = None
+                session.add(run)
+            if stale:
+                session.commit()
+        return len(stale)
+
+    # ---------------- claim / lease ----------------
+    def _claim_next(self) -> Optional[int]:
+        """按创建顺序领取一个到期的 queued 运行；条件更新保证多 worker/多进程下只有一个领取成功"""
+        now = datetime.now()
+        inflight = aliased(WorkflowRun)
+        with Session(db_engine) as session:
+            candidates = session.exec(
+                select(WorkflowRun.id)
+                .where(
+                    WorkflowRun.status == "queued",
+                    sa.or_(WorkflowRun.available_at.is_(None), WorkflowRun.available_at <= now),  # type: ignore[union-attr,operator]
+                    ~sa.exists().where(
+                        inflight.workflow_id == WorkflowRun.workflow_id,
+                        inflight.idempotency_key == WorkflowRun.idempotency_key,
+                        inflight.status == "running",
+                    ),
+                )
+                .order_by(WorkflowRun.id)  # type: ignore[arg-type]
+                .limit(8)
+            ).all()
+            for run_id in candidates:
+                result = session.exec(  # type: ignore[call-overload]
+                    sa.update(WorkflowRun)
+                    .where(WorkflowRun.id == run_id, WorkflowRun.status == "queued")
+                    .values(
+                        status="running",
+                        lease_owner=self.worker_id,
+                        lease_expires_at=now + timedelta(seconds=settings.WORKFLOW_RUN_LEASE_SEC),
+                        heartbeat_at=now,
+                        started_at=now,
+                        attempts=WorkflowRun.attempts + 1,
+                    )
+                )
+                session.commit()
+                if result.rowcount == 1:
+                    return int(run_id)
+        return None
+
+    def _next_due_in(self) -> float:
+        """距离最近一个延迟运行到期的秒数（无延迟运行时返回空闲轮询间隔）"""
+        poll = settings.WORKFLOW_QUEUE_POLL_INTERVAL_SEC
+        with Session(db_engine) as session:
+            due = session.exec(
+                select(sa.func.min(WorkflowRun.available_at)).where(
+                    WorkflowRun.status == "queued",
+                    WorkflowRun.available_at > datetime.now(),  # type: ignore[operator]
+                )
+            ).one()
+        if due is None:
+            return poll
+        return max(0.05, min(poll, (due - datetime.now()).total_seconds()))
+
+    def _renew_lease(self, run_id: int) -> None:
+        now = datetime.now()
+        with Session(db_engine) as session:
+            session.exec(  # type: ignore[call-overload]
+                sa.update(WorkflowRun)
+                .where(WorkflowRun.id == run_id, WorkflowRun.lease_owner == self.worker_id)
+                .values(
+                    heartbeat_at=now,
+                    lease_expires_at=now + timedelta(seconds=settings.WORKFLOW_RUN_LEASE_SEC),
+                )
+            )
+            session.commit()
+
+    async def _heartbeat(self, run_id: int) -> None:
+        while True:
+            await asyncio.sleep(settings.WORKFLOW_RUN_HEARTBEAT_SEC)
+            try:
+                self._renew_lease(run_id)
+            except Exception as e:  # noqa: BLE001
+                logger.warning(f"[工作流队列] 续租失败 run_id={run_id} err={e}")
+
+    async def _throttle(self) -> None:
+        """保证相邻两次领取之间至少间隔 WORKFLOW_QUEUE_DISPATCH_INTERVAL_MS"""
+        interval = max(0, settings.WORKFLOW_QUEUE_DISPATCH_INTERVAL_MS) / 1000.0
+        if interval <= 0:
+            return
+        wait = self._last_dispatch + interval - monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        self._last_dispatch = monotonic()
+
+    def cancel_queued(self, run_id: int) -> bool:
+        """取消尚未被领取的运行"""
+        with Session(db_engine) as session:
+            result = session.exec(  # type: ignore[call-overload]
+                sa.update(WorkflowRun)
+                .where(WorkflowRun.id == run_id, WorkflowRun.status == "queued")
+                .values(status="cancelled", finished_at=datetime.now())
+            )
+            session.commit()
+            return result.rowcount == 1
+
+    # ---------------- workers ----------------
+    async def _worker_loop(self, index: int) -> None:
+        while not self._stopping:
+            try:
+                async with self._dispatch_lock:
+                    await self._throttle()
+                    run_id = self._claim_next()
+                if run_id is None:
+                    self._wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), timeout=self._next_due_in())
+                    except asyncio.TimeoutError:
+                        # 空闲时顺带回收其他 worker 遗留的过期租约
+                        self.recover()
+                    continue
+                await self._process(run_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:  # noqa: BLE001
+                logger.exception(f"[工作流队列] worker#{index} 异常 err={e}")
+                await asyncio.sleep(settings.WORKFLOW_QUEUE_POLL_INTERVAL_SEC)
+
+    async def _process(self, run_id: int) -> None:
+        with Session(db_engine) as session:
+            run = session.get(WorkflowRun, run_id)
+            workflow = session.get(Workflow, run.workflow_id) if run else None
+            if not run or not workflow:
+                logger.error(f"[工作流队列] 运行或工作流不存在 run_id={run_id}")
+                if run:
+                    run.status = "failed"
+                    run.error_json = {"error": f"Workflow not found: {run.workflow_id}"}
+                    run.finished_at = datetime.now()
+                    session.add(run)
+                    session.commit()
+                return
+
+            logger.info(f"[工作流队列] 领取运行 run_id={run_id} workflow_id={workflow.id} attempts={run.attempts}")
+            task = asyncio.create_task(self._engine.execute(session, workflow, run))
+            self._engine.register_task(run_id, task)
+            heartbeat = asyncio.create_task(self._heartbeat(run_id))
+            try:
+                await task
+            except asyncio.CancelledError:
+                if self._stopping:
+                    # 关闭进程：释放租约，重新入队，下次启动时继续
+                    session.rollback()
+                    run.status = "queued"
+                    run.lease_owner = None
+                    run.lease_expires_at = None
+                    session.add(run)
+                    session.commit()
+                    raise
+                # 用户取消
+                session.rollback()
+                await self._engine.mark_cancelled(session, run)
+            finally:
+                heartbeat.cancel()
+                if run.status != "queued" and run.lease_owner:
+                    run.lease_owner = None
+                    run.lease_expires_at = None
+                    session.add(run)
+                    session.commit()
+
+
+run_queue = WorkflowRunQueue(wf_engine)
@@ -0,0 +1,308 @@
+"""工作流运行轨迹。
+
+引擎在每个节点执行期间通过 ContextVar 暴露当前步骤，LLM 调用统计（agent_service._record_usage）
+与 state 路径写入（nodes._set_by_path）据此归属到节点；并发节点与并发迭代各自运行在独立的
+asyncio 任务中，上下文互不干扰。循环体节点的每次迭代先单独计量，结束时按节点 ID 聚合为一行。
+"""
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from datetime import datetime
+from time import perf_counter
+from typing import Any, Dict, Iterator, List, Optional
+
+import sqlalchemy as sa
+from sqlalchemy import func
+from sqlmodel import Session, select
+
+from app.db.models import WorkflowRun, WorkflowRunStep
+
+
+_MISSING = object()
+# 单个步骤记录的 state 键上限，避免循环体写入大量不同路径时轨迹膨胀
+_MAX_STATE_KEYS = 64
+_MAX_ERROR_LEN = 500
+
+
+@dataclass
+class StepTrace:
+    node_id: str
+    node_type: str
+    parent_id: Optional[str] = None
+    status: str = "completed"
+    started_at: datetime = field(default_factory=datetime.now)
+    finished_at: Optional[datetime] = None
+    queue_wait_ms: float = 0.0
+    duration_ms: float = 0.0
+    iterations: int = 1
+    cache_hits: int = 0
+    llm_calls: int = 0
+    input_tokens: int = 0
+    output_tokens: int = 0
+    llm_retries: int = 0
+    llm_retry_wait_ms: float = 0.0
+    shared_hits: int = 0
+    state_keys: Dict[str, None] = field(default_factory=dict)
+    error: Optional[str] = None
+    # 执行中的节点 state，用于判断 _set_by_path 写的是否为 state 本身
+    state: Optional[dict] = field(default=None, repr=False)
+
+    def note_key(self, key: str) -> None:
+        if len(self.state_keys) < _MAX_STATE_KEYS:
+            self.state_keys[key] = None
+
+    def absorb(self, other: "StepTrace") -> None:
+        """合并同一节点的另一次执行（循环迭代）"""
+        self.iterations += other.iterations
+        self.started_at = min(self.started_at, other.started_at)
+        if other.finished_at and (self.finished_at is None or other.finished_at > self.finished_at):
+            self.finished_at = other.finished_at
+        self.queue_wait_ms += other.queue_wait_ms
+        self.duration_ms += other.duration_ms
+        self.cache_hits += other.cache_hits
+        self.llm_calls += other.llm_calls
+        self.input_tokens += other.input_tokens
+        self.output_tokens += other.output_tokens
+        self.llm_retries += other.llm_retries
+        self.llm_retry_wait_ms += other.llm_retry_wait_ms
+        self.shared_hits += other.shared_hits
+        for key in other.state_keys:
+            self.note_key(key)
+        if other.status != "completed" and self.status == "completed":
+            self.status, self.error = other.status, other.error
+
+
+_current_step: ContextVar[Optional[StepTrace]] = ContextVar("workflow_step", default=None)
+
+
+def record_llm_usage(input_tokens: int, output_tokens: int, calls: int = 1) -> None:
+    """把一次 LLM 调用计入当前节点；不在工作流节点内时忽略"""
+    step = _current_step.get()
+    if step is not None:
+        step.llm_calls += max(0, calls)
+        step.input_tokens += max(0, input_tokens)
+        step.output_tokens += max(0, output_tokens)
+
+
+def record_llm_retry(wait_sec: float) -> None:
+    """把一次 LLM 重试（及其退避等待）计入当前节点"""
+    step = _current_step.get()
+    if step is not None:
+        step.llm_retries += 1
+        step.llm_retry_wait_ms += max(0.0, wait_sec) * 1000
+
+
+@contextmanager
+def capture_llm_usage(sink: StepTrace) -> Iterator[StepTrace]:
+    """把其中的 LLM 用量计入 sink 而不是当前节点（合并的共享请求先单独计量，完成后归属给发起请求的节点）"""
+    token = _current_step.set(sink)
+    try:
+        yield sink
+    finally:
+        _current_step.reset(token)
+
+
+def attribute_llm_usage(sink: StepTrace) -> None:
+    """把 capture_llm_usage 计量到的 LLM 用量计入当前节点"""
+    step = _current_step.get()
+    if step is not None:
+        step.llm_calls += sink.llm_calls
+        step.input_tokens += sink.input_tokens
+        step.output_tokens += sink.output_tokens
+        step.llm_retries += sink.llm_retries
+        step.llm_retry_wait_ms += sink.llm_retry_wait_ms
+
+
+def record_shared_llm_hit() -> None:
+    """当前节点合并进了其他节点进行中的相同请求：只计次数，不计调用与 token"""
+    step = _current_step.get()
+    if step is not None:
+        step.shared_hits += 1
+
+
+def record_state_write(obj: Any, path: str) -> None:
+    """记录节点对 state 的路径写入（只记录写到节点 state 本身的路径）"""
+    step = _current_step.get()
+    if step is not None and obj is step.state:
+        step.note_key(path)
+
+
+def record_cache_hit() -> None:
+    step = _current_step.get()
+    if step is not None:
+        step.cache_hits += 1
+
+
+class RunTrace:
+    """单次运行的轨迹：按节点首次开始的顺序保存步骤"""
+
+    def __init__(self, run_id: int) -> None:
+        self.run_id = run_id
+        self._steps: Dict[str, StepTrace] = {}
+
+    @contextmanager
+    def step(self, node_id: str, node_type: str, state: dict, parent_id: Optional[str] = None,
+             queue_wait_ms: float = 0.0) -> Iterator[StepTrace]:
+        current = StepTrace(node_id=node_id, node_type=node_type, parent_id=parent_id,
+                            queue_wait_ms=queue_wait_ms, state=state)
+        base = dict(state)
+        token = _current_step.set(current)
+        start = perf_counter()
+        try:
+            yield current
+        except BaseException as e:
+            current.status = "failed" if isinstance(e, Exception) else "cancelled"
+            current.error = str(e)[:_MAX_ERROR_LEN] or type(e).__name__
+            raise
+        finally:
+            _current_step.reset(token)
+            current.duration_ms = (perf_counter() - start) * 1000
+            current.finished_at = datetime.now()
+            current.state = None
+            for key, value in state.items():
+                if base.get(key, _MISSING) is not value:
+                    current.note_key(key)
+            for key in base:
+                if key not in state:
+                    current.note_key(key)
+            existing = self._steps.get(node_id)
+            if existing is None:
+                self._steps[node_id] = current
+            else:
+                existing.absorb(current)
+
+    def to_rows(self) -> List[WorkflowRunStep]:
+        return [
+            WorkflowRunStep(
+                run_id=self.run_id,
+                node_id=s.node_id,
+                node_type=s.node_type,
+                parent_id=s.parent_id,
+                status=s.status,
+                started_at=s.started_at,
+                finished_at=s.finished_at,
+                queue_wait_ms=round(s.queue_wait_ms, 3),
+                duration_ms=round(s.duration_ms, 3),
+                iterations=s.iterations,
+                cache_hits=s.cache_hits,
+                llm_calls=s.llm_calls,
+                input_tokens=s.input_tokens,
+                output_tokens=s.output_tokens,
+                llm_retries=s.llm_retries,
+                llm_retry_wait_ms=round(s.llm_retry_wait_ms, 3),
+                shared_hits=s.shared_hits,
+                state_keys=list(s.state_keys) or None,
+                error=s.error,
+            )
+            for s in sorted(self._steps.values(), key=lambda s: s.started_at)
+        ]
+
+
+# ---------------- 查询 ----------------
+def _ms_between(start: Optional[datetime], end: Optional[datetime]) -> Optional[float]:
+    if start is None or end is None:
+        return None
+    return round((end - start).total_seconds() * 1000, 3)
+
+
+def run_trace(session: Session, run: WorkflowRun) -> Dict[str, Any]:
+    """单次运行的轨迹：运行级排队等待/耗时、token 合计与按开始时间排序的节点步骤"""
+    steps = session.exec(
+        select(WorkflowRunStep).where(WorkflowRunStep.run_id == run.id).order_by(WorkflowRunStep.id)  # type: ignore[arg-type]
+    ).all()
+    # 循环体节点的耗时已包含在所属循环节点中，合计只统计顶层节点；token 统计在最内层节点上，不会重复
+    top = [s for s in steps if s.parent_id is None]
+    return {
+        "run_id": run.id,
+        "workflow_id": run.workflow_id,
+        "status": run.status,
+        "queue_wait_ms": _ms_between(run.created_at, run.started_at),
+        "duration_ms": _ms_between(run.started_at, run.finished_at),
+        "totals": {
+            "nodes": len(top),
+            "node_ms": round(sum(s.duration_ms for s in top), 3),
+            "llm_calls": sum(s.llm_calls for s in steps),
+            "input_tokens": sum(s.input_tokens for s in steps),
+            "output_tokens": sum(s.output_tokens for s in steps),
+            "llm_retries": sum(s.llm_retries for s in steps),
+            "llm_retry_wait_ms": round(sum(s.llm_retry_wait_ms for s in steps), 3),
+            "shared_hits": sum(s.shared_hits or 0 for s in steps),
+        },
+        "steps": [s.model_dump(exclude={"run_id"}) for s in steps],
+    }
+
+
+def _filter_runs(stmt, workflow_id: Optional[int], since: Optional[datetime]):
+    if workflow_id is None and since is None:
+        return stmt
+    stmt = stmt.join(WorkflowRun, WorkflowRun.id == WorkflowRunStep.run_id)  # type: ignore[arg-type]
+    if workflow_id is not None:
+        stmt = stmt.where(WorkflowRun.workflow_id == workflow_id)
+    if since is not None:
+        stmt = stmt.where(WorkflowRun.created_at >= since)
+    return stmt
+
+
+def summarize_by_node_type(session: Session, workflow_id: Optional[int] = None, since: Optional[datetime] = None,
+                           include_body: bool = True) -> List[Dict[str, Any]]:
+    """
+    按节点类型聚合轨迹，按总耗时降序：用于定位流水线中耗时占比最高的节点
+    share 为该类型总耗时占所有顶层节点总耗时的比例（循环节点的耗时包含其循环体）
+    """
+    stmt = (
+        select(
+            WorkflowRunStep.node_type,
+            func.count(WorkflowRunStep.id),
+            func.count(func.distinct(WorkflowRunStep.run_id)),
+            func.sum(WorkflowRunStep.iterations),
+            func.sum(WorkflowRunStep.duration_ms),
+            func.max(WorkflowRunStep.duration_ms),
+            func.sum(WorkflowRunStep.queue_wait_ms),
+            func.sum(WorkflowRunStep.llm_calls),
+            func.sum(WorkflowRunStep.input_tokens),
+            func.sum(WorkflowRunStep.output_tokens),
+            func.sum(WorkflowRunStep.cache_hits),
+            func.sum(WorkflowRunStep.llm_retries),
+            func.sum(WorkflowRunStep.shared_hits),
+            func.sum(sa.case((WorkflowRunStep.status == "failed", 1), else_=0)),
+            func.max(sa.case((WorkflowRunStep.parent_id.is_(None), 0), else_=1)),  # type: ignore[union-attr]
+        )
+        .group_by(WorkflowRunStep.node_type)
+    )
+    stmt = _filter_runs(stmt, workflow_id, since)
+    if not include_body:
+        stmt = stmt.where(WorkflowRunStep.parent_id.is_(None))  # type: ignore[union-attr]
+    rows = session.exec(stmt).all()  # type: ignore[call-overload]
+
+    top_total_stmt = _filter_runs(
+        select(func.sum(WorkflowRunStep.duration_ms)).where(WorkflowRunStep.parent_id.is_(None)),  # type: ignore[union-attr]
+        workflow_id, since,
+    )
+    top_total = float(session.exec(top_total_stmt).one() or 0.0)  # type: ignore[call-overload]
+
+    out: List[Dict[str, Any]] = []
+    for (node_type, steps, runs, iterations, total_ms, max_ms, wait_ms,
+         calls, in_tokens, out_tokens, hits, retries, shared, failed, in_body) in rows:
+        total_ms = float(total_ms or 0.0)
+        out.append({
+            "node_type": node_type,
+            "in_loop_body": bool(in_body),
+            "steps": steps,
+            "runs": runs,
+            "iterations": int(iterations or 0),
+            "total_ms": round(total_ms, 3),
+            "avg_ms": round(total_ms / steps, 3) if steps else 0.0,
+            "max_ms": round(float(max_ms or 0.0), 3),
+            "queue_wait_ms": round(float(wait_ms or 0.0), 3),
+            "share": round(total_ms / top_total, 4) if top_total else 0.0,
+            "llm_calls": int(calls or 0),
+            "input_tokens": int(in_tokens or 0),
+            "output_tokens": int(out_tokens or 0),
+            "cache_hits": int(hits or 0),
+            "llm_retries": int(retries or 0),
+            "shared_hits": int(shared or 0),
+            "failed": int(failed or 0),
+        })
+    out.sort(key=lambda r: r["total_ms"], reverse=True)
+    return out
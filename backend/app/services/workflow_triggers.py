@@ -1,29 +1,131 @@
-from typing import List, Dict
+import threading
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import List, Dict, Optional, Tuple
 from sqlmodel import Session, select
-from time import monotonic
 
-from app.db.models import WorkflowTrigger, Card, Workflow, WorkflowRun
+from loguru import logger
+
+from app.core.config import settings
+from app.db.models import WorkflowTrigger, Card, CardType, Workflow, WorkflowRun
 from app.services.workflow_engine import engine as wf_engine
 
 
-def _match_triggers_for_card(session: Session, event: str, card: Card) -> List[WorkflowTrigger]:
-    q = select(WorkflowTrigger).where(
-        WorkflowTrigger.trigger_on == event,
-        WorkflowTrigger.is_active == True,  # noqa: E712
-    )
-    triggers = session.exec(q).all()
-    matched: List[WorkflowTrigger] = []
-    for t in triggers:
-        # 过滤 card_type
-        if t.card_type_name and card.card_type and card.card_type.name != t.card_type_name:
-            continue
-        # filter_json 预留：当前不实现复杂匹配
-        matched.append(t)
-    return matched
+@dataclass(frozen=True)
+class _IndexedWorkflow:
+    """重建索引时随触发器一并取出的工作流字段，匹配时不再逐个按 ID 读取工作流"""
+    id: int
+    name: str
+    version: int
+    is_active: bool
+    definition_json: Optional[dict] = field(default=None, compare=False, hash=False)
+
+
+@dataclass(frozen=True)
+class _IndexedTrigger:
+    trigger_id: int
+    workflow: _IndexedWorkflow
+    card_type_name: Optional[str]
+    inflight_policy: str
+
+    @property
+    def workflow_id(self) -> int:
+        return self.workflow.id
+
+
+class _TriggerIndex:
+    """
+    进程内触发器索引：(event, card_type_name) -> 启用中的触发器（连同所属工作流的字段）
+    - 重建时用一次联表查询取出启用中的触发器与启用中的工作流，停用的工作流在此时就被排除
+    - 触发器、工作流或卡片类型增删改后调用 invalidate()，下次匹配时重建
+    - 事件没有任何触发器时直接返回，不访问数据库（也不加载卡片类型）
+    - 卡片类型名按 card_type_id 从重建时加载的映射中解析（只含触发器引用到的类型），不懒加载 card.card_type
+    - card_type_name 为空的触发器匹配该事件下的所有卡片
+    """
+
+    def __init__(self) -> None:
+        # event -> {card_type_name | None -> [触发器]}
+        self._by_event: Dict[str, Dict[Optional[str], List[_IndexedTrigger]]] = {}
+        # event -> 该事件下的全部触发器（卡片类型未知时使用）
+        self._all: Dict[str, List[_IndexedTrigger]] = {}
+        # card_type_id -> 类型名（只含触发器引用到的类型）
+        self._type_names: Dict[int, str] = {}
+        self._stale = True
+        self._lock = threading.Lock()
+
+    def invalidate(self) -> None:
+        self._stale = True
+
+    def _rebuild(self, session: Session) -> None:
+        rows = session.exec(
+            select(WorkflowTrigger, Workflow)
+            .join(Workflow, Workflow.id == WorkflowTrigger.workflow_id)  # type: ignore[arg-type]
+            .where(
+                WorkflowTrigger.is_active == True,  # noqa: E712
+                Workflow.is_active == True,  # noqa: E712
+            )
+            .order_by(WorkflowTrigger.id)  # type: ignore[arg-type]
+        ).all()
+        by_event: Dict[str, Dict[Optional[str], List[_IndexedTrigger]]] = {}
+        all_by_event: Dict[str, List[_IndexedTrigger]] = {}
+        workflows: Dict[int, _IndexedWorkflow] = {}
+        for t, wf in rows:
+            workflow = workflows.get(int(wf.id))
+            if workflow is None:
+                workflow = workflows[int(wf.id)] = _IndexedWorkflow(
+                    id=int(wf.id),
+                    name=wf.name,
+                    version=int(wf.version or 1),
+                    is_active=bool(wf.is_active),
+                    definition_json=wf.definition_json,
+                )
+            # filter_json 预留：当前不实现复杂匹配
+            entry = _IndexedTrigger(
+                trigger_id=int(t.id),
+                workflow=workflow,
+                card_type_name=t.card_type_name or None,
+                inflight_policy=t.inflight_policy or "supersede",
+            )
+            by_event.setdefault(t.trigger_on, {}).setdefault(entry.card_type_name, []).append(entry)
+            all_by_event.setdefault(t.trigger_on, []).append(entry)
+        type_names = {t.card_type_name for t, _ in rows if t.card_type_name}
+        self._type_names = dict(session.exec(
+            select(CardType.id, CardType.name).where(CardType.name.in_(type_names))  # type: ignore[attr-defined]
+        ).all()) if type_names else {}
+        self._by_event = by_event
+        self._all = all_by_event
+        logger.info(f"[工作流触发] 触发器索引已重建 count={len(rows)} workflows={len(workflows)}")
+
+    def match(self, session: Session, event: str, card: Optional[Card]) -> List[_IndexedTrigger]:
+        if self._stale:
+            with self._lock:
+                if self._stale:
+                    # 先清标记：重建期间发生的变更会再次置脏，下一次匹配时重建
+                    self._stale = False
+                    try:
+                        self._rebuild(session)
+                    except Exception:
+                        self._stale = True
+                        raise
+        by_type = self._by_event.get(event)
+        if not by_type:
+            return []
+        if card is None:
+            return list(self._all.get(event, []))
+        # 未被任何触发器引用的类型不在映射中，只匹配不限类型的触发器
+        typed = by_type.get(self._type_names.get(card.card_type_id), []) if card.card_type_id else []
+        wildcard = by_type.get(None, [])
+        if not typed or not wildcard:
+            return list(typed or wildcard)
+        return sorted(typed + wildcard, key=lambda e: e.trigger_id)
+
+
+trigger_index = _TriggerIndex()
 
 
-_recent_keys: Dict[str, float] = {}
-_DEBOUNCE_MS = 1500  # 同一 key 在该时间窗内不再触发
+def invalidate_trigger_index() -> None:
+    """触发器、工作流或卡片类型变更后调用"""
+    trigger_index.invalidate()
 
 
 def _make_idempotency_key(event: str, workflow_id: int, card: Card | None, project_id: int | None) -> str:
@@ -32,82 +134,119 @@ def _make_idempotency_key(event: str, workflow_id: int, card: Card | None, proje
     return f"evt:{event}|wf:{workflow_id}|card:{card_id}|proj:{proj_id}"
 
 
-def _should_suppress(session: Session, key: str, workflow_id: int) -> bool:
-    # 1) 进程内防抖
-    now = monotonic()
-    last = _recent_keys.get(key)
-    if last is not None and (now - last) * 1000 < _DEBOUNCE_MS:
-        return True
-    # 清理过期项，避免泄漏
-    try:
-        for k, v in list(_recent_keys.items()):
-            if (now - v) * 1000 > 60000:
-                _recent_keys.pop(k, None)
-    except Exception:
-        pass
-    # 2) 持久层“同运行周期不二次触发”：查找相同幂等键且仍在进行的运行
-    existing = session.exec(
-        select(WorkflowRun).where(
-            WorkflowRun.workflow_id == workflow_id,
-            WorkflowRun.idempotency_key == key,
-            WorkflowRun.status.in_(["queued", "running"]),  # type: ignore[arg-type]
-        )
-    ).first()
-    if existing:
-        return True
-    # 标记本次
-    _recent_keys[key] = now
-    return False
+@dataclass
+class TriggerMetrics:
+    """触发合并统计（进程内，按事件类型）"""
+    events: int = 0      # 收到的触发事件
+    coalesced: int = 0   # 合并进已排队运行、未新建运行的事件
+    executed: int = 0    # 新建并提交执行的运行
+    superseded: int = 0  # 新运行排在同一卡片的在途运行之后
+    cancelled: int = 0   # 因新事件被取消的在途运行
 
+    def to_dict(self) -> Dict[str, int]:
+        return {
+            "events": self.events,
+            "coalesced": self.coalesced,
+            "executed": self.executed,
+            "superseded": self.superseded,
+            "cancelled": self.cancelled,
+        }
+
+
+_metrics: Dict[str, TriggerMetrics] = {}
+_coalesce_lock = threading.Lock()
+# 参与尾沿合并的事件：卡片保存会连续高频发生；生成完成、项目创建等事件立即提交
+_COALESCED_EVENTS = frozenset({"onsave"})
+
+
+def trigger_metrics() -> Dict[str, Dict[str, int]]:
+    """各事件类型的触发合并统计"""
+    return {event: m.to_dict() for event, m in _metrics.items()}
+
+
+def _submit(session: Session, event: str, entry: _IndexedTrigger,
+            card: Card | None, project_id: int | None, scope: dict) -> Optional[int]:
+    """
+    提交触发的运行；卡片保存事件做尾沿合并，每个 (工作流, 卡片) 至多一个排队中的运行
+    - 已有排队运行：把它的可领取时间顺延一个窗口，本次事件并入该运行（运行开始时读取的是最新内容）；
+      顺延不超过首个事件（即该运行创建时刻）之后 WORKFLOW_TRIGGER_COALESCE_MAX_WAIT_MS
+    - 只有在途运行：按触发器策略 supersede（其后排队一次）或 cancel（取消在途运行）后新建运行。
+      cancel 只能取消在本进程内执行的运行；由其他进程的 worker 执行的运行无法取消，按 supersede 处理
+    - 其他事件不延迟、不合并，直接新建运行
+    队列领取时会跳过同一幂等键仍在运行的记录，因此同一卡片的运行不会重叠。
+    """
+    metrics = _metrics.setdefault(event, TriggerMetrics())
+    metrics.events += 1
+    # 索引中的工作流字段：create_run 只读取 id 与 version
+    wf = entry.workflow
+    key = _make_idempotency_key(event, int(wf.id), card, project_id)
+    coalesce = event in _COALESCED_EVENTS
+    with _coalesce_lock:
+        now = datetime.now()
+        window = timedelta(milliseconds=settings.WORKFLOW_TRIGGER_COALESCE_MS) if coalesce else timedelta(0)
+        active = session.exec(
+            select(WorkflowRun).where(
+                WorkflowRun.workflow_id == wf.id,
+                WorkflowRun.idempotency_key == key,
+                WorkflowRun.status.in_(["queued", "running"]),  # type: ignore[attr-defined]
+            ).order_by(WorkflowRun.id)  # type: ignore[arg-type]
+        ).all()
+        queued = next((r for r in active if r.status == "queued"), None) if coalesce else None
+        if queued is not None:
+            # created_at 为 UTC 时间，按剩余可等待时长换算到本地时间
+            max_wait = timedelta(milliseconds=settings.WORKFLOW_TRIGGER_COALESCE_MAX_WAIT_MS)
+            remaining = queued.created_at + max_wait - datetime.utcnow()
+            queued.available_at = now + max(timedelta(0), min(window, remaining))
+            session.add(queued)
+            session.commit()
+            metrics.coalesced += 1
+            return int(queued.id)
+
+        for inflight in active:
+            if inflight.status != "running":
+                continue
+            if entry.inflight_policy == "cancel" and wf_engine.cancel(int(inflight.id)):
+                metrics.cancelled += 1
+                logger.info(f"[工作流触发] 取消在途运行 run_id={inflight.id} key={key}")
+            else:
+                if entry.inflight_policy == "cancel":
+                    logger.info(f"[工作流触发] 在途运行不在本进程执行，无法取消，其后排队 run_id={inflight.id} owner={inflight.lease_owner}")
+                metrics.superseded += 1
 
-def trigger_on_card_save(session: Session, card: Card) -> List[int]:
-    """保存/更新卡片后触发 OnSave 类型工作流，返回 run_id 列表。"""
-    run_ids: List[int] = []
-    triggers = _match_triggers_for_card(session, "onsave", card)
-    for t in triggers:
-        wf = session.get(Workflow, t.workflow_id)
-        if not wf or not wf.is_active:
-            continue
-        idem_key = _make_idempotency_key("onsave", int(t.workflow_id), card, card.project_id)
-        if _should_suppress(session, idem_key, int(t.workflow_id)):
-            continue
         run = wf_engine.create_run(
             session=session,
             workflow=wf,
-            scope_json={"card_id": card.id, "project_id": card.project_id},
+            scope_json=scope,
             params_json={},
-            idempotency_key=idem_key,
+            idempotency_key=key,
+            available_at=now + window if coalesce else None,
         )
-        wf_engine.run(session, run)
-        if run.id:
-            run_ids.append(int(run.id))
+    wf_engine.run(session, run)
+    metrics.executed += 1
+    return int(run.id) if run.id else None
+
+
+def trigger_on_card_save(session: Session, card: Card) -> List[int]:
+    """保存/更新卡片后触发 OnSave 类型工作流，返回 run_id 列表（含合并进的已排队运行）。"""
+    run_ids: List[int] = []
+    for entry in trigger_index.match(session, "onsave", card):
+        scope = {"card_id": card.id, "project_id": card.project_id}
+        run_id = _submit(session, "onsave", entry, card, card.project_id, scope)
+        if run_id:
+            run_ids.append(run_id)
     return run_ids
 
 
 def trigger_on_generate_finish(session: Session, card: Card | None, project_id: int | None) -> List[int]:
     """生成/续写完成后触发 OnGenerateFinish 类型工作流，返回 run_id 列表。"""
     run_ids: List[int] = []
-    q = select(WorkflowTrigger).where(
-        WorkflowTrigger.trigger_on == "ongenfinish",
-        WorkflowTrigger.is_active == True,  # noqa: E712
-    )
-    triggers = session.exec(q).all()
-    for t in triggers:
-        if card and t.card_type_name and card.card_type and card.card_type.name != t.card_type_name:
-            continue
-        wf = session.get(Workflow, t.workflow_id)
-        if not wf or not wf.is_active:
-            continue
+    for entry in trigger_index.match(session, "ongenfinish", card):
         scope = {"project_id": project_id}
         if card and card.id:
             scope["card_id"] = card.id
-        idem_key = _make_idempotency_key("ongenfinish", int(t.workflow_id), card, project_id)
-        if _should_suppress(session, idem_key, int(t.workflow_id)):
-            continue
-        run = wf_engine.create_run(session, wf, scope_json=scope, params_json={}, idempotency_key=idem_key)
-        wf_engine.run(session, run)
-        if run.id:
-            run_ids.append(int(run.id))
+        run_id = _submit(session, "ongenfinish", entry, card, project_id, scope)
+        if run_id:
+            run_ids.append(run_id)
     return run_ids
 
 
@@ -117,27 +256,8 @@ def trigger_on_project_create(session: Session, project_id: int) -> List[int]:
     作用域仅包含 project_id，不携带 card_id。
     """
     run_ids: List[int] = []
-    triggers = session.exec(
-        select(WorkflowTrigger).where(
-            WorkflowTrigger.trigger_on == "onprojectcreate",
-            WorkflowTrigger.is_active == True,
-        )
-    ).all()
-    for t in triggers:
-        wf = session.get(Workflow, t.workflow_id)
-        if not wf or not wf.is_active:
-            continue
-        idem_key = _make_idempotency_key("onprojectcreate", int(t.workflow_id), None, project_id)
-        if _should_suppress(session, idem_key, int(t.workflow_id)):
-            continue
-        run = wf_engine.create_run(
-            session=session,
-            workflow=wf,
-            scope_json={"project_id": project_id},
-            params_json={},
-            idempotency_key=idem_key,
-        )
-        wf_engine.run(session, run)
-        if run.id:
-            run_ids.append(int(run.id))
+    for entry in trigger_index.match(session, "onprojectcreate", None):
+        run_id = _submit(session, "onprojectcreate", entry, None, project_id, {"project_id": project_id})
+        if run_id:
+            run_ids.append(run_id)
     return run_ids
@@ -0,0 +1,157 @@
+"""
+微基准：10,000 项 List.ForEach 中的参数模板渲染吞吐。
+
+对比三种渲染方式：
+- legacy：每次求值都用正则匹配模板、split 路径（预编译层引入前的实现，内联在本脚本中作为基线）
+- compiled：app.services.workflow_expr 预编译并缓存的访问闭包（nodes._render_value 现行实现）
+- plan：整个参数结构一次性编译为渲染函数（执行计划中 CompiledNode.render 的做法）
+
+第一组只测渲染本身；第二组经工作流引擎执行完整的 ForEach（含循环体调度开销）。
+
+用法（在 backend 目录下）：
+    python bench_foreach_render.py [items]
+"""
+import asyncio
+import re
+import sys
+import time
+
+from loguru import logger
+
+from app.db.models import Workflow
+from app.services import nodes
+from app.services.workflow_engine import LocalAsyncEngine
+from app.services.workflow_expr import compile_value
+from app.services.workflow_plan import compile_plan
+
+
+ITEMS = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+
+PARAMS = {
+    "title": "第{index}章：{item.title}",
+    "prompt": "请为{item.title}续写，主角{item.chars[0].name}，项目{scope.project_id}，卷{current.card.content.volume}",
+    "participants": {"$toNameList": "item.chars"},
+    "targetPath": "$.last",
+}
+
+_LEGACY_TPL = re.compile(r"\{([^{}]+)\}")
+
+
+def _legacy_get_by_path(obj, path):
+    if not path or not isinstance(path, str) or not path.startswith("$."):
+        return None
+    parts = path[2:].split(".")
+    cur = obj.get("$") if isinstance(obj, dict) and "$" in obj else obj
+    for p in parts:
+        if cur is None:
+            return None
+        if isinstance(cur, dict):
+            cur = cur.get(p)
+        else:
+            try:
+                cur = getattr(cur, p)
+            except Exception:
+                return None
+    return cur
+
+
+def _legacy_resolve(expr, state):
+    expr = expr.strip()
+    if expr == "index":
+        return (state.get("item") or {}).get("index")
+    for root in ("item", "current", "scope"):
+        if expr.startswith(root + "."):
+            return _legacy_get_by_path({root: state.get(root) or {}}, "$." + expr)
+    return None
+
+
+def _legacy_render(val, state):
+    if isinstance(val, dict):
+        if "$toNameList" in val and isinstance(val.get("$toNameList"), str):
+            return nodes._to_name_list(_legacy_resolve(val["$toNameList"], state))
+        return {k: _legacy_render(v, state) for k, v in val.items()}
+    if isinstance(val, list):
+        return [_legacy_render(v, state) for v in val]
+    if isinstance(val, str):
+        m = _LEGACY_TPL.fullmatch(val.strip())
+        if m:
+            return _legacy_resolve(m.group(1), state)
+
+        def repl(match):
+            res = _legacy_resolve(match.group(1), state)
+            return "" if res is None else str(res)
+        return _LEGACY_TPL.sub(repl, val)
+    return val
+
+
+def _items():
+    return [
+        {"title": f"章节{i}", "chars": [{"name": f"角色{i}"}, {"name": "配角"}]}
+        for i in range(ITEMS)
+    ]
+
+
+def _base_state():
+    return {
+        "scope": {"project_id": 1},
+        "current": {"card": {"content": {"volume": 3}}},
+        "touched_card_ids": set(),
+    }
+
+
+def bench_render():
+    """只测渲染：legacy 的 "{item.chars[0].name}" 不支持下标，结果为空串，不影响计时"""
+    items = [{**it, "index": i} for i, it in enumerate(_items(), start=1)]
+    whole = compile_value(PARAMS, nodes._to_name_list)
+    renderers = (
+        ("legacy", _legacy_render),
+        ("compiled", nodes._render_value),
+        # 执行计划中的整体预编译（CompiledNode.render）
+        ("plan", lambda params, state: whole(state)),
+    )
+    results = {}
+    for name, render in renderers:
+        state = _base_state()
+        start = time.perf_counter()
+        for it in items:
+            state["item"] = it
+            render(PARAMS, state)
+        results[name] = time.perf_counter() - start
+    return results
+
+
+async def bench_foreach():
+    """完整的 ForEach：循环体节点渲染 PARAMS 并写回 state"""
+    @nodes.register_node("Bench.Render")
+    def _render(session, state, params):
+        nodes._set_by_path(state, params["targetPath"], nodes._render_value(params, state))
+
+    workflow = Workflow(id=None, name="bench", definition_json={
+        "nodes": [
+            {"id": "loop", "type": "List.ForEach", "params": {"list": _items()}},
+            {"id": "body", "type": "Bench.Render", "params": PARAMS},
+        ],
+        "edges": [{"source": "loop", "target": "body", "sourceHandle": "b"}],
+    })
+    plan, _ = compile_plan(workflow)
+    engine = LocalAsyncEngine()
+    state = _base_state()
+    start = time.perf_counter()
+    await engine._execute_graph(plan, None, state, run_id=0)
+    return time.perf_counter() - start, state.get("last")
+
+
+def main():
+    logger.remove()
+    logger.add(sys.stderr, level="WARNING")
+    render = bench_render()
+    for name, secs in render.items():
+        print(f"render   {name:<8} {ITEMS} items  {secs * 1000:8.1f} ms  {ITEMS / secs:10.0f} items/s")
+    print(f"render   speedup  compiled x{render['legacy'] / render['compiled']:.2f}  plan x{render['legacy'] / render['plan']:.2f}")
+    secs, last = asyncio.run(bench_foreach())
+    print(f"foreach  engine   {ITEMS} items  {secs * 1000:8.1f} ms  {ITEMS / secs:10.0f} items/s")
+    print(f"last     {last}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""
+微基准：流式续写 10k token 从模型流到 SSE 帧的开销。
+
+对比：
+- legacy：旧版路径（`accumulated += delta` 累加、端点再存一份 chunk 列表、每个 token 一次 json.dumps 一帧，内联在本脚本中作为基线）
+- pipeline：app.services.stream_pipeline（TextRope 累加 + 按时间窗口/字符数合帧 + 每帧一次 json.dumps）
+
+场景：
+- burst：模型流不限速（测 CPU 开销上限）
+- paced：模型流按 tps 限速（测实际帧率，时间窗口生效）
+- slow-client：客户端每帧耗时 slow_ms（测背压：缓冲峰值不超过高水位）
+
+用法（在 backend 目录下）：
+    python bench_stream_pipeline.py [tokens] [tps]
+"""
+import asyncio
+import json
+import sys
+import time
+
+from loguru import logger
+
+from app.services import stream_pipeline
+from app.services.stream_pipeline import PipelineStats, TextRope
+from app.services.token_counter import estimate_tokens
+
+
+TOKENS = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+TPS = float(sys.argv[2]) if len(sys.argv) > 2 else 2_000
+SLOW_MS = 5
+_PIECES = ["夜色", "长街", "，", "灯火", "他", "缓缓", "抬起头", "。", "the ", "sword"]
+
+
+async def _source(n: int, tps: float = 0):
+    interval = 1 / tps if tps else 0
+    start = time.perf_counter()
+    for i in range(n):
+        if interval:
+            # 按绝对时间对齐，避免 sleep 误差累积
+            delay = start + i * interval - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        else:
+            # 不限速时也让出事件循环，模拟每个增量来自一次网络读取
+            await asyncio.sleep(0)
+        yield _PIECES[i % len(_PIECES)]
+
+
+async def legacy(n: int, tps: float = 0, slow_ms: float = 0) -> dict:
+    accumulated = ""
+    content_acc = []
+    frames = 0
+    async for delta in _source(n, tps):
+        accumulated += delta
+        content_acc.append(delta)
+        frame = f"data: {json.dumps({'content': delta})}\n\n"
+        frames += 1
+        if slow_ms:
+            await asyncio.sleep(slow_ms / 1000)
+    "".join(content_acc)
+    estimate_tokens(accumulated)
+    return {"frames": frames, "bytes": len(accumulated.encode())}
+
+
+async def pipeline(n: int, tps: float = 0, slow_ms: float = 0) -> dict:
+    rope = TextRope()
+    stats = PipelineStats()
+
+    async def produce():
+        async for delta in _source(n, tps):
+            rope.append(delta)
+            yield delta
+
+    async for item in stream_pipeline.coalesce(produce(), stats=stats):
+        frame = f"data: {json.dumps({'content': item}, ensure_ascii=False)}\n\n"
+        if slow_ms:
+            await asyncio.sleep(slow_ms / 1000)
+    estimate_tokens(rope.text())
+    return {"frames": stats.frames, "bytes": len(rope), "max_buffered": stats.max_buffered, "paused": stats.paused}
+
+
+def _run(fn, *args) -> tuple:
+    cpu, wall = time.process_time(), time.perf_counter()
+    result = asyncio.run(fn(*args))
+    return result, time.process_time() - cpu, time.perf_counter() - wall
+
+
+def main() -> None:
+    logger.remove()
+    per_10k = 10_000 / TOKENS
+    scenarios = [("burst", (TOKENS, 0, 0)), ("paced", (TOKENS, TPS, 0)), ("slow-client", (TOKENS, 0, SLOW_MS))]
+    print(f"tokens={TOKENS} tps={TPS:.0f} slow_ms={SLOW_MS}")
+    for name, args in scenarios:
+        for label, fn in (("legacy", legacy), ("pipeline", pipeline)):
+            if name == "slow-client" and label == "legacy":
+                # 旧路径每 token 一帧，慢客户端下耗时为 tokens*slow_ms，只做估算不实际运行
+                print(f"  {name:<12}{label:<10}frames={TOKENS:>6}  wall≈{TOKENS * SLOW_MS / 1000:.1f}s（估算）")
+                continue
+            result, cpu, wall = _run(fn, *args)
+            extra = "".join(f"  {k}={v}" for k, v in result.items() if k not in ("frames", "bytes"))
+            print(
+                f"  {name:<12}{label:<10}frames={result['frames']:>6}  frames/s={result['frames'] / wall:>9.0f}"
+                f"  cpu/10k={cpu * per_10k * 1000:>7.1f}ms  wall={wall:.2f}s{extra}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+微基准：1 MB 文本的 token 估算耗时。
+
+对比：
+- legacy：旧版 agent_service._estimate_tokens（四分支 VERBOSE 正则 + 生成器逐个计数，内联在本脚本中作为基线）
+- single-pass：app.services.token_counter.heuristic_count（split/join 统计非空白字符 + 只扫描英文单词）
+- memoized：token_counter.estimate_tokens 重复计数同一文本（按内容哈希命中缓存）
+
+同时校验三者结果一致。
+
+用法（在 backend 目录下）：
+    python bench_token_counter.py [size_mb]
+"""
+import random
+import re
+import sys
+import time
+
+from app.services import token_counter
+
+
+SIZE = int(float(sys.argv[1]) * 1024 * 1024) if len(sys.argv) > 1 else 1024 * 1024
+ROUNDS = 5
+
+_LEGACY_REGEX = re.compile(
+    r"""
+    ([A-Za-z]+)               # 英文单词（连续字母算 1）
+    |([0-9])                 # 1个数字算 1
+    |([\u4E00-\u9FFF])       # 单个中文汉字算 1
+    |(\S)                     # 其它非空白符号/标点算 1
+    """,
+    re.VERBOSE,
+)
+
+
+def legacy(text: str) -> int:
+    return sum(1 for _ in _LEGACY_REGEX.finditer(text))
+
+
+def _corpus(kind: str, size: int) -> str:
+    rng = random.Random(42)
+    cjk = "夜色长街灯火他缓缓抬起头看向远处的山门风吹过剑鞘轻声说道仿佛一切都还未曾开始少年握紧手中旧信"
+    words = ["the", "sword", "night", "river", "whisper", "2024", "chapter", "-", "it's", "light"]
+    parts, length = [], 0
+    while length < size:
+        if kind == "cjk" or (kind == "mixed" and rng.random() < 0.7):
+            piece = "".join(rng.choice(cjk) for _ in range(rng.randint(8, 30))) + rng.choice("，。！？\n")
+        else:
+            piece = " ".join(rng.choice(words) for _ in range(rng.randint(4, 12))) + rng.choice(".,\n ")
+        parts.append(piece)
+        length += len(piece)
+    return "".join(parts)[:size]
+
+
+def _bench(fn, text: str) -> float:
+    best = float("inf")
+    for _ in range(ROUNDS):
+        start = time.perf_counter()
+        fn(text)
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def main() -> None:
+    print(f"文本大小: {SIZE / 1024 / 1024:.2f} MB（字符），每项取 {ROUNDS} 次最优")
+    print(f"{'corpus':<8}{'legacy ms':>12}{'single ms':>12}{'memo ms':>10}{'speedup':>10}{'tokens':>12}")
+    for kind in ("cjk", "mixed", "english"):
+        text = _corpus(kind, SIZE)
+        expected = legacy(text)
+        assert token_counter.heuristic_count(text) == expected
+        assert token_counter.estimate_tokens(text) == expected
+        legacy_ms = _bench(legacy, text)
+        single_ms = _bench(token_counter.heuristic_count, text)
+        memo_ms = _bench(token_counter.estimate_tokens, text)
+        print(f"{kind:<8}{legacy_ms:>12.2f}{single_ms:>12.2f}{memo_ms:>10.3f}{legacy_ms / single_ms:>9.1f}x{expected:>12}")
+
+
+if __name__ == "__main__":
+    main()
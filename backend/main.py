@@ -8,6 +8,7 @@ from sqlmodel import SQLModel, Session, select
 from app.api.router import api_router
 from app.db.session import engine
 from app.db import models
+from app.db.schema_upgrade import upgrade_schema
 from app.bootstrap.init_app import init_prompts, create_default_card_types
 # 知识库初始化
 from app.bootstrap.init_app import init_knowledge
@@ -17,10 +18,12 @@ from app.bootstrap.init_app import init_card_templates
 
 def init_db():
     models.SQLModel.metadata.create_all(engine)
+    upgrade_schema(engine)
 
 # 创建所有表
 # models.Base.metadata.create_all(bind=engine)
 
+import asyncio
 from contextlib import asynccontextmanager
 
 # 使用 lifespan 事件处理器替代 on_event
@@ -29,6 +32,8 @@ async def lifespan(app):
     # 启动时执行
     # 确保所有表存在（开发阶段可用；生产建议通过 Alembic 迁移）
     models.SQLModel.metadata.create_all(engine)
+    # 已有数据库补齐新增列（create_all 不会修改已存在的表）
+    upgrade_schema(engine)
     with Session(engine) as session:
         init_prompts(session)
         create_default_card_types(session)
@@ -41,17 +46,20 @@ async def lifespan(app):
         # 初始化卡片模板
         init_card_templates(session)
         
-        # 清理僵死工作流 (Zombie Workflow Cleanup)
-        from app.db.models import WorkflowRun
-        zombies = session.exec(select(WorkflowRun).where(WorkflowRun.status == "running")).all()
-        if zombies:
-            for z in zombies:
-                z.status = "failed"
-                z.error_json = {"error": "System restarted while running"}
-            session.commit()
-            logger.info(f"Cleaned up {len(zombies)} zombie workflows.")
+    # 启动持久化工作流运行队列：中断/排队中的运行会被重新领取执行
+    from app.services.workflow_queue import run_queue
+    # LLM 用量账本：内存记账，定期批量回写
+    from app.services.llm_usage_ledger import usage_ledger
+    from app.services.llm_model_pool import chat_model_pool
+    from app.services import cache_store
+    await usage_ledger.start()
+    await run_queue.start()
     yield
-    # 关闭时可添加清理逻辑（如有需要）
+    await run_queue.stop()
+    await usage_ledger.stop()
+    # 等待后台写线程中排队的缓存写入落库
+    await asyncio.to_thread(cache_store.wait_writes, 10)
+    await chat_model_pool.aclose_all()
 
 # 创建 FastAPI 应用实例，注册 lifespan
 app = FastAPI(
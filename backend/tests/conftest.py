@@ -0,0 +1,53 @@
+"""后端回归测试公共夹具。
+
+在导入 app 之前把数据库指向临时目录，测试不会触碰本地 aiauthor.db；
+每个测试前重建全部表。异步用例直接用 asyncio.run 执行，不依赖额外的 pytest 插件。
+用法（在 backend 目录下）：
+    python -m pytest -q tests
+"""
+
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+_DB_DIR = tempfile.mkdtemp(prefix="novelforge-tests-")
+os.environ["AIAUTHOR_DB_PATH"] = str(Path(_DB_DIR) / "test.db")
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import pytest  # noqa: E402
+from sqlmodel import Session, SQLModel  # noqa: E402
+
+from app.db import models  # noqa: E402,F401
+from app.db.session import engine  # noqa: E402
+from app.services.cache_store import wait_writes  # noqa: E402
+from app.services.llm_usage_ledger import usage_ledger  # noqa: E402
+
+engine.echo = False
+
+
+@pytest.fixture
+def db_engine():
+    # 上一个测试排队的缓存写入先落库，避免写进重建后的表
+    wait_writes()
+    SQLModel.metadata.drop_all(engine)
+    SQLModel.metadata.create_all(engine)
+    # 账本按配置 ID 缓存用量，重建表后 ID 会复用
+    for config_id in list(usage_ledger._accounts):
+        usage_ledger.forget(config_id)
+    yield engine
+
+
+@pytest.fixture
+def session(db_engine):
+    with Session(db_engine) as s:
+        yield s
+
+
+@pytest.fixture
+def project(session):
+    proj = models.Project(name="测试项目")
+    session.add(proj)
+    session.commit()
+    session.refresh(proj)
+    return proj
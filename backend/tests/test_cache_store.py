@@ -0,0 +1,77 @@
+from pydantic import BaseModel
+from sqlmodel import Session, select
+
+from app.core.config import settings
+from app.db.models import Knowledge, LLMConfig, LLMResponseCache, WorkflowNodeCache
+from app.services import cache_store, llm_response_cache, workflow_node_cache
+
+
+class _Out(BaseModel):
+    text: str
+
+
+def _config(session):
+    cfg = LLMConfig(provider="openai_compatible", model_name="m", api_key="k")
+    session.add(cfg)
+    session.commit()
+    session.refresh(cfg)
+    return cfg
+
+
+def test_response_cache_hit_does_not_commit_callers_session(session, db_engine):
+    cfg = _config(session)
+    llm_response_cache.store(db_engine, "k1", cfg, _Out(text="缓存"), 10, 5)
+    cache_store.wait_writes()
+
+    session.add(Knowledge(name="未提交", content="x"))
+    assert llm_response_cache.lookup(session, "k1", _Out, cfg.id) == _Out(text="缓存")
+    session.rollback()
+    with Session(db_engine) as s:
+        assert s.exec(select(Knowledge)).all() == []
+        assert s.exec(select(LLMResponseCache)).one().hit_count == 0
+
+    # 命中记录随下一次写入回写
+    llm_response_cache.store(db_engine, "k2", cfg, _Out(text="另一条"), 1, 1)
+    cache_store.wait_writes()
+    with Session(db_engine) as s:
+        assert s.exec(select(LLMResponseCache).where(LLMResponseCache.cache_key == "k1")).one().hit_count == 1
+
+
+def test_response_cache_store_leaves_callers_transaction_alone(session, db_engine):
+    cfg = _config(session)
+    # 调用方持有未提交的写事务（SQLite 写锁）：写入不阻塞调用方，也不提交/回滚其写入
+    session.add(Knowledge(name="进行中", content="x"))
+    session.flush()
+    llm_response_cache.store(db_engine, "k1", cfg, _Out(text="缓存"), 10, 5)
+    assert session.exec(select(Knowledge)).one().name == "进行中"
+    session.rollback()
+
+    cache_store.wait_writes(timeout=10)
+    with Session(db_engine) as s:
+        assert s.exec(select(Knowledge)).all() == []
+        assert s.exec(select(LLMResponseCache)).one().cache_key == "k1"
+
+
+def test_node_cache_evicts_least_recently_used_over_size_limit(session, monkeypatch):
+    workflow_node_cache.store(session, "old", "Test.Node", {"a": "x" * 100}, None)
+    cache_store.wait_writes()
+    workflow_node_cache.store(session, "new", "Test.Node", {"a": "y" * 100}, None)
+    cache_store.wait_writes()
+    assert workflow_node_cache.lookup(session, "old") is not None
+
+    entry_size = session.exec(select(WorkflowNodeCache)).first().size_bytes
+    monkeypatch.setattr(settings, "WORKFLOW_NODE_CACHE_MAX_BYTES", entry_size * 2)
+    # 第三条写入后超限：最近被命中的 old 保留，最久未用的 new 被淘汰
+    workflow_node_cache.store(session, "third", "Test.Node", {"a": "z" * 100}, None)
+    cache_store.wait_writes()
+    session.expire_all()
+    keys = {e.cache_key for e in session.exec(select(WorkflowNodeCache)).all()}
+    assert keys == {"old", "third"}
+
+
+def test_counters_share_one_shape():
+    node_stats = workflow_node_cache.NodeCacheStats(enabled=True)
+    node_stats.bump("hits")
+    assert node_stats.to_dict() == {"hits": 1, "misses": 0, "stores": 0, "enabled": True, "bypass": False}
+    llm_response_cache.stats.bump(1, "stores")
+    assert llm_response_cache.stats.to_dict()["by_config"][1]["stores"] >= 1
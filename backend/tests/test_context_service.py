@@ -0,0 +1,118 @@
+import asyncio
+import time
+
+from app.db.models import Card, CardType, Project
+from app.services import context_cache, context_service
+
+
+def test_cache_hit_keeps_pack_details(session, project, monkeypatch):
+    facts = context_service._FactsResult(
+        relations=[], fact_summaries=[f"事实{i}：" + "很长的描述" * 20 for i in range(30)],
+    )
+    monkeypatch.setattr(context_service, "_fetch_facts", lambda params, plan: facts)
+    context_cache.clear()
+    params = context_service.ContextAssembleParams(project_id=project.id, participants=["甲"], token_budget=300)
+
+    miss = context_service.assemble_context(session, params)
+    hit = context_service.assemble_context(session, params)
+
+    assert miss.budget_stats["cache"] == "miss"
+    assert miss.budget_stats["dropped_count"] > 0
+    assert hit.budget_stats["cache"] == "hit"
+    for key in ("budget_tokens", "used_tokens", "tokenizer", "kept", "dropped_count", "dropped", "sources"):
+        assert hit.budget_stats[key] == miss.budget_stats[key]
+    assert hit.facts_subgraph == miss.facts_subgraph
+
+
+def _counting_facts(monkeypatch):
+    calls = []
+
+    def fetch(params, plan):
+        calls.append(params.project_id)
+        return context_service._FactsResult(relations=[], fact_summaries=["甲与乙相识"])
+    monkeypatch.setattr(context_service, "_fetch_facts", fetch)
+    return calls
+
+
+def test_card_save_invalidates_only_its_project(session, project, monkeypatch):
+    calls = _counting_facts(monkeypatch)
+    context_cache.clear()
+    other = Project(name="另一个项目")
+    session.add(other)
+    session.commit()
+
+    def assemble(project_id, participants):
+        params = context_service.ContextAssembleParams(project_id=project_id, participants=participants)
+        return context_service.assemble_context(session, params).budget_stats["cache"]
+
+    assert assemble(project.id, ["甲", "乙"]) == "miss"
+    assert assemble(project.id, ["乙", "甲"]) == "hit"
+    assert assemble(other.id, ["甲"]) == "miss"
+
+    ctype = CardType(name="章节")
+    session.add(ctype)
+    session.commit()
+    session.add(Card(title="第一章", content={}, project_id=project.id, card_type_id=ctype.id))
+    session.commit()
+    assert assemble(project.id, ["甲", "乙"]) == "miss"
+    assert assemble(other.id, ["甲"]) == "hit"
+    assert len(calls) == 3
+
+
+def test_result_assembled_across_a_data_change_is_not_cached(session, project, monkeypatch):
+    context_cache.clear()
+
+    def fetch(params, plan):
+        # 装配期间项目数据被修改
+        context_cache.bump(params.project_id, "测试")
+        return context_service._FactsResult(relations=[], fact_summaries=[])
+    monkeypatch.setattr(context_service, "_fetch_facts", fetch)
+    skips = context_cache.cache_stats()["stale_skips"]
+    params = context_service.ContextAssembleParams(project_id=project.id, participants=["甲"])
+
+    context_service.assemble_context(session, params)
+    assert context_cache.cache_stats()["stale_skips"] == skips + 1
+    assert context_service.assemble_context(session, params).budget_stats["cache"] == "miss"
+
+
+def _slow(seconds, value):
+    def fetch(*args):
+        time.sleep(seconds)
+        return value
+    return fetch
+
+
+def test_async_assembly_queries_sources_concurrently(session, project, monkeypatch):
+    context_cache.clear()
+    facts = context_service._FactsResult(relations=[], fact_summaries=["甲与乙相识"])
+    monkeypatch.setattr(context_service, "_fetch_facts", _slow(0.2, facts))
+    monkeypatch.setattr(context_service, "_fetch_writing_guide_isolated", _slow(0.2, "多写对白"))
+    monkeypatch.setattr(context_service, "_fetch_vector_results", _slow(0.2, []))
+    params = context_service.ContextAssembleParams(
+        project_id=project.id, participants=["甲"], current_draft_tail="他推开门",
+    )
+
+    started = time.perf_counter()
+    out = asyncio.run(context_service.assemble_context_async(session, params, source_timeout=5))
+    assert time.perf_counter() - started < 0.5
+    sources = out.budget_stats["sources"]
+    assert {name: src["status"] for name, src in sources.items()} == {
+        "graph": "ok", "writing_guide": "ok", "vector": "ok",
+    }
+    assert all(src["ms"] >= 150 for src in sources.values())
+    assert "甲与乙相识" in out.facts_subgraph and out.writing_guide == "多写对白"
+
+
+def test_slow_source_degrades_and_is_not_cached(session, project, monkeypatch):
+    context_cache.clear()
+    monkeypatch.setattr(context_service, "_fetch_facts", _slow(1.0, None))
+    monkeypatch.setattr(context_service, "_fetch_writing_guide_isolated", _slow(0, "多写对白"))
+    params = context_service.ContextAssembleParams(project_id=project.id, participants=["甲"])
+
+    out = asyncio.run(context_service.assemble_context_async(session, params, source_timeout=0.1))
+    sources = out.budget_stats["sources"]
+    assert sources["graph"]["status"] == "timeout"
+    assert sources["vector"]["status"] == "skipped"
+    assert out.facts_subgraph == context_service._compose_facts_subgraph_stub()
+    assert out.writing_guide == "多写对白"
+    assert context_cache.lookup(context_service._plan(session, params).cache_key) is None
@@ -0,0 +1,107 @@
+from app.core.config import settings
+from app.services import context_packer, context_service, kg_provider
+from app.services.kg_provider import Neo4jKGProvider
+
+
+class _FakeSession:
+    def __init__(self, driver):
+        self._driver = driver
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def run(self, cypher, **params):
+        self._driver.queries.append((cypher, params))
+        return self._driver.rows
+
+
+class _FakeDriver:
+    """记录查询并返回预设行的 Neo4j 驱动替身"""
+
+    def __init__(self, rows=()):
+        self.rows = list(rows)
+        self.queries = []
+
+    def session(self):
+        return _FakeSession(self)
+
+
+def _provider(rows=()):
+    provider = object.__new__(Neo4jKGProvider)
+    provider._driver = _FakeDriver(rows)
+    return provider
+
+
+def test_radius_expands_variable_length_with_filters_in_database():
+    cypher, params = Neo4jKGProvider._subgraph_query(
+        "proj:1", ["甲"], 99, ["FRIEND"], 10, 5, "甲",
+    )
+    assert f"[:RELATES_TO*1..{settings.KG_MAX_RADIUS}]" in cypher
+    assert "all(r IN relationships(path) WHERE" in cypher
+    assert "$whitelist" in cypher and "$max_chapter_id" in cypher and "$pov_character" in cypher
+    assert "ORDER BY hops ASC, anchored DESC" in cypher
+    assert params["whitelist"] == ["FRIEND"] and params["limit"] == 10
+
+    direct, _ = Neo4jKGProvider._subgraph_query("proj:1", ["甲", "乙"], 0, None, 10, None, None)
+    assert "*1.." not in direct and "b.name IN $parts" in direct
+    assert "$whitelist" not in direct
+
+
+def test_query_subgraph_returns_hops_per_relation():
+    rows = [
+        {"a": "甲", "b": "乙", "t": "RELATES_TO", "props": {"kind": "朋友", "valid_from": 3}, "hops": 1},
+        {"a": "乙", "b": "丙", "t": "RELATES_TO", "props": {"kind": "师徒"}, "hops": 2},
+    ]
+    provider = _provider(rows)
+    out = provider.query_subgraph(project_id=1, participants=["甲"], radius=2, top_k=10)
+    assert [(r["a"], r["b"], r["hops"]) for r in out["relation_summaries"]] == [("甲", "乙", 1), ("乙", "丙", 2)]
+    assert [e["hops"] for e in out["edges"]] == [1, 2]
+    _, params = provider._driver.queries[0]
+    assert params["group"] == "proj:1" and params["parts"] == ["甲"]
+
+
+def test_indexes_are_created_once_per_process(monkeypatch):
+    monkeypatch.setattr(kg_provider, "_indexes_ready", False)
+
+    class _Result(list):
+        def consume(self):
+            return None
+
+    first, second = _provider(_Result()), _provider(_Result())
+    first._ensure_indexes()
+    second._ensure_indexes()
+    assert [q for q, _ in first._driver.queries] == list(kg_provider._INDEX_STATEMENTS)
+    assert second._driver.queries == []
+
+
+def test_profile_plan_sums_db_hits_across_operators():
+    plan = {"operatorType": "ProduceResults", "dbHits": 2, "rows": 1, "args": {"Details": "a"},
+            "children": [{"operatorType": "Expand(All)", "dbHits": 5, "children": [{"dbHits": 3}]}]}
+    assert kg_provider._sum_db_hits(plan) == 10
+    compact = kg_provider._compact_plan(plan)
+    assert compact["operator"] == "ProduceResults" and compact["details"] == "a"
+    assert compact["children"][0]["operator"] == "Expand(All)"
+
+
+def test_farther_relations_score_lower_and_survive_only_with_radius(monkeypatch):
+    near = {"a": "甲", "b": "乙", "hops": 1}
+    far = {"a": "乙", "b": "丙", "hops": 2}
+    assert context_packer.score_relation(far, ["甲"], None) < context_packer.score_relation(
+        {**far, "hops": 1}, ["甲"], None)
+
+    class _Provider:
+        def query_subgraph(self, **kwargs):
+            return {"relation_summaries": [near, far], "fact_summaries": []}
+
+    monkeypatch.setattr(context_service, "get_provider", lambda: _Provider())
+
+    def relations(radius):
+        params = context_service.ContextAssembleParams(project_id=1, participants=["甲", "乙"], radius=radius)
+        plan = context_service._Plan(["甲", "乙"], radius, 20, None, 1000, None, None)
+        return [(r["a"], r["b"]) for r in context_service._fetch_facts(params, plan).relations]
+
+    assert relations(2) == [("甲", "乙"), ("乙", "丙")]
+    assert relations(0) == [("甲", "乙")]
@@ -0,0 +1,58 @@
+import asyncio
+
+import pytest
+
+from app.db.models import LLMFailoverGroup
+from app.services.llm_failover import stream_with_failover
+
+
+def test_cancelled_request_awaits_and_closes_pending_attempts():
+    closed = []
+
+    async def never_first_token(config_id):
+        try:
+            await asyncio.sleep(10)
+            yield "不会到达"
+        finally:
+            # 模拟流在收尾时记录中止用量（需要一次 await）
+            await asyncio.sleep(0)
+            closed.append(config_id)
+
+    group = LLMFailoverGroup(name="g-cancel", config_ids=[1, 2], hedge_delay_ms=10)
+
+    async def consume():
+        async for _ in stream_with_failover(group, never_first_token):
+            pass
+
+    async def scenario():
+        task = asyncio.ensure_future(consume())
+        await asyncio.sleep(0.05)  # 主请求与对冲请求都已发出
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        # 取消返回时两条尝试都已结束收尾，无需再让出事件循环
+        return list(closed)
+
+    assert sorted(asyncio.run(scenario())) == [1, 2]
+
+
+def test_losing_hedge_stream_is_closed_when_primary_wins():
+    closed = []
+
+    def open_stream(config_id):
+        async def gen():
+            try:
+                await asyncio.sleep(0.01 if config_id == 1 else 10)
+                yield f"c{config_id}"
+                yield "尾"
+            finally:
+                closed.append(config_id)
+        return gen()
+
+    group = LLMFailoverGroup(name="g-win", config_ids=[1, 2], hedge_delay_ms=1)
+
+    async def scenario():
+        return [d async for d in stream_with_failover(group, open_stream)]
+
+    assert asyncio.run(scenario()) == ["c1", "尾"]
+    assert sorted(closed) == [1, 2]
@@ -0,0 +1,67 @@
+import asyncio
+from typing import List, Literal
+
+import pytest
+from pydantic import BaseModel, Field
+
+from app.db.models import LLMConfig
+from app.services.llm_factory import build_chat_model
+from app.services.llm_fake import FakeBehavior, FakeChatModel, create_fake_chat_model
+from app.services.llm_retry import RATE_LIMIT, classify, retry_after
+
+
+class _Role(BaseModel):
+    name: str = Field(min_length=2, max_length=6)
+    gender: Literal["男", "女"]
+    age: int = Field(ge=12, le=60)
+
+
+class _Cast(BaseModel):
+    roles: List[_Role] = Field(min_length=1, max_length=4)
+
+
+def test_behavior_parses_query_with_or_without_prefix():
+    b = FakeBehavior.parse("fake://?tps=40&latency_ms=300&error=rate_limit&tokens=5&unknown=1")
+    assert (b.tps, b.latency_ms, b.error, b.tokens) == (40.0, 300.0, "rate_limit", 5)
+    assert FakeBehavior.parse("seed=7").seed == 7
+    assert FakeBehavior.parse(None) == FakeBehavior()
+    with pytest.raises(ValueError):
+        FakeBehavior.parse("tokens=many")
+
+
+def test_factory_builds_fake_model_from_config(session):
+    cfg = LLMConfig(provider="fake", display_name="fake", model_name="bench", api_base="fake://?tokens=3", api_key="")
+    session.add(cfg)
+    session.commit()
+    model = build_chat_model(session, cfg.id, max_tokens=2)
+    assert isinstance(model, FakeChatModel)
+    assert model.invoke("你好").usage_metadata["output_tokens"] == 2
+
+
+def test_structured_output_is_valid_and_deterministic():
+    async def scenario():
+        model = create_fake_chat_model("bench", "seed=3")
+        runnable = model.with_structured_output(_Cast)
+        return await runnable.ainvoke("写三个角色"), await runnable.ainvoke("写三个角色")
+
+    first, second = asyncio.run(scenario())
+    assert isinstance(first, _Cast) and first == second
+    assert all(12 <= r.age <= 60 and 2 <= len(r.name) <= 6 for r in first.roles)
+
+
+def test_stream_yields_configured_tokens():
+    async def scenario():
+        model = create_fake_chat_model("bench", "tokens=4&seed=1")
+        return [chunk.content async for chunk in model.astream("开头") if chunk.content]
+
+    chunks = asyncio.run(scenario())
+    assert len(chunks) == 4
+    assert "".join(chunks) == create_fake_chat_model("bench", "tokens=4&seed=1").invoke("开头").content
+
+
+def test_injected_errors_are_classified_like_provider_errors():
+    model = create_fake_chat_model("bench", "error_rate=1&error=rate_limit&retry_after=2")
+    with pytest.raises(Exception) as info:
+        model.invoke("x")
+    assert classify(info.value) == RATE_LIMIT
+    assert retry_after(info.value) == 2.0
@@ -0,0 +1,65 @@
+import asyncio
+
+import httpx
+
+from app.db.models import LLMConfig
+from app.services.llm_model_pool import ChatModelPool
+
+
+def _cfg(config_id=1):
+    return LLMConfig(id=config_id, provider="openai_compatible", model_name="m", api_key="k")
+
+
+def _serve(pool, cfg, release: asyncio.Event):
+    """把共享 AsyncClient 的底层传输换成本地处理函数，响应体在 release 之后才结束"""
+    _, aclient = pool.http_clients(cfg)
+
+    async def body():
+        yield b"partial"
+        await release.wait()
+        yield b"done"
+
+    inner = httpx.MockTransport(lambda request: httpx.Response(200, content=body()))
+    aclient._transport._transport = inner
+    return aclient
+
+
+def test_invalidate_closes_clients_after_inflight_requests_finish():
+    async def scenario():
+        pool = ChatModelPool(max_size=4)
+        cfg = _cfg()
+        sync_client, _ = pool.http_clients(cfg)
+        release = asyncio.Event()
+        aclient = _serve(pool, cfg, release)
+
+        async with aclient.stream("GET", "http://llm.test/v1") as response:
+            pool.invalidate(cfg.id)
+            # 进行中的流式响应不受影响，客户端尚未关闭
+            assert sync_client.is_closed is False
+            assert aclient.is_closed is False
+            release.set()
+            assert b"".join([chunk async for chunk in response.aiter_bytes()]) == b"partialdone"
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        assert sync_client.is_closed
+        assert aclient.is_closed
+        # 失效后重新申请得到新的客户端
+        assert pool.http_clients(cfg)[1] is not aclient
+
+    asyncio.run(scenario())
+
+
+def test_idle_clients_close_immediately_and_on_shutdown():
+    async def scenario():
+        pool = ChatModelPool(max_size=4)
+        idle_sync, idle_async = pool.http_clients(_cfg(1))
+        pool.invalidate(1)
+        await asyncio.sleep(0)
+        assert idle_sync.is_closed and idle_async.is_closed
+
+        live_sync, live_async = pool.http_clients(_cfg(2))
+        await pool.aclose_all()
+        assert live_sync.is_closed and live_async.is_closed
+        assert pool.stats()["http_clients"] == 0
+
+    asyncio.run(scenario())
@@ -0,0 +1,71 @@
+import asyncio
+
+import httpx
+import pytest
+
+from app.services import llm_retry
+from app.services.llm_retry import (
+    AUTH, INVALID_OUTPUT, NETWORK, OTHER, RATE_LIMIT, TIMEOUT,
+    CallRetryStats, InvalidOutputError, RetryPolicy, classify, record_call, retry_after, retry_metrics,
+)
+
+
+class _ProviderError(Exception):
+    """模拟提供商 SDK 的异常：带 status_code 与 response.headers"""
+
+    def __init__(self, status_code, headers=None):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+        self.response = httpx.Response(status_code, headers=headers or {})
+
+
+@pytest.mark.parametrize("exc, kind", [
+    (_ProviderError(429), RATE_LIMIT),
+    (_ProviderError(401), AUTH),
+    (_ProviderError(503), NETWORK),
+    (httpx.ConnectError("refused"), NETWORK),
+    (asyncio.TimeoutError(), TIMEOUT),
+    (httpx.ReadTimeout("slow"), TIMEOUT),
+    (InvalidOutputError("空响应"), INVALID_OUTPUT),
+    (RuntimeError("Too Many Requests, slow down"), RATE_LIMIT),
+    (RuntimeError("Incorrect API key provided"), AUTH),
+    (RuntimeError("boom"), OTHER),
+])
+def test_classify(exc, kind):
+    assert classify(exc) == kind
+
+
+def test_retry_after_reads_seconds_and_milliseconds():
+    assert retry_after(_ProviderError(429, {"retry-after": "7"})) == 7.0
+    assert retry_after(_ProviderError(429, {"retry-after-ms": "1500", "retry-after": "9"})) == 1.5
+    assert retry_after(_ProviderError(429, {"retry-after": "Wed, 21 Oct 2015 07:28:00 GMT"})) == 0.0
+    assert retry_after(RuntimeError("no response")) is None
+
+
+def test_policy_delays_by_error_kind(monkeypatch):
+    policy = RetryPolicy(max_attempts=3, base_delay=1.0, max_delay=8.0, max_retry_after=30.0)
+    monkeypatch.setattr(llm_retry.random, "uniform", lambda lo, hi: hi)
+    assert policy.delay(NETWORK, 3) == 4.0
+    assert policy.delay(NETWORK, 10) == 8.0
+    assert policy.delay(INVALID_OUTPUT, 1) == 0.0
+    assert policy.delay(RATE_LIMIT, 1, server_hint=12.0) == 12.0
+    assert policy.delay(RATE_LIMIT, 1, server_hint=120.0) == 30.0
+    monkeypatch.setattr(llm_retry.random, "uniform", lambda lo, hi: lo)
+    assert policy.delay(RATE_LIMIT, 1) == 1.0
+    assert policy.delay(TIMEOUT, 1) == 0.0
+
+    assert policy.should_retry(NETWORK, 2) and not policy.should_retry(NETWORK, 3)
+    assert not policy.should_retry(AUTH, 1)
+
+
+def test_record_call_aggregates_metrics():
+    before = retry_metrics()
+    stats = CallRetryStats(attempts=3, errors=[RATE_LIMIT, NETWORK], delays=[0.5, 1.25])
+    record_call(stats, failed=False)
+    after = retry_metrics()
+    assert after["calls"] - before["calls"] == 1
+    assert after["retries"] - before["retries"] == 2
+    assert after["retried_calls"] - before["retried_calls"] == 1
+    assert after["failures"] == before["failures"]
+    assert after["errors"][RATE_LIMIT] - before["errors"][RATE_LIMIT] == 1
+    assert stats.to_dict()["delays"] == [0.5, 1.25]
@@ -0,0 +1,94 @@
+import asyncio
+import sys
+import types
+
+import pytest
+from pydantic import BaseModel
+
+from app.db.models import LLMConfig
+from app.services import agent_service
+from app.services.llm_scheduler import LLMScheduler, llm_scheduler
+
+
+class _Out(BaseModel):
+    text: str
+
+
+class _FailingModel:
+    def with_structured_output(self, *args, **kwargs):
+        return self
+
+    async def ainvoke(self, messages):
+        raise RuntimeError("provider down")
+
+
+@pytest.fixture
+def tpm_config(session):
+    cfg = LLMConfig(provider="openai_compatible", model_name="m", api_key="k", tpm_limit=100000)
+    session.add(cfg)
+    session.commit()
+    session.refresh(cfg)
+    yield cfg
+    llm_scheduler._limiters.pop(cfg.id, None)
+
+
+def test_grant_release_refunds_reservation(session, tpm_config):
+    async def scenario():
+        scheduler = LLMScheduler()
+        grant = await scheduler.acquire(session, tpm_config.id, 5000)
+        assert scheduler.metrics()[tpm_config.id]["tokens_available"] <= 95001
+        grant.release()
+        # 已结算后再次 release/settle 不重复记账
+        grant.settle(9999)
+        return scheduler.metrics()[tpm_config.id]["tokens_available"]
+
+    assert asyncio.run(scenario()) >= 99999
+
+
+def test_failed_structured_call_refunds_grant(session, tpm_config, monkeypatch):
+    # _invoke_structured 在调用时才导入 build_chat_model，这里替换为总是失败的模型
+    fake = types.ModuleType("app.services.langchain_assistant")
+    fake.build_chat_model = lambda **kwargs: _FailingModel()
+    monkeypatch.setitem(sys.modules, "app.services.langchain_assistant", fake)
+
+    async def scenario():
+        with pytest.raises(ValueError):
+            await agent_service._invoke_structured(
+                session, tpm_config.id, "写一段开头" * 200, _Out, None, "系统",
+                max_tokens=None, max_retries=1, temperature=0.7, timeout=None,
+                track_stats=False, reservation=None,
+            )
+        return llm_scheduler.metrics()[tpm_config.id]
+
+    snapshot = asyncio.run(scenario())
+    assert snapshot["reserved_tokens"] > 0
+    assert snapshot["settled_tokens"] == 0
+    assert snapshot["tokens_available"] >= 99999
+
+
+def test_cancel_after_grant_returns_request_and_tokens(session):
+    cfg = LLMConfig(provider="openai_compatible", model_name="m", api_key="k", rpm_limit=1, tpm_limit=1000)
+    session.add(cfg)
+    session.commit()
+    session.refresh(cfg)
+
+    async def scenario():
+        scheduler = LLMScheduler()
+        await scheduler.acquire(session, cfg.id, 400)
+        waiting = asyncio.create_task(scheduler.acquire(session, cfg.id, 300))
+        await asyncio.sleep(0)
+        limiter = scheduler._limiters[cfg.id]
+        [waiter] = [w for queues in limiter.queues.values() for q in queues.values() for w in q]
+        # 额度回填后放行排队请求，但该请求恢复执行前就被取消
+        limiter.rpm.give(1)
+        limiter.pump()
+        assert waiter.future.done()
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+        return scheduler.metrics()[cfg.id]
+
+    metrics = asyncio.run(scenario())
+    assert metrics["refunded"] == 1
+    assert metrics["requests_available"] >= 1
+    assert metrics["tokens_available"] >= 600
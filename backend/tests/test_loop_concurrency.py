@@ -0,0 +1,71 @@
+import asyncio
+
+import pytest
+from sqlmodel import Session, select
+
+from app.db.models import Knowledge, Workflow
+from app.services import nodes
+from app.services.workflow_engine import LocalAsyncEngine
+from app.services.workflow_plan import compile_plan
+
+_in_flight = {"now": 0, "peak": 0}
+
+
+@nodes.register_node("Test.Accumulate")
+async def _accumulate(session, state, params):
+    """读取后追加：第 k 次迭代依赖前 k-1 次的写入"""
+    items = state.get("items") or []
+    await asyncio.sleep(0.01)
+    state["items"] = items + [state["item"]["index"]]
+
+
+@nodes.register_node("Test.WriteOwnKey")
+async def _write_own_key(session, state, params):
+    """每次迭代只写自己的键并落一行数据，迭代之间互不依赖"""
+    index = state["item"]["index"]
+    _in_flight["now"] += 1
+    _in_flight["peak"] = max(_in_flight["peak"], _in_flight["now"])
+    try:
+        session.add(Knowledge(name=f"k{index}", content="x"))
+        await asyncio.sleep(0.01)
+    finally:
+        _in_flight["now"] -= 1
+    state[f"k{index}"] = index
+    state["last"] = index
+
+
+def _run_loop(session, body_type, concurrency, count=6):
+    plan = compile_plan(Workflow(id=None, name="t", definition_json={
+        "nodes": [
+            {"id": "loop", "type": "List.ForEach", "params": {"list": list(range(count)), "concurrency": concurrency}},
+            {"id": "body", "type": body_type},
+        ],
+        "edges": [{"source": "loop", "target": "body", "sourceHandle": "b"}],
+    }))[0]
+    state = {"scope": {}, "touched_card_ids": set()}
+    asyncio.run(LocalAsyncEngine()._execute_graph(plan, session, state, run_id=0))
+    return state
+
+
+@pytest.mark.parametrize("body_type", ["Test.Accumulate", "Test.WriteOwnKey"])
+def test_concurrent_foreach_matches_serial_state(session, db_engine, body_type):
+    serial = _run_loop(session, body_type, concurrency=1)
+    with Session(db_engine) as s:
+        for row in s.exec(select(Knowledge)).all():
+            s.delete(row)
+        s.commit()
+    concurrent = _run_loop(session, body_type, concurrency=4)
+    assert concurrent == serial
+
+
+def test_accumulating_body_falls_back_to_serial(session):
+    state = _run_loop(session, "Test.Accumulate", concurrency=4)
+    assert state["items"] == [1, 2, 3, 4, 5, 6]
+
+
+def test_independent_body_runs_concurrently_with_own_sessions(session, db_engine):
+    _in_flight["peak"] = 0
+    _run_loop(session, "Test.WriteOwnKey", concurrency=4)
+    assert _in_flight["peak"] > 1
+    with Session(db_engine) as s:
+        assert sorted(k.name for k in s.exec(select(Knowledge)).all()) == [f"k{i}" for i in range(1, 7)]
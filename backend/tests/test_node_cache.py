@@ -0,0 +1,53 @@
+import asyncio
+
+from app.services import cache_store, nodes
+from app.services.workflow_engine import LocalAsyncEngine
+
+from tests.test_workflow_engine import _make_run
+
+_calls = {"echo": 0}
+_seen = []
+
+
+@nodes.register_node("Test.Echo")
+async def _echo(session, state, params):
+    _calls["echo"] += 1
+    state["echo"] = params["text"]
+    return {"text": params["text"]}
+
+
+@nodes.register_node("Test.Record")
+def _record(session, state, params):
+    _seen.append(state.get("echo"))
+
+
+nodes.register_cacheable("Test.Echo", outputs=lambda params: ["$.echo"])
+
+
+def _run_twice(session, text):
+    results = []
+    for _ in range(2):
+        wf, run = _make_run(session, [
+            {"id": "echo", "type": "Test.Echo", "params": {"text": text}},
+            {"id": "record", "type": "Test.Record"},
+        ], edges=[{"source": "echo", "target": "record"}], params_json={"node_cache": True})
+        asyncio.run(LocalAsyncEngine().execute(session, wf, run))
+        cache_store.wait_writes()
+        session.refresh(run)
+        results.append(run.summary_json["node_cache"])
+    return results
+
+
+def test_cache_hit_replays_state_outputs_without_calling_node(session):
+    _calls["echo"] = 0
+    _seen.clear()
+    first, second = _run_twice(session, "你好")
+    assert (first["misses"], first["stores"], second["hits"]) == (1, 1, 1)
+    assert _calls["echo"] == 1
+    assert _seen == ["你好", "你好"]
+
+
+def test_nodes_with_side_effects_are_not_cacheable():
+    assert nodes.get_cache_spec("LLM.Generate") is not None
+    assert nodes.get_cache_spec("Outline.Generate") is None
+    assert nodes.get_cache_spec("KG.UpdateFromContent") is None
@@ -0,0 +1,55 @@
+from sqlalchemy import inspect as sa_inspect
+from sqlmodel import Session, SQLModel
+
+from app.db.models import WorkflowRun, WorkflowTrigger
+from app.db.schema_upgrade import upgrade_schema
+from app.services.workflow_queue import WorkflowRunQueue
+from app.services.workflow_engine import LocalAsyncEngine
+
+# 升级前的 workflowrun / workflowtrigger 表结构
+_LEGACY_DDL = [
+    "DROP TABLE IF EXISTS workflowrun",
+    "DROP TABLE IF EXISTS workflowtrigger",
+    """CREATE TABLE workflowrun (
+        id INTEGER PRIMARY KEY, workflow_id INTEGER NOT NULL REFERENCES workflow(id),
+        definition_version INTEGER NOT NULL, status VARCHAR NOT NULL, scope_json JSON, params_json JSON,
+        idempotency_key VARCHAR, created_at DATETIME NOT NULL, started_at DATETIME, finished_at DATETIME,
+        summary_json JSON, error_json JSON)""",
+    """CREATE TABLE workflowtrigger (
+        id INTEGER PRIMARY KEY, workflow_id INTEGER NOT NULL REFERENCES workflow(id),
+        trigger_on VARCHAR NOT NULL, card_type_name VARCHAR, filter_json JSON, is_active BOOLEAN NOT NULL)""",
+    "INSERT INTO workflow (id, name, version, dsl_version, is_built_in, is_active, created_at, updated_at) "
+    "VALUES (1, 'wf', 1, 1, 0, 1, '2024-01-01', '2024-01-01')",
+    "INSERT INTO workflowrun (id, workflow_id, definition_version, status, created_at) "
+    "VALUES (1, 1, 1, 'running', '2024-01-01')",
+    "INSERT INTO workflowtrigger (id, workflow_id, trigger_on, is_active) VALUES (1, 1, 'onsave', 1)",
+]
+
+
+def test_upgrade_adds_missing_columns_to_existing_tables(db_engine):
+    with db_engine.begin() as conn:
+        for stmt in _LEGACY_DDL:
+            conn.exec_driver_sql(stmt)
+
+    added = upgrade_schema(db_engine)
+    assert "workflowrun.lease_owner" in added
+    assert "workflowrun.checkpoint_json" in added
+    assert "workflowtrigger.inflight_policy" in added
+    # 可重复执行
+    assert upgrade_schema(db_engine) == []
+
+    inspector = sa_inspect(db_engine)
+    assert "ix_workflowrun_lease_owner" in {ix["name"] for ix in inspector.get_indexes("workflowrun")}
+    with Session(db_engine) as s:
+        assert s.get(WorkflowTrigger, 1).inflight_policy == "supersede"
+        assert s.get(WorkflowRun, 1).attempts == 0
+
+    # 旧库上启动回收：没有租约的 running 运行重新入队
+    assert WorkflowRunQueue(LocalAsyncEngine()).recover(on_boot=True) == 1
+    with Session(db_engine) as s:
+        assert s.get(WorkflowRun, 1).status == "queued"
+
+
+def test_upgrade_is_noop_on_fresh_schema(db_engine):
+    SQLModel.metadata.create_all(db_engine)
+    assert upgrade_schema(db_engine) == []
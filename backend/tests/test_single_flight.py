@@ -0,0 +1,57 @@
+import asyncio
+import sys
+import types
+
+from pydantic import BaseModel
+
+from app.db.models import LLMConfig
+from app.services import agent_service, llm_scheduler
+from app.services.workflow_trace import RunTrace
+
+
+class _Out(BaseModel):
+    text: str
+
+
+class _SlowModel:
+    def __init__(self):
+        self.calls = []
+
+    def with_structured_output(self, *args, **kwargs):
+        return self
+
+    async def ainvoke(self, messages):
+        # 记录共享任务看到的调度上下文：应沿用发起者的优先级与项目
+        self.calls.append((llm_scheduler._ctx_priority.get(), llm_scheduler._ctx_project.get()))
+        await asyncio.sleep(0.05)
+        return {"parsed": _Out(text="共享"), "raw": None, "parsing_error": None}
+
+
+def test_shared_flight_keeps_owner_context_and_bills_usage_once(session, monkeypatch):
+    cfg = LLMConfig(provider="openai_compatible", model_name="m", api_key="k")
+    session.add(cfg)
+    session.commit()
+    session.refresh(cfg)
+    model = _SlowModel()
+    fake = types.ModuleType("app.services.langchain_assistant")
+    fake.build_chat_model = lambda **kwargs: model
+    monkeypatch.setitem(sys.modules, "app.services.langchain_assistant", fake)
+
+    async def waiter(trace, node_id, project_id, delay):
+        await asyncio.sleep(delay)
+        with llm_scheduler.llm_context("background", project_id), trace.step(node_id, "LLM.Generate", {}) as step:
+            result = await agent_service.run_llm_agent(session, cfg.id, "同一个提示词", _Out, temperature=0.7)
+        return result, step
+
+    async def scenario():
+        trace = RunTrace(0)
+        # a 先发起请求，b 在其进行中合并进来
+        return await asyncio.gather(waiter(trace, "a", 1, 0), waiter(trace, "b", 2, 0.01))
+
+    (ra, owner), (rb, joiner) = asyncio.run(scenario())
+    assert model.calls == [("background", 1)]
+    assert ra == rb == _Out(text="共享")
+    assert ra is not rb
+    assert owner.llm_calls == 1 and owner.shared_hits == 0
+    assert owner.input_tokens > 0 and owner.output_tokens > 0
+    assert (joiner.llm_calls, joiner.input_tokens, joiner.output_tokens, joiner.shared_hits) == (0, 0, 0, 1)
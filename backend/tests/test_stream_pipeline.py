@@ -0,0 +1,86 @@
+import asyncio
+
+import pytest
+
+from app.services.stream_pipeline import PipelineStats, TextRope, coalesce
+
+
+def test_text_rope_joins_once_and_keeps_appending():
+    rope = TextRope()
+    assert not rope and rope.text() == ""
+    for part in ("夜", "", "色", "长街"):
+        rope.append(part)
+    assert len(rope) == 4 and rope.text() == "夜色长街"
+    assert rope.text() is rope.text()
+    rope.append("。")
+    assert rope.text() == "夜色长街。"
+
+
+async def _burst(parts, delay=0.0):
+    for part in parts:
+        if delay:
+            await asyncio.sleep(delay)
+        yield part
+
+
+def test_coalesce_merges_deltas_without_losing_text():
+    parts = [f"字{i}" for i in range(50)]
+
+    async def scenario():
+        stats = PipelineStats()
+        frames = [f async for f in coalesce(_burst(parts), window_ms=20, max_chars=30, stats=stats)]
+        return frames, stats
+
+    frames, stats = asyncio.run(scenario())
+    assert "".join(frames) == "".join(parts)
+    assert stats.deltas == 50 and len(frames) == stats.frames < 50
+
+
+def test_slow_consumer_pauses_the_source_at_high_water():
+    async def scenario():
+        stats = PipelineStats()
+        frames = []
+        async for frame in coalesce(_burst(["x" * 10] * 20), window_ms=0, max_chars=10, high_water=40, stats=stats):
+            frames.append(frame)
+            await asyncio.sleep(0.01)
+        return frames, stats
+
+    frames, stats = asyncio.run(scenario())
+    assert "".join(frames) == "x" * 200
+    assert stats.paused > 0
+    assert stats.max_buffered <= 40
+
+
+def test_source_error_is_raised_after_buffered_text():
+    async def failing():
+        yield "前文"
+        raise RuntimeError("模型断开")
+
+    async def scenario():
+        frames = []
+        with pytest.raises(RuntimeError):
+            async for frame in coalesce(failing(), window_ms=0, max_chars=10):
+                frames.append(frame)
+        return frames
+
+    assert asyncio.run(scenario()) == ["前文"]
+
+
+def test_closing_downstream_closes_a_paused_source():
+    closed = []
+
+    async def endless():
+        try:
+            while True:
+                yield "y" * 10
+        finally:
+            closed.append(True)
+
+    async def scenario():
+        frames = coalesce(endless(), window_ms=0, max_chars=10, high_water=20)
+        await frames.__anext__()
+        await asyncio.sleep(0.01)
+        await frames.aclose()
+
+    asyncio.run(scenario())
+    assert closed == [True]
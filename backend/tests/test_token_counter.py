@@ -0,0 +1,76 @@
+import asyncio
+import sys
+import types
+
+import pytest
+from pydantic import BaseModel
+
+from app.db.models import LLMConfig
+from app.services import agent_service, token_counter
+
+
+@pytest.fixture
+def registered():
+    families = []
+
+    def register(family, name, counter):
+        families.append(family)
+        token_counter.register_tokenizer(family, name, counter)
+        return token_counter.get_estimator(family)
+
+    yield register
+    for family in families:
+        token_counter._registered.pop(family, None)
+        token_counter._estimators.pop(family, None)
+
+
+def _explode(text):
+    raise AssertionError("calibrate 不应重新计数输入文本")
+
+
+def test_calibrate_uses_precounted_estimate(registered):
+    estimator = registered("google", token_counter.HEURISTIC, _explode)
+    token_counter.calibrate("google", 100, 150)
+    assert estimator.calibration.samples == 1
+    assert estimator.calibration.ratio == pytest.approx(1.5)
+
+
+def test_calibrate_skips_estimates_from_another_tokenizer(registered):
+    estimator = registered("anthropic", "custom", _explode)
+    token_counter.calibrate("anthropic", 100, 150)
+    assert estimator.calibration.samples == 0
+
+
+class _Out(BaseModel):
+    text: str
+
+
+class _Raw:
+    usage_metadata = {"input_tokens": 321}
+
+
+class _Model:
+    def with_structured_output(self, *args, **kwargs):
+        return self
+
+    async def ainvoke(self, messages):
+        return {"parsed": _Out(text="好"), "raw": _Raw(), "parsing_error": None}
+
+
+def test_structured_call_calibrates_with_its_input_estimate(session, monkeypatch):
+    cfg = LLMConfig(provider="openai_compatible", model_name="m", api_key="k")
+    session.add(cfg)
+    session.commit()
+    fake = types.ModuleType("app.services.langchain_assistant")
+    fake.build_chat_model = lambda **kwargs: _Model()
+    monkeypatch.setitem(sys.modules, "app.services.langchain_assistant", fake)
+    calls = []
+    monkeypatch.setattr(token_counter, "calibrate", lambda *args: calls.append(args))
+
+    _, in_tokens, _ = asyncio.run(agent_service._invoke_structured(
+        session, cfg.id, "用户提示词", _Out, None, "实际发送的系统提示词",
+        max_tokens=None, max_retries=1, temperature=0.7, timeout=None,
+        track_stats=False, reservation=None,
+    ))
+    assert in_tokens == agent_service._calc_input_tokens("实际发送的系统提示词", "用户提示词")
+    assert calls == [("openai_compatible", in_tokens, 321)]
@@ -0,0 +1,24 @@
+from sqlmodel import Session
+
+from app.db.models import LLMConfig
+from app.services import llm_config_service
+from app.services.llm_usage_ledger import usage_ledger
+
+
+def test_listing_configs_overlays_pending_usage_without_flushing(session, db_engine):
+    cfg = LLMConfig(provider="openai_compatible", model_name="m", api_key="k", used_tokens_input=10, used_calls=1)
+    session.add(cfg)
+    session.commit()
+    session.refresh(cfg)
+    usage_ledger.record(session, cfg.id, 5, 7, calls=2)
+    flushes = usage_ledger.flushes
+
+    configs = llm_config_service.get_llm_configs(session)
+    assert usage_ledger.flushes == flushes
+    with Session(db_engine) as s:
+        assert s.get(LLMConfig, cfg.id).used_tokens_input == 10
+
+    shown = llm_config_service.with_pending_usage(configs[0])
+    assert (shown.used_tokens_input, shown.used_tokens_output, shown.used_calls) == (15, 7, 3)
+    # 展示副本不改动会话中的行
+    assert configs[0].used_tokens_input == 10
@@ -0,0 +1,152 @@
+import asyncio
+
+from sqlmodel import Session, select
+
+from app.db.models import Knowledge, Workflow, WorkflowRun
+from app.services import nodes
+from app.services.workflow_engine import LocalAsyncEngine
+
+
+@nodes.register_node("Test.AddKnowledge")
+async def _add_knowledge(session, state, params):
+    """写入一行但不提交，等待后可选失败：模拟 LLM 调用前后跨 await 的节点写入"""
+    session.add(Knowledge(name=params["name"], content="x"))
+    await asyncio.sleep(params.get("delay", 0))
+    if params.get("fail"):
+        raise RuntimeError(f"{params['name']} failed")
+    state[params["name"]] = True
+
+
+def _make_run(session: Session, node_defs, edges=(), params_json=None):
+    wf = Workflow(name="t", definition_json={"nodes": list(node_defs), "edges": list(edges)})
+    session.add(wf)
+    session.commit()
+    session.refresh(wf)
+    run = WorkflowRun(workflow_id=wf.id, definition_version=wf.version, params_json=params_json)
+    session.add(run)
+    session.commit()
+    session.refresh(run)
+    return wf, run
+
+
+def _knowledge_names(db_engine):
+    with Session(db_engine) as s:
+        return sorted(k.name for k in s.exec(select(Knowledge)).all())
+
+
+def test_parallel_node_failure_keeps_sibling_writes_isolated(session, db_engine):
+    wf, run = _make_run(session, [
+        {"id": "ok", "type": "Test.AddKnowledge", "params": {"name": "ok", "delay": 0.01}},
+        {"id": "bad", "type": "Test.AddKnowledge", "params": {"name": "bad", "delay": 0.05, "fail": True}},
+    ], params_json={"max_concurrency": 2})
+
+    asyncio.run(LocalAsyncEngine().execute(session, wf, run))
+
+    session.refresh(run)
+    assert run.status == "failed"
+    # ok 合并时提交了自己的写入；检查点提交没有带上 bad 未完成的写入，失败也没有回滚 ok 的写入
+    assert _knowledge_names(db_engine) == ["ok"]
+    assert run.checkpoint_json["executed"] == ["ok"]
+
+
+def test_card_state_crosses_isolated_node_sessions(session, db_engine, project):
+    from app.db.models import Card, CardType
+
+    ctype = CardType(name="章节")
+    session.add(ctype)
+    session.commit()
+    card = Card(title="第一章", content={}, project_id=project.id, card_type_id=ctype.id)
+    session.add(card)
+    session.commit()
+    wf, run = _make_run(session, [
+        {"id": "read", "type": "Card.Read", "params": {"target": "$self"}},
+        {"id": "a", "type": "Card.ModifyContent", "params": {"setPath": "a", "setValue": 1}},
+        {"id": "side", "type": "Test.AddKnowledge", "params": {"name": "side", "delay": 0.01}},
+        {"id": "b", "type": "Card.ModifyContent", "params": {"setPath": "b", "setValue": 2}},
+    ], edges=[
+        {"source": "read", "target": "a"},
+        {"source": "read", "target": "side"},
+        {"source": "a", "target": "b"},
+    ], params_json={"max_concurrency": 2})
+    run.scope_json = {"card_id": card.id}
+    session.add(run)
+    session.commit()
+
+    asyncio.run(LocalAsyncEngine().execute(session, wf, run))
+
+    session.refresh(run)
+    assert run.status == "completed", run.error_json
+    with Session(db_engine) as s:
+        assert s.get(Card, card.id).content == {"a": 1, "b": 2}
+    assert _knowledge_names(db_engine) == ["side"]
+
+
+_calls: dict = {}
+
+
+@nodes.register_node("Test.Step")
+async def _step(session, state, params):
+    """计数执行次数；fail_until 之前的执行失败，需要上游写入的 state 才能继续"""
+    name = params["name"]
+    _calls[name] = _calls.get(name, 0) + 1
+    for dep in params.get("needs", []):
+        assert state[dep] == "done", f"{dep} 的输出未恢复"
+    if _calls[name] <= params.get("fail_until", 0):
+        raise RuntimeError(f"{name} failed")
+    state[name] = "done"
+
+
+def test_failed_run_resumes_from_failed_node(session):
+    from app.services.workflow_engine import engine as wf_engine
+
+    _calls.clear()
+    wf, run = _make_run(session, [
+        {"id": "a", "type": "Test.Step", "params": {"name": "a"}},
+        {"id": "b", "type": "Test.Step", "params": {"name": "b", "needs": ["a"], "fail_until": 1}},
+        {"id": "c", "type": "Test.Step", "params": {"name": "c", "needs": ["a", "b"]}},
+    ], edges=[{"source": "a", "target": "b"}, {"source": "b", "target": "c"}])
+
+    asyncio.run(LocalAsyncEngine().execute(session, wf, run))
+    session.refresh(run)
+    assert run.status == "failed"
+    assert run.checkpoint_json["executed"] == ["a"]
+
+    submitted = []
+    wf_engine.set_dispatcher(submitted.append)
+    try:
+        wf_engine.resume_failed(session, run)
+    finally:
+        wf_engine.set_dispatcher(None)
+    assert submitted == [run.id] and run.status == "queued"
+
+    asyncio.run(LocalAsyncEngine().execute(session, wf, run))
+    session.refresh(run)
+    assert run.status == "completed", run.error_json
+    # a 从检查点恢复不再执行，b 重试一次，c 执行一次
+    assert _calls == {"a": 1, "b": 2, "c": 1}
+
+
+def test_resume_after_workflow_edit_starts_from_scratch(session):
+    _calls.clear()
+    wf, run = _make_run(session, [
+        {"id": "a", "type": "Test.Step", "params": {"name": "a"}},
+        {"id": "b", "type": "Test.Step", "params": {"name": "b", "needs": ["a"], "fail_until": 1}},
+    ], edges=[{"source": "a", "target": "b"}])
+
+    asyncio.run(LocalAsyncEngine().execute(session, wf, run))
+    session.refresh(run)
+    assert run.status == "failed" and run.checkpoint_json["executed"] == ["a"]
+
+    # 失败后修改了节点 a：检查点中的 a 已不是当前定义，续跑需重新执行
+    definition = dict(wf.definition_json)
+    definition["nodes"] = [{**definition["nodes"][0], "params": {"name": "a", "edited": True}}, definition["nodes"][1]]
+    wf.definition_json = definition
+    wf.version += 1
+    session.add(wf)
+    session.commit()
+
+    asyncio.run(LocalAsyncEngine().execute(session, wf, run))
+    session.refresh(run)
+    assert run.status == "completed", run.error_json
+    assert _calls == {"a": 2, "b": 2}
+    assert run.definition_version == wf.version
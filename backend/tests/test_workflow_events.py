@@ -0,0 +1,49 @@
+import asyncio
+
+from app.services.workflow_events import RunEventBus
+
+
+async def _collect(bus, run_id, last_event_id=None):
+    return [evt async for evt in bus.subscribe(run_id, last_event_id)]
+
+
+def test_subscribers_each_receive_every_event_and_resume_by_id():
+    async def scenario():
+        bus = RunEventBus(buffer_size=10, ttl_sec=60)
+        bus.open(1)
+        first = asyncio.create_task(_collect(bus, 1))
+        second = asyncio.create_task(_collect(bus, 1))
+        await asyncio.sleep(0)
+        for name in ("a", "b", "c"):
+            bus.publish(1, f"data: {name}\n\n")
+            await asyncio.sleep(0)
+        bus.close(1)
+        resumed = await _collect(bus, 1, last_event_id=2)
+        return await first, await second, resumed
+
+    first, second, resumed = asyncio.run(scenario())
+    assert first == second == ["id: 1\ndata: a\n\n", "id: 2\ndata: b\n\n", "id: 3\ndata: c\n\n"]
+    assert resumed == ["id: 3\ndata: c\n\n"]
+
+
+def test_overflowed_events_are_reported_as_dropped():
+    async def scenario():
+        bus = RunEventBus(buffer_size=2, ttl_sec=60)
+        for i in range(5):
+            bus.publish(1, f"data: {i}\n\n")
+        bus.close(1)
+        return await _collect(bus, 1, last_event_id=1)
+
+    assert asyncio.run(scenario()) == [
+        ": 2 events dropped\n\n", "id: 4\ndata: 3\n\n", "id: 5\ndata: 4\n\n",
+    ]
+
+
+def test_closed_buffers_are_evicted_after_ttl():
+    bus = RunEventBus(buffer_size=4, ttl_sec=0)
+    bus.publish(1, "data: x\n\n")
+    bus.close(1)
+    assert bus.has(1)
+    bus.open(2)
+    assert not bus.has(1)
+    assert bus.stats()["streams"] == 1
@@ -0,0 +1,45 @@
+from types import SimpleNamespace
+
+from app.services.nodes import _get_by_path, _render_value, _to_name_list
+from app.services.workflow_expr import compile_path, compile_template, compile_value
+
+
+STATE = {
+    "item": {"index": 2, "title": "雨夜", "chars": [{"name": "林舟"}, {"name": "沈砚"}, {"name": "林舟"}]},
+    "scope": {"tags": ["悬疑", "群像"]},
+    "current": {"card": SimpleNamespace(content={"outline": {"beats": ["开端", "转折", "收束"]}})},
+}
+
+
+def test_whole_expression_keeps_type_and_embedded_renders_string():
+    assert compile_template("{scope.tags}")(STATE) == ["悬疑", "群像"]
+    assert compile_template("{index}")(STATE) == 2
+    assert compile_template("第{index}章：{item.title}{item.missing}")(STATE) == "第2章：雨夜"
+    assert compile_template("无模板")(STATE) == "无模板"
+
+
+def test_paths_support_indexes_and_card_content():
+    assert compile_template("{item.chars[1].name}")(STATE) == "沈砚"
+    assert compile_template("{item.chars.0.name}")(STATE) == "林舟"
+    assert compile_template("{$.content.outline.beats[-1]}")(STATE) == "收束"
+    assert compile_template("{item.chars[9].name}")(STATE) is None
+
+
+def test_compiled_value_matches_interpreted_render():
+    params = {
+        "title": "第{index}章",
+        "beats": "{current.card.content.outline.beats}",
+        "names": {"$toNameList": "item.chars"},
+        "nested": [{"t": "{item.title}"}, 3, None],
+    }
+    compiled = compile_value(params, _to_name_list)(STATE)
+    assert compiled == _render_value(params, STATE)
+    assert compiled["names"] == ["林舟", "沈砚"]
+
+
+def test_compile_path_matches_get_by_path():
+    obj = {"a": {"list": [{"name": "x"}, {"name": "y"}]}}
+    for path in ("$.a.list[0].name", "$.a.list[-1].name", "$.a.list.1.name", "$.a.nope", "a.list"):
+        assert compile_path(path)(obj) == _get_by_path(obj, path)
+    assert compile_path("$.a.list[-1].name")(obj) == "y"
+    assert compile_path("a.list")(obj) is None
@@ -0,0 +1,60 @@
+from app.db.models import Workflow
+from app.services.workflow_plan import PlanCache, compile_plan
+
+
+def _graph_workflow(version=1):
+    return Workflow(id=7, name="wf", version=version, definition_json={
+        "nodes": [
+            {"id": "read", "type": "Card.Read", "params": {"target": "$self"}},
+            {"id": "loop", "type": "List.ForEach", "params": {"list": [1, 2]}},
+            {"id": "body", "type": "Card.ModifyContent", "params": {"setPath": "a", "setValue": "{item.index}"}},
+            {"id": "save", "type": "Card.ModifyContent", "params": {"setPath": "b", "setValue": 1}},
+        ],
+        "edges": [
+            {"source": "read", "target": "loop"},
+            {"source": "loop", "target": "body", "sourceHandle": "b"},
+            {"source": "loop", "target": "save"},
+        ],
+    })
+
+
+def test_graph_plan_resolves_dependencies_and_loop_bodies():
+    plan, errors = compile_plan(_graph_workflow())
+    assert errors == []
+    assert plan.kind == "graph"
+    assert plan.start_nodes == ("read",)
+    assert plan.successors["loop"] == ("save",)
+    assert plan.body_ids == frozenset({"body"})
+    assert [n.id for n in plan.nodes["loop"].body] == ["body"]
+    # 含模板的参数预编译为渲染函数，静态参数原样复用
+    assert plan.nodes["body"].static_params is False
+    assert plan.nodes["body"].render({"item": {"index": 3}})["setValue"] == 3
+    assert plan.nodes["save"].render({}) is plan.nodes["save"].params
+
+
+def test_plan_cache_reuses_plan_until_version_changes():
+    cache = PlanCache()
+    first, _ = cache.get(_graph_workflow(version=1))
+    assert cache.get(_graph_workflow(version=1))[0] is first
+    second, _ = cache.get(_graph_workflow(version=2))
+    assert second is not first and second.version == 2
+    cache.invalidate(7)
+    assert cache.get(_graph_workflow(version=2))[0] is not second
+
+
+def test_unknown_node_type_is_reported_but_compiles():
+    wf = Workflow(id=None, name="wf", definition_json={"nodes": [{"id": "x", "type": "No.Such"}], "edges": []})
+    plan, errors = compile_plan(wf)
+    assert "x" in plan.nodes
+    assert errors and "No.Such" in errors[0]
+
+
+def test_legacy_foreach_without_body_folds_next_node():
+    wf = Workflow(id=None, name="wf", definition_json={"nodes": [
+        {"type": "List.ForEach", "params": {"list": [1]}},
+        {"type": "Card.ModifyContent", "params": {"setPath": "a", "setValue": 1}},
+    ]})
+    plan, _ = compile_plan(wf)
+    assert plan.kind == "linear"
+    assert plan.sequence == ("#0",)
+    assert [n.type for n in plan.nodes["#0"].body] == ["Card.ModifyContent"]
@@ -0,0 +1,57 @@
+import pytest
+
+from app.db.models import Workflow, WorkflowRun
+from app.services.workflow_trace import (
+    RunTrace, record_llm_usage, record_state_write, run_trace, summarize_by_node_type,
+)
+
+
+def test_loop_iterations_fold_into_one_step_with_usage_and_keys():
+    trace = RunTrace(run_id=1)
+    state = {"keep": 1}
+    with trace.step("loop", "List.ForEach", state):
+        for i in range(3):
+            with trace.step("body", "LLM.Generate", state, parent_id="loop"):
+                record_llm_usage(10, 5)
+                state[f"out{i}"] = i
+    with pytest.raises(ValueError):
+        with trace.step("save", "Card.ModifyContent", state) as step:
+            record_state_write(state, "$.content.title")
+            raise ValueError("写入失败")
+    record_llm_usage(99, 99)
+
+    rows = {r.node_id: r for r in trace.to_rows()}
+    body = rows["body"]
+    assert (body.iterations, body.llm_calls, body.input_tokens, body.output_tokens) == (3, 3, 30, 15)
+    assert body.state_keys == ["out0", "out1", "out2"]
+    assert rows["loop"].llm_calls == 0 and rows["loop"].parent_id is None
+    assert (rows["save"].status, rows["save"].error) == ("failed", "写入失败")
+    assert rows["save"].state_keys == ["$.content.title"]
+    assert step.state is None
+
+
+def test_run_trace_totals_count_top_level_time_once(session):
+    wf = Workflow(name="wf", definition_json={"nodes": [], "edges": []})
+    session.add(wf)
+    session.commit()
+    run = WorkflowRun(workflow_id=wf.id, status="succeeded")
+    session.add(run)
+    session.commit()
+
+    trace = RunTrace(run_id=run.id)
+    with trace.step("loop", "List.ForEach", {}):
+        with trace.step("body", "LLM.Generate", {}, parent_id="loop"):
+            record_llm_usage(7, 3)
+    session.add_all(trace.to_rows())
+    session.commit()
+
+    out = run_trace(session, run)
+    loop_ms = next(s["duration_ms"] for s in out["steps"] if s["node_id"] == "loop")
+    assert out["totals"]["nodes"] == 1
+    assert out["totals"]["node_ms"] == loop_ms
+    assert (out["totals"]["llm_calls"], out["totals"]["input_tokens"]) == (1, 7)
+
+    by_type = {r["node_type"]: r for r in summarize_by_node_type(session, workflow_id=wf.id)}
+    assert by_type["LLM.Generate"]["in_loop_body"] is True
+    assert by_type["List.ForEach"]["share"] == 1.0
+    assert [r["node_type"] for r in summarize_by_node_type(session, include_body=False)] == ["List.ForEach"]
@@ -0,0 +1,132 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from app.db.models import Card, CardType, Workflow, WorkflowRun, WorkflowTrigger
+from app.services import workflow_triggers
+from app.services.workflow_engine import engine as wf_engine
+
+
+@pytest.fixture
+def dispatched(session):
+    """记录提交的运行，不实际执行"""
+    submitted = []
+    wf_engine.set_dispatcher(submitted.append)
+    workflow_triggers.invalidate_trigger_index()
+    yield submitted
+    wf_engine.set_dispatcher(None)
+    workflow_triggers.invalidate_trigger_index()
+
+
+def _workflow_with_trigger(session, event):
+    wf = Workflow(name=f"wf-{event}", definition_json={"nodes": [], "edges": []})
+    session.add(wf)
+    session.commit()
+    session.add(WorkflowTrigger(workflow_id=wf.id, trigger_on=event))
+    session.commit()
+    return wf
+
+
+def _card(session, project):
+    ctype = CardType(name="章节")
+    session.add(ctype)
+    session.commit()
+    card = Card(title="第一章", content={}, project_id=project.id, card_type_id=ctype.id)
+    session.add(card)
+    session.commit()
+    session.refresh(card)
+    return card
+
+
+def test_card_saves_coalesce_but_wait_is_capped(session, project, dispatched):
+    _workflow_with_trigger(session, "onsave")
+    card = _card(session, project)
+
+    first = workflow_triggers.trigger_on_card_save(session, card)
+    second = workflow_triggers.trigger_on_card_save(session, card)
+    assert first == second
+    run = session.get(WorkflowRun, first[0])
+    assert run.available_at > datetime.now()
+
+    # 首次保存已过去超过最长等待：继续保存不再顺延，运行立即可被领取
+    run.created_at = datetime.utcnow() - timedelta(seconds=60)
+    session.add(run)
+    session.commit()
+    assert workflow_triggers.trigger_on_card_save(session, card) == first
+    session.refresh(run)
+    assert run.available_at <= datetime.now()
+
+
+def test_other_events_are_not_delayed_or_merged(session, project, dispatched):
+    _workflow_with_trigger(session, "onprojectcreate")
+
+    first = workflow_triggers.trigger_on_project_create(session, project.id)
+    second = workflow_triggers.trigger_on_project_create(session, project.id)
+    assert first != second
+    for run_id in first + second:
+        assert session.get(WorkflowRun, run_id).available_at is None
+    assert dispatched == first + second
+
+
+def test_index_matches_card_type_and_wildcard_in_trigger_order(session, project, dispatched):
+    card = _card(session, project)
+    wf = Workflow(name="wf-index", definition_json={"nodes": [], "edges": []})
+    inactive = Workflow(name="wf-off", is_active=False, definition_json={"nodes": [], "edges": []})
+    session.add(wf)
+    session.add(inactive)
+    session.commit()
+    session.add(WorkflowTrigger(workflow_id=wf.id, trigger_on="ongenfinish"))
+    session.add(WorkflowTrigger(workflow_id=wf.id, trigger_on="ongenfinish", card_type_name="角色"))
+    session.add(WorkflowTrigger(workflow_id=wf.id, trigger_on="ongenfinish", card_type_name="章节"))
+    session.add(WorkflowTrigger(workflow_id=inactive.id, trigger_on="ongenfinish"))
+    session.commit()
+
+    index = workflow_triggers.trigger_index
+    typed = index.match(session, "ongenfinish", card)
+    assert [e.card_type_name for e in typed] == [None, "章节"]
+    assert [e.trigger_id for e in typed] == sorted(e.trigger_id for e in typed)
+    assert len(index.match(session, "ongenfinish", None)) == 3
+    assert index.match(session, "onsave", card) == []
+
+    # 索引在失效前不会看到新增的触发器
+    session.add(WorkflowTrigger(workflow_id=wf.id, trigger_on="onsave"))
+    session.commit()
+    assert index.match(session, "onsave", card) == []
+    workflow_triggers.invalidate_trigger_index()
+    assert len(index.match(session, "onsave", card)) == 1
+
+
+def test_matching_reads_no_workflow_or_card_type_rows(session, project, dispatched):
+    from sqlalchemy import event
+
+    card = _card(session, project)
+    wf = Workflow(name="wf-prejoined", version=3, definition_json={"nodes": [], "edges": []})
+    session.add(wf)
+    session.commit()
+    session.add(WorkflowTrigger(workflow_id=wf.id, trigger_on="ongenfinish", card_type_name="章节"))
+    session.commit()
+    index = workflow_triggers.trigger_index
+    index.match(session, "ongenfinish", None)  # 重建索引
+
+    session.expire_all()
+    card = session.get(Card, card.id)
+    statements = []
+    listener = lambda *args: statements.append(args[2])  # noqa: E731
+    event.listen(session.get_bind(), "before_cursor_execute", listener)
+    try:
+        [entry] = index.match(session, "ongenfinish", card)
+    finally:
+        event.remove(session.get_bind(), "before_cursor_execute", listener)
+    assert statements == []
+    assert (entry.workflow.id, entry.workflow.version, entry.workflow.name) == (wf.id, 3, "wf-prejoined")
+
+    run_ids = workflow_triggers.trigger_on_generate_finish(session, card, project.id)
+    assert session.get(WorkflowRun, run_ids[0]).definition_version == 3
+
+    # 卡片类型改名后需失效索引（卡片类型接口会调用）
+    ctype = session.get(CardType, card.card_type_id)
+    ctype.name = "场景"
+    session.add(ctype)
+    session.commit()
+    workflow_triggers.invalidate_trigger_index()
+    assert index.match(session, "ongenfinish", card) == []